@@ -1,29 +1,116 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
+import json
+
 from django.contrib import admin
+from django.core.exceptions import PermissionDenied
+from django.core.paginator import Paginator
+from django.db import connections
+from django.db.models import Q
+from django.template.response import TemplateResponse
+from django.utils.functional import cached_property
 from xfc_control.models import *
 
+# The CachedFile, CachedDirectory and ScanJournalEntry tables can have 100s of millions of rows, so the
+# change lists of these models (and the User and ScheduledDeletion models that are linked to them) do not
+# count the rows exactly or search with LIKE '%term%', both of which read the whole table.
+
+# below this number of rows (estimated), the rows are counted exactly
+EXACT_COUNT_LIMIT = 10000
+
+
+def estimate_count(queryset):
+    """Return the number of rows in a queryset estimated by the PostgreSQL planner, or None if it cannot
+    be estimated.  An unfiltered queryset is estimated from the table statistics (pg_class.reltuples),
+    which are updated by VACUUM and ANALYZE, and a filtered queryset from the plan of the query."""
+    connection = connections[queryset.db]
+    if connection.vendor != "postgresql":
+        return None
+    if not queryset.query.where:
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT reltuples FROM pg_class WHERE oid = %s::regclass",
+                           [queryset.model._meta.db_table])
+            row = cursor.fetchone()
+        # reltuples is -1 for a table that has never been analyzed
+        if row is None or row[0] < 0:
+            return None
+        return int(row[0])
+    plan = json.loads(queryset.explain(format="json"))
+    return int(plan[0]["Plan"]["Plan Rows"])
+
+
+class EstimatedCountPaginator(Paginator):
+    """Paginator that uses the planner's estimate of the number of rows, rather than counting them,
+    when there are more than EXACT_COUNT_LIMIT rows.  The number of pages shown is then approximate."""
+
+    @cached_property
+    def count(self):
+        estimate = estimate_count(self.object_list)
+        if estimate is not None and estimate >= EXACT_COUNT_LIMIT:
+            return estimate
+        return super(EstimatedCountPaginator, self).count
+
+
+def user_prefix_q(term, field="user"):
+    """Return a filter for the rows of the users whose name starts with term, which uses the
+    user_name_prefix index."""
+    return Q(**{field + "__in": User.objects.filter(name__startswith=term).values("pk")})
+
+
+def directory_path_q(term, field="directory__path_hash"):
+    """Return a filter for the rows of the directory with the path (AFTER the CacheDisk mountpoint)
+    term, which uses the cacheddirectory_path_hash index."""
+    return Q(**{field: CachedDirectory.hash_path(term.strip("/"))})
+
+
+class LargeTableAdmin(admin.ModelAdmin):
+    """ModelAdmin for the models with large tables.  The change list uses the EstimatedCountPaginator
+    and does not count the unfiltered rows, and the search only uses indexed lookups: each word of the
+    search must match the filter returned by search_term_q."""
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+
+    def search_term_q(self, term):
+        """Return the filter for one word of the search.  The subclasses override this with an indexed
+        lookup - by default no rows match, rather than falling back to a search that reads the whole table."""
+        return Q(pk__in=[])
+
+    def get_search_results(self, request, queryset, search_term):
+        for term in search_term.split():
+            queryset = queryset.filter(self.search_term_q(term))
+        # the lookups do not join to multi-valued relations, so there are no duplicate rows
+        return queryset, False
+
 # Register CacheDisk model with admin
 
 class CacheDiskAdmin(admin.ModelAdmin):
     save_on_top = True
-    list_display = ('mountpoint', 'formatted_size', 'formatted_allocated', 'formatted_used')
+    list_display = ('mountpoint', 'formatted_size', 'formatted_allocated', 'formatted_used',
+                    'formatted_real_used', 'reconciled', 'retiring')
     search_fields = ('mountpoint',)
-    fields = ('mountpoint', 'size_bytes', 'formatted_allocated', 'formatted_used')
-    readonly_fields = ('formatted_allocated', 'formatted_used',)
+    fields = ('mountpoint', 'size_bytes', 'formatted_allocated', 'formatted_used', 'formatted_real_used',
+              'reconciled', 'retiring', 'scan_mode', 'scan_depth')
+    readonly_fields = ('formatted_allocated', 'formatted_used', 'formatted_real_used', 'reconciled')
 admin.site.register(CacheDisk, CacheDiskAdmin)
 
 # Register User model with admin
 
-class UserAdmin(admin.ModelAdmin):
+class UserAdmin(LargeTableAdmin):
     save_on_top = True
     list_display = ('name', 'email', 'notify', 'formatted_size', 'formatted_used',
                     'formatted_hard_limit', 'formatted_total_used','cache_disk', 'cache_path')
     fields = ('name', 'email', 'notify', 'quota_size', 'formatted_used',
-              'hard_limit_size', 'formatted_total_used', 'cache_disk', 'cache_path')
-    search_fields = ('name', 'email')
-    readonly_fields = ('email', 'formatted_used', 'formatted_total_used')
+              'hard_limit_size', 'formatted_total_used', 'cache_disk', 'cache_path', 'scan_mode', 'scan_depth',
+              'last_scanned', 'scan_dispatched', 'next_scan', 'churn', 'scan_seconds')
+    search_fields = ('name',)
+    search_help_text = "Search by the start of the user name"
+    readonly_fields = ('email', 'formatted_used', 'formatted_total_used', 'last_scanned', 'scan_dispatched',
+                       'next_scan', 'churn', 'scan_seconds')
+    list_select_related = ('cache_disk',)
+
+    def search_term_q(self, term):
+        return Q(name__startswith=term)
 admin.site.register(User, UserAdmin)
 
 class UserLockAdmin(admin.ModelAdmin):
@@ -32,20 +119,135 @@ class UserLockAdmin(admin.ModelAdmin):
     readonly_fields = ('user_lock',)
 admin.site.register(UserLock, UserLockAdmin)
 
+class UserMigrationAdmin(admin.ModelAdmin):
+    save_on_top = True
+    list_display = ('user', 'source_disk', 'target_disk', 'state', 'files_copied', 'formatted_bytes_copied',
+                    'started', 'finished')
+    list_filter = ('state',)
+    fields = ('user', 'source_disk', 'target_disk', 'state', 'files_copied', 'formatted_bytes_copied',
+              'started', 'finished', 'attempts', 'error')
+    readonly_fields = ('user', 'source_disk', 'target_disk', 'state', 'files_copied', 'formatted_bytes_copied',
+                       'started', 'finished', 'attempts', 'error')
+admin.site.register(UserMigration, UserMigrationAdmin)
+
 # Register CachedFile model with admin
 
-class CachedFileAdmin(admin.ModelAdmin):
+class CachedFileAdmin(LargeTableAdmin):
     save_on_top = True
     list_display = ('full_path', 'formatted_size', 'first_seen', 'user')
-    fields = ('path', 'formatted_size', 'first_seen', 'user')
-    search_fields = ('path', )
-    readonly_fields = ('path', 'formatted_size', 'first_seen', 'user')
+    fields = ('directory', 'name', 'formatted_size', 'first_seen', 'user', 'inode', 'mtime', 'atime')
+    search_fields = ('user__name', 'directory__path')
+    search_help_text = "Search by the start of the user name, or the exact path of the directory"
+    readonly_fields = ('directory', 'name', 'formatted_size', 'first_seen', 'user', 'inode', 'mtime', 'atime')
+    list_select_related = ('directory', 'user__cache_disk')
+
+    def search_term_q(self, term):
+        return user_prefix_q(term) | directory_path_q(term)
 admin.site.register(CachedFile, CachedFileAdmin)
 
-class ScheduledDeletionAdmin(admin.ModelAdmin):
+# Register CachedDirectory model with admin
+
+class CachedDirectoryAdmin(LargeTableAdmin):
+    save_on_top = True
+    list_display = ('full_path', 'formatted_size', 'n_files', 'formatted_quota_used', 'first_seen', 'aggregate', 'user')
+    fields = ('path', 'formatted_size', 'n_files', 'formatted_quota_used', 'first_seen',
+              'own_size', 'own_files', 'own_first_seen', 'aggregate', 'subtree', 'user')
+    search_fields = ('user__name', 'path')
+    search_help_text = "Search by the start of the user name, or the exact path of the directory"
+    readonly_fields = ('path', 'formatted_size', 'n_files', 'formatted_quota_used', 'first_seen',
+                       'own_size', 'own_files', 'own_first_seen', 'aggregate', 'subtree', 'user')
+    list_select_related = ('user__cache_disk',)
+
+    def search_term_q(self, term):
+        return user_prefix_q(term) | directory_path_q(term, "path_hash")
+admin.site.register(CachedDirectory, CachedDirectoryAdmin)
+
+class ScheduledDeletionAdmin(LargeTableAdmin):
     save_on_top = True
     list_display = ('user', 'time_entered', 'time_delete')
-    search_fields = ('user',)
+    search_fields = ('user__name',)
+    search_help_text = "Search by the start of the user name"
     fields = ('user', 'time_entered', 'time_delete')
     readonly_fields = ('user', 'time_entered')
+    list_select_related = ('user',)
+
+    def search_term_q(self, term):
+        return user_prefix_q(term)
 admin.site.register(ScheduledDeletion, ScheduledDeletionAdmin)
+
+class ScanPassAdmin(admin.ModelAdmin):
+    save_on_top = True
+    list_display = ('user', 'scan_mode', 'started', 'finished', 'n_files', 'n_added', 'n_resized', 'n_removed')
+    search_fields = ('user__name',)
+    readonly_fields = ('user', 'scan_mode', 'started', 'finished', 'n_files', 'total_size', 'n_added',
+                       'n_resized', 'n_removed', 'bytes_added', 'bytes_removed')
+admin.site.register(ScanPass, ScanPassAdmin)
+
+class ScanLeaseAdmin(admin.ModelAdmin):
+    list_display = ('cache_disk', 'holder', 'expires', 'progress', 'current_user', 'pass_started', 'pass_finished')
+    readonly_fields = ('cache_disk', 'holder', 'acquired', 'expires', 'pass_started', 'pass_finished',
+                       'users_total', 'users_done', 'current_user')
+    list_select_related = ('cache_disk',)
+admin.site.register(ScanLease, ScanLeaseAdmin)
+
+class ScanJournalEntryAdmin(LargeTableAdmin):
+    list_display = ('id', 'user', 'event', 'path', 'aggregate', 'size', 'old_size', 'time')
+    list_filter = ('event',)
+    search_fields = ('user__name',)
+    search_help_text = "Search by the start of the user name"
+    list_select_related = ('user',)
+
+    def search_term_q(self, term):
+        return user_prefix_q(term)
+    readonly_fields = ('scan_pass', 'user', 'event', 'path', 'aggregate', 'size', 'old_size', 'time')
+admin.site.register(ScanJournalEntry, ScanJournalEntryAdmin)
+
+class JournalCheckpointAdmin(admin.ModelAdmin):
+    list_display = ('consumer', 'sequence', 'updated')
+admin.site.register(JournalCheckpoint, JournalCheckpointAdmin)
+
+class NotificationAdmin(admin.ModelAdmin):
+    list_display = ('subject', 'to_address', 'state', 'attempts', 'created', 'next_attempt', 'sent')
+    list_filter = ('state',)
+    search_fields = ('to_address', 'user__name')
+    readonly_fields = ('user', 'to_address', 'from_address', 'subject', 'body', 'attempts', 'created', 'sent', 'error')
+admin.site.register(Notification, NotificationAdmin)
+
+class DashboardAdmin(admin.ModelAdmin):
+    """The dashboard, shown in place of the change list of the DiskRollups.  It only reads the rollups,
+    which are refreshed by the daemons (see xfc_control.dashboard)."""
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    def has_delete_permission(self, request, obj=None):
+        return False
+
+    def changelist_view(self, request, extra_context=None):
+        if not self.has_view_permission(request):
+            raise PermissionDenied
+        rollups = list(DiskRollup.objects.select_related("cache_disk").order_by("cache_disk__mountpoint"))
+        totals = {}
+        for field in ("n_users", "quota_size", "quota_used", "hard_limit_size", "total_used", "n_over_quota",
+                      "n_over_hard_limit", "pending_deletions", "pending_files", "pending_bytes", "n_stale"):
+            totals[field] = sum(getattr(r, field) for r in rollups)
+        for field in ("size_bytes", "allocated_bytes", "used_bytes", "real_used_bytes"):
+            totals[field] = sum(getattr(r.cache_disk, field) for r in rollups)
+        users = {}
+        for ur in UserRollup.objects.select_related("user__cache_disk"):
+            users.setdefault(ur.ranking, []).append(ur)
+        context = dict(
+            self.admin_site.each_context(request),
+            title="Dashboard",
+            opts=self.model._meta,
+            rollups=rollups,
+            totals=totals,
+            rankings=[(label, users.get(ranking, [])) for ranking, label in UserRollup.RANKING_CHOICES],
+            updated=min((r.updated for r in rollups), default=None),
+        )
+        context.update(extra_context or {})
+        return TemplateResponse(request, "admin/xfc_control/dashboard.html", context)
+admin.site.register(DiskRollup, DashboardAdmin)
@@ -0,0 +1,7 @@
+"""Benchmarks of the xfc_control scripts and queries.  These are run via the xfc_benchmark script:
+
+  ``python manage.py runscript xfc_benchmark --script-args suite=<suite>``
+
+The benchmarks create their own synthetic CacheDisk, Users and CachedFiles, but they should still be
+run against a scratch database rather than the production database.
+"""
@@ -0,0 +1,205 @@
+"""Benchmark of the CachedFile lookups that use the (directory, name), CachedDirectory (user, path_hash)
+and CachedFile (user, first_seen) indexes, on a synthetic table of CachedFiles:
+
+  - the existence check for a single file, by directory path and by directory path_hash
+  - the listing of the files in one directory made by xfc_scan for every directory it walks
+  - the ordering of a user's files by first_seen made by xfc_schedule and the predict view
+
+With ``compare=true`` the indexes are dropped for the "before" measurements and recreated for the
+"after" measurements, so that the query plans and latencies can be compared on the same data.  Building
+the indexes on tens of millions of rows takes several minutes.
+
+Query plans are from ``QuerySet.explain()`` and so depend on the database backend - the results are
+only meaningful on the same backend (PostgreSQL) as the production database.  On PostgreSQL the
+size of the tables and their indexes is also reported.
+"""
+
+import datetime
+import random
+import time
+from contextlib import contextmanager
+
+from django.db import connection
+
+from xfc_control.models import CacheDisk, User, CachedFile, CachedDirectory
+
+# the synthetic CacheDisk - deleting it deletes all the synthetic Users and CachedFiles
+BENCH_MOUNTPOINT = "/xfc_benchmark/cachedfile_index"
+
+
+def bench_user_name(u):
+    return "xfc_bench_%06d" % u
+
+
+def bench_dir_path(user_name, f):
+    return "user_cache/%s/d%03d" % (user_name, f % 100)
+
+
+def bench_file_name(f):
+    return "f%09d.nc" % f
+
+
+def populate(n_rows, n_users, batch_size=10000):
+    """Create the synthetic CacheDisk, Users and CachedFiles, unless they already exist.
+       :var int n_rows: number of CachedFiles to create
+       :var int n_users: number of Users to spread the CachedFiles over
+       :return: list of the synthetic Users
+    """
+    cd, created = CacheDisk.objects.get_or_create(mountpoint=BENCH_MOUNTPOINT)
+    users = list(User.objects.filter(cache_disk=cd).order_by("name"))
+    if len(users) == n_users and CachedFile.objects.filter(user__cache_disk=cd).count() >= n_rows:
+        return users
+    # start again if the existing data does not match
+    User.objects.filter(cache_disk=cd).delete()
+    users = User.objects.bulk_create([
+        User(name=bench_user_name(u), email="", cache_path="user_cache/" + bench_user_name(u), cache_disk=cd)
+        for u in range(n_users)
+    ])
+
+    rng = random.Random(0)
+    now = datetime.datetime.utcnow()
+    files_per_user = n_rows // n_users
+    batch = []
+    for user in users:
+        root = CachedDirectory(user=user, path=user.cache_path, depth=0)
+        root.save()
+        dirs = [CachedDirectory(user=user, path=bench_dir_path(user.name, d), parent=root, depth=1)
+                for d in range(min(100, files_per_user))]
+        for d in dirs:
+            d.path_hash = CachedDirectory.hash_path(d.path)
+        dirs = CachedDirectory.objects.bulk_create(dirs)
+        for f in range(files_per_user):
+            batch.append(CachedFile(
+                user=user, directory=dirs[f % 100], name=bench_file_name(f),
+                size=int(rng.lognormvariate(14, 3)),
+                first_seen=now - datetime.timedelta(seconds=rng.randint(0, 365 * 86400))
+            ))
+            if len(batch) >= batch_size:
+                CachedFile.objects.bulk_create(batch)
+                batch = []
+    if batch:
+        CachedFile.objects.bulk_create(batch)
+    return users
+
+
+def cleanup():
+    """Delete the synthetic CacheDisk, Users and CachedFiles."""
+    CacheDisk.objects.filter(mountpoint=BENCH_MOUNTPOINT).delete()
+
+
+@contextmanager
+def without_indexes():
+    """Drop the (directory, name), (user, path_hash) and (user, first_seen) indexes for the duration
+    of the context."""
+    file_constraint = [c for c in CachedFile._meta.constraints if c.name == "cachedfile_directory_name"][0]
+    dir_constraint = [c for c in CachedDirectory._meta.constraints
+                      if c.name == "cacheddirectory_user_path_hash"][0]
+    index = [i for i in CachedFile._meta.indexes if i.name == "cachedfile_user_first_seen"][0]
+    with connection.schema_editor() as schema_editor:
+        schema_editor.remove_constraint(CachedFile, file_constraint)
+        schema_editor.remove_constraint(CachedDirectory, dir_constraint)
+        schema_editor.remove_index(CachedFile, index)
+    try:
+        yield
+    finally:
+        with connection.schema_editor() as schema_editor:
+            schema_editor.add_index(CachedFile, index)
+            schema_editor.add_constraint(CachedDirectory, dir_constraint)
+            schema_editor.add_constraint(CachedFile, file_constraint)
+
+
+def table_sizes():
+    """Return the size in bytes of the CachedFile and CachedDirectory tables, and of their indexes,
+    or None if the database is not PostgreSQL."""
+    if connection.vendor != "postgresql":
+        return None
+    sizes = {}
+    with connection.cursor() as cursor:
+        for model in (CachedFile, CachedDirectory):
+            table = model._meta.db_table
+            cursor.execute("SELECT pg_relation_size(%s), pg_indexes_size(%s)", [table, table])
+            sizes[table] = dict(zip(("table_bytes", "index_bytes"), cursor.fetchone()))
+    return sizes
+
+
+def time_query(make_queryset, probes, evaluate):
+    """Time a query over a list of probes.
+       :var make_queryset: function taking a probe and returning a QuerySet
+       :var List probes: the arguments to make_queryset
+       :var evaluate: function taking the QuerySet and running it
+       :return: dictionary with the query plan of the first probe and the latency statistics in ms
+    """
+    plan = make_queryset(probes[0]).explain()
+    times = []
+    for probe in probes:
+        qs = make_queryset(probe)
+        start = time.perf_counter()
+        evaluate(qs)
+        times.append((time.perf_counter() - start) * 1000.0)
+    times.sort()
+    return {
+        "plan": plan,
+        "probes": len(times),
+        "mean_ms": sum(times) / len(times),
+        "p50_ms": times[len(times) // 2],
+        "p95_ms": times[min(len(times) - 1, int(len(times) * 0.95))],
+        "max_ms": times[-1],
+    }
+
+
+def measure(users, files_per_user, n_probes, by_hash):
+    """Measure the scan existence check and the scheduler ordering."""
+    rng = random.Random(1)
+    file_probes = []
+    for p in range(n_probes):
+        user = users[rng.randrange(len(users))]
+        f = rng.randrange(files_per_user)
+        file_probes.append((user, bench_dir_path(user.name, f), bench_file_name(f)))
+    user_probes = [users[rng.randrange(len(users))] for p in range(min(n_probes, 100))]
+    dir_probes = list(CachedDirectory.objects.filter(
+        user__in=user_probes, depth=1).values_list("pk", flat=True)[:n_probes])
+
+    results = {}
+    if by_hash:
+        results["scan_exists"] = time_query(
+            lambda p: CachedFile.objects.filter(directory__user=p[0],
+                                                directory__path_hash=CachedDirectory.hash_path(p[1]),
+                                                name=p[2]),
+            file_probes, lambda qs: qs.exists())
+    else:
+        results["scan_exists"] = time_query(
+            lambda p: CachedFile.objects.filter(directory__user=p[0], directory__path=p[1], name=p[2]),
+            file_probes, lambda qs: qs.exists())
+    results["scan_directory"] = time_query(
+        lambda d: CachedFile.objects.filter(directory_id=d).values_list("name", "size", "first_seen"),
+        dir_probes, lambda qs: list(qs))
+    results["schedule_order"] = time_query(
+        lambda u: CachedFile.objects.filter(user=u).order_by("first_seen").values_list("pk", "size", "first_seen"),
+        user_probes, lambda qs: list(qs[:1000]))
+    return results
+
+
+def run_benchmark(rows=20000000, users=1000, probes=1000, compare=False, keep=False):
+    """Run the benchmark.
+       :var int rows: number of synthetic CachedFiles
+       :var int users: number of synthetic Users
+       :var int probes: number of lookups to time for each query
+       :var bool compare: measure without the indexes as well as with them
+       :var bool keep: keep the synthetic data for the next run
+       :return: dictionary of results
+    """
+    start = time.perf_counter()
+    bench_users = populate(rows, users)
+    results = {"suite": "index", "rows": rows, "users": users, "backend": connection.vendor,
+               "populate_s": time.perf_counter() - start, "table_sizes": table_sizes()}
+    files_per_user = rows // users
+    try:
+        if compare:
+            with without_indexes():
+                results["before"] = measure(bench_users, files_per_user, probes, by_hash=False)
+        results["after"] = measure(bench_users, files_per_user, probes, by_hash=True)
+        results["after_by_path"] = measure(bench_users, files_per_user, probes, by_hash=False)["scan_exists"]
+    finally:
+        if not keep:
+            cleanup()
+    return results
@@ -0,0 +1,281 @@
+"""Benchmark of the xfc daemons and the REST API on synthetic user trees.
+
+A tree of directories and files is generated for each synthetic User in a temporary directory, which is
+used as the mountpoint of a synthetic CacheDisk:
+
+  - the directories are ``depth`` levels deep, with ``fanout`` subdirectories in each directory
+  - the files are spread over the directories at random, with sizes from a log-normal distribution
+    (``size_mu`` and ``size_sigma`` are the mean and standard deviation of the log of the size in
+    bytes).  The files are sparse, so the sizes do not use disk space
+  - the modification time of each file is set with ``os.utime`` to a random time in the last
+    ``age_days`` days, and after the first scan the first_seen of each CachedFile is set to its
+    modification time, so that the files have a realistic spread of ages
+
+Each step of the pipeline is then timed, in the order it runs in production:
+
+  - ``scan``: ``xfc_scan.run_loop`` over the new trees (all files added)
+  - ``rescan``: ``xfc_scan.run_loop`` again with no changes (the scans are not adaptive, so that every
+    user is scanned again, see xfc_control.scan_frequency)
+  - ``fix_quotas``: ``xfc_fix_quotas.fix_user_quotas`` and ``fix_cache_disk_quotas``
+  - ``schedule``: ``xfc_schedule.schedule_deletions`` for each user, with each user's quota set to half
+    of the quota they have used
+  - ``api_<view>``: each of the v1 REST API endpoints, for each user
+  - ``delete``: ``xfc_delete.do_deletions`` for each user, with the scheduled deletions made due
+
+For each step the wall time, the throughput (files, or requests, per second), the number of database
+queries and the peak resident set size of the process so far are reported.  The results can be
+compared against the results of an earlier run (the baseline), with the steps that are slower by more
+than the tolerance reported as regressions.
+
+As ``xfc_scan.run_loop`` scans every User in the database, the benchmark will not run if there are
+any Users that it did not create.
+"""
+
+import datetime
+import os
+import random
+import resource
+import shutil
+import tempfile
+import time
+from contextlib import contextmanager
+
+from django.db import connection
+from django.test import RequestFactory
+from django.urls import resolve
+
+import xfc_control.urls
+from xfc_control.models import CacheDisk, User, CachedFile, ScheduledDeletion, Notification
+from xfc_control.scripts import xfc_scan, xfc_schedule, xfc_delete, xfc_fix_quotas
+
+# prefix of the synthetic CacheDisk mountpoint - the tree is generated in a temporary directory
+BENCH_PREFIX = "xfc_benchmark_"
+# quota and hard limit of the synthetic Users, large enough that no user goes over them, but small enough
+# that the totals over all the users (e.g. in xfc_control.dashboard) fit in a 64 bit integer
+BENCH_QUOTA = 2 ** 50
+
+
+def bench_user_name(u):
+    return "xfc_pipe_%06d" % u
+
+
+def directory_paths(depth, fanout):
+    """Return the relative paths of the directories of a tree, including the root ("")."""
+    paths = [""]
+    level = [""]
+    for d in range(depth):
+        level = [os.path.join(parent, "d%02d_%02d" % (d, i)) for parent in level for i in range(fanout)]
+        paths.extend(level)
+    return paths
+
+
+def generate_tree(root, n_files, depth=3, fanout=4, size_mu=12.0, size_sigma=3.0, age_days=365, rng=None):
+    """Generate a synthetic tree of files.
+       :var string root: directory to generate the tree in
+       :var int n_files: number of files to generate
+       :var int depth: number of levels of subdirectories
+       :var int fanout: number of subdirectories in each directory
+       :var float size_mu: mean of the log of the file sizes in bytes
+       :var float size_sigma: standard deviation of the log of the file sizes in bytes
+       :var int age_days: the modification times are spread over this many days before now
+       :var random.Random rng: (*optional*) random number generator
+       :return: total size of the files in bytes
+    """
+    if rng is None:
+        rng = random.Random(0)
+    dirs = directory_paths(depth, fanout)
+    for d in dirs:
+        os.makedirs(os.path.join(root, d), exist_ok=True)
+    now = time.time()
+    total_size = 0
+    for f in range(n_files):
+        path = os.path.join(root, rng.choice(dirs), "f%08d.nc" % f)
+        size = min(int(rng.lognormvariate(size_mu, size_sigma)), 2 ** 40)
+        # a sparse file of the size
+        with open(path, "wb") as fh:
+            fh.truncate(size)
+        mtime = now - rng.uniform(0, age_days * 86400)
+        os.utime(path, (mtime, mtime))
+        total_size += size
+    return total_size
+
+
+def populate(root, n_users, files_per_user, **tree_args):
+    """Create the synthetic CacheDisk and Users, and generate a tree for each user.
+       :var string root: directory to use as the mountpoint of the CacheDisk
+       :var int n_users: number of Users
+       :var int files_per_user: number of files in each user's tree
+       :return: the CacheDisk
+    """
+    if User.objects.exclude(cache_disk__mountpoint__startswith=os.path.join(tempfile.gettempdir(), BENCH_PREFIX)).exists():
+        raise Exception("The pipeline benchmark must be run against a scratch database with no Users")
+    rng = random.Random(0)
+    cd = CacheDisk.objects.create(mountpoint=root, size_bytes=2 ** 62)
+    for u in range(n_users):
+        name = bench_user_name(u)
+        cache_path = os.path.join("user_cache", name)
+        generate_tree(os.path.join(root, cache_path), files_per_user, rng=rng, **tree_args)
+        User.objects.create(name=name, email=name + "@localhost", notify=True, cache_path=cache_path,
+                            cache_disk=cd, quota_size=BENCH_QUOTA, hard_limit_size=BENCH_QUOTA)
+    return cd
+
+
+def age_files(cd):
+    """Set the first_seen of each CachedFile to the modification time of the file."""
+    batch = []
+    for cf in CachedFile.objects.filter(user__cache_disk=cd).select_related("directory").iterator(chunk_size=10000):
+        mtime = os.stat(os.path.join(cd.mountpoint, cf.path)).st_mtime
+        cf.first_seen = datetime.datetime.utcfromtimestamp(mtime)
+        batch.append(cf)
+        if len(batch) >= 10000:
+            CachedFile.objects.bulk_update(batch, ["first_seen"])
+            batch = []
+    if batch:
+        CachedFile.objects.bulk_update(batch, ["first_seen"])
+
+
+def peak_rss_mb():
+    """Return the peak resident set size of the process in MB."""
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+@contextmanager
+def measure_step(results, name, n_items):
+    """Time a step, and count the database queries it runs.
+       :var dict results: dictionary to add the results of the step to
+       :var string name: name of the step
+       :var int n_items: number of files or requests processed by the step, for the throughput
+    """
+    queries = [0]
+
+    def count_query(execute, sql, params, many, context):
+        queries[0] += 1
+        return execute(sql, params, many, context)
+
+    start = time.perf_counter()
+    with connection.execute_wrapper(count_query):
+        yield
+    elapsed = time.perf_counter() - start
+    results[name] = {
+        "seconds": elapsed,
+        "items": n_items,
+        "per_second": n_items / elapsed if elapsed > 0 else None,
+        "queries": queries[0],
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+
+def api_requests(cd, users):
+    """Return the v1 REST API requests to time, as a dictionary of lists of paths keyed on the view."""
+    requests = {
+        "disk": ["/api/v1/disk?mountpoint=" + cd.mountpoint],
+        "user": [], "file": [], "directory": [], "scheduled_deletions": [], "predict_deletions": [],
+    }
+    for user in users:
+        requests["user"].append("/api/v1/user?name=" + user.name)
+        requests["file"].append("/api/v1/file?name=" + user.name)
+        requests["directory"].append("/api/v1/directory?name=" + user.name)
+        requests["scheduled_deletions"].append("/api/v1/scheduled_deletions?name=" + user.name)
+        requests["predict_deletions"].append("/api/v1/predict_deletions?name=" + user.name)
+    return requests
+
+
+def compare_baseline(results, baseline, tolerance=0.2):
+    """Compare the step results against a baseline.
+       :var dict results: results of this run
+       :var dict baseline: results of an earlier run
+       :var float tolerance: fraction by which a step can be slower before it is a regression
+       :return: dictionary of the comparison of each step in both results
+    """
+    comparison = {}
+    for name, step in results["steps"].items():
+        base = baseline.get("steps", {}).get(name)
+        if base is None:
+            continue
+        ratio = step["seconds"] / base["seconds"] if base["seconds"] > 0 else None
+        comparison[name] = {
+            "baseline_seconds": base["seconds"],
+            "seconds": step["seconds"],
+            "ratio": ratio,
+            "baseline_queries": base["queries"],
+            "queries": step["queries"],
+            "regression": (ratio is not None and ratio > 1.0 + tolerance) or step["queries"] > base["queries"],
+        }
+    return comparison
+
+
+def run_benchmark(users=10, files=10000, depth=3, fanout=4, size_mu=12.0, size_sigma=3.0, age_days=365,
+                  baseline=None, tolerance=0.2, keep=False):
+    """Run the benchmark.
+       :var int users: number of synthetic Users
+       :var int files: number of files in each user's tree
+       :var int depth: number of levels of subdirectories in each tree
+       :var int fanout: number of subdirectories in each directory
+       :var float size_mu: mean of the log of the file sizes in bytes
+       :var float size_sigma: standard deviation of the log of the file sizes in bytes
+       :var int age_days: the files are spread over this many days before now
+       :var dict baseline: (*optional*) results of an earlier run to compare against
+       :var float tolerance: fraction by which a step can be slower than the baseline before it is a
+                             regression
+       :var bool keep: keep the synthetic trees and database entries
+       :return: dictionary of results
+    """
+    root = tempfile.mkdtemp(prefix=BENCH_PREFIX)
+    results = {"suite": "pipeline", "users": users, "files": files, "depth": depth, "fanout": fanout,
+               "size_mu": size_mu, "size_sigma": size_sigma, "age_days": age_days,
+               "backend": connection.vendor, "steps": {}}
+    steps = results["steps"]
+    n_files = users * files
+    try:
+        start = time.perf_counter()
+        cd = populate(root, users, files, depth=depth, fanout=fanout, size_mu=size_mu,
+                      size_sigma=size_sigma, age_days=age_days)
+        results["populate_s"] = time.perf_counter() - start
+
+        # every user is scanned in both steps, rather than only those due to be scanned
+        with measure_step(steps, "scan", n_files):
+            xfc_scan.run_loop({}, adaptive=False)
+        age_files(cd)
+        with measure_step(steps, "rescan", n_files):
+            xfc_scan.run_loop({}, adaptive=False)
+        with measure_step(steps, "fix_quotas", n_files):
+            xfc_fix_quotas.fix_user_quotas()
+            xfc_fix_quotas.fix_cache_disk_quotas()
+
+        bench_users = list(User.objects.filter(cache_disk=cd).order_by("name"))
+        for user in bench_users:
+            user.quota_size = user.quota_used // 2
+            user.save()
+        with measure_step(steps, "schedule", n_files):
+            for user in bench_users:
+                xfc_schedule.schedule_deletions(user)
+
+        factory = RequestFactory()
+        for view, paths in api_requests(cd, bench_users).items():
+            with measure_step(steps, "api_" + view, len(paths)):
+                for path in paths:
+                    request = factory.get(path)
+                    response = resolve(request.path, urlconf=xfc_control.urls).func(request)
+                    if response.status_code != 200:
+                        raise Exception("Benchmark request failed: {} {}".format(path, response.status_code))
+
+        # make the scheduled deletions due - the files are older than the time they were entered
+        ScheduledDeletion.objects.filter(user__cache_disk=cd).update(
+            time_delete=datetime.datetime.utcnow() - datetime.timedelta(minutes=1)
+        )
+        n_scheduled = CachedFile.objects.filter(user__cache_disk=cd, scheduleddeletion__isnull=False).count()
+        with measure_step(steps, "delete", n_scheduled):
+            for user in bench_users:
+                xfc_delete.do_deletions(user)
+    finally:
+        if not keep:
+            # the notification emails to the synthetic users must not be sent
+            Notification.objects.filter(user__cache_disk__mountpoint=root).delete()
+            CacheDisk.objects.filter(mountpoint=root).delete()
+            shutil.rmtree(root, ignore_errors=True)
+
+    if baseline is not None:
+        results["comparison"] = compare_baseline(results, baseline, tolerance)
+        results["regressions"] = sorted(name for name, c in results["comparison"].items() if c["regression"])
+    return results
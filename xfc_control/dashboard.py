@@ -0,0 +1,142 @@
+"""Rollups of the CacheDisks and users for the dashboard in the admin.
+
+The dashboard shows, for each CacheDisk, the space allocated, used and really used, the users over
+their quota or hard limit, the volume of files scheduled for deletion and how recently the users
+were scanned, along with the top users by quota used and by total size used.  Working these out
+reads the User, CachedFile, CachedDirectory and ScanPass tables, so they are worked out by the
+daemons, at the end of each run, and written to the DiskRollup and UserRollup tables::
+
+    refresh_rollups()
+
+The dashboard then only reads the rollups, which have one row for each CacheDisk and
+XFC_DASHBOARD_TOP_N rows for each ranking, and shows the time they were last refreshed.
+"""
+
+import datetime
+import logging
+
+from django.db import transaction
+from django.db.models import Count, F, Max, Q, Sum
+
+from xfc_control.models import CacheDisk, User, CachedFile, CachedDirectory, ScheduledDeletion, ScanPass
+from xfc_control.models import DiskRollup, UserRollup
+import xfc_site.settings as settings
+
+# number of users in each ranking
+TOP_N = 20
+# users whose last scan finished longer ago than this are counted as stale
+STALE_HOURS = 24
+
+
+def last_scans():
+    """Return the time the last scan of each user finished, as a dictionary keyed on the user id."""
+    return dict(ScanPass.objects.filter(finished__isnull=False).values("user").annotate(
+        last=Max("finished")).order_by().values_list("user", "last"))
+
+
+def disk_totals():
+    """Return the totals of the users on each CacheDisk, as a dictionary keyed on the CacheDisk id."""
+    # the annotations cannot have the names of the fields, which the filters refer to
+    fields = ("quota_size", "quota_used", "hard_limit_size", "total_used")
+    totals = {}
+    for t in User.objects.values("cache_disk").annotate(
+            n_users=Count("id"),
+            n_over_quota=Count("id", filter=Q(quota_used__gt=F("quota_size"))),
+            n_over_hard_limit=Count("id", filter=Q(total_used__gt=F("hard_limit_size"))),
+            **{"sum_" + f: Sum(f) for f in fields}
+    ).order_by():
+        totals[t["cache_disk"]] = dict(
+            n_users=t["n_users"], n_over_quota=t["n_over_quota"], n_over_hard_limit=t["n_over_hard_limit"],
+            **{f: t["sum_" + f] for f in fields}
+        )
+    return totals
+
+
+def pending_totals():
+    """Return the number of ScheduledDeletions on each CacheDisk, and the number and size of the files in
+    them, as a dictionary of (deletions, files, bytes) keyed on the CacheDisk id."""
+    pending = {}
+
+    def add(cache_disk, deletions=0, files=0, size=0):
+        d, f, s = pending.get(cache_disk, (0, 0, 0))
+        pending[cache_disk] = (d + deletions, f + (files or 0), s + (size or 0))
+
+    for t in ScheduledDeletion.objects.values("user__cache_disk").annotate(n=Count("id")).order_by():
+        add(t["user__cache_disk"], deletions=t["n"])
+    for t in CachedFile.objects.filter(scheduleddeletion__isnull=False).values("user__cache_disk").annotate(
+            n=Count("id"), total=Sum("size")).order_by():
+        add(t["user__cache_disk"], files=t["n"], size=t["total"])
+    # for users scanned in DIRECTORY_MODE, the directory totals are scheduled instead of the files
+    for t in CachedDirectory.objects.filter(scheduleddeletion__isnull=False).values("user__cache_disk").annotate(
+            n=Sum("own_files"), total=Sum("own_size")).order_by():
+        add(t["user__cache_disk"], files=t["n"], size=t["total"])
+    return pending
+
+
+def rankings(top_n, scans):
+    """Return the UserRollups of the top_n users in each ranking.
+       :var int top_n: number of users in each ranking
+       :var dict scans: the time of the last scan of each user, from last_scans
+    """
+    querysets = (
+        (UserRollup.TEMPORAL, User.objects.order_by("-quota_used", "pk"), "quota_used", "quota_size"),
+        (UserRollup.HARD, User.objects.order_by("-total_used", "pk"), "total_used", "hard_limit_size"),
+        (UserRollup.OVER_QUOTA, User.objects.filter(quota_used__gt=F("quota_size")).order_by(
+            (F("quota_used") - F("quota_size")).desc(), "pk"), "quota_used", "quota_size"),
+    )
+    rollups = []
+    for ranking, qs, used_field, limit_field in querysets:
+        for rank, user in enumerate(qs.only("pk", used_field, limit_field)[:top_n], 1):
+            rollups.append(UserRollup(ranking=ranking, rank=rank, user=user, used=getattr(user, used_field),
+                                      limit=getattr(user, limit_field), last_scan=scans.get(user.pk)))
+    return rollups
+
+
+def refresh_rollups(top_n=None, stale_hours=None):
+    """Work out the rollups of each CacheDisk and the rankings of the users, and replace the rollups
+    in the database with them.
+       :var int top_n: (*optional*) number of users in each ranking, defaults to the
+                       XFC_DASHBOARD_TOP_N setting
+       :var int stale_hours: (*optional*) users not scanned in this many hours are counted as stale,
+                             defaults to the XFC_DASHBOARD_STALE_HOURS setting
+    """
+    if top_n is None:
+        top_n = getattr(settings, "XFC_DASHBOARD_TOP_N", TOP_N)
+    if stale_hours is None:
+        stale_hours = getattr(settings, "XFC_DASHBOARD_STALE_HOURS", STALE_HOURS)
+    now = datetime.datetime.utcnow()
+    stale_before = now - datetime.timedelta(hours=stale_hours)
+
+    # read the large tables outside of the transaction that replaces the rollups
+    scans = last_scans()
+    totals = disk_totals()
+    pending = pending_totals()
+    freshness = {}
+    for user_id, cache_disk in User.objects.values_list("pk", "cache_disk").iterator():
+        oldest, newest, n_stale = freshness.get(cache_disk, (None, None, 0))
+        last = scans.get(user_id)
+        if last is None or last < stale_before:
+            n_stale += 1
+        if last is not None:
+            oldest = last if oldest is None else min(oldest, last)
+            newest = last if newest is None else max(newest, last)
+        freshness[cache_disk] = (oldest, newest, n_stale)
+    user_rollups = rankings(top_n, scans)
+
+    with transaction.atomic():
+        # lock the CacheDisks, so that two daemons refreshing the rollups at once do not both insert them
+        disks = list(CacheDisk.objects.select_for_update().order_by("pk"))
+        disk_rollups = []
+        for cd in disks:
+            oldest, newest, n_stale = freshness.get(cd.pk, (None, None, 0))
+            deletions, files, size = pending.get(cd.pk, (0, 0, 0))
+            disk_rollups.append(DiskRollup(
+                cache_disk=cd, pending_deletions=deletions, pending_files=files, pending_bytes=size,
+                oldest_scan=oldest, newest_scan=newest, n_stale=n_stale, updated=now,
+                **{k: v or 0 for k, v in totals.get(cd.pk, {}).items()}
+            ))
+        DiskRollup.objects.all().delete()
+        DiskRollup.objects.bulk_create(disk_rollups)
+        UserRollup.objects.all().delete()
+        UserRollup.objects.bulk_create(user_rollups)
+    logging.debug("Refreshed the dashboard rollups of %d cache disks", len(disk_rollups))
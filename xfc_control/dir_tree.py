@@ -0,0 +1,231 @@
+"""Functions to build the per-directory aggregates (CachedDirectory) for a user while their
+cache area is being walked by xfc_scan.
+
+The aggregates are du-style: each CachedDirectory holds the totals for all the files in the
+directory and all of its subdirectories, so that the size of any part of the tree can be
+returned by looking at a single level of the tree, rather than summing over all the files.
+
+The CachedDirectory entries are also the directory part of the CachedFile paths, so the
+DirectoryTree keeps the CachedDirectory record for each directory, creating the record when a
+new directory is walked, so that the CachedFiles in the directory can refer to it.
+
+For users scanned in CacheDisk.DIRECTORY_MODE, no CachedFiles are created and the totals for the
+files directly in each directory (or, below the scan depth, in each subtree) are the record of the
+files.  These are stored in the own_ fields of the CachedDirectory, with the aggregate flag set.
+"""
+
+import datetime
+import os
+
+from xfc_control.models import CachedDirectory
+from xfc_control.metrics import ROWS_WRITTEN
+
+# reference time for the size-weighted first_seen, which is summed in integer microseconds so that
+# it is the same on every scan if the files have not changed
+EPOCH = datetime.datetime(1970, 1, 1)
+MICROSECOND = datetime.timedelta(microseconds=1)
+
+
+class DirectoryTree(object):
+    """Accumulator for the file sizes, counts and ages in each directory of a user's cache area.
+    Directories are keyed on their path AFTER the CacheDisk mountpoint, in the same way as
+    CachedDirectory.path.
+    """
+
+    def __init__(self, root_path, current_date=None, user=None, aggregate=False, scan_depth=None):
+        """:var string root_path: path to the user's cache area AFTER the CacheDisk mountpoint
+           :var datetime.datetime current_date: date used to calculate the temporal quota
+           :var xfc_control.models.User user: (*optional*) user to load the CachedDirectory records for
+           :var bool aggregate: the files are only recorded by the directory totals (DIRECTORY_MODE)
+           :var int scan_depth: (*optional*) with aggregate, the depth at which the directories are
+                                totalled with all of their subdirectories
+        """
+        if current_date is None:
+            current_date = datetime.datetime.utcnow()
+        self.root_path = os.path.normpath(root_path)
+        self.current_date = current_date
+        self.aggregate = aggregate
+        self.scan_depth = scan_depth if aggregate else None
+        # each entry is [size, n_files, quota_used, first_seen, age] for the files directly
+        # in the directory - the subdirectories are added in when the tree is totalled.
+        # age is the sum of size * first_seen (in microseconds after EPOCH), to find the size-weighted
+        # mean first_seen
+        self.directories = {}
+        self.add_directory(self.root_path)
+        # the CachedDirectory record for each directory, keyed on the path
+        self.user = user
+        self.records = {}
+        if user is not None:
+            self.records = {cd.path: cd for cd in CachedDirectory.objects.filter(user=user)}
+
+    def record(self, path):
+        """Return the CachedDirectory record for a directory, creating it (and any missing parents)
+        if the directory is new.  The size of a new record is filled in by update_directory_tree.
+           :var string path: path to the directory AFTER the CacheDisk mountpoint
+           :return: the CachedDirectory record
+        """
+        path = os.path.normpath(path)
+        if path in self.records:
+            return self.records[path]
+        self.add_directory(path)
+        parent = None
+        if path != self.root_path:
+            parent = self.record(os.path.dirname(path))
+        cd = CachedDirectory(user=self.user, path=path, parent=parent, depth=self.depth(path))
+        cd.save()
+        ROWS_WRITTEN.inc(process="xfc_scan", model="CachedDirectory", operation="create")
+        self.records[path] = cd
+        return cd
+
+    def add_directory(self, path):
+        """Add a directory (and any missing parents up to the root) to the tree.
+           :var string path: path to the directory AFTER the CacheDisk mountpoint
+        """
+        path = os.path.normpath(path)
+        while path not in self.directories:
+            self.directories[path] = [0, 0, 0, None, 0]
+            if path == self.root_path:
+                break
+            path = os.path.dirname(path)
+
+    def add_file(self, dir_path, size, first_seen, n_files=1):
+        """Add a file to the directory that contains it.
+           :var string dir_path: path to the directory containing the file AFTER the CacheDisk mountpoint
+           :var int size: size of the file in bytes
+           :var datetime.datetime first_seen: date the file was first seen by xfc_scan
+           :var int n_files: number of files, if size is the total of several files with the same first_seen
+        """
+        dir_path = os.path.normpath(dir_path)
+        self.add_directory(dir_path)
+        entry = self.directories[dir_path]
+        entry[0] += size
+        entry[1] += n_files
+        # same formula as CachedFile.quota_use - files first seen during this scan have a
+        # first_seen later than current_date, but still use one day of quota
+        entry[2] += size * (max((self.current_date - first_seen).days, 0) + 1)
+        if entry[3] is None or first_seen < entry[3]:
+            entry[3] = first_seen
+        entry[4] += size * ((first_seen - EPOCH) // MICROSECOND)
+
+    def fold(self, path):
+        """Return the path of the directory whose totals the files in a directory are added to.  This is
+        the directory itself, unless it is deeper than the scan depth, when it is the parent directory
+        at the scan depth.
+           :var string path: path to the directory AFTER the CacheDisk mountpoint
+        """
+        path = os.path.normpath(path)
+        if self.scan_depth is None:
+            return path
+        depth = self.depth(path)
+        while depth > self.scan_depth:
+            path = os.path.dirname(path)
+            depth -= 1
+        return path
+
+    def own_first_seen(self, path):
+        """Return the size-weighted mean first_seen of the files directly in a directory."""
+        entry = self.directories[path]
+        if entry[0] == 0:
+            return entry[3]
+        return EPOCH + MICROSECOND * (entry[4] // entry[0])
+
+    def aggregate_first_seen(self, path):
+        """Return the own_first_seen of the aggregate record that covered a directory when the user was
+        last scanned in DIRECTORY_MODE, or None if there is not one.  When a user is changed back to
+        FILE_MODE, this is used as the first_seen of the files, so that they keep their age.
+           :var string path: path to the directory AFTER the CacheDisk mountpoint
+        """
+        path = os.path.normpath(path)
+        cd = self.records.get(path)
+        if cd is not None and cd.aggregate:
+            return cd.own_first_seen
+        while path != self.root_path and os.sep in path:
+            path = os.path.dirname(path)
+            cd = self.records.get(path)
+            if cd is not None and cd.aggregate and cd.subtree:
+                return cd.own_first_seen
+        return None
+
+    def depth(self, path):
+        """Depth of the directory below the user's root directory."""
+        if path == self.root_path:
+            return 0
+        return os.path.relpath(path, self.root_path).count(os.sep) + 1
+
+    def totals(self):
+        """Return the recursive totals for each directory, as a dictionary keyed on the path,
+        with each value being [size, n_files, quota_used, first_seen, age].
+        """
+        totals = {path: list(entry) for path, entry in self.directories.items()}
+        # add each directory into its parent, deepest directories first
+        for path in sorted(totals, key=self.depth, reverse=True):
+            if path == self.root_path:
+                continue
+            entry = totals[path]
+            parent = totals[os.path.dirname(path)]
+            parent[0] += entry[0]
+            parent[1] += entry[1]
+            parent[2] += entry[2]
+            parent[4] += entry[4]
+            if entry[3] is not None and (parent[3] is None or entry[3] < parent[3]):
+                parent[3] = entry[3]
+        return totals
+
+
+def update_directory_tree(user, tree):
+    """Update the CachedDirectory entries for the user from the DirectoryTree built during the scan.
+    New directories are created, changed directories are updated and directories that no longer
+    exist are deleted.  The own_ totals are stored for each directory, with the aggregate and subtree
+    flags set if the tree was built in DIRECTORY_MODE.
+
+       :var xfc_control.models.User user: instance of User to update
+       :var DirectoryTree tree: the directory tree built during the scan
+    """
+    totals = tree.totals()
+    if tree.user is not None:
+        existing = tree.records
+    else:
+        existing = {cd.path: cd for cd in CachedDirectory.objects.filter(user=user)}
+
+    # remove the directories that no longer exist - this also removes any CachedFiles left in them
+    removed = [cd.pk for path, cd in existing.items() if path not in totals]
+    if len(removed) != 0:
+        CachedDirectory.objects.filter(pk__in=removed).delete()
+        ROWS_WRITTEN.inc(len(removed), process="xfc_scan", model="CachedDirectory", operation="delete")
+    existing = {path: cd for path, cd in existing.items() if path in totals}
+
+    # update the existing directories, and create the new directories one level at a time so
+    # that the parent directory exists when the child directory is created
+    fields = ["size", "n_files", "quota_used", "first_seen",
+              "own_size", "own_files", "own_first_seen", "aggregate", "subtree"]
+    updated = []
+    levels = {}
+    for path, (size, n_files, quota_used, first_seen, age) in totals.items():
+        own = tree.directories[path]
+        depth = tree.depth(path)
+        values = (size, n_files, quota_used, first_seen, own[0], own[1], tree.own_first_seen(path),
+                  tree.aggregate, tree.aggregate and depth == tree.scan_depth)
+        if path in existing:
+            cd = existing[path]
+            if tuple(getattr(cd, f) for f in fields) != values:
+                for f, v in zip(fields, values):
+                    setattr(cd, f, v)
+                updated.append(cd)
+        else:
+            cd = CachedDirectory(user=user, path=path, path_hash=CachedDirectory.hash_path(path), depth=depth)
+            for f, v in zip(fields, values):
+                setattr(cd, f, v)
+            levels.setdefault(depth, []).append(cd)
+
+    if len(updated) != 0:
+        CachedDirectory.objects.bulk_update(updated, fields, batch_size=1000)
+        ROWS_WRITTEN.inc(len(updated), process="xfc_scan", model="CachedDirectory", operation="update")
+
+    for depth in sorted(levels):
+        for cd in levels[depth]:
+            if depth != 0:
+                cd.parent = existing[os.path.dirname(cd.path)]
+        CachedDirectory.objects.bulk_create(levels[depth], batch_size=1000)
+        ROWS_WRITTEN.inc(len(levels[depth]), process="xfc_scan", model="CachedDirectory", operation="create")
+        for cd in levels[depth]:
+            existing[cd.path] = cd
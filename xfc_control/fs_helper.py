@@ -0,0 +1,262 @@
+#!/usr/bin/python3 -I
+"""Helper to carry out privileged filesystem operations (mkdir, chown and chmod) in batches.
+
+Rather than forking ``/usr/bin/sudo /bin/mkdir`` and ``/usr/bin/sudo /bin/chown`` for every
+directory, a single helper process is started with sudo and kept running.  Batches of operations
+are sent to it over a pipe, one JSON list per line, and it carries them out with direct system
+calls, replying with one JSON list of results per batch.
+
+This module is installed, owned by root, as a fixed executable (``XFC_FS_HELPER_PATH``), so that the
+code run as root cannot be chosen by the caller::
+
+    install -o root -g root -m 0755 xfc_control/fs_helper.py /usr/local/sbin/xfc_fs_helper
+
+and the helper process is run as::
+
+    /usr/bin/sudo -n /usr/local/sbin/xfc_fs_helper
+
+with a sudoers entry that allows it to be run with no arguments::
+
+    xfc ALL=(root) NOPASSWD: /usr/local/sbin/xfc_fs_helper ""
+
+The directories that the helper may operate below (the CacheDisk mountpoints) are read from CONFIG_FILE,
+``{"roots": ["/path/to/cache_disk", ...]}``, rather than from the command line.  The file must be owned
+by root and not writable by anyone else, and the helper refuses to start if it is not, or if it gives no
+roots.  The helper is run with ``python -I``, so that it does not import modules from the current
+directory or the environment.
+
+In non-privileged mode (``XFC_FS_HELPER = "local"`` in the settings) the operations are carried
+out in the calling process, which is used for testing and development.
+
+This module must not import Django, so that the helper process starts quickly.
+"""
+
+import json
+import os
+import subprocess
+import sys
+import threading
+
+# root-owned file with the directories the privileged helper may operate below
+CONFIG_FILE = "/etc/xfc_control/fs_helper.json"
+# path that the privileged helper is installed at, if the XFC_FS_HELPER_PATH setting is not set
+HELPER_PATH = "/usr/local/sbin/xfc_fs_helper"
+
+
+def _check_path(path, roots):
+    """Check that the path is absolute and, if roots are given, that it is below one of them."""
+    if not os.path.isabs(path):
+        raise ValueError("Path is not absolute: {}".format(path))
+    path = os.path.normpath(path)
+    if roots and not any(path == r or path.startswith(r.rstrip("/") + "/") for r in roots):
+        raise ValueError("Path is not below an allowed root: {}".format(path))
+    return path
+
+
+def _chown_tree(path, uid, gid):
+    """Change the owner of a directory and everything below it, without following links."""
+    os.lchown(path, uid, gid)
+    for root, dirs, files in os.walk(path):
+        for name in dirs + files:
+            os.lchown(os.path.join(root, name), uid, gid)
+
+
+def apply_operations(operations, roots=None):
+    """Carry out a batch of filesystem operations.  Each operation is a dictionary, one of:
+
+        - ``{"op": "mkdir", "path": path, "mode": mode}``
+        - ``{"op": "chown", "path": path, "uid": uid, "gid": gid, "recursive": False}``
+        - ``{"op": "chmod", "path": path, "mode": mode}``
+
+    A failed operation does not stop the rest of the batch.
+
+       :var List[Dictionary] operations: the operations to carry out
+       :var List[string] roots: (*optional*) directories that the paths must be below
+       :return: list of error strings, one per operation, with None for operations that succeeded
+    """
+    results = []
+    for operation in operations:
+        try:
+            path = _check_path(operation["path"], roots)
+            op = operation["op"]
+            if op == "mkdir":
+                os.makedirs(path, exist_ok=True)
+                # makedirs applies the umask to the mode, so set it explicitly
+                os.chmod(path, operation["mode"])
+            elif op == "chown":
+                if operation.get("recursive", False):
+                    _chown_tree(path, operation["uid"], operation["gid"])
+                else:
+                    os.lchown(path, operation["uid"], operation["gid"])
+            elif op == "chmod":
+                os.chmod(path, operation["mode"])
+            else:
+                raise ValueError("Unknown operation: {}".format(op))
+        except Exception as e:
+            results.append(str(e))
+        else:
+            results.append(None)
+    return results
+
+
+def read_roots(config_file=CONFIG_FILE):
+    """Read the directories that the privileged helper may operate below from its config file, which must
+    be owned by root and not writable by group or others.
+       :var string config_file: path of the config file
+       :return: list of the roots
+    """
+    st = os.stat(config_file)
+    if st.st_uid != 0 or st.st_mode & 0o022:
+        raise ValueError("{} must be owned by root and not writable by others".format(config_file))
+    with open(config_file) as fh:
+        roots = json.load(fh).get("roots", [])
+    if not roots or not all(isinstance(r, str) and os.path.isabs(r) for r in roots):
+        raise ValueError("{} must give a list of absolute roots".format(config_file))
+    return [os.path.normpath(r) for r in roots]
+
+
+def serve(infile, outfile, roots=None):
+    """Read batches of operations from infile, one JSON list per line, and write the results to
+    outfile, one JSON list per line.  Returns when infile is closed."""
+    for line in infile:
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            results = apply_operations(json.loads(line), roots)
+        except Exception as e:
+            results = {"error": str(e)}
+        outfile.write(json.dumps(results) + "\n")
+        outfile.flush()
+
+
+class FileSystemHelper(object):
+    """Client for the privileged helper.  Operations are queued with mkdir, chown and chmod and
+    sent to the helper in one batch when flush is called."""
+
+    def __init__(self, privileged=True, roots=None, sudo="/usr/bin/sudo", helper_path=HELPER_PATH):
+        """:var bool privileged: run the operations in a helper process started with sudo, or
+                                  in this process if False
+           :var List[string] roots: (*optional*) directories that the operations may be below, when they
+                                    are carried out in this process.  The privileged helper reads its
+                                    roots from CONFIG_FILE
+           :var string sudo: path to the sudo executable
+           :var string helper_path: path that the privileged helper is installed at
+        """
+        self.privileged = privileged
+        self.roots = roots if roots else []
+        self.sudo = sudo
+        self.helper_path = helper_path
+        self.operations = []
+        self.process = None
+        # the helper is shared by the threads of the process, so the queue is only changed under the lock
+        self.lock = threading.Lock()
+
+    def _queue(self, operation):
+        with self.lock:
+            self.operations.append(operation)
+
+    def mkdir(self, path, mode=0o755):
+        """Queue the creation of a directory (and its parents), with the permissions set to mode."""
+        self._queue({"op": "mkdir", "path": path, "mode": mode})
+
+    def chown(self, path, uid, gid, recursive=False):
+        """Queue a change of owner of a path, and everything below it if recursive is True."""
+        self._queue({"op": "chown", "path": path, "uid": uid, "gid": gid, "recursive": recursive})
+
+    def chmod(self, path, mode):
+        """Queue a change of the permissions of a path."""
+        self._queue({"op": "chmod", "path": path, "mode": mode})
+
+    def _start(self):
+        # no arguments - the helper reads its roots from its own root-owned config
+        command = [self.sudo, "-n", self.helper_path]
+        self.process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                        universal_newlines=True, bufsize=1)
+
+    def _send(self, operations):
+        if self.process is None or self.process.poll() is not None:
+            self._start()
+        try:
+            self.process.stdin.write(json.dumps(operations) + "\n")
+            self.process.stdin.flush()
+            line = self.process.stdout.readline()
+        except (IOError, OSError) as e:
+            self.close()
+            raise Exception("Privileged filesystem helper failed: {}".format(e))
+        if not line:
+            self.close()
+            raise Exception("Privileged filesystem helper exited unexpectedly")
+        results = json.loads(line)
+        if isinstance(results, dict):
+            raise Exception("Privileged filesystem helper failed: {}".format(results["error"]))
+        return results
+
+    def flush(self):
+        """Send the queued operations to the helper and wait for them to complete.
+           :return: list of (operation, error) for the operations that failed
+        """
+        with self.lock:
+            operations = self.operations
+            self.operations = []
+            if len(operations) == 0:
+                return []
+            if self.privileged:
+                results = self._send(operations)
+            else:
+                results = apply_operations(operations, self.roots)
+        return [(op, error) for op, error in zip(operations, results) if error is not None]
+
+    def close(self):
+        """Stop the helper process."""
+        if self.process is not None:
+            try:
+                self.process.stdin.close()
+                self.process.wait(timeout=10)
+            except Exception:
+                self.process.kill()
+            self.process = None
+
+
+_helper = None
+_helper_lock = threading.Lock()
+
+
+def get_fs_helper():
+    """Get the shared FileSystemHelper, created from the settings on first use:
+
+        - ``XFC_FS_HELPER``: ``"sudo"`` (the default) to use the privileged helper process, or
+          ``"local"`` to carry out the operations in this process
+        - ``XFC_FS_HELPER_PATH``: (*optional*) path that the privileged helper is installed at
+        - ``XFC_FS_HELPER_ROOTS``: (*optional*) directories that the operations may be below in
+          ``"local"`` mode
+    """
+    global _helper
+    with _helper_lock:
+        if _helper is None:
+            import xfc_site.settings as settings
+            _helper = FileSystemHelper(
+                privileged=(getattr(settings, "XFC_FS_HELPER", "sudo") != "local"),
+                roots=getattr(settings, "XFC_FS_HELPER_ROOTS", None),
+                helper_path=getattr(settings, "XFC_FS_HELPER_PATH", HELPER_PATH),
+            )
+        return _helper
+
+
+def set_fs_helper(helper):
+    """Replace the shared FileSystemHelper."""
+    global _helper
+    with _helper_lock:
+        if _helper is not None and _helper is not helper:
+            _helper.close()
+        _helper = helper
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        sys.exit("xfc_fs_helper takes no arguments - the roots are read from " + CONFIG_FILE)
+    try:
+        allowed_roots = read_roots()
+    except (OSError, ValueError) as e:
+        sys.exit("xfc_fs_helper: {}".format(e))
+    serve(sys.stdin, sys.stdout, roots=allowed_roots)
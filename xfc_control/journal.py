@@ -0,0 +1,157 @@
+"""Append-only journal of the changes found by xfc_scan, and the checkpoints of its consumers.
+
+Each pass of xfc_scan over a user's cache area is recorded as a ScanPass, and every file (or, in
+DIRECTORY_MODE, every directory total) that is added, changes size or is removed is recorded as a
+ScanJournalEntry, whose id is its sequence number.  The files deleted by xfc_delete are recorded as
+REMOVE entries without a ScanPass.
+
+Consumers of the journal (quota history, notifications, ...) keep the sequence number of the last
+entry they have processed in a JournalCheckpoint, and read the entries after it::
+
+    entries = tail("quota_history")
+    for entry in entries:
+        ...
+    if entries:
+        commit("quota_history", entries[-1].id)
+
+so that the work they do is proportional to the number of changes, rather than the number of files.
+
+The entries are written in batches, each in a transaction that holds a lock on a single row, so that
+the batches are committed in the order of their sequence numbers - a consumer can never read an entry
+and later find that an entry with a lower sequence number has been committed.
+"""
+
+import datetime
+
+from django.db import transaction
+from django.db.models import Min
+
+from xfc_control.models import ScanPass, ScanJournalEntry, JournalCheckpoint
+
+# name of the JournalCheckpoint row that is locked while entries are written
+WRITER_LOCK = "__journal_writer__"
+
+
+class ScanJournal(object):
+    """Writer of the journal entries for one pass of xfc_scan (or one run of xfc_delete) for a user.
+    The entries are buffered and written in batches."""
+
+    def __init__(self, user, scan_pass=None, batch_size=10000):
+        """:var xfc_control.models.User user: the user whose files are being scanned
+           :var xfc_control.models.ScanPass scan_pass: (*optional*) the ScanPass the entries belong to
+           :var int batch_size: number of entries to buffer before they are written
+        """
+        self.user = user
+        self.scan_pass = scan_pass
+        self.batch_size = batch_size
+        self.entries = []
+
+    @staticmethod
+    def start(user, scan_mode, batch_size=10000):
+        """Start a ScanPass for a user and return the journal for it.
+           :var xfc_control.models.User user: the user being scanned
+           :var string scan_mode: the scan mode being used
+        """
+        scan_pass = ScanPass.objects.create(user=user, scan_mode=scan_mode, started=datetime.datetime.utcnow())
+        return ScanJournal(user, scan_pass, batch_size)
+
+    def _append(self, event, path, size, old_size, aggregate):
+        self.entries.append(ScanJournalEntry(
+            scan_pass=self.scan_pass, user=self.user, event=event, path=path, aggregate=aggregate,
+            size=size, old_size=old_size, time=datetime.datetime.utcnow()
+        ))
+        if self.scan_pass is not None:
+            if event == ScanJournalEntry.ADD:
+                self.scan_pass.n_added += 1
+            elif event == ScanJournalEntry.RESIZE:
+                self.scan_pass.n_resized += 1
+            else:
+                self.scan_pass.n_removed += 1
+            if size > old_size:
+                self.scan_pass.bytes_added += size - old_size
+            else:
+                self.scan_pass.bytes_removed += old_size - size
+        if len(self.entries) >= self.batch_size:
+            self.flush()
+
+    def add(self, path, size, aggregate=False):
+        """Record a file that has been added.
+           :var string path: path to the file AFTER the CacheDisk mountpoint
+           :var int size: size of the file
+           :var bool aggregate: the path is a directory total rather than a file
+        """
+        self._append(ScanJournalEntry.ADD, path, size, 0, aggregate)
+
+    def resize(self, path, old_size, size, aggregate=False):
+        """Record a file that has changed size."""
+        self._append(ScanJournalEntry.RESIZE, path, size, old_size, aggregate)
+
+    def remove(self, path, old_size, aggregate=False):
+        """Record a file that has been removed."""
+        self._append(ScanJournalEntry.REMOVE, path, 0, old_size, aggregate)
+
+    def flush(self):
+        """Write the buffered entries."""
+        if len(self.entries) == 0:
+            return
+        JournalCheckpoint.objects.get_or_create(consumer=WRITER_LOCK)
+        with transaction.atomic():
+            # hold the lock until the entries are committed, so that entries are committed in
+            # the order of their sequence numbers
+            JournalCheckpoint.objects.select_for_update().get(consumer=WRITER_LOCK)
+            ScanJournalEntry.objects.bulk_create(self.entries, batch_size=1000)
+        self.entries = []
+
+    def finish(self, n_files=0, total_size=0):
+        """Write the remaining entries and mark the ScanPass as finished.
+           :var int n_files: number of files found by the pass
+           :var int total_size: total size of the files found by the pass
+        """
+        self.flush()
+        if self.scan_pass is not None:
+            self.scan_pass.n_files = n_files
+            self.scan_pass.total_size = total_size
+            self.scan_pass.finished = datetime.datetime.utcnow()
+            self.scan_pass.save()
+
+
+def checkpoint(consumer):
+    """Return the sequence number of the last entry processed by a consumer (0 if it has not
+    processed any)."""
+    try:
+        return JournalCheckpoint.objects.get(consumer=consumer).sequence
+    except JournalCheckpoint.DoesNotExist:
+        return 0
+
+
+def tail(consumer, limit=1000, user=None):
+    """Return the journal entries after the consumer's checkpoint, in sequence order.
+       :var string consumer: name of the consumer
+       :var int limit: maximum number of entries to return
+       :var xfc_control.models.User user: (*optional*) only return the entries for this user
+       :return: list of ScanJournalEntry
+    """
+    entries = ScanJournalEntry.objects.filter(id__gt=checkpoint(consumer))
+    if user is not None:
+        entries = entries.filter(user=user)
+    return list(entries.select_related("user").order_by("id")[:limit])
+
+
+def commit(consumer, sequence):
+    """Commit the consumer's checkpoint, after it has processed the entries up to sequence."""
+    if consumer == WRITER_LOCK:
+        raise Exception("Reserved journal consumer name: {}".format(consumer))
+    JournalCheckpoint.objects.update_or_create(
+        consumer=consumer, defaults={"sequence": sequence, "updated": datetime.datetime.utcnow()}
+    )
+
+
+def prune():
+    """Delete the entries that have been processed by every consumer.
+       :return: number of entries deleted
+    """
+    sequence = JournalCheckpoint.objects.exclude(consumer=WRITER_LOCK).aggregate(Min("sequence"))["sequence__min"]
+    if sequence is None:
+        return 0
+    deleted, _ = ScanJournalEntry.objects.filter(id__lte=sequence).delete()
+    return deleted
@@ -0,0 +1,230 @@
+"""Look up the numeric uid and gid (and the email address) of JASMIN users on the LDAP server.
+
+Connections to the LDAP server are kept in a pool and reused between lookups, and the results
+are kept in an in-process cache for ``XFC_LDAP_CACHE_TTL`` seconds, so that initialising many
+users does not create a new connection and query for every user.  Many users can be looked up
+at once with :func:`lookup_users`.
+
+The backend can be replaced (for example with a :class:`FakeLDAPBackend` in tests) by calling
+:func:`set_ldap_backend`.
+"""
+
+import threading
+import time
+import queue
+from collections import namedtuple
+
+from jasmin_ldap.core import *
+from jasmin_ldap.query import *
+
+import xfc_site.settings as settings
+
+# the details of a user returned from LDAP.  uid and gid will be None if the uidNumber or
+# gidNumber were not in the returned LDAP entry
+LDAPUser = namedtuple("LDAPUser", ["name", "uid", "gid", "email"])
+
+
+class LDAPBackend(object):
+    """Look up users on the LDAP server(s), using a pool of reusable connections."""
+
+    def __init__(self, primary, replicas, base_dn, pool_size=4):
+        """:var string primary: the primary LDAP server
+           :var List[string] replicas: the replica LDAP servers
+           :var string base_dn: the base dn to search for users under
+           :var int pool_size: the maximum number of open connections
+        """
+        self.servers = ServerPool(primary, replicas)
+        self.base_dn = base_dn
+        self.pool_size = pool_size
+        self.pool = queue.LifoQueue()
+        self.n_connections = 0
+        self.lock = threading.Lock()
+
+    def get_connection(self):
+        """Get a connection from the pool, creating one if the pool is not yet full."""
+        try:
+            return self.pool.get_nowait()
+        except queue.Empty:
+            pass
+        with self.lock:
+            if self.n_connections < self.pool_size:
+                self.n_connections += 1
+                create = True
+            else:
+                create = False
+        if not create:
+            # wait for another thread to return its connection
+            return self.pool.get()
+        try:
+            return Connection.create(self.servers)
+        except:
+            with self.lock:
+                self.n_connections -= 1
+            raise
+
+    def release_connection(self, conn):
+        """Return a connection to the pool."""
+        self.pool.put(conn)
+
+    def discard_connection(self, conn):
+        """Close a connection that has failed, rather than returning it to the pool."""
+        with self.lock:
+            self.n_connections -= 1
+        try:
+            conn.close()
+        except:
+            pass
+
+    def close(self):
+        """Close all the connections in the pool."""
+        while True:
+            try:
+                conn = self.pool.get_nowait()
+            except queue.Empty:
+                break
+            self.discard_connection(conn)
+
+    def search(self, usernames):
+        """Look up a list of users in a single query.  Users not found in LDAP are not returned.
+           :var List[string] usernames: the names of the users to look up
+           :return: dictionary of LDAPUser, keyed on the user name
+        """
+        # a pooled connection may have been closed by the server since it was last used, so
+        # retry once with a new connection
+        for attempt in range(2):
+            conn = self.get_connection()
+            try:
+                query = Query(conn, base_dn=self.base_dn).filter(uid__in=list(usernames))
+                records = list(query)
+            except:
+                self.discard_connection(conn)
+                if attempt == 1:
+                    raise
+            else:
+                self.release_connection(conn)
+                break
+
+        users = {}
+        for q in records:
+            if "uid" not in q:
+                continue
+            name = str(q["uid"][0])
+            users[name] = LDAPUser(
+                name=name,
+                uid=int(q["uidNumber"][0]) if "uidNumber" in q else None,
+                gid=int(q["gidNumber"][0]) if "gidNumber" in q else None,
+                email=str(q["mail"][0]) if "mail" in q else "",
+            )
+        return users
+
+
+class FakeLDAPBackend(object):
+    """Backend that looks up users in a dictionary, rather than on the LDAP server.  Used for
+    testing and development."""
+
+    def __init__(self, users=None):
+        """:var Dict[string, LDAPUser] users: the users that can be found, keyed on the user name
+        """
+        if users is None:
+            users = {}
+        self.users = users
+        self.n_searches = 0
+
+    def add_user(self, name, uid, gid, email=""):
+        self.users[name] = LDAPUser(name=name, uid=uid, gid=gid, email=email)
+
+    def search(self, usernames):
+        self.n_searches += 1
+        return {name: self.users[name] for name in usernames if name in self.users}
+
+    def close(self):
+        pass
+
+
+class LDAPUserCache(object):
+    """In-process cache of LDAPUser, where each entry expires after ttl seconds."""
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.entries = {}
+        self.lock = threading.Lock()
+
+    def get(self, name):
+        """Return the cached LDAPUser, or None if it is not cached or has expired."""
+        with self.lock:
+            entry = self.entries.get(name)
+            if entry is None:
+                return None
+            if entry[0] < time.monotonic():
+                del self.entries[name]
+                return None
+            return entry[1]
+
+    def put(self, ldap_user):
+        with self.lock:
+            self.entries[ldap_user.name] = (time.monotonic() + self.ttl, ldap_user)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+_backend = None
+_backend_lock = threading.Lock()
+_cache = LDAPUserCache(getattr(settings, "XFC_LDAP_CACHE_TTL", 600))
+
+
+def get_ldap_backend():
+    """Get the shared LDAP backend, creating it from the settings on first use."""
+    global _backend
+    with _backend_lock:
+        if _backend is None:
+            _backend = LDAPBackend(settings.XFC_LDAP_PRIMARY, settings.XFC_LDAP_REPLICAS,
+                                   settings.XFC_LDAP_BASE_USER,
+                                   pool_size=getattr(settings, "XFC_LDAP_POOL_SIZE", 4))
+        return _backend
+
+
+def set_ldap_backend(backend):
+    """Replace the shared LDAP backend, and empty the cache.
+       :var backend: LDAPBackend or FakeLDAPBackend to use for lookups
+    """
+    global _backend
+    with _backend_lock:
+        if _backend is not None and _backend is not backend:
+            _backend.close()
+        _backend = backend
+    _cache.clear()
+
+
+def lookup_users(usernames, batch_size=100):
+    """Look up many users at once, using the cache where possible and querying LDAP for the
+    remaining users in batches.
+       :var List[string] usernames: the names of the users to look up
+       :var int batch_size: maximum number of users to look up in a single LDAP query
+       :return: dictionary of LDAPUser, keyed on the user name.  Users not found in LDAP are not returned.
+    """
+    users = {}
+    missing = []
+    for name in usernames:
+        ldap_user = _cache.get(name)
+        if ldap_user is None:
+            missing.append(name)
+        else:
+            users[name] = ldap_user
+
+    backend = get_ldap_backend()
+    for b in range(0, len(missing), batch_size):
+        found = backend.search(missing[b:b+batch_size])
+        for name, ldap_user in found.items():
+            _cache.put(ldap_user)
+            users[name] = ldap_user
+    return users
+
+
+def lookup_user(username):
+    """Look up a single user.
+       :var string username: the name of the user to look up
+       :return: LDAPUser, or None if the user was not found in LDAP
+    """
+    return lookup_users([username]).get(username)
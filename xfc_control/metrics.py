@@ -0,0 +1,303 @@
+"""Counters and histograms of the work done by the xfc daemons and the REST API, in the Prometheus
+text exposition format.
+
+The metrics are held in the memory of each process:
+
+    - the REST API serves the metrics of the web server process at ``/xfc_control/metrics``.  As the
+      metrics are not shared between processes, the REST API must be served by a single process (with
+      threads for concurrency, e.g. ``gunicorn --workers 1 --threads 8``, or mod_wsgi daemon mode with
+      ``processes=1``) for the endpoint to report every request.  With more than one worker process,
+      each scrape returns the counters of whichever worker served it, so the counters undercount and
+      appear to go backwards between scrapes.
+    - the daemons (xfc_scan, xfc_schedule, xfc_delete, ...) write their metrics to
+      ``<XFC_METRICS_DIR>/<process>.prom`` after each run (if the XFC_METRICS_DIR setting is set),
+      which can be read by the node_exporter textfile collector
+
+The metrics are defined in this module, so that the names and labels are in one place::
+
+    FILES_WALKED.inc(len(files), mode="file")
+    with PHASE_DURATION.time(process="xfc_scan", phase="walk"):
+        ...
+
+Label values should come from a small set (process, phase, view) - user names and paths should not
+be used as labels, as each combination of label values is a separate time series.
+"""
+
+import functools
+import math
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from django.db import connection
+
+import xfc_site.settings as settings
+
+# buckets for request latencies (seconds)
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# buckets for the durations of the phases of the daemons (seconds)
+DURATION_BUCKETS = (0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0, 300.0, 900.0, 1800.0, 3600.0, 7200.0, 21600.0)
+# buckets for the number of database queries
+QUERY_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+
+def _format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=None):
+    pairs = list(zip(names, values))
+    if extra is not None:
+        pairs.append(extra)
+    if len(pairs) == 0:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(n, _escape(v)) for n, v in pairs) + "}"
+
+
+class Metric(object):
+    """Base class of the metrics, holding a value for each combination of label values."""
+
+    type = None
+
+    def __init__(self, name, documentation, labelnames=(), registry=None):
+        """:var string name: name of the metric
+           :var string documentation: description of the metric, for the HELP line
+           :var tuple labelnames: names of the labels of the metric
+           :var Registry registry: (*optional*) registry to add the metric to, defaults to REGISTRY
+        """
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        if registry is None:
+            registry = REGISTRY
+        registry.register(self)
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError("Metric {} has labels {}, not {}".format(
+                self.name, self.labelnames, tuple(labels)))
+        return tuple(str(labels[n]) for n in self.labelnames)
+
+    def samples(self):
+        """Return the samples of the metric, as a list of (suffix, label values, extra label, value)."""
+        raise NotImplementedError
+
+    def render(self):
+        """Return the metric in the text exposition format."""
+        lines = ["# HELP {} {}".format(self.name, self.documentation),
+                 "# TYPE {} {}".format(self.name, self.type)]
+        for suffix, values, extra, value in self.samples():
+            lines.append("{}{}{} {}".format(self.name, suffix, _format_labels(self.labelnames, values, extra),
+                                           _format_value(value)))
+        return "\n".join(lines) + "\n"
+
+    def clear(self):
+        with self._lock:
+            self._values = {}
+
+
+class Counter(Metric):
+    """A value that only increases, e.g. the number of files walked."""
+
+    type = "counter"
+
+    def inc(self, amount=1, **labels):
+        """Add amount to the counter for the label values."""
+        if amount < 0:
+            raise ValueError("Counters can only increase")
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def get(self, **labels):
+        return self._values.get(self._key(labels), 0)
+
+    def samples(self):
+        with self._lock:
+            return [("", key, None, value) for key, value in sorted(self._values.items())]
+
+
+class Gauge(Metric):
+    """A value that can go up and down, e.g. the time of the last run."""
+
+    type = "gauge"
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def set_to_current_time(self, **labels):
+        self.set(time.time(), **labels)
+
+    def get(self, **labels):
+        return self._values.get(self._key(labels), 0)
+
+    def samples(self):
+        with self._lock:
+            return [("", key, None, value) for key, value in sorted(self._values.items())]
+
+
+class Histogram(Metric):
+    """Distribution of observed values in cumulative buckets, e.g. request latencies."""
+
+    type = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS, registry=None):
+        """:var tuple buckets: upper bounds of the buckets - a +Inf bucket is always added"""
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        super(Histogram, self).__init__(name, documentation, labelnames, registry)
+
+    def observe(self, value, **labels):
+        """Add an observed value to the histogram for the label values."""
+        key = self._key(labels)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                # count in each bucket, sum, count
+                entry = [[0] * len(self.buckets), 0.0, 0]
+                self._values[key] = entry
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry[0][i] += 1
+                    break
+            entry[1] += value
+            entry[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """Context manager that observes the time taken by the block, in seconds."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def get(self, **labels):
+        """Return (sum, count) for the label values."""
+        entry = self._values.get(self._key(labels))
+        if entry is None:
+            return 0.0, 0
+        return entry[1], entry[2]
+
+    def samples(self):
+        samples = []
+        with self._lock:
+            for key, (counts, total, count) in sorted(self._values.items()):
+                cumulative = 0
+                for bound, n in zip(self.buckets, counts):
+                    cumulative += n
+                    samples.append(("_bucket", key, ("le", _format_value(bound)), cumulative))
+                samples.append(("_sum", key, None, total))
+                samples.append(("_count", key, None, count))
+        return samples
+
+
+class Registry(object):
+    """Collection of metrics that are rendered together."""
+
+    def __init__(self):
+        self.metrics = {}
+
+    def register(self, metric):
+        if metric.name in self.metrics:
+            raise ValueError("Metric already registered: {}".format(metric.name))
+        self.metrics[metric.name] = metric
+
+    def render(self):
+        """Return all the metrics in the text exposition format."""
+        return "".join(self.metrics[name].render() for name in sorted(self.metrics))
+
+    def clear(self):
+        for metric in self.metrics.values():
+            metric.clear()
+
+
+REGISTRY = Registry()
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# daemons
+FILES_WALKED = Counter("xfc_scan_files_walked_total", "Number of files found by xfc_scan", ["mode"])
+STAT_ERRORS = Counter("xfc_stat_errors_total", "Number of files that could not be stat-ed", ["process"])
+ROWS_WRITTEN = Counter("xfc_db_rows_written_total", "Number of database rows created, updated or deleted",
+                       ["process", "model", "operation"])
+PHASE_DURATION = Histogram("xfc_phase_duration_seconds", "Duration of each phase of a daemon, for one user",
+                           ["process", "phase"], buckets=DURATION_BUCKETS)
+USER_DURATION = Histogram("xfc_user_duration_seconds", "Duration of all the phases of a daemon, for one user",
+                          ["process"], buckets=DURATION_BUCKETS)
+LOCK_WAIT = Histogram("xfc_user_lock_wait_seconds", "Time taken to check and take the lock on a user",
+                      ["process"])
+USERS_LOCKED = Counter("xfc_users_skipped_locked_total", "Number of users skipped as they were locked",
+                       ["process"])
+LAST_RUN = Gauge("xfc_last_run_timestamp_seconds", "Time the last run of a daemon finished", ["process"])
+
+# REST API
+REQUEST_LATENCY = Histogram("xfc_http_request_duration_seconds", "Latency of the REST API requests",
+                            ["view", "method"])
+REQUEST_QUERIES = Histogram("xfc_http_request_queries", "Number of database queries run by each REST API request",
+                            ["view", "method"], buckets=QUERY_BUCKETS)
+REQUESTS = Counter("xfc_http_requests_total", "Number of REST API requests", ["view", "method", "status"])
+
+
+def write_textfile(path, registry=REGISTRY):
+    """Write the metrics to a file, through a temporary file that is renamed so that a partly written
+    file is never read."""
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as fh:
+        fh.write(registry.render())
+    os.replace(tmp_path, path)
+
+
+def write_process_metrics(process):
+    """Record the end of a run of a daemon, and write its metrics to ``<XFC_METRICS_DIR>/<process>.prom``
+    if the XFC_METRICS_DIR setting is set.
+       :var string process: name of the daemon
+    """
+    LAST_RUN.set_to_current_time(process=process)
+    metrics_dir = getattr(settings, "XFC_METRICS_DIR", None)
+    if metrics_dir:
+        write_textfile(os.path.join(metrics_dir, process + ".prom"))
+
+
+def instrument_view(name):
+    """Decorator for a view (or the result of ``View.as_view()``) that records the latency, the number
+    of database queries and the status of each request.
+       :var string name: name of the view, for the view label
+    """
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(request, *args, **kwargs):
+            queries = [0]
+
+            def count_query(execute, sql, params, many, context):
+                queries[0] += 1
+                return execute(sql, params, many, context)
+
+            start = time.perf_counter()
+            status = 500
+            try:
+                with connection.execute_wrapper(count_query):
+                    response = view(request, *args, **kwargs)
+                status = response.status_code
+                return response
+            finally:
+                REQUEST_LATENCY.observe(time.perf_counter() - start, view=name, method=request.method)
+                REQUEST_QUERIES.observe(queries[0], view=name, method=request.method)
+                REQUESTS.inc(view=name, method=request.method, status=status)
+        return wrapper
+    return decorator
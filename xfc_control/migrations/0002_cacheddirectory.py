@@ -0,0 +1,29 @@
+# Generated by Django 6.0.6 on 2026-10-18 22:07
+
+import django.db.models.deletion
+import sizefield.models
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('xfc_control', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CachedDirectory',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('path', models.CharField(help_text='Relative path to the directory', max_length=2024)),
+                ('depth', models.IntegerField(default=0, help_text="Depth of the directory below the user's cache area")),
+                ('size', sizefield.models.FileSizeField(default=0, help_text='Total size of the files in the directory and its subdirectories')),
+                ('n_files', models.BigIntegerField(default=0, help_text='Number of files in the directory and its subdirectories')),
+                ('quota_used', sizefield.models.FileSizeField(default=0, help_text='Quota used by the directory and its subdirectories, in (bytes day)')),
+                ('first_seen', models.DateTimeField(blank=True, help_text='Date the oldest file in the directory was first scanned', null=True)),
+                ('parent', models.ForeignKey(blank=True, help_text='Directory containing this directory', null=True, on_delete=django.db.models.deletion.CASCADE, related_name='children', to='xfc_control.cacheddirectory')),
+                ('user', models.ForeignKey(help_text='User that owns the directory', on_delete=django.db.models.deletion.CASCADE, to='xfc_control.user')),
+            ],
+        ),
+    ]
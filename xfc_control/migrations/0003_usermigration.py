@@ -0,0 +1,35 @@
+# Generated by Django 6.0.6 on 2026-10-18 22:10
+
+import django.db.models.deletion
+import sizefield.models
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('xfc_control', '0002_cacheddirectory'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='cachedisk',
+            name='retiring',
+            field=models.BooleanField(default=False, help_text='No new users will be placed on the disk, and existing users will be moved off it by xfc_rebalance'),
+        ),
+        migrations.CreateModel(
+            name='UserMigration',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('state', models.CharField(choices=[('copying', 'Copying'), ('done', 'Done')], default='copying', help_text='State of the move', max_length=16)),
+                ('files_copied', models.BigIntegerField(default=0, help_text='Number of files copied so far')),
+                ('bytes_copied', sizefield.models.FileSizeField(default=0, help_text='Number of bytes copied so far')),
+                ('started', models.DateTimeField(blank=True, help_text='Time the move was started', null=True)),
+                ('finished', models.DateTimeField(blank=True, help_text='Time the move was finished', null=True)),
+                ('error', models.TextField(blank=True, default='', help_text='Error that stopped the move')),
+                ('source_disk', models.ForeignKey(help_text='Cache disk the user is being moved from', on_delete=django.db.models.deletion.CASCADE, related_name='migrations_from', to='xfc_control.cachedisk')),
+                ('target_disk', models.ForeignKey(help_text='Cache disk the user is being moved to', on_delete=django.db.models.deletion.CASCADE, related_name='migrations_to', to='xfc_control.cachedisk')),
+                ('user', models.ForeignKey(help_text='User being moved', on_delete=django.db.models.deletion.CASCADE, to='xfc_control.user')),
+            ],
+        ),
+    ]
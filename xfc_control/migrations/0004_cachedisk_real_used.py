@@ -0,0 +1,24 @@
+# Generated by Django 6.0.6 on 2026-10-18 22:11
+
+import sizefield.models
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('xfc_control', '0003_usermigration'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='cachedisk',
+            name='real_used_bytes',
+            field=sizefield.models.FileSizeField(default=0, help_text='Used value read from the filesystem by xfc_reconcile'),
+        ),
+        migrations.AddField(
+            model_name='cachedisk',
+            name='reconciled',
+            field=models.DateTimeField(blank=True, help_text='Time the used value was last read from the filesystem', null=True),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 6.0.6 on 2026-10-19 09:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('xfc_control', '0004_cachedisk_real_used'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='cachedfile',
+            name='path_hash',
+            field=models.CharField(default='', editable=False, help_text='SHA1 hash of the relative path', max_length=40),
+            preserve_default=False,
+        ),
+    ]
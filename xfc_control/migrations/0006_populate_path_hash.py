@@ -0,0 +1,41 @@
+# Generated by Django 6.0.6 on 2026-10-19 09:12
+
+import hashlib
+
+from django.db import migrations, models
+
+
+def populate_path_hash(apps, schema_editor):
+    """Fill in the path_hash of the existing CachedFiles, and remove any duplicate CachedFiles (same user
+    and path) so that the unique constraint can be added.  The CachedFile with the lowest id is kept, as it
+    has the earliest first_seen."""
+    CachedFile = apps.get_model('xfc_control', 'CachedFile')
+    batch = []
+    for cf in CachedFile.objects.only('pk', 'path').order_by('pk').iterator(chunk_size=10000):
+        cf.path_hash = hashlib.sha1(cf.path.encode('utf-8')).hexdigest()
+        batch.append(cf)
+        if len(batch) >= 10000:
+            CachedFile.objects.bulk_update(batch, ['path_hash'])
+            batch = []
+    if batch:
+        CachedFile.objects.bulk_update(batch, ['path_hash'])
+
+    duplicates = CachedFile.objects.values('user', 'path_hash').annotate(
+        n=models.Count('pk'), keep=models.Min('pk')).filter(n__gt=1).order_by()
+    for d in duplicates:
+        CachedFile.objects.filter(user=d['user'], path_hash=d['path_hash']).exclude(pk=d['keep']).delete()
+
+
+class Migration(migrations.Migration):
+    """The data step is in a migration of its own, so that it is committed before the index and constraint
+    are added.  On PostgreSQL, removing the duplicates leaves deferred foreign key trigger events (from
+    the ScheduledDeletion.delete_files rows removed with them) pending until the end of the transaction,
+    and the table cannot be altered while they are pending."""
+
+    dependencies = [
+        ('xfc_control', '0005_cachedfile_path_hash'),
+    ]
+
+    operations = [
+        migrations.RunPython(populate_path_hash, migrations.RunPython.noop),
+    ]
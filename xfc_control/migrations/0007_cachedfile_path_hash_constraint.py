@@ -0,0 +1,21 @@
+# Generated by Django 6.0.6 on 2026-10-19 09:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('xfc_control', '0006_populate_path_hash'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='cachedfile',
+            index=models.Index(fields=['user', 'first_seen'], name='cachedfile_user_first_seen'),
+        ),
+        migrations.AddConstraint(
+            model_name='cachedfile',
+            constraint=models.UniqueConstraint(fields=('user', 'path_hash'), name='cachedfile_user_path_hash'),
+        ),
+    ]
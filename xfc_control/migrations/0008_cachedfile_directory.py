@@ -0,0 +1,35 @@
+# Generated by Django 6.0.6 on 2026-10-19 11:40
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('xfc_control', '0007_cachedfile_path_hash_constraint'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='cacheddirectory',
+            name='path_hash',
+            field=models.CharField(default='', editable=False, help_text='SHA1 hash of the relative path', max_length=40),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name='cachedfile',
+            name='directory',
+            field=models.ForeignKey(null=True, help_text='Directory containing the file', on_delete=django.db.models.deletion.CASCADE, related_name='files', to='xfc_control.cacheddirectory'),
+        ),
+        migrations.AddField(
+            model_name='cachedfile',
+            name='name',
+            field=models.CharField(default='', help_text='Name of the file within the directory', max_length=255),
+            preserve_default=False,
+        ),
+        migrations.RemoveConstraint(
+            model_name='cachedfile',
+            name='cachedfile_user_path_hash',
+        ),
+    ]
@@ -0,0 +1,95 @@
+# Generated by Django 6.0.6 on 2026-10-19 11:40
+
+import hashlib
+import os
+
+from django.db import migrations
+
+
+def hash_path(path):
+    return hashlib.sha1(path.encode('utf-8')).hexdigest()
+
+
+def populate_directory_hash(apps, schema_editor):
+    """Fill in the path_hash of the existing CachedDirectories."""
+    CachedDirectory = apps.get_model('xfc_control', 'CachedDirectory')
+    batch = []
+    for cd in CachedDirectory.objects.only('pk', 'path').order_by('pk').iterator(chunk_size=10000):
+        cd.path_hash = hash_path(cd.path)
+        batch.append(cd)
+        if len(batch) >= 10000:
+            CachedDirectory.objects.bulk_update(batch, ['path_hash'])
+            batch = []
+    if batch:
+        CachedDirectory.objects.bulk_update(batch, ['path_hash'])
+
+
+def split_file_paths(apps, schema_editor):
+    """Split the path of each existing CachedFile into a CachedDirectory and a name, one user at a time.
+    Any CachedDirectory (and parent directories up to the user's cache area) that does not exist yet is
+    created with zero size - the sizes are filled in by the next run of xfc_scan."""
+    User = apps.get_model('xfc_control', 'User')
+    CachedFile = apps.get_model('xfc_control', 'CachedFile')
+    CachedDirectory = apps.get_model('xfc_control', 'CachedDirectory')
+    for user in User.objects.order_by('pk').iterator():
+        root_path = os.path.normpath(user.cache_path)
+        directories = {cd.path: cd for cd in CachedDirectory.objects.filter(user=user)}
+
+        def get_directory(path):
+            if path in directories:
+                return directories[path]
+            parent = None
+            depth = 0
+            if path != root_path and path not in ('', '/'):
+                parent = get_directory(os.path.dirname(path))
+                depth = parent.depth + 1
+            cd = CachedDirectory.objects.create(user=user, path=path, path_hash=hash_path(path),
+                                                parent=parent, depth=depth)
+            directories[path] = cd
+            return cd
+
+        batch = []
+        for cf in CachedFile.objects.filter(user=user).only('pk', 'path').order_by('pk').iterator(chunk_size=10000):
+            path = os.path.normpath(cf.path)
+            cf.directory = get_directory(os.path.dirname(path))
+            cf.name = os.path.basename(path)
+            batch.append(cf)
+            if len(batch) >= 10000:
+                CachedFile.objects.bulk_update(batch, ['directory', 'name'])
+                batch = []
+        if batch:
+            CachedFile.objects.bulk_update(batch, ['directory', 'name'])
+    # CachedFiles without a user cannot be placed in a directory
+    CachedFile.objects.filter(user__isnull=True).delete()
+
+
+def join_file_paths(apps, schema_editor):
+    """Rebuild the path of each CachedFile from its CachedDirectory and name."""
+    CachedFile = apps.get_model('xfc_control', 'CachedFile')
+    batch = []
+    for cf in CachedFile.objects.select_related('directory').order_by('pk').iterator(chunk_size=10000):
+        cf.path = os.path.join(cf.directory.path, cf.name)
+        cf.path_hash = hash_path(cf.path)
+        batch.append(cf)
+        if len(batch) >= 10000:
+            CachedFile.objects.bulk_update(batch, ['path', 'path_hash'])
+            batch = []
+    if batch:
+        CachedFile.objects.bulk_update(batch, ['path', 'path_hash'])
+
+
+class Migration(migrations.Migration):
+    """The data steps are in a migration of their own, between the migration that adds the new fields and
+    the one that removes the old fields and adds the constraints, so that they are committed before the
+    tables are altered.  On PostgreSQL, creating the CachedDirectories and setting CachedFile.directory
+    leaves deferred foreign key trigger events pending until the end of the transaction, and the tables
+    cannot be altered while they are pending."""
+
+    dependencies = [
+        ('xfc_control', '0008_cachedfile_directory'),
+    ]
+
+    operations = [
+        migrations.RunPython(populate_directory_hash, migrations.RunPython.noop),
+        migrations.RunPython(split_file_paths, join_file_paths),
+    ]
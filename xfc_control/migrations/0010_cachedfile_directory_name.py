@@ -0,0 +1,46 @@
+# Generated by Django 6.0.6 on 2026-10-19 11:40
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('xfc_control', '0009_split_file_paths'),
+    ]
+
+    operations = [
+        migrations.AddConstraint(
+            model_name='cacheddirectory',
+            constraint=models.UniqueConstraint(fields=('user', 'path_hash'), name='cacheddirectory_user_path_hash'),
+        ),
+        # give the old fields a default, so that they can be added back if the migration is reversed
+        migrations.AlterField(
+            model_name='cachedfile',
+            name='path',
+            field=models.CharField(default='', help_text='Relative path to the file', max_length=2024),
+        ),
+        migrations.AlterField(
+            model_name='cachedfile',
+            name='path_hash',
+            field=models.CharField(default='', editable=False, help_text='SHA1 hash of the relative path', max_length=40),
+        ),
+        migrations.RemoveField(
+            model_name='cachedfile',
+            name='path',
+        ),
+        migrations.RemoveField(
+            model_name='cachedfile',
+            name='path_hash',
+        ),
+        migrations.AlterField(
+            model_name='cachedfile',
+            name='directory',
+            field=models.ForeignKey(help_text='Directory containing the file', on_delete=django.db.models.deletion.CASCADE, related_name='files', to='xfc_control.cacheddirectory'),
+        ),
+        migrations.AddConstraint(
+            model_name='cachedfile',
+            constraint=models.UniqueConstraint(fields=('directory', 'name'), name='cachedfile_directory_name'),
+        ),
+    ]
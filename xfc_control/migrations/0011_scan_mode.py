@@ -0,0 +1,64 @@
+# Generated by Django 6.0.6 on 2026-10-18 22:18
+
+import sizefield.models
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('xfc_control', '0010_cachedfile_directory_name'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='cacheddirectory',
+            name='aggregate',
+            field=models.BooleanField(default=False, help_text='The files in the directory are recorded by the totals only'),
+        ),
+        migrations.AddField(
+            model_name='cacheddirectory',
+            name='own_files',
+            field=models.BigIntegerField(default=0, help_text='Number of files directly in the directory'),
+        ),
+        migrations.AddField(
+            model_name='cacheddirectory',
+            name='own_first_seen',
+            field=models.DateTimeField(blank=True, help_text='Size-weighted mean date the files directly in the directory were first scanned', null=True),
+        ),
+        migrations.AddField(
+            model_name='cacheddirectory',
+            name='own_size',
+            field=sizefield.models.FileSizeField(default=0, help_text='Total size of the files directly in the directory'),
+        ),
+        migrations.AddField(
+            model_name='cacheddirectory',
+            name='subtree',
+            field=models.BooleanField(default=False, help_text='The totals for the files directly in the directory include the subdirectories'),
+        ),
+        migrations.AddField(
+            model_name='cachedisk',
+            name='scan_depth',
+            field=models.IntegerField(blank=True, help_text='In directory mode, the depth at which directories are totalled with their subdirectories (blank for no limit)', null=True),
+        ),
+        migrations.AddField(
+            model_name='cachedisk',
+            name='scan_mode',
+            field=models.CharField(choices=[('file', 'File'), ('directory', 'Directory')], default='file', help_text='Record each file, or only the totals for each directory', max_length=16),
+        ),
+        migrations.AddField(
+            model_name='scheduleddeletion',
+            name='delete_directories',
+            field=models.ManyToManyField(blank=True, default=None, help_text='The list of directory aggregates whose files will be deleted in this schedule', to='xfc_control.cacheddirectory'),
+        ),
+        migrations.AddField(
+            model_name='user',
+            name='scan_depth',
+            field=models.IntegerField(blank=True, help_text='In directory mode, the depth at which directories are totalled with their subdirectories (blank to use the setting of the cache disk)', null=True),
+        ),
+        migrations.AddField(
+            model_name='user',
+            name='scan_mode',
+            field=models.CharField(blank=True, choices=[('file', 'File'), ('directory', 'Directory')], default='', help_text='Record each file, or only the totals for each directory (blank to use the setting of the cache disk)', max_length=16),
+        ),
+    ]
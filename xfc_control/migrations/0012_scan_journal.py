@@ -0,0 +1,62 @@
+# Generated by Django 6.0.6 on 2026-10-18 22:23
+
+import django.db.models.deletion
+import sizefield.models
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('xfc_control', '0011_scan_mode'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='JournalCheckpoint',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('consumer', models.CharField(help_text='Name of the consumer', max_length=254, unique=True)),
+                ('sequence', models.BigIntegerField(default=0, help_text='Sequence number of the last entry processed')),
+                ('updated', models.DateTimeField(blank=True, help_text='Time the checkpoint was last committed', null=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='ScanPass',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('scan_mode', models.CharField(choices=[('file', 'File'), ('directory', 'Directory')], default='file', help_text='Scan mode used for the pass', max_length=16)),
+                ('started', models.DateTimeField(help_text='Time the pass started')),
+                ('finished', models.DateTimeField(blank=True, help_text='Time the pass finished', null=True)),
+                ('n_files', models.BigIntegerField(default=0, help_text='Number of files found')),
+                ('total_size', sizefield.models.FileSizeField(default=0, help_text='Total size of the files found')),
+                ('n_added', models.BigIntegerField(default=0, help_text='Number of files added')),
+                ('n_resized', models.BigIntegerField(default=0, help_text='Number of files that changed size')),
+                ('n_removed', models.BigIntegerField(default=0, help_text='Number of files removed')),
+                ('bytes_added', models.BigIntegerField(default=0, help_text='Bytes added')),
+                ('bytes_removed', models.BigIntegerField(default=0, help_text='Bytes removed')),
+                ('user', models.ForeignKey(help_text='User that was scanned', on_delete=django.db.models.deletion.CASCADE, to='xfc_control.user')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='ScanJournalEntry',
+            fields=[
+                ('id', models.BigAutoField(primary_key=True, serialize=False)),
+                ('event', models.CharField(choices=[('add', 'Add'), ('resize', 'Resize'), ('remove', 'Remove')], help_text='Type of change', max_length=8)),
+                ('path', models.CharField(help_text='Relative path to the file', max_length=2024)),
+                ('aggregate', models.BooleanField(default=False, help_text='The change is to a directory total')),
+                ('size', sizefield.models.FileSizeField(default=0, help_text='Size after the change')),
+                ('old_size', sizefield.models.FileSizeField(default=0, help_text='Size before the change')),
+                ('time', models.DateTimeField(help_text='Time the change was found')),
+                ('user', models.ForeignKey(help_text='User that owns the file', on_delete=django.db.models.deletion.CASCADE, to='xfc_control.user')),
+                ('scan_pass', models.ForeignKey(blank=True, help_text='Scan pass that found the change', null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='entries', to='xfc_control.scanpass')),
+            ],
+            options={
+                'verbose_name_plural': 'scan journal entries',
+            },
+        ),
+        migrations.AddIndex(
+            model_name='scanpass',
+            index=models.Index(fields=['user', 'started'], name='scanpass_user_started'),
+        ),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 6.0.6 on 2026-10-18 22:26
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('xfc_control', '0012_scan_journal'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Notification',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('to_address', models.EmailField(help_text='Address the email is sent to', max_length=254)),
+                ('from_address', models.EmailField(help_text='Address the email is sent from', max_length=254)),
+                ('subject', models.CharField(help_text='Subject of the email', max_length=254)),
+                ('body', models.TextField(help_text='Body of the email')),
+                ('state', models.CharField(choices=[('pending', 'Pending'), ('sent', 'Sent'), ('failed', 'Failed')], default='pending', help_text='Delivery state', max_length=8)),
+                ('attempts', models.IntegerField(default=0, help_text='Number of attempts made to send the email')),
+                ('created', models.DateTimeField(help_text='Time the email was written to the outbox')),
+                ('next_attempt', models.DateTimeField(help_text='Time of the next attempt to send the email')),
+                ('sent', models.DateTimeField(blank=True, help_text='Time the email was sent', null=True)),
+                ('error', models.TextField(blank=True, default='', help_text='Error from the last failed attempt')),
+                ('user', models.ForeignKey(blank=True, help_text='User the email is to', null=True, on_delete=django.db.models.deletion.SET_NULL, to='xfc_control.user')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['state', 'next_attempt'], name='notification_state_next')],
+            },
+        ),
+    ]
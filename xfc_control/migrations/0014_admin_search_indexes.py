@@ -0,0 +1,21 @@
+# Generated by Django 6.0.6 on 2026-10-18 22:34
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('xfc_control', '0013_notification_outbox'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='cacheddirectory',
+            index=models.Index(fields=['path_hash'], name='cacheddirectory_path_hash'),
+        ),
+        migrations.AddIndex(
+            model_name='user',
+            index=models.Index(fields=['name'], name='user_name_prefix', opclasses=['varchar_pattern_ops']),
+        ),
+    ]
@@ -0,0 +1,55 @@
+# Generated by Django 6.0.6 on 2026-10-18 22:37
+
+import django.db.models.deletion
+import sizefield.models
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('xfc_control', '0014_admin_search_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DiskRollup',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('n_users', models.IntegerField(default=0, help_text='Number of users on the CacheDisk')),
+                ('quota_size', sizefield.models.FileSizeField(default=0, help_text="Total of the users' quotas, in (bytes day)")),
+                ('quota_used', sizefield.models.FileSizeField(default=0, help_text='Total of the quota used by the users, in (bytes day)')),
+                ('hard_limit_size', sizefield.models.FileSizeField(default=0, help_text="Total of the users' hard limits")),
+                ('total_used', sizefield.models.FileSizeField(default=0, help_text="Total size of the users' files")),
+                ('n_over_quota', models.IntegerField(default=0, help_text='Number of users over their quota')),
+                ('n_over_hard_limit', models.IntegerField(default=0, help_text='Number of users over their hard limit')),
+                ('pending_deletions', models.IntegerField(default=0, help_text='Number of scheduled deletions')),
+                ('pending_files', models.BigIntegerField(default=0, help_text='Number of files scheduled for deletion')),
+                ('pending_bytes', sizefield.models.FileSizeField(default=0, help_text='Size of the files scheduled for deletion')),
+                ('oldest_scan', models.DateTimeField(blank=True, help_text="The least recent of the users' last finished scans", null=True)),
+                ('newest_scan', models.DateTimeField(blank=True, help_text="The most recent of the users' last finished scans", null=True)),
+                ('n_stale', models.IntegerField(default=0, help_text='Number of users that have not been scanned recently')),
+                ('updated', models.DateTimeField(help_text='Time the rollup was refreshed')),
+                ('cache_disk', models.OneToOneField(help_text='CacheDisk summarised', on_delete=django.db.models.deletion.CASCADE, related_name='rollup', to='xfc_control.cachedisk')),
+            ],
+            options={
+                'verbose_name': 'dashboard',
+                'verbose_name_plural': 'dashboard',
+            },
+        ),
+        migrations.CreateModel(
+            name='UserRollup',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('ranking', models.CharField(choices=[('temporal', 'Quota used'), ('hard', 'Total used'), ('over_quota', 'Over quota')], help_text='Ranking the user is in', max_length=16)),
+                ('rank', models.IntegerField(help_text='Position of the user in the ranking')),
+                ('used', sizefield.models.FileSizeField(default=0, help_text='Quota used, or total size used')),
+                ('limit', sizefield.models.FileSizeField(default=0, help_text='Quota, or hard limit')),
+                ('last_scan', models.DateTimeField(blank=True, help_text="Time the user's last scan finished", null=True)),
+                ('user', models.ForeignKey(help_text='User ranked', on_delete=django.db.models.deletion.CASCADE, to='xfc_control.user')),
+            ],
+            options={
+                'ordering': ['ranking', 'rank'],
+            },
+        ),
+    ]
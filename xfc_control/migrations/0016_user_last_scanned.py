@@ -0,0 +1,27 @@
+# Generated by Django 6.0.6 on 2026-10-18 22:39
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('xfc_control', '0015_dashboard_rollups'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='user',
+            name='last_scanned',
+            field=models.DateTimeField(blank=True, help_text='Time the last scan of the user finished', null=True),
+        ),
+        migrations.AddField(
+            model_name='user',
+            name='scan_dispatched',
+            field=models.DateTimeField(blank=True, help_text='Time the user was put on the scan queue', null=True),
+        ),
+        migrations.AddIndex(
+            model_name='user',
+            index=models.Index(fields=['last_scanned'], name='user_last_scanned'),
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 6.0.6 on 2026-10-18 22:42
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('xfc_control', '0016_user_last_scanned'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ScanLease',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('holder', models.CharField(blank=True, default='', help_text='Instance holding the lease', max_length=254)),
+                ('acquired', models.DateTimeField(blank=True, help_text='Time the lease was taken', null=True)),
+                ('expires', models.DateTimeField(blank=True, help_text='Time the lease expires', null=True)),
+                ('pass_started', models.DateTimeField(blank=True, help_text='Time the current pass started', null=True)),
+                ('pass_finished', models.DateTimeField(blank=True, help_text='Time the last complete pass finished', null=True)),
+                ('users_total', models.IntegerField(default=0, help_text='Number of users in the current pass')),
+                ('users_done', models.IntegerField(default=0, help_text='Number of users scanned in the current pass')),
+                ('current_user', models.CharField(blank=True, default='', help_text='User being scanned', max_length=254)),
+                ('cache_disk', models.OneToOneField(help_text='CacheDisk leased', on_delete=django.db.models.deletion.CASCADE, related_name='scan_lease', to='xfc_control.cachedisk')),
+            ],
+        ),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 6.0.6 on 2026-10-18 22:44
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('xfc_control', '0017_scan_lease'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='user',
+            name='churn',
+            field=models.FloatField(default=0.0, help_text='Average number of files changed per hour'),
+        ),
+        migrations.AddField(
+            model_name='user',
+            name='next_scan',
+            field=models.DateTimeField(blank=True, help_text='Time the user is next due to be scanned', null=True),
+        ),
+        migrations.AddField(
+            model_name='user',
+            name='scan_seconds',
+            field=models.FloatField(default=0.0, help_text='Time taken by the last scan, in seconds'),
+        ),
+        migrations.AddIndex(
+            model_name='user',
+            index=models.Index(fields=['next_scan'], name='user_next_scan'),
+        ),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 6.0.6 on 2026-10-18 22:47
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('xfc_control', '0018_user_next_scan'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='cachedfile',
+            name='atime',
+            field=models.DateTimeField(blank=True, help_text='Access time of the file when last scanned', null=True),
+        ),
+        migrations.AddField(
+            model_name='cachedfile',
+            name='inode',
+            field=models.BigIntegerField(blank=True, help_text='Inode number of the file', null=True),
+        ),
+        migrations.AddField(
+            model_name='cachedfile',
+            name='mtime',
+            field=models.DateTimeField(blank=True, help_text='Modification time of the file when last scanned', null=True),
+        ),
+        migrations.AddIndex(
+            model_name='cachedfile',
+            index=models.Index(fields=['user', 'inode'], name='cachedfile_user_inode'),
+        ),
+    ]
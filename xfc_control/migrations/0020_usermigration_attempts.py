@@ -0,0 +1,23 @@
+# Generated by Django 6.0.6 on 2026-10-19 09:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('xfc_control', '0019_cachedfile_stat'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='usermigration',
+            name='attempts',
+            field=models.IntegerField(default=0, help_text='Number of times the move has failed'),
+        ),
+        migrations.AlterField(
+            model_name='usermigration',
+            name='state',
+            field=models.CharField(choices=[('copying', 'Copying'), ('done', 'Done'), ('abandoned', 'Abandoned')], default='copying', help_text='State of the move', max_length=16),
+        ),
+    ]
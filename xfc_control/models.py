@@ -1,16 +1,16 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
-from django.db import models
+from django.db import models, transaction
 
 from sizefield.models import FileSizeField
 from sizefield.utils import filesizeformat
 
-from jasmin_ldap.core import *
-from jasmin_ldap.query import *
+from xfc_control.ldap_users import lookup_user, lookup_users
+from xfc_control.fs_helper import get_fs_helper
 
 import os, sys
-import subprocess
+import hashlib
 import datetime
 import calendar
 import xfc_site.settings as settings
@@ -23,8 +23,21 @@ class CacheDisk(models.Model):
     :var FileSizeField size_bytes: amount of space on the disk allocated to users
     :var FileSizeField allocated_bytes: number of bytes allocated to users via their quotas
     :var FileSizeField used_bytes: amount of space that has been used in the cache area
+    :var FileSizeField real_used_bytes: amount of space used on the volume, as reported by the filesystem
+    :var models.DateTimeField reconciled: time real_used_bytes was last read from the filesystem
+    :var models.BooleanField retiring: the CacheDisk is being retired - no new users will be placed on it
+                                       and xfc_rebalance will move its users to other CacheDisks
+    :var models.CharField scan_mode: whether xfc_scan records each file (FILE_MODE) or only the totals for
+                                     each directory (DIRECTORY_MODE) for the users on the CacheDisk
+    :var models.IntegerField scan_depth: in DIRECTORY_MODE, the depth below each user's cache area at which
+                                         the directories are totalled with all of their subdirectories
+                                         (None for every directory to be recorded separately)
     """
 
+    FILE_MODE = "file"
+    DIRECTORY_MODE = "directory"
+    SCAN_MODE_CHOICES = ((FILE_MODE, "File"), (DIRECTORY_MODE, "Directory"))
+
     mountpoint = models.CharField(blank=True, max_length=1024, help_text="Root directory of cache area", unique=True)
     size_bytes = FileSizeField(default=0,
                                help_text="Maximum size on the disk that can be allocated to the cache area")
@@ -32,6 +45,18 @@ class CacheDisk(models.Model):
                                     help_text="Amount of space allocated to users")
     used_bytes = FileSizeField(default=0,
                                help_text="Used value calculated by update daemon")
+    real_used_bytes = FileSizeField(default=0,
+                                    help_text="Used value read from the filesystem by xfc_reconcile")
+    reconciled = models.DateTimeField(blank=True, null=True,
+                                      help_text="Time the used value was last read from the filesystem")
+    retiring = models.BooleanField(default=False,
+                                   help_text="No new users will be placed on the disk, and existing users will be "
+                                             "moved off it by xfc_rebalance")
+    scan_mode = models.CharField(max_length=16, choices=SCAN_MODE_CHOICES, default=FILE_MODE,
+                                 help_text="Record each file, or only the totals for each directory")
+    scan_depth = models.IntegerField(blank=True, null=True,
+                                     help_text="In directory mode, the depth at which directories are totalled "
+                                               "with their subdirectories (blank for no limit)")
     def __str__(self):
         return "%s" % self.mountpoint
 
@@ -47,71 +72,211 @@ class CacheDisk(models.Model):
         return filesizeformat(self.size_bytes)
     formatted_size.short_description = "total size"
 
+    def formatted_real_used(self):
+        return filesizeformat(self.real_used_bytes)
+    formatted_real_used.short_description = "real used"
+
+    def filesystem_usage(self):
+        """Read the size of the volume and the space used on it from the filesystem, with statvfs.
+        This is fast, as it does not depend on the number of files on the volume.
+        :return: (size, used) in bytes
+        """
+        st = os.statvfs(self.mountpoint)
+        size = st.f_blocks * st.f_frsize
+        used = (st.f_blocks - st.f_bfree) * st.f_frsize
+        return size, used
+
     @staticmethod
-    def find_free_cache_disk(requested_bytes):
-        """Find a CacheDisk with the most free (unallocated) space to store the user's quota.
-        If the mountpoint of the CacheDisk does not exist then it will be created.
+    def placement_candidates(requested_bytes, policy=None, exclude=None):
+        """Return the CacheDisks with enough unallocated space for requested_bytes, in the order of
+        preference of the placement policy.  CacheDisks that are being retired are not returned.
 
         :var int requested_bytes: amount of space requested for the user's allocated quota
+        :var string policy: (*optional*) name of the placement policy in PLACEMENT_POLICIES,
+                            defaults to the XFC_PLACEMENT_POLICY setting
+        :var List[int] exclude: (*optional*) ids of CacheDisks not to consider
         """
-        free_cd = None
-        free_bytes = 0
-        for cd in CacheDisk.objects.all():
-            if (cd.size_bytes - cd.used_bytes) > free_bytes:
-                free_cd = cd
-                free_bytes = cd.size_bytes - cd.used_bytes
-
-        # if the free_cd root path does not exist then create it
-        if free_cd:
-            if not os.path.exists(cd.mountpoint):
-                # have to use subprocess to do as sudo
-                subprocess.call(["/usr/bin/sudo", "/bin/mkdir", "-p", cd.mountpoint])
-        return free_cd
+        if policy is None:
+            policy = getattr(settings, "XFC_PLACEMENT_POLICY", "most_free")
+        if policy not in PLACEMENT_POLICIES:
+            raise Exception("Unknown placement policy: {}".format(policy))
+        disks = CacheDisk.objects.filter(size_bytes__gte=models.F("allocated_bytes") + requested_bytes,
+                                         retiring=False)
+        if exclude:
+            disks = disks.exclude(pk__in=exclude)
+        return PLACEMENT_POLICIES[policy](disks)
 
+    @staticmethod
+    def reserve_cache_disk(requested_bytes, policy=None, exclude=None):
+        """Find a CacheDisk with enough free (unallocated) space to store the user's quota and reserve
+        the space by adding it to allocated_bytes.  The check for free space and the reservation are made
+        in a single UPDATE statement, so concurrent reservations cannot overcommit a CacheDisk - if another
+        reservation takes the space first then the next CacheDisk in the policy's order is tried.
+        If the mountpoint of the CacheDisk does not exist then it will be created, and if it cannot be created
+        the space is released again and the exception is raised.
 
-    def create_user_cache_path(self, username):
-        """Create the path to the user's cache.
+        :var int requested_bytes: amount of space requested for the user's allocated quota
+        :var string policy: (*optional*) name of the placement policy in PLACEMENT_POLICIES
+        :var List[int] exclude: (*optional*) ids of CacheDisks not to consider
+        :return: the CacheDisk the space was reserved on, or None if no CacheDisk has enough space
+        """
+        candidates = list(CacheDisk.placement_candidates(requested_bytes, policy, exclude).values_list("pk", flat=True))
+        for pk in candidates:
+            with transaction.atomic():
+                # the UPDATE takes the row lock, and only succeeds if the space is still free
+                reserved = CacheDisk.objects.filter(
+                    pk=pk, size_bytes__gte=models.F("allocated_bytes") + requested_bytes
+                ).update(allocated_bytes=models.F("allocated_bytes") + requested_bytes)
+                if reserved:
+                    free_cd = CacheDisk.objects.get(pk=pk)
+                    break
+        else:
+            return None
+        try:
+            free_cd.create_mountpoint()
+        except Exception:
+            # do not leak the reservation if the privileged helper fails
+            free_cd.release(requested_bytes)
+            raise
+        return free_cd
+
+    def release(self, released_bytes):
+        """Release space that was reserved on the CacheDisk by reserve_cache_disk.
+        :var int released_bytes: amount of space to remove from allocated_bytes
+        """
+        CacheDisk.objects.filter(pk=self.pk).update(allocated_bytes=models.F("allocated_bytes") - released_bytes)
+        self.refresh_from_db(fields=["allocated_bytes"])
+
+    def create_mountpoint(self):
+        """Create the mountpoint of the CacheDisk, if it does not exist."""
+        if not os.path.exists(self.mountpoint):
+            # have to use the privileged helper to do as root
+            helper = get_fs_helper()
+            helper.mkdir(self.mountpoint, 0o755)
+            failed = helper.flush()
+            if len(failed) != 0:
+                raise Exception("Could not create mountpoint {}: {}".format(
+                    self.mountpoint, "; ".join(error for op, error in failed)))
+
+
+    def _queue_user_cache_path(self, helper, username, ldap_user=None):
+        """Queue the operations to create the path to the user's cache on the privileged helper.
+        :var xfc_control.fs_helper.FileSystemHelper helper: the helper to queue the operations on
         :var string username: name of the user to create.
+        :var xfc_control.ldap_users.LDAPUser ldap_user: (*optional*) the user's details from LDAP
+        :return: the path to the user's cache AFTER the mountpoint, and the full path if it needs creating
         """
-        # concatenate the mountpoint and the user_cache area
-        cache_path = os.path.join(self.mountpoint, "user_cache")
         user_path = os.path.join("user_cache", username)
         # concatenate the user_cache and the relative userpath
         total_path = os.path.join(self.mountpoint, user_path)
 
-        # create the cache area for all users
+        # create the cache area for the user
+        if os.path.exists(total_path):
+            return user_path, None
+
+        # transfer ownership to the user - first we have to get the numeric uid and gid from the ldap server
+        if ldap_user is None:
+            ldap_user = lookup_user(username)
+        # check for a valid return
+        if ldap_user is None:
+            raise Exception("Username: {} not found from LDAP in create_user_cache_path".format(username))
+        # check that the uid and gid were returned
+        if ldap_user.uid is None or ldap_user.gid is None:
+            raise Exception("uidNumber and / or gidNumber not in returned LDAP query for user {}".format(username))
+
+        # Only create the directory if the user exists in LDAP.  The directory is new, so only the
+        # directory itself needs its ownership transferring to the user
+        helper.mkdir(total_path, 0o700)
+        helper.chown(total_path, ldap_user.uid, ldap_user.gid)
+        return user_path, total_path
+
+
+    def _queue_cache_path(self, helper):
+        """Queue the creation of the cache area for all users on the privileged helper."""
+        # concatenate the mountpoint and the user_cache area
+        cache_path = os.path.join(self.mountpoint, "user_cache")
         if not os.path.exists(cache_path):
-            # have to use subprocess to do as sudo
-            subprocess.call(["/usr/bin/sudo", "/bin/mkdir", "-p", cache_path, "-m", "755"])
+            helper.mkdir(cache_path, 0o755)
+
 
+    def create_user_cache_path(self, username):
+        """Create the path to the user's cache.
+        :var string username: name of the user to create.
+        """
+        helper = get_fs_helper()
+        # create the cache area for all users
+        self._queue_cache_path(helper)
         # create the cache area for the user
-        if not os.path.exists(total_path):
-            # transfer ownership to the user - first we have to get the numeric uid and gid from the ldap server
-            servers = ServerPool(settings.XFC_LDAP_PRIMARY, settings.XFC_LDAP_REPLICAS)
-            with Connection.create(servers) as conn:
-                # form the query
-                query = Query(conn, base_dn=settings.XFC_LDAP_BASE_USER).filter(uid=username)
-                # check for a valid return
-                if len(query) == 0:
-                    raise Exception("Username: {} not found from LDAP in create_user_cache_path".format(username))
-
-                # use just the first returned result
-                q = query[0]
-                # # check that the keys exist in q
-                if not ("uidNumber" in q and "gidNumber" in q):
-                    raise Exception("uidNumber and / or gidNumber not in returned LDAP query for user {}".format(username))
-
-                # Only create the directory if the user exists in LDAP.  Have to use subprocess to do as sudo
-                subprocess.call(["/usr/bin/sudo", "/bin/mkdir", "-p", total_path, "-m", "700"])
-
-                # form the user:group string
-                uidgid = str(q["uidNumber"][0]) + ":" + str(q["gidNumber"][0])
-                # have to use subprocess to do as sudo
-                subprocess.call(["/usr/bin/sudo", "/bin/chown", "-R", uidgid, total_path])
+        user_path, total_path = self._queue_user_cache_path(helper, username)
+        failed = helper.flush()
+        if len(failed) != 0:
+            raise Exception("Could not create cache path for user {}: {}".format(
+                username, "; ".join(error for op, error in failed)))
 
         # return just the user path - will facilitate moving entire user directories to a new cache disk
         return user_path
 
+    def create_user_cache_paths(self, usernames):
+        """Create the paths to the caches of many users at once.  The users are looked up in LDAP
+        in batches, and the directories are created in a single batch by the privileged helper,
+        rather than one at a time.  Users that are not found in LDAP, or whose directories could
+        not be created, are skipped.
+        :var List[string] usernames: names of the users to create.
+        :return: dictionary of the user paths, keyed on the user name
+        """
+        helper = get_fs_helper()
+        # create the cache area for all users
+        self._queue_cache_path(helper)
+        # look up all the users that need a cache area creating in one go
+        new_users = [u for u in usernames if not os.path.exists(os.path.join(self.mountpoint, "user_cache", u))]
+        ldap_users = lookup_users(new_users)
+        user_paths = {}
+        total_paths = {}
+        for username in usernames:
+            # skip the users who were not found in LDAP
+            if username in new_users and username not in ldap_users:
+                continue
+            try:
+                user_path, total_path = self._queue_user_cache_path(helper, username, ldap_users.get(username))
+            except Exception:
+                continue
+            user_paths[username] = user_path
+            total_paths[total_path] = username
+        # remove the users whose directories could not be created
+        for op, error in helper.flush():
+            if op["path"] in total_paths:
+                user_paths.pop(total_paths[op["path"]], None)
+            else:
+                # the cache area for all users could not be created
+                return {}
+        return user_paths
+
+
+def most_free_policy(disks):
+    """Placement policy: prefer the CacheDisk with the most unallocated space."""
+    return disks.order_by((models.F("size_bytes") - models.F("allocated_bytes")).desc(), "pk")
+
+
+def least_loaded_policy(disks):
+    """Placement policy: prefer the CacheDisk with the fewest users."""
+    return disks.annotate(n_users=models.Count("user")).order_by(
+        "n_users", (models.F("size_bytes") - models.F("allocated_bytes")).desc(), "pk")
+
+
+def fill_first_policy(disks):
+    """Placement policy: prefer the CacheDisk with the least unallocated space that can still hold
+    the quota, so that each CacheDisk is filled before the next is used."""
+    return disks.order_by((models.F("size_bytes") - models.F("allocated_bytes")).asc(), "pk")
+
+
+# the placement policies, keyed on the name used in the XFC_PLACEMENT_POLICY setting.
+# Each takes a QuerySet of CacheDisks and returns it in the order of preference.
+PLACEMENT_POLICIES = {
+    "most_free": most_free_policy,
+    "least_loaded": least_loaded_policy,
+    "fill_first": fill_first_policy,
+}
+
 
 class User(models.Model):
     """User of the transfer cache disk(s).  Users will be allocated space on a CacheDisk
@@ -122,6 +287,15 @@ class User(models.Model):
     :var FileSizeField quota_used: total quota amount used
     :var models.CharField cache_path: path to the user's cache area AFTER the CacheDisk mountpoint
     :var models.ForeignKey cache_disk: the CacheDisk the user is allocated
+    :var models.CharField scan_mode: the scan mode for the user, blank to use the scan_mode of the CacheDisk
+    :var models.IntegerField scan_depth: the scan depth for the user, None to use the scan_depth of the CacheDisk
+    :var models.DateTimeField last_scanned: time the last scan of the user finished (None if never scanned)
+    :var models.DateTimeField scan_dispatched: time the user was put on the scan queue by xfc_dispatch (None if
+                                               the user is not waiting on the queue)
+    :var models.DateTimeField next_scan: time the user is next due to be scanned (None to scan on the next run),
+                                         see xfc_control.scan_frequency
+    :var models.FloatField churn: moving average of the number of files added, resized and removed per hour
+    :var models.FloatField scan_seconds: time taken by the last scan of the user, in seconds
     """
 
     name = models.CharField(max_length=254, help_text="Name of user - should be same as JASMIN user name")
@@ -135,10 +309,44 @@ class User(models.Model):
 
     cache_path = models.CharField(max_length=2024, help_text="Relative path to cache area")
     cache_disk = models.ForeignKey(CacheDisk, help_text="Cache disk allocated to the user", on_delete=models.CASCADE)
+    scan_mode = models.CharField(max_length=16, blank=True, choices=CacheDisk.SCAN_MODE_CHOICES, default="",
+                                 help_text="Record each file, or only the totals for each directory "
+                                           "(blank to use the setting of the cache disk)")
+    scan_depth = models.IntegerField(blank=True, null=True,
+                                     help_text="In directory mode, the depth at which directories are totalled "
+                                               "with their subdirectories (blank to use the setting of the cache disk)")
+    last_scanned = models.DateTimeField(blank=True, null=True, help_text="Time the last scan of the user finished")
+    scan_dispatched = models.DateTimeField(blank=True, null=True,
+                                           help_text="Time the user was put on the scan queue")
+    next_scan = models.DateTimeField(blank=True, null=True, help_text="Time the user is next due to be scanned")
+    churn = models.FloatField(default=0.0, help_text="Average number of files changed per hour")
+    scan_seconds = models.FloatField(default=0.0, help_text="Time taken by the last scan, in seconds")
+
+    class Meta:
+        indexes = [
+            # for xfc_dispatch to find the users that have gone longest without a scan
+            models.Index(fields=["last_scanned"], name="user_last_scanned"),
+            # for the scanners to find the users that are due to be scanned
+            models.Index(fields=["next_scan"], name="user_next_scan"),
+            # for the prefix search on the name in the admin (LIKE 'name%' on PostgreSQL)
+            models.Index(fields=["name"], name="user_name_prefix", opclasses=["varchar_pattern_ops"]),
+        ]
 
     def __str__(self):
         return "%s (%s / %s)" % (self.name, filesizeformat(self.quota_used), filesizeformat(self.quota_size))
 
+    def get_scan_mode(self):
+        """Get the scan mode for the user, from the user or, if that is not set, from their CacheDisk."""
+        if self.scan_mode:
+            return self.scan_mode
+        return self.cache_disk.scan_mode
+
+    def get_scan_depth(self):
+        """Get the scan depth for the user, from the user or, if that is not set, from their CacheDisk."""
+        if self.scan_depth is not None:
+            return self.scan_depth
+        return self.cache_disk.scan_depth
+
     def formatted_used(self):
         return filesizeformat(self.quota_used)
     formatted_used.short_description = "quota_used"
@@ -180,20 +388,145 @@ class UserLock(models.Model):
     user_lock = models.ForeignKey(User, blank=True, help_text="User that is locked", on_delete=models.CASCADE)
 
 
+class CachedDirectory(models.Model):
+    """Aggregate description of a directory in a user's cache area.  These are built by the xfc_scan.py Daemon
+    during the walk of the user's cache area.  The totals include all the files in the directory and in all of its
+    subdirectories, so that the usage of any part of the tree can be found by looking at one level of the tree.
+    The CachedFiles refer to the CachedDirectory that contains them, so that the directory part of their path
+    is only stored once.
+
+    For users scanned in CacheDisk.DIRECTORY_MODE there are no CachedFiles.  Instead the own_ fields of each
+    CachedDirectory (with aggregate set) are the record of the files directly in the directory, or, if subtree
+    is set, of all the files in the directory and its subdirectories.  These are scheduled and deleted in the
+    same way as a CachedFile, with own_first_seen used as the first_seen of all the files.
+
+    :var models.CharField path: path to the directory AFTER the CacheDisk mountpoint
+    :var models.CharField path_hash: fixed width hash of the path, used to look up the directory by path
+    :var models.ForeignKey parent: the directory containing this directory (None for the user's cache area)
+    :var models.IntegerField depth: depth of the directory below the user's cache area
+    :var FileSizeField size: total size of the files in the directory and its subdirectories
+    :var models.BigIntegerField n_files: number of files in the directory and its subdirectories
+    :var FileSizeField quota_used: temporal quota used by the files in the directory and its subdirectories
+    :var models.DateTimeField first_seen: time the oldest file in the directory and its subdirectories was first seen
+    :var FileSizeField own_size: size of the files directly in the directory (in the subtree if subtree is set)
+    :var models.BigIntegerField own_files: number of files directly in the directory (in the subtree if subtree is set)
+    :var models.DateTimeField own_first_seen: size-weighted mean time that the own files were first seen
+    :var models.BooleanField aggregate: the own files are only recorded by the own_ totals, not as CachedFiles
+    :var models.BooleanField subtree: the own_ totals include the files in all the subdirectories
+    :var models.ForeignKey user: the user that the directory belongs to
+    """
+
+    path = models.CharField(max_length=2024, help_text="Relative path to the directory")
+    path_hash = models.CharField(max_length=40, editable=False, help_text="SHA1 hash of the relative path")
+    parent = models.ForeignKey("self", blank=True, null=True, related_name="children",
+                               help_text="Directory containing this directory", on_delete=models.CASCADE)
+    depth = models.IntegerField(default=0, help_text="Depth of the directory below the user's cache area")
+    size = FileSizeField(default=0, help_text="Total size of the files in the directory and its subdirectories")
+    n_files = models.BigIntegerField(default=0,
+                                     help_text="Number of files in the directory and its subdirectories")
+    quota_used = FileSizeField(default=0, help_text="Quota used by the directory and its subdirectories, "
+                                                    "in (bytes day)")
+    first_seen = models.DateTimeField(blank=True, null=True,
+                                      help_text="Date the oldest file in the directory was first scanned")
+    own_size = FileSizeField(default=0, help_text="Total size of the files directly in the directory")
+    own_files = models.BigIntegerField(default=0, help_text="Number of files directly in the directory")
+    own_first_seen = models.DateTimeField(blank=True, null=True,
+                                          help_text="Size-weighted mean date the files directly in the "
+                                                    "directory were first scanned")
+    aggregate = models.BooleanField(default=False,
+                                    help_text="The files in the directory are recorded by the totals only")
+    subtree = models.BooleanField(default=False,
+                                  help_text="The totals for the files directly in the directory include the "
+                                            "subdirectories")
+    user = models.ForeignKey(User, help_text="User that owns the directory", on_delete=models.CASCADE)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["user", "path_hash"], name="cacheddirectory_user_path_hash"),
+        ]
+        indexes = [
+            # for looking up a directory by path for any user, in the admin search
+            models.Index(fields=["path_hash"], name="cacheddirectory_path_hash"),
+        ]
+
+    @staticmethod
+    def hash_path(path):
+        """Return the hash of a path, to store in or look up path_hash.  The path can be up to 2024
+        characters, which is too long to index well, so directories are looked up by the hash instead.
+        :var string path: path to the directory AFTER the CacheDisk mountpoint
+        """
+        return hashlib.sha1(path.encode("utf-8")).hexdigest()
+
+    def save(self, *args, **kwargs):
+        self.path_hash = CachedDirectory.hash_path(self.path)
+        super(CachedDirectory, self).save(*args, **kwargs)
+
+    def formatted_size(self):
+        return filesizeformat(self.size)
+    formatted_size.short_description = "size"
+
+    def formatted_quota_used(self):
+        return filesizeformat(self.quota_used)
+    formatted_quota_used.short_description = "quota_used"
+
+    def full_path(self):
+        return os.path.join(self.user.cache_disk.mountpoint, self.path)
+
+    def __str__(self):
+        return "%s (%s)" % (self.path, filesizeformat(self.size))
+
+    def own_quota_use(self, current_date = None):
+        """Get the amount of quota the files recorded by the own_ totals will use up, in the same way
+        as CachedFile.quota_use"""
+        if self.own_first_seen is None:
+            return 0
+        if current_date == None:
+            current_date = datetime.datetime.utcnow()
+        days_persistent = (current_date - self.own_first_seen).days + 1
+        use = self.own_size * days_persistent
+        return use
+
+
 class CachedFile(models.Model):
     """Description of a cached file.  These files are added by the xfc_scan.py Daemon.
+    The path of the file is stored as the CachedDirectory that contains the file and the name of the file
+    within the directory, and the path is rebuilt from these when it is needed.
 
-    :var models.CharField path: path to the file AFTER the User mountpoint
+    :var models.ForeignKey directory: the directory that contains the file
+    :var models.CharField name: name of the file within the directory
     :var FileSizeField size: size of the file
     :var models.DateTimeField first_seen: time the file was first scanned by the cache_manager Daemon
     :var models.ForeignKey user: the user that the file belongs to
+    :var models.BigIntegerField inode: inode number of the file, used to find files that have been renamed
+    :var models.DateTimeField mtime: modification time of the file when it was last scanned
+    :var models.DateTimeField atime: access time of the file when it was last scanned
     """
 
-    path = models.CharField(max_length=2024, help_text="Relative path to the file")
+    directory = models.ForeignKey(CachedDirectory, related_name="files", help_text="Directory containing the file",
+                                  on_delete=models.CASCADE)
+    name = models.CharField(max_length=255, help_text="Name of the file within the directory")
     size = FileSizeField(default=0, help_text="Size of the file")
     first_seen = models.DateTimeField(blank=True, null=True,
                                       help_text="Date the file was first scanned by the cache_manager")
     user = models.ForeignKey(User, help_text="User that owns the file", null=True, on_delete=models.CASCADE)
+    inode = models.BigIntegerField(blank=True, null=True, help_text="Inode number of the file")
+    mtime = models.DateTimeField(blank=True, null=True, help_text="Modification time of the file when last scanned")
+    atime = models.DateTimeField(blank=True, null=True, help_text="Access time of the file when last scanned")
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["directory", "name"], name="cachedfile_directory_name"),
+        ]
+        indexes = [
+            models.Index(fields=["user", "first_seen"], name="cachedfile_user_first_seen"),
+            models.Index(fields=["user", "inode"], name="cachedfile_user_inode"),
+        ]
+
+    @property
+    def path(self):
+        """Path to the file AFTER the CacheDisk mountpoint.  Use select_related("directory") when
+        getting many CachedFiles, to avoid a query for each file."""
+        return os.path.join(self.directory.path, self.name)
 
     def formatted_size(self):
         return filesizeformat(self.size)
@@ -216,6 +549,50 @@ class CachedFile(models.Model):
         return use
 
 
+class UserMigration(models.Model):
+    """Progress of moving a user's cache area from one CacheDisk to another, by the xfc_rebalance script.
+    The copy can be resumed if xfc_rebalance is stopped, as the target CacheDisk (and the space reserved on it)
+    is kept here, and files that have already been copied are not copied again.
+
+    :var models.ForeignKey user: the user being moved
+    :var models.ForeignKey source_disk: the CacheDisk the user is being moved from
+    :var models.ForeignKey target_disk: the CacheDisk the user is being moved to
+    :var models.CharField state: the state of the move
+    :var models.BigIntegerField files_copied: number of files copied so far
+    :var FileSizeField bytes_copied: number of bytes copied so far
+    :var models.DateTimeField started: time the move was started
+    :var models.DateTimeField finished: time the move was finished
+    :var models.TextField error: the last error that stopped the move - it will be retried on the next run
+    :var models.IntegerField attempts: number of times the move has failed - after max_attempts failures the
+                                       move is abandoned and the space reserved on the target is released
+    """
+
+    COPYING = "copying"
+    DONE = "done"
+    ABANDONED = "abandoned"
+    STATE_CHOICES = ((COPYING, "Copying"), (DONE, "Done"), (ABANDONED, "Abandoned"))
+
+    user = models.ForeignKey(User, help_text="User being moved", on_delete=models.CASCADE)
+    source_disk = models.ForeignKey(CacheDisk, related_name="migrations_from",
+                                    help_text="Cache disk the user is being moved from", on_delete=models.CASCADE)
+    target_disk = models.ForeignKey(CacheDisk, related_name="migrations_to",
+                                    help_text="Cache disk the user is being moved to", on_delete=models.CASCADE)
+    state = models.CharField(max_length=16, choices=STATE_CHOICES, default=COPYING, help_text="State of the move")
+    files_copied = models.BigIntegerField(default=0, help_text="Number of files copied so far")
+    bytes_copied = FileSizeField(default=0, help_text="Number of bytes copied so far")
+    started = models.DateTimeField(blank=True, null=True, help_text="Time the move was started")
+    finished = models.DateTimeField(blank=True, null=True, help_text="Time the move was finished")
+    error = models.TextField(blank=True, default="", help_text="Error that stopped the move")
+    attempts = models.IntegerField(default=0, help_text="Number of times the move has failed")
+
+    def formatted_bytes_copied(self):
+        return filesizeformat(self.bytes_copied)
+    formatted_bytes_copied.short_description = "copied"
+
+    def __str__(self):
+        return "%s (%s -> %s)" % (self.user.name, self.source_disk.mountpoint, self.target_disk.mountpoint)
+
+
 class ScheduledDeletion(models.Model):
     """Description of the deletion of a file which will take place in the future.
     The date the deletion was entered into the schedule is kept so that the user can touch the files, whereupon
@@ -225,6 +602,9 @@ class ScheduledDeletion(models.Model):
     :var models.DateTimeField time_entered: time the ScheduledDeletion was entered into the db
     :var models.DateTimeField time_delete:  time the ScheduledDeletion will take place
     :var models.ForeignKey user: user that the ScheduledDeletion will target
+    :var models.ManyToManyField delete_files: the CachedFiles to delete
+    :var models.ManyToManyField delete_directories: the CachedDirectory aggregates whose files will be deleted,
+                                                    for users scanned in CacheDisk.DIRECTORY_MODE
     """
 
     schedule_hours = 72  # number of hours before file is deleted
@@ -235,6 +615,271 @@ class ScheduledDeletion(models.Model):
     user = models.ForeignKey(User, help_text="User that the ScheduledDeletion belongs to", on_delete=models.CASCADE)
     delete_files = models.ManyToManyField(CachedFile, default=None,
                                           help_text="The list of files to be deleted in this schedule")
+    delete_directories = models.ManyToManyField(CachedDirectory, default=None, blank=True,
+                                                help_text="The list of directory aggregates whose files will be "
+                                                          "deleted in this schedule")
 
     def __str__(self):
         return "%s" % self.user.name
+
+
+class ScanPass(models.Model):
+    """Record of one pass of xfc_scan over a user's cache area, with the number of changes found.
+    The changes themselves are in the ScanJournalEntries of the pass.
+
+    :var models.ForeignKey user: the user that was scanned
+    :var models.CharField scan_mode: the scan mode used (see CacheDisk.scan_mode)
+    :var models.DateTimeField started: time the pass started
+    :var models.DateTimeField finished: time the pass finished (None if it has not finished)
+    :var models.BigIntegerField n_files: number of files found
+    :var FileSizeField total_size: total size of the files found
+    :var models.BigIntegerField n_added: number of files (or directory totals) added
+    :var models.BigIntegerField n_resized: number of files (or directory totals) that changed size
+    :var models.BigIntegerField n_removed: number of files (or directory totals) removed
+    :var models.BigIntegerField bytes_added: bytes added by the added and resized files
+    :var models.BigIntegerField bytes_removed: bytes removed by the removed and resized files
+    """
+
+    user = models.ForeignKey(User, help_text="User that was scanned", on_delete=models.CASCADE)
+    scan_mode = models.CharField(max_length=16, choices=CacheDisk.SCAN_MODE_CHOICES, default=CacheDisk.FILE_MODE,
+                                 help_text="Scan mode used for the pass")
+    started = models.DateTimeField(help_text="Time the pass started")
+    finished = models.DateTimeField(blank=True, null=True, help_text="Time the pass finished")
+    n_files = models.BigIntegerField(default=0, help_text="Number of files found")
+    total_size = FileSizeField(default=0, help_text="Total size of the files found")
+    n_added = models.BigIntegerField(default=0, help_text="Number of files added")
+    n_resized = models.BigIntegerField(default=0, help_text="Number of files that changed size")
+    n_removed = models.BigIntegerField(default=0, help_text="Number of files removed")
+    bytes_added = models.BigIntegerField(default=0, help_text="Bytes added")
+    bytes_removed = models.BigIntegerField(default=0, help_text="Bytes removed")
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["user", "started"], name="scanpass_user_started"),
+        ]
+
+    def __str__(self):
+        return "%s (%s)" % (self.user.name, self.started)
+
+
+class ScanJournalEntry(models.Model):
+    """Append-only record of a change found by xfc_scan (or made by xfc_delete).  The id of the entry is its
+    sequence number: entries are only ever appended, and they are committed in the order of their ids, so a
+    consumer can read the changes after the last sequence number it has processed (see xfc_control.journal).
+
+    :var models.BigAutoField id: sequence number of the entry
+    :var models.ForeignKey scan_pass: the ScanPass that found the change (None for changes made by xfc_delete)
+    :var models.ForeignKey user: the user that owns the file
+    :var models.CharField event: ADD, RESIZE or REMOVE
+    :var models.CharField path: path to the file AFTER the CacheDisk mountpoint
+    :var models.BooleanField aggregate: the change is to a directory total (DIRECTORY_MODE), rather than a file
+    :var FileSizeField size: size of the file after the change (0 for REMOVE)
+    :var FileSizeField old_size: size of the file before the change (0 for ADD)
+    :var models.DateTimeField time: time the change was found
+    """
+
+    ADD = "add"
+    RESIZE = "resize"
+    REMOVE = "remove"
+    EVENT_CHOICES = ((ADD, "Add"), (RESIZE, "Resize"), (REMOVE, "Remove"))
+
+    id = models.BigAutoField(primary_key=True)
+    scan_pass = models.ForeignKey(ScanPass, blank=True, null=True, related_name="entries",
+                                  help_text="Scan pass that found the change", on_delete=models.SET_NULL)
+    user = models.ForeignKey(User, help_text="User that owns the file", on_delete=models.CASCADE)
+    event = models.CharField(max_length=8, choices=EVENT_CHOICES, help_text="Type of change")
+    path = models.CharField(max_length=2024, help_text="Relative path to the file")
+    aggregate = models.BooleanField(default=False, help_text="The change is to a directory total")
+    size = FileSizeField(default=0, help_text="Size after the change")
+    old_size = FileSizeField(default=0, help_text="Size before the change")
+    time = models.DateTimeField(help_text="Time the change was found")
+
+    class Meta:
+        verbose_name_plural = "scan journal entries"
+
+    def __str__(self):
+        return "%d %s %s" % (self.id, self.event, self.path)
+
+
+class JournalCheckpoint(models.Model):
+    """The last ScanJournalEntry sequence number processed by a consumer of the journal.
+
+    :var models.CharField consumer: name of the consumer
+    :var models.BigIntegerField sequence: sequence number of the last entry processed
+    :var models.DateTimeField updated: time the checkpoint was last committed
+    """
+
+    consumer = models.CharField(max_length=254, unique=True, help_text="Name of the consumer")
+    sequence = models.BigIntegerField(default=0, help_text="Sequence number of the last entry processed")
+    updated = models.DateTimeField(blank=True, null=True, help_text="Time the checkpoint was last committed")
+
+    def __str__(self):
+        return "%s (%d)" % (self.consumer, self.sequence)
+
+
+class Notification(models.Model):
+    """An email to a user, written to the outbox in the same transaction as the change it describes, and
+    sent later by xfc_notify (see xfc_control.notifications).  Failed sends are retried with an
+    exponential backoff, until MAX_ATTEMPTS have been made.
+
+    :var models.ForeignKey user: the user the email is to
+    :var models.EmailField to_address: address the email is sent to
+    :var models.EmailField from_address: address the email is sent from
+    :var models.CharField subject: subject of the email
+    :var models.TextField body: body of the email
+    :var models.CharField state: PENDING, SENT or FAILED
+    :var models.IntegerField attempts: number of attempts made to send the email
+    :var models.DateTimeField created: time the email was written to the outbox
+    :var models.DateTimeField next_attempt: time of the next attempt to send the email
+    :var models.DateTimeField sent: time the email was sent (None if it has not been sent)
+    :var models.TextField error: error from the last failed attempt
+    """
+
+    PENDING = "pending"
+    SENT = "sent"
+    FAILED = "failed"
+    STATE_CHOICES = ((PENDING, "Pending"), (SENT, "Sent"), (FAILED, "Failed"))
+
+    user = models.ForeignKey(User, blank=True, null=True, help_text="User the email is to",
+                             on_delete=models.SET_NULL)
+    to_address = models.EmailField(max_length=254, help_text="Address the email is sent to")
+    from_address = models.EmailField(max_length=254, help_text="Address the email is sent from")
+    subject = models.CharField(max_length=254, help_text="Subject of the email")
+    body = models.TextField(help_text="Body of the email")
+    state = models.CharField(max_length=8, choices=STATE_CHOICES, default=PENDING, help_text="Delivery state")
+    attempts = models.IntegerField(default=0, help_text="Number of attempts made to send the email")
+    created = models.DateTimeField(help_text="Time the email was written to the outbox")
+    next_attempt = models.DateTimeField(help_text="Time of the next attempt to send the email")
+    sent = models.DateTimeField(blank=True, null=True, help_text="Time the email was sent")
+    error = models.TextField(blank=True, default="", help_text="Error from the last failed attempt")
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["state", "next_attempt"], name="notification_state_next"),
+        ]
+
+    def __str__(self):
+        return "%s (%s)" % (self.subject, self.to_address)
+
+
+class DiskRollup(models.Model):
+    """Summary of a CacheDisk and its users, for the dashboard in the admin.  The rollups are refreshed
+    by the daemons (see xfc_control.dashboard), so that the dashboard does not read the User, CachedFile
+    and ScanPass tables.
+
+    :var models.OneToOneField cache_disk: the CacheDisk summarised
+    :var models.IntegerField n_users: number of users on the CacheDisk
+    :var FileSizeField quota_size: total of the users' quotas (bytes day)
+    :var FileSizeField quota_used: total of the quota used by the users (bytes day)
+    :var FileSizeField hard_limit_size: total of the users' hard limits
+    :var FileSizeField total_used: total size of the users' files
+    :var models.IntegerField n_over_quota: number of users over their quota
+    :var models.IntegerField n_over_hard_limit: number of users over their hard limit
+    :var models.IntegerField pending_deletions: number of ScheduledDeletions of the users
+    :var models.BigIntegerField pending_files: number of files in the ScheduledDeletions
+    :var FileSizeField pending_bytes: total size of the files in the ScheduledDeletions
+    :var models.DateTimeField oldest_scan: the least recent of the users' last finished scans
+    :var models.DateTimeField newest_scan: the most recent of the users' last finished scans
+    :var models.IntegerField n_stale: number of users not scanned in the last XFC_DASHBOARD_STALE_HOURS
+                                      (including the users that have never been scanned)
+    :var models.DateTimeField updated: time the rollup was refreshed
+    """
+
+    cache_disk = models.OneToOneField(CacheDisk, related_name="rollup", help_text="CacheDisk summarised",
+                                      on_delete=models.CASCADE)
+    n_users = models.IntegerField(default=0, help_text="Number of users on the CacheDisk")
+    quota_size = FileSizeField(default=0, help_text="Total of the users' quotas, in (bytes day)")
+    quota_used = FileSizeField(default=0, help_text="Total of the quota used by the users, in (bytes day)")
+    hard_limit_size = FileSizeField(default=0, help_text="Total of the users' hard limits")
+    total_used = FileSizeField(default=0, help_text="Total size of the users' files")
+    n_over_quota = models.IntegerField(default=0, help_text="Number of users over their quota")
+    n_over_hard_limit = models.IntegerField(default=0, help_text="Number of users over their hard limit")
+    pending_deletions = models.IntegerField(default=0, help_text="Number of scheduled deletions")
+    pending_files = models.BigIntegerField(default=0, help_text="Number of files scheduled for deletion")
+    pending_bytes = FileSizeField(default=0, help_text="Size of the files scheduled for deletion")
+    oldest_scan = models.DateTimeField(blank=True, null=True,
+                                       help_text="The least recent of the users' last finished scans")
+    newest_scan = models.DateTimeField(blank=True, null=True,
+                                       help_text="The most recent of the users' last finished scans")
+    n_stale = models.IntegerField(default=0, help_text="Number of users that have not been scanned recently")
+    updated = models.DateTimeField(help_text="Time the rollup was refreshed")
+
+    class Meta:
+        verbose_name = "dashboard"
+        verbose_name_plural = "dashboard"
+
+    def __str__(self):
+        return "%s" % self.cache_disk.mountpoint
+
+
+class UserRollup(models.Model):
+    """A user in one of the rankings on the dashboard in the admin: the top users by quota used, by
+    total size used, and by how far they are over their quota.  Refreshed with the DiskRollups.
+
+    :var models.CharField ranking: TEMPORAL, HARD or OVER_QUOTA
+    :var models.IntegerField rank: position of the user in the ranking, from 1
+    :var models.ForeignKey user: the user
+    :var FileSizeField used: quota used (TEMPORAL, OVER_QUOTA) or total size used (HARD)
+    :var FileSizeField limit: quota (TEMPORAL, OVER_QUOTA) or hard limit (HARD)
+    :var models.DateTimeField last_scan: time the user's last scan finished
+    """
+
+    TEMPORAL = "temporal"
+    HARD = "hard"
+    OVER_QUOTA = "over_quota"
+    RANKING_CHOICES = ((TEMPORAL, "Quota used"), (HARD, "Total used"), (OVER_QUOTA, "Over quota"))
+
+    ranking = models.CharField(max_length=16, choices=RANKING_CHOICES, help_text="Ranking the user is in")
+    rank = models.IntegerField(help_text="Position of the user in the ranking")
+    user = models.ForeignKey(User, help_text="User ranked", on_delete=models.CASCADE)
+    used = FileSizeField(default=0, help_text="Quota used, or total size used")
+    limit = FileSizeField(default=0, help_text="Quota, or hard limit")
+    last_scan = models.DateTimeField(blank=True, null=True, help_text="Time the user's last scan finished")
+
+    class Meta:
+        ordering = ["ranking", "rank"]
+
+    def __str__(self):
+        return "%s %d %s" % (self.ranking, self.rank, self.user.name)
+
+
+class ScanLease(models.Model):
+    """Lease on a CacheDisk (a shard) by an xfc_scan instance running with ``shard=true``, which scans the
+    users on the CacheDisk while it holds the lease (see xfc_control.sharding).  The lease is renewed by
+    the instance while it runs, and a lease that has expired can be taken by another instance, which
+    carries on the pass from where it was left.
+
+    :var models.OneToOneField cache_disk: the CacheDisk leased
+    :var models.CharField holder: the instance holding the lease (``<host>:<pid>``), blank if it is free
+    :var models.DateTimeField acquired: time the lease was taken by the holder
+    :var models.DateTimeField expires: time the lease expires, unless it is renewed
+    :var models.DateTimeField pass_started: time the current (or last) pass over the users started
+    :var models.DateTimeField pass_finished: time the last complete pass over the users finished
+    :var models.IntegerField users_total: number of users in the current pass
+    :var models.IntegerField users_done: number of users scanned in the current pass
+    :var models.CharField current_user: name of the user being scanned
+    """
+
+    cache_disk = models.OneToOneField(CacheDisk, related_name="scan_lease", help_text="CacheDisk leased",
+                                      on_delete=models.CASCADE)
+    holder = models.CharField(max_length=254, blank=True, default="", help_text="Instance holding the lease")
+    acquired = models.DateTimeField(blank=True, null=True, help_text="Time the lease was taken")
+    expires = models.DateTimeField(blank=True, null=True, help_text="Time the lease expires")
+    pass_started = models.DateTimeField(blank=True, null=True, help_text="Time the current pass started")
+    pass_finished = models.DateTimeField(blank=True, null=True, help_text="Time the last complete pass finished")
+    users_total = models.IntegerField(default=0, help_text="Number of users in the current pass")
+    users_done = models.IntegerField(default=0, help_text="Number of users scanned in the current pass")
+    current_user = models.CharField(max_length=254, blank=True, default="", help_text="User being scanned")
+
+    def in_pass(self):
+        """Return whether a pass has been started and not finished."""
+        return self.pass_started is not None and (self.pass_finished is None or
+                                                  self.pass_finished < self.pass_started)
+
+    def progress(self):
+        if self.users_total == 0:
+            return ""
+        return "%d / %d" % (self.users_done, self.users_total)
+
+    def __str__(self):
+        return "%s (%s)" % (self.cache_disk.mountpoint, self.holder or "free")
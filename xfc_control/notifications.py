@@ -0,0 +1,146 @@
+"""Outbox of the notification emails to users.
+
+The emails are not sent by the processes that decide to send them (xfc_schedule, xfc_delete and the
+REST API), which would hold the user's lock (or the web request) while waiting for the mail server,
+and would lose the email if the mail server was unavailable.  Instead they are written to the outbox
+as a Notification, in the same transaction as the change they describe::
+
+    with transaction.atomic():
+        sd.save()
+        queue_notification(user, subject, msg)
+
+so that the email is sent if, and only if, the change is committed.  The outbox is delivered by
+xfc_notify, which sends the emails in batches over one connection to the mail server, retrying
+the emails that fail with an exponential backoff.
+"""
+
+import datetime
+import logging
+
+from django.core.mail import EmailMessage, get_connection
+from django.db import transaction
+
+from xfc_control.models import Notification
+import xfc_site.settings as settings
+
+# from address is just a dummy address
+FROM_ADDRESS = "support@ceda.ac.uk"
+# number of attempts to send an email before it is marked as FAILED
+MAX_ATTEMPTS = 8
+# delay before the first retry, doubled after each failed attempt, up to MAX_BACKOFF
+BACKOFF = datetime.timedelta(minutes=1)
+MAX_BACKOFF = datetime.timedelta(hours=6)
+
+
+def queue_notification(user, subject, body, from_address=None):
+    """Write an email to a user to the outbox.  If this is called inside a transaction, the email is only
+    sent if the transaction is committed.
+       :var xfc_control.models.User user: user to send the email to
+       :var string subject: subject of the email
+       :var string body: body of the email
+       :var string from_address: (*optional*) address to send the email from
+       :return: the Notification
+    """
+    if from_address is None:
+        from_address = getattr(settings, "XFC_NOTIFY_FROM", FROM_ADDRESS)
+    now = datetime.datetime.utcnow()
+    return Notification.objects.create(
+        user=user, to_address=user.email, from_address=from_address, subject=subject, body=body,
+        created=now, next_attempt=now
+    )
+
+
+def backoff(attempts):
+    """Return the delay before the next attempt to send an email that has failed attempts times."""
+    return min(BACKOFF * 2 ** (attempts - 1), MAX_BACKOFF)
+
+
+def _failed(notification, error, now, max_attempts):
+    notification.attempts += 1
+    notification.error = str(error)
+    if notification.attempts >= max_attempts:
+        notification.state = Notification.FAILED
+        logging.error("Failed to send notification {} to {}: {}".format(
+            notification.pk, notification.to_address, error))
+    else:
+        notification.next_attempt = now + backoff(notification.attempts)
+        logging.warning("Could not send notification {} to {}, retrying at {}: {}".format(
+            notification.pk, notification.to_address, notification.next_attempt, error))
+
+
+def deliver_batch(batch_size=100, max_attempts=MAX_ATTEMPTS, connection=None):
+    """Send one batch of the pending emails that are due, over one connection to the mail server.
+    The batch is locked while it is sent (with SKIP LOCKED, where the database supports it) so that
+    more than one xfc_notify can deliver the outbox.
+       :var int batch_size: maximum number of emails to send
+       :var int max_attempts: number of attempts before an email is marked as FAILED
+       :var connection: (*optional*) mail backend to send with, defaults to ``get_connection()``
+       :return: (number sent, number failed) in the batch
+    """
+    now = datetime.datetime.utcnow()
+    n_sent = 0
+    n_failed = 0
+    with transaction.atomic():
+        batch = list(Notification.objects.select_for_update(skip_locked=True).filter(
+            state=Notification.PENDING, next_attempt__lte=now
+        ).order_by("next_attempt", "id")[:batch_size])
+        if len(batch) == 0:
+            return 0, 0
+
+        if connection is None:
+            connection = get_connection(fail_silently=False)
+        try:
+            connection.open()
+        except Exception as e:
+            # the mail server is unavailable - try the whole batch again later
+            for notification in batch:
+                _failed(notification, e, now, max_attempts)
+            n_failed = len(batch)
+        else:
+            try:
+                for notification in batch:
+                    message = EmailMessage(notification.subject, notification.body,
+                                           notification.from_address, [notification.to_address],
+                                           connection=connection)
+                    try:
+                        connection.send_messages([message])
+                    except Exception as e:
+                        _failed(notification, e, now, max_attempts)
+                        n_failed += 1
+                    else:
+                        notification.attempts += 1
+                        notification.state = Notification.SENT
+                        notification.sent = datetime.datetime.utcnow()
+                        notification.error = ""
+                        n_sent += 1
+            finally:
+                connection.close()
+
+        Notification.objects.bulk_update(batch, ["state", "attempts", "next_attempt", "sent", "error"])
+    return n_sent, n_failed
+
+
+def deliver(batch_size=100, max_attempts=MAX_ATTEMPTS, connection=None):
+    """Send all the pending emails that are due, in batches.
+       :return: (number sent, number failed)
+    """
+    total_sent = 0
+    total_failed = 0
+    while True:
+        n_sent, n_failed = deliver_batch(batch_size, max_attempts, connection)
+        total_sent += n_sent
+        total_failed += n_failed
+        # stop when the outbox is empty, or when the mail server is failing everything, rather than
+        # retrying the same emails in this run (their next_attempt has been moved on)
+        if n_sent == 0:
+            break
+    return total_sent, total_failed
+
+
+def purge(days):
+    """Delete the emails that were sent more than days ago.
+       :return: number of emails deleted
+    """
+    cutoff = datetime.datetime.utcnow() - datetime.timedelta(days=days)
+    deleted, _ = Notification.objects.filter(state=Notification.SENT, sent__lt=cutoff).delete()
+    return deleted
@@ -0,0 +1,171 @@
+"""Profiling of the runscript daemons, one user at a time.
+
+The daemons time each user, and each phase of the work for a user, with a Profiler::
+
+    profiler = Profiler("xfc_scan")
+    for user in User.objects.all():
+        with profiler.user(user.name):
+            with profiler.phase("walk"):
+                ...
+    profiler.finish()
+
+The durations are always recorded in the USER_DURATION and PHASE_DURATION metrics (see
+xfc_control.metrics).  When profiling is enabled (with the ``profile=true`` runscript argument), each
+user is also run under cProfile, and the wall time, CPU time and number of database queries of each
+phase are recorded.  The results of each run are written to ``<profile_dir>/<process>/<time>/``:
+
+  - ``<user>.prof``: the cProfile stats for the user, which can be read with ``python -m pstats``
+  - ``summary.json``: the per-phase breakdown for every user, slowest user first
+
+With ``profile_top=<n>`` only the stats of the n slowest users are written, so that a run over many
+users does not write a file for each of them.
+
+Profiling slows the daemons down, and cProfile only profiles the thread (and process) it was started
+in - the processes in the pool of ``xfc_fix_quotas processes=<n>`` are not profiled.
+"""
+
+import cProfile
+import datetime
+import heapq
+import json
+import os
+import tempfile
+import time
+from contextlib import contextmanager
+
+from django.db import connection
+
+from xfc_control.metrics import PHASE_DURATION, USER_DURATION
+import xfc_site.settings as settings
+
+
+class Profiler(object):
+    """Times the users and phases of a run of a daemon, and profiles them if enabled."""
+
+    def __init__(self, process, enabled=False, profile_dir=None, top_n=None):
+        """:var string process: name of the daemon
+           :var bool enabled: run each user under cProfile and record the per-phase breakdown
+           :var string profile_dir: (*optional*) directory to write the results to, defaults to the
+                                    XFC_PROFILE_DIR setting, or ``xfc_profile`` in the temporary directory
+           :var int top_n: (*optional*) only write the cProfile stats of the top_n slowest users
+        """
+        self.process = process
+        self.enabled = enabled
+        if profile_dir is None:
+            profile_dir = getattr(settings, "XFC_PROFILE_DIR", os.path.join(tempfile.gettempdir(), "xfc_profile"))
+        self.run_dir = os.path.join(profile_dir, process, datetime.datetime.utcnow().strftime("%Y%m%dT%H%M%S"))
+        self.top_n = top_n
+        # the per-phase breakdown of each user
+        self.summaries = []
+        # the profiles of the slowest users, as a heap of (wall time, sequence, name, profile)
+        self._kept = []
+        self._current = None
+        self._queries = 0
+
+    def _count_query(self, execute, sql, params, many, context):
+        self._queries += 1
+        return execute(sql, params, many, context)
+
+    def _write_stats(self, name, profile):
+        os.makedirs(self.run_dir, exist_ok=True)
+        profile.dump_stats(os.path.join(self.run_dir, name.replace(os.sep, "_") + ".prof"))
+
+    @contextmanager
+    def user(self, name):
+        """Context manager for all the work for one user.
+           :var string name: name of the user
+        """
+        if not self.enabled:
+            with USER_DURATION.time(process=self.process):
+                yield
+            return
+
+        summary = {"user": name, "phases": {}}
+        self._current = summary
+        self._queries = 0
+        profile = cProfile.Profile()
+        start_wall = time.perf_counter()
+        start_cpu = time.process_time()
+        try:
+            with connection.execute_wrapper(self._count_query):
+                profile.enable()
+                try:
+                    yield
+                finally:
+                    profile.disable()
+        finally:
+            summary["wall_s"] = time.perf_counter() - start_wall
+            summary["cpu_s"] = time.process_time() - start_cpu
+            summary["queries"] = self._queries
+            USER_DURATION.observe(summary["wall_s"], process=self.process)
+            self._current = None
+            self.summaries.append(summary)
+            if self.top_n is None:
+                self._write_stats(name, profile)
+            elif self.top_n > 0:
+                entry = (summary["wall_s"], len(self.summaries), name, profile)
+                if len(self._kept) < self.top_n:
+                    heapq.heappush(self._kept, entry)
+                else:
+                    heapq.heappushpop(self._kept, entry)
+
+    @contextmanager
+    def phase(self, name):
+        """Context manager for one phase of the work for the current user.
+           :var string name: name of the phase
+        """
+        if self._current is None:
+            with PHASE_DURATION.time(process=self.process, phase=name):
+                yield
+            return
+
+        start_wall = time.perf_counter()
+        start_cpu = time.process_time()
+        start_queries = self._queries
+        try:
+            yield
+        finally:
+            wall = time.perf_counter() - start_wall
+            PHASE_DURATION.observe(wall, process=self.process, phase=name)
+            phase = self._current["phases"].setdefault(name, {"wall_s": 0.0, "cpu_s": 0.0, "queries": 0, "calls": 0})
+            phase["wall_s"] += wall
+            phase["cpu_s"] += time.process_time() - start_cpu
+            phase["queries"] += self._queries - start_queries
+            phase["calls"] += 1
+
+    def finish(self):
+        """Write the stats of the slowest users (with top_n) and the summary of the run.
+           :return: path of the summary, or None if profiling is not enabled
+        """
+        if not self.enabled:
+            return None
+        profiled = []
+        if self.top_n is None:
+            profiled = [s["user"] for s in self.summaries]
+        else:
+            for wall, seq, name, profile in self._kept:
+                self._write_stats(name, profile)
+                profiled.append(name)
+            self._kept = []
+        os.makedirs(self.run_dir, exist_ok=True)
+        path = os.path.join(self.run_dir, "summary.json")
+        with open(path, "w") as fh:
+            json.dump({"process": self.process,
+                       "users": sorted(self.summaries, key=lambda s: s["wall_s"], reverse=True),
+                       "profiled": profiled}, fh, indent=2)
+        return path
+
+
+def profiler_from_args(process, arg_dict):
+    """Create the Profiler for a daemon from its runscript arguments:
+
+      - ``profile=true|false``: profile each user (default false)
+      - ``profile_dir=<path>``: directory to write the profiles to
+      - ``profile_top=<n>``: only write the cProfile stats of the n slowest users
+
+       :var string process: name of the daemon
+       :var dict arg_dict: the arguments from split_args
+    """
+    enabled = (arg_dict.get("profile", "false").lower() == "true")
+    top_n = int(arg_dict["profile_top"]) if "profile_top" in arg_dict else None
+    return Profiler(process, enabled, arg_dict.get("profile_dir"), top_n)
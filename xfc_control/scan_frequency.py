@@ -0,0 +1,88 @@
+"""Adaptive scheduling of the scans of each user, from how often their files change.
+
+Rather than every user being scanned on every run of xfc_scan, each user is given a time they are
+next due to be scanned (User.next_scan) at the end of each scan, and the users that are not due are
+skipped.  The interval to the next scan is worked out from:
+
+  - **churn**: the moving average of the number of files added, resized and removed per hour
+    (User.churn).  The interval is the time in which TARGET_CHANGES files are expected to change, so
+    a busy user is scanned often and an idle user rarely
+  - **cost**: the interval is at least COST_FACTOR times the time the last scan took
+    (User.scan_seconds), so that a large user is not scanned almost continuously
+  - **quota**: a user whose quota used or total used is within NEAR_QUOTA of their quota or hard limit
+    is scanned every MIN_HOURS.  As the quota used grows by the total used each day, a user is also
+    scanned at least twice in the time they would take to reach their quota with no changes
+  - **bounds**: the interval is between MIN_HOURS and MAX_HOURS, so that every user is scanned at
+    least every MAX_HOURS
+
+Each of these can be changed with the XFC_SCAN_<name> setting, e.g. XFC_SCAN_MAX_HOURS.
+"""
+
+import datetime
+
+import xfc_site.settings as settings
+
+MIN_HOURS = 1.0
+MAX_HOURS = 72.0
+TARGET_CHANGES = 100
+COST_FACTOR = 10.0
+NEAR_QUOTA = 0.9
+# weight of the latest scan in the moving average of the churn
+CHURN_WEIGHT = 0.5
+
+
+def _setting(name, default):
+    return getattr(settings, "XFC_SCAN_" + name, default)
+
+
+def churn_rate(scan_pass, previous_scan):
+    """Return the number of files changed per hour between the previous scan and a scan.
+       :var xfc_control.models.ScanPass scan_pass: the scan
+       :var datetime.datetime previous_scan: time the previous scan of the user finished, or None
+       :return: the rate, or None if there was no previous scan
+    """
+    if previous_scan is None:
+        # the first scan adds all the files, which is not a change
+        return None
+    hours = max((scan_pass.finished - previous_scan).total_seconds() / 3600.0, 1.0 / 60)
+    return (scan_pass.n_added + scan_pass.n_resized + scan_pass.n_removed) / hours
+
+
+def scan_interval(user):
+    """Return the time to the next scan of a user, from their churn, scan time and quota.
+       :var xfc_control.models.User user: the user, with churn, scan_seconds and the quotas set
+       :return: datetime.timedelta
+    """
+    min_hours = _setting("MIN_HOURS", MIN_HOURS)
+    max_hours = _setting("MAX_HOURS", MAX_HOURS)
+    if user.churn > 0:
+        hours = _setting("TARGET_CHANGES", TARGET_CHANGES) / user.churn
+    else:
+        hours = max_hours
+    # do not spend too much of the time scanning a large user
+    hours = max(hours, _setting("COST_FACTOR", COST_FACTOR) * user.scan_seconds / 3600.0)
+
+    near = _setting("NEAR_QUOTA", NEAR_QUOTA)
+    if ((user.quota_size > 0 and user.quota_used >= near * user.quota_size) or
+            (user.hard_limit_size > 0 and user.total_used >= near * user.hard_limit_size)):
+        hours = min_hours
+    elif user.quota_size > 0 and user.total_used > 0:
+        # the quota used grows by the total used each day
+        hours_to_quota = (user.quota_size - user.quota_used) / user.total_used * 24
+        hours = min(hours, hours_to_quota / 2)
+    return datetime.timedelta(hours=min(max(hours, min_hours), max_hours))
+
+
+def schedule_next_scan(user, scan_pass):
+    """Update the churn and scan time of a user from a scan, and set the time of their next scan.  The
+    user is not saved.
+       :var xfc_control.models.User user: the user, with last_scanned still the time of the previous scan,
+                                         and the quotas from this scan
+       :var xfc_control.models.ScanPass scan_pass: the scan
+    """
+    rate = churn_rate(scan_pass, user.last_scanned)
+    if rate is not None:
+        weight = _setting("CHURN_WEIGHT", CHURN_WEIGHT)
+        user.churn = weight * rate + (1 - weight) * user.churn
+    user.scan_seconds = (scan_pass.finished - scan_pass.started).total_seconds()
+    user.next_scan = scan_pass.finished + scan_interval(user)
@@ -1,8 +1,14 @@
 """Read in the config file for, convert from JSON to a dictionary and return
 the config xfc."""
 
+import atexit
+import copy
+import datetime
 import json
 import logging
+import logging.handlers
+import queue
+import sys
 
 def config_path():
     """Return the path of the config file"""
@@ -41,6 +47,98 @@ def get_logging_format():
     formt = "[%(asctime)s] %(levelname)s:%(message)s"
     return formt
 
+# format of the asctime in the text log format
+LOG_DATE_FORMAT = '%Y-%d-%m %I:%M:%S'
+
+# attributes of every LogRecord - any other attributes are fields passed with ``extra=``
+_LOG_RECORD_ATTRIBUTES = set(logging.makeLogRecord({}).__dict__) | {"message", "asctime", "taskName"}
+
+
+class JsonFormatter(logging.Formatter):
+    """Format each log record as a single line of JSON, with the time (UTC), level, process and
+    message, and any fields passed to the logging call with ``extra=``::
+
+        logging.info("Scanned user %s", user.name, extra={"user": user.name, "n_files": n_files})
+    """
+
+    def __init__(self, process=None):
+        super(JsonFormatter, self).__init__()
+        self.process = process
+
+    def format(self, record):
+        entry = {
+            "time": datetime.datetime.utcfromtimestamp(record.created).isoformat() + "Z",
+            "level": record.levelname,
+            "process": self.process,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for key, value in record.__dict__.items():
+            if key not in _LOG_RECORD_ATTRIBUTES and key not in entry:
+                entry[key] = value
+        if record.exc_info:
+            entry["exc_info"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that leaves the traceback of a record to the formatter of the listener.  The
+    default QueueHandler formats the traceback into the message and removes it from the record, so
+    that the record can be pickled, which is not needed as the listener is in the same process."""
+
+    def prepare(self, record):
+        # merge the arguments into the message now, as they may be changed before the record is written
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+
+def setup_logging(process, config):
+    """Set up the logging for a daemon.  The log records are put on a queue by the daemon's thread and
+    written by a QueueListener in a background thread, so that the daemon does not wait for the log to
+    be written.  Records below the log level are discarded before they are formatted, so the
+    arguments of a debug message should be passed to the logging call rather than formatted into the
+    message::
+
+        logging.debug("Adding file: %s", filepath)
+
+    The process config can contain:
+
+      - ``LOG_LEVEL``: DEBUG, INFO, WARNING, ERROR or CRITICAL
+      - ``LOG_FORMAT``: ``text`` (default) or ``json``, for one JSON object per record
+      - ``LOG_FILE``: (*optional*) file to write the log to, rather than standard error
+
+       :var string process: name of the daemon
+       :var dict config: the process config (see read_process_config)
+       :return: the QueueListener, which is stopped (and the remaining records written) at exit
+    """
+    if config.get("LOG_FILE"):
+        handler = logging.handlers.WatchedFileHandler(config["LOG_FILE"])
+    else:
+        handler = logging.StreamHandler(sys.stderr)
+    if config.get("LOG_FORMAT", "text").lower() == "json":
+        handler.setFormatter(JsonFormatter(process))
+    else:
+        handler.setFormatter(logging.Formatter(get_logging_format(), datefmt=LOG_DATE_FORMAT))
+
+    log_queue = queue.SimpleQueue()
+    root = logging.getLogger()
+    for h in list(root.handlers):
+        root.removeHandler(h)
+    root.addHandler(_QueueHandler(log_queue))
+    root.setLevel(get_logging_level(config["LOG_LEVEL"]))
+
+    listener = logging.handlers.QueueListener(log_queue, handler, respect_handler_level=True)
+    listener.start()
+
+    def stop_listener():
+        # write the records left on the queue, unless the listener has already been stopped
+        if listener._thread is not None:
+            listener.stop()
+    atexit.register(stop_listener)
+    return listener
+
 def split_args(args):
     # split args that are in the form somekey=somevalue into a dictionary
     arg_dict = {}
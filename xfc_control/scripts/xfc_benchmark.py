@@ -0,0 +1,86 @@
+"""Function to run the benchmarks in xfc_control.benchmarks and output the results as JSON.
+
+ This script is designed to be run via the django-extensions runscript command, against a scratch
+ database:
+
+  ``python manage.py runscript xfc_benchmark --script-args suite=index rows=20000000 compare=true``
+
+ Arguments:
+
+  - ``suite=index|pipeline``: the benchmark to run (default index)
+  - ``output=<path>``: file to write the JSON results to (default: standard output)
+  - ``keep=true|false``: keep the synthetic data for the next run (default false)
+
+ Arguments for ``suite=index`` (see xfc_control.benchmarks.cachedfile_index):
+
+  - ``rows=<n>``: number of synthetic CachedFiles (default 20000000)
+  - ``users=<n>``: number of synthetic Users (default 1000)
+  - ``probes=<n>``: number of lookups to time for each query (default 1000)
+  - ``compare=true|false``: also measure with the indexes dropped (default false)
+
+ Arguments for ``suite=pipeline`` (see xfc_control.benchmarks.pipeline):
+
+  - ``users=<n>``: number of synthetic Users (default 10)
+  - ``files=<n>``: number of files in each user's tree (default 10000)
+  - ``depth=<n>``: number of levels of subdirectories (default 3)
+  - ``fanout=<n>``: number of subdirectories in each directory (default 4)
+  - ``size_mu=<x>``, ``size_sigma=<x>``: log-normal distribution of the file sizes (default 12, 3)
+  - ``age_days=<n>``: spread of the ages of the files in days (default 365)
+  - ``baseline=<path>``: (*optional*) JSON results of an earlier run to compare against
+  - ``tolerance=<x>``: fraction by which a step can be slower than the baseline (default 0.2)
+
+  For example, to record a baseline and compare a later run against it::
+
+    python manage.py runscript xfc_benchmark --script-args suite=pipeline output=baseline.json
+    python manage.py runscript xfc_benchmark --script-args suite=pipeline baseline=baseline.json
+"""
+
+import json
+import sys
+
+from xfc_control.scripts.config import split_args
+
+
+def run(*args):
+    """Entry point for the Django script run via ``./manage.py runscript``
+    """
+    arg_dict = split_args(args)
+    suite = arg_dict.get("suite", "index")
+    keep = (arg_dict.get("keep", "false").lower() == "true")
+
+    if suite == "index":
+        from xfc_control.benchmarks.cachedfile_index import run_benchmark
+        results = run_benchmark(
+            rows=int(arg_dict.get("rows", 20000000)),
+            users=int(arg_dict.get("users", 1000)),
+            probes=int(arg_dict.get("probes", 1000)),
+            compare=(arg_dict.get("compare", "false").lower() == "true"),
+            keep=keep,
+        )
+    elif suite == "pipeline":
+        from xfc_control.benchmarks.pipeline import run_benchmark
+        baseline = None
+        if "baseline" in arg_dict:
+            with open(arg_dict["baseline"]) as fh:
+                baseline = json.load(fh)
+        results = run_benchmark(
+            users=int(arg_dict.get("users", 10)),
+            files=int(arg_dict.get("files", 10000)),
+            depth=int(arg_dict.get("depth", 3)),
+            fanout=int(arg_dict.get("fanout", 4)),
+            size_mu=float(arg_dict.get("size_mu", 12.0)),
+            size_sigma=float(arg_dict.get("size_sigma", 3.0)),
+            age_days=int(arg_dict.get("age_days", 365)),
+            baseline=baseline,
+            tolerance=float(arg_dict.get("tolerance", 0.2)),
+            keep=keep,
+        )
+    else:
+        raise Exception("Unknown benchmark suite: {}".format(suite))
+
+    if "output" in arg_dict:
+        with open(arg_dict["output"], "w") as fh:
+            json.dump(results, fh, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        sys.stdout.write("\n")
@@ -0,0 +1,185 @@
+"""Function to save the results of the scans from the completion queue, which are published by the
+scanners (``xfc_scan consume=true``, see xfc_control.broker).
+
+The messages are taken from the queue in batches, and each batch is applied in one transaction: the
+quota used, total used, last_scanned and next scan time (see xfc_control.scan_frequency) of all the
+users in the batch are saved with one bulk update, and the used space of each CacheDisk with one
+update.  The whole batch is then acknowledged at once.  A notification email is queued (in the same
+transaction) for each user that has gone over their quota or hard limit since their last scan.  After
+each batch, the dashboard rollups (see xfc_control.dashboard) are refreshed with the new quotas.
+
+A batch is applied when it has ``batch_size`` messages, or when no message has arrived for
+IDLE_SECONDS.  If a batch fails it is put back on the queue to be tried once more, and it is dropped if
+it fails again - the next scans of the users will correct their quotas.
+
+ This script is designed to be run via the django-extensions runscript command:
+
+  ``python manage.py runscript xfc_complete --script-args daemon=true``
+
+ Arguments:
+
+  - ``daemon=true|false``: keep consuming the queue, rather than stopping when it is empty (default false)
+  - ``batch_size=<n>``: number of messages to apply in each transaction (default 500)
+  - ``broker=<url>``: URL of the broker (default: the XFC_BROKER_URL setting)
+"""
+
+import datetime
+import logging
+import signal, sys
+
+from django.db import transaction
+from django.db.models import F
+from sizefield.utils import filesizeformat
+
+from xfc_control.models import User, CacheDisk
+from xfc_control.broker import get_broker, complete_queue
+from xfc_control.notifications import queue_notification
+from xfc_control.dashboard import refresh_rollups
+from xfc_control.metrics import ROWS_WRITTEN, write_process_metrics
+
+from xfc_control.scripts.config import read_process_config, split_args
+from xfc_control.scripts.config import setup_logging
+
+
+def send_notification_email(user, over_quota, over_limit):
+    """Queue an email to the user to tell them they have gone over their quota or hard limit.  The email
+    is sent by xfc_notify.
+    :var xfc_control.models.User user: user to send notification email to
+    :var bool over_quota: the user has gone over their quota
+    :var bool over_limit: the user has gone over their hard limit
+    """
+    if not user.notify:
+        return
+
+    subject = "[XFC] - Over quota"
+    msg = "JASMIN user: " + str(user.name) + " is over their "
+    if over_quota:
+        msg += "quota on the transfer cache (XFC).\n\n"
+    else:
+        msg += "hard limit on the transfer cache (XFC).\n\n"
+    msg += "Quota used: " + filesizeformat(user.quota_used) + " of " + filesizeformat(user.quota_size) + " (size x days)\n"
+    msg += "Total used: " + filesizeformat(user.total_used) + " of " + filesizeformat(user.hard_limit_size) + "\n\n"
+    msg += "The oldest files will be scheduled for deletion, and you will be notified before they are deleted."
+
+    queue_notification(user, subject, msg)
+
+
+def apply_completions(messages):
+    """Save the results of a batch of scans, in one transaction.
+       :var List[dict] messages: the completion messages
+       :return: (number of users updated, number of users notified)
+    """
+    # the latest scan of each user - a batch can hold more than one scan of a user
+    latest = {}
+    for message in messages:
+        finished = datetime.datetime.fromisoformat(message["finished"])
+        if message["user_id"] not in latest or finished > latest[message["user_id"]][0]:
+            latest[message["user_id"]] = (finished, message)
+
+    with transaction.atomic():
+        users = User.objects.select_for_update().filter(pk__in=list(latest)).order_by("pk")
+        updated = []
+        disk_used = {}
+        notify = []
+        for user in users:
+            finished, message = latest[user.pk]
+            # a scan that finished before one already saved is out of date
+            if user.last_scanned is not None and finished <= user.last_scanned:
+                continue
+            was_over_quota = user.quota_used > user.quota_size
+            was_over_limit = user.total_used > user.hard_limit_size
+            disk_used[user.cache_disk_id] = (disk_used.get(user.cache_disk_id, 0) +
+                                             message["total_used"] - user.total_used)
+            user.quota_used = message["quota_used"]
+            user.total_used = message["total_used"]
+            user.last_scanned = finished
+            user.scan_dispatched = None
+            if message.get("next_scan") is not None:
+                user.churn = message["churn"]
+                user.scan_seconds = message["scan_seconds"]
+                user.next_scan = datetime.datetime.fromisoformat(message["next_scan"])
+            updated.append(user)
+            over_quota = user.quota_used > user.quota_size and not was_over_quota
+            over_limit = user.total_used > user.hard_limit_size and not was_over_limit
+            if over_quota or over_limit:
+                notify.append((user, over_quota, over_limit))
+
+        User.objects.bulk_update(updated, ["quota_used", "total_used", "last_scanned", "scan_dispatched",
+                                           "churn", "scan_seconds", "next_scan"], batch_size=1000)
+        ROWS_WRITTEN.inc(len(updated), process="xfc_complete", model="User", operation="update")
+        for cache_disk, amount in disk_used.items():
+            if amount != 0:
+                CacheDisk.objects.filter(pk=cache_disk).update(used_bytes=F("used_bytes") + amount)
+        # the emails are only sent if the batch is committed
+        for user, over_quota, over_limit in notify:
+            send_notification_email(user, over_quota, over_limit)
+    n_notified = sum(1 for user, over_quota, over_limit in notify if user.notify)
+    return len(updated), n_notified
+
+
+def apply_batch(broker, batch):
+    """Apply a batch of deliveries from the completion queue, and acknowledge them all, or put them
+    back on the queue if the batch fails."""
+    try:
+        n_updated, n_notified = apply_completions([delivery.body for delivery in batch])
+    except Exception:
+        logging.exception("Could not apply a batch of %d scan completions", len(batch))
+        for delivery in batch:
+            # try each message once more, in case the failure was transient
+            broker.nack(delivery, requeue=not delivery.redelivered)
+        return
+    broker.ack(batch[-1], multiple=True)
+    logging.info("Applied %d scan completions: %d users updated, %d notified", len(batch), n_updated,
+                 n_notified, extra={"n_messages": len(batch), "n_users": n_updated, "n_notified": n_notified})
+
+
+def consume_loop(config, broker, batch_size=500, stop_when_idle=True):
+    """Apply the completion messages in batches.
+       :var dict config: the process config
+       :var broker: the broker to consume from (see xfc_control.broker)
+       :var int batch_size: maximum number of messages to apply in each transaction
+       :var bool stop_when_idle: return when the queue is empty, rather than waiting for more messages
+    """
+    idle_seconds = config.get("IDLE_SECONDS", 5)
+    batch = []
+    # the prefetch is the batch size, so that a full batch can be delivered before it is acknowledged
+    for delivery in broker.consume(complete_queue(), prefetch=batch_size, inactivity_timeout=idle_seconds):
+        if delivery is not None:
+            batch.append(delivery)
+            if len(batch) < batch_size:
+                continue
+        if len(batch) != 0:
+            apply_batch(broker, batch)
+            batch = []
+            refresh_rollups()
+            write_process_metrics("xfc_complete")
+        elif stop_when_idle:
+            break
+
+
+def exit_handler(signal, frame):
+    logging.info("Stopping xfc_complete")
+    sys.exit(0)
+
+
+def run(*args):
+    """Entry point for the Django script run via ``./manage.py runscript``
+    """
+    # setup the logging
+    config = read_process_config("xfc_complete")
+    setup_logging("xfc_complete", config)
+    logging.info("Starting xfc_complete")
+
+    # setup exit signal handling
+    signal.signal(signal.SIGINT, exit_handler)
+    signal.signal(signal.SIGHUP, exit_handler)
+    signal.signal(signal.SIGTERM, exit_handler)
+
+    arg_dict = split_args(args)
+    daemon = (arg_dict.get("daemon", "false").lower() == "true")
+    batch_size = int(arg_dict.get("batch_size", 500))
+    broker = get_broker(arg_dict.get("broker"))
+    try:
+        consume_loop(config, broker, batch_size, stop_when_idle=not daemon)
+    finally:
+        broker.close()
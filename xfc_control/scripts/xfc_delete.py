@@ -1,34 +1,57 @@
 """Function to delete files in the ScheduledDeletions after the notification period has been served.
 
    If the  modification date on the files is updated (ahead of deletion entry), then the deletion
-   will not take place.  This allows users to touch files to keep them.
+   will not take place.  This allows users to touch files to keep them.  The files that were modified
+   when xfc_scan last stored their modification time (CachedFile.mtime) are kept without being read
+   from the disk, and only the remaining files are checked again, just before they are deleted.
 
    However, the scheduling algorithm is relentless - it will simply schedule some other files to
    be deleted.
 
+   For the directory totals scheduled for users in CacheDisk.DIRECTORY_MODE, the files in the directory
+   (and in its subdirectories, if the total is for the subtree) are deleted, with the same check of the
+   modification date and also of the change date, so that files moved into the directory after the deletion
+   was scheduled are kept.  Links are not followed.  The total is reduced by the files deleted.
+
    This script is designed to be run via the django-extensions runscript command:
 
       ``python manage.py runscript xfc_delete``
+
+   Arguments:
+
+    - ``daemon=true|false``: run continuously, every RUN_EVERY_HOURS (default false)
+    - ``profile=true|false``: profile each user, writing the cProfile stats and the per-phase breakdown
+      to ``profile_dir`` (see xfc_control.profiling, default false)
+    - ``profile_dir=<path>``: directory to write the profiles to (default: the XFC_PROFILE_DIR setting)
+    - ``profile_top=<n>``: (*optional*) only write the cProfile stats of the n slowest users
 """
 import datetime, calendar
 import os
+import stat
 import logging
 from time import sleep
 import signal, sys
 
-from django.core.mail import send_mail
+from django.db import transaction
+from django.db.models import Q
 
-from xfc_control.models import User, CachedFile, ScheduledDeletion
+from xfc_control.models import User, ScheduledDeletion
 from xfc_control.scripts.xfc_user_lock import lock_user, user_locked, unlock_user
 from xfc_control.scripts.xfc_scan import update_cache_disk_used_space, calc_user_quota, calc_user_used_space
-from xfc_control.scripts.xfc_scan import get_log_time_string
+from xfc_control.journal import ScanJournal
+from xfc_control.notifications import queue_notification
+from xfc_control.metrics import STAT_ERRORS, ROWS_WRITTEN
+from xfc_control.profiling import Profiler, profiler_from_args
+from xfc_control.dashboard import refresh_rollups
+from xfc_control.metrics import LOCK_WAIT, USERS_LOCKED, write_process_metrics
 
 from xfc_control.scripts.config import read_process_config, split_args
-from xfc_control.scripts.config import get_logging_format, get_logging_level
+from xfc_control.scripts.config import setup_logging
 
 
 def send_notification_email(user, file_list, date):
-    """Send an email to the user to notify which files will be deleted and when
+    """Queue an email to the user to notify which files will be deleted and when.  The email is
+    sent by xfc_notify.
     :var xfc_control.models.User user: user to send notification email to
     """
     if not user.notify:
@@ -37,26 +60,84 @@ def send_notification_email(user, file_list, date):
     if len(file_list) == 0:
         return
 
-    # to address is notify_on_first
-    toaddrs = [user.email]
-    # from address is just a dummy address
-    fromaddr = "support@ceda.ac.uk"
-
     # subject
     subject = "[XFC] - Files deleted"
     date_string = "% 2i %s %d %02d:%02d" % (date.day, calendar.month_abbr[date.month], date.year, date.hour, date.minute)
 
     msg = "The following files have been deleted on " + date_string + " UTC\n\n"
     for f in file_list:
-        msg += os.path.join(user.cache_disk.mountpoint, f.path) + "\n"
+        msg += os.path.join(user.cache_disk.mountpoint, f) + "\n"
+
+    queue_notification(user, subject, msg)
+
+
+def directory_files(dir_path, subtree):
+    """Return the paths of the files recorded by a directory total.  Links to directories are not followed,
+    so that only files below the directory are returned.
+       :var string dir_path: full path to the directory
+       :var bool subtree: include the files in the subdirectories
+    """
+    if subtree:
+        for root, dirs, files in os.walk(dir_path):
+            for file in files:
+                yield os.path.join(root, file)
+    else:
+        try:
+            with os.scandir(dir_path) as it:
+                entries = [entry.path for entry in it if entry.is_file(follow_symlinks=False)]
+        except OSError:
+            return
+        for path in entries:
+            yield path
 
-    send_mail(subject, msg, fromaddr, toaddrs, fail_silently=False)
 
+def delete_directory_files(user, sd, cd, journal=None):
+    """Delete the files recorded by a directory total in a ScheduledDeletion, except those that have been
+    modified since the deletion was scheduled, and reduce the directory total by the files deleted.
+       :var User user: user to perform deletions for
+       :var ScheduledDeletion sd: the scheduled deletion
+       :var CachedDirectory cd: the directory total
+       :var xfc_control.journal.ScanJournal journal: (*optional*) journal to record the change to the total in
+       :return: list of the paths of the deleted files, AFTER the CacheDisk mountpoint
+    """
+    deleted = []
+    deleted_size = 0
+    for filepath in directory_files(os.path.join(user.cache_disk.mountpoint, cd.path), cd.subtree):
+        try:
+            st = os.lstat(filepath)
+            # check file_date against time_entered - anything newer will not be deleted.  The change time is
+            # checked as well, as a file moved or copied (with its modification time) into the directory
+            # after the deletion was scheduled keeps its old modification time
+            if not stat.S_ISREG(st.st_mode):
+                continue
+            if datetime.datetime.utcfromtimestamp(max(st.st_mtime, st.st_ctime)) >= sd.time_entered:
+                continue
+            os.unlink(filepath)
+        except:
+            logging.error("Could not delete the file: %s", filepath)
+        else:
+            logging.debug("Deleted file: %s", filepath)
+            deleted.append(os.path.relpath(filepath, user.cache_disk.mountpoint))
+            deleted_size += st.st_size
+    old_size = cd.own_size
+    cd.own_size = max(cd.own_size - deleted_size, 0)
+    cd.own_files = max(cd.own_files - len(deleted), 0)
+    cd.save(update_fields=["own_size", "own_files"])
+    if journal is not None and len(deleted) != 0:
+        if cd.own_files == 0:
+            journal.remove(cd.path, old_size, aggregate=True)
+        else:
+            journal.resize(cd.path, old_size, cd.own_size, aggregate=True)
+    return deleted
 
-def do_deletions(user):
+
+def do_deletions(user, profiler=None):
     """Delete files from the ScheduledDeletions
     :var User user: user to perform deletions for
+    :var xfc_control.profiling.Profiler profiler: (*optional*) profiler to time the phases with
     """
+    if profiler is None:
+        profiler = Profiler("xfc_delete")
     # get the scheduled deletion(s) that have a schedule time less than the current time
     # there should only be one (due to the user locking but we'll assume there may be more
     scheduled_deletions = ScheduledDeletion.objects.filter(user=user, time_delete__lt=datetime.datetime.utcnow())
@@ -67,21 +148,14 @@ def do_deletions(user):
     # keep a list of files to delete, as those with newer date will not be deleted
     files_to_delete = []
 
-    # loop over them all
-    for sd in scheduled_deletions:
-        # loop over all the files
-        for file in sd.delete_files.all():
-            # get the filepath
-            filepath = os.path.join(user.cache_disk.mountpoint, file.path)
-            log_time = get_log_time_string()
-            try:
-                # get the time from the file
-                file_date = datetime.datetime.fromtimestamp(os.stat(filepath).st_mtime)
-                # check file_date against time_entered - anything newer will not be deleted
-                if file_date < sd.time_entered:
-                    files_to_delete.append(file)
-            except:
-                logging.error("[" + log_time + "] Could not get information about file: " + filepath)
+    with profiler.phase("check"):
+        # loop over them all
+        for sd in scheduled_deletions:
+            # the files modified after time_entered when they were last scanned will not be deleted.  The
+            # others are checked again before they are deleted, as they may have been touched since
+            candidates = sd.delete_files.filter(Q(mtime__isnull=True) | Q(mtime__lt=sd.time_entered))
+            for file in candidates.select_related("directory"):
+                files_to_delete.append((file, sd.time_entered))
 
     # There are five things to do when deleting the file:
     # 1. Update the user's quota, subtracting the amount used
@@ -92,70 +166,107 @@ def do_deletions(user):
 
     # get the number of bytes used on the cache disk by the user
     old_user_used_space = user.total_used
-    # Delete the files and remove from the database
-    for file in files_to_delete:
-        try:
+    deleted_paths = []
+    # record the deletions in the journal
+    journal = ScanJournal(user)
+    with profiler.phase("unlink"):
+        # Delete the files and remove from the database
+        for file, time_entered in files_to_delete:
             # get the filepath
             filepath = os.path.join(user.cache_disk.mountpoint, file.path)
-            os.unlink(filepath)
-        except:
-            logging.error("[" + log_time + "] Could not delete the file: " + filepath)
-        else:
-            # remove the file from the database
-            logging.info("[" + log_time + "] Deleted file: " + filepath)
-            file.delete()
+            try:
+                # get the time from the file
+                file_date = datetime.datetime.utcfromtimestamp(os.stat(filepath).st_mtime)
+            except:
+                logging.error("Could not get information about file: %s", filepath)
+                STAT_ERRORS.inc(process="xfc_delete")
+                continue
+            # check file_date against time_entered - anything newer will not be deleted
+            if file_date >= time_entered:
+                continue
+            try:
+                os.unlink(filepath)
+            except:
+                logging.error("Could not delete the file: %s", filepath)
+            else:
+                # remove the file from the database
+                logging.debug("Deleted file: %s", filepath)
+                deleted_paths.append(file.path)
+                journal.remove(file.path, file.size)
+                file.delete()
+                ROWS_WRITTEN.inc(process="xfc_delete", model="CachedFile", operation="delete")
+
+        # Delete the files in the directory totals
+        for sd in scheduled_deletions:
+            for cd in sd.delete_directories.all():
+                deleted_paths.extend(delete_directory_files(user, sd, cd, journal))
+        journal.finish()
 
-    # Update the user quota
-    calc_user_quota(user)
-    # Update the disk quota
-    calc_user_used_space(user)
-    update_cache_disk_used_space(user, user.total_used-old_user_used_space)
+    with profiler.phase("quota"):
+        # Update the user quota
+        calc_user_quota(user)
+        # Update the disk quota
+        calc_user_used_space(user)
+        update_cache_disk_used_space(user, user.total_used-old_user_used_space)
 
-    # remove the scheduled deletions
-    for sd in scheduled_deletions:
-        sd.delete()
+    # remove the scheduled deletions, and queue the notification email in the same transaction
+    with profiler.phase("notify"), transaction.atomic():
+        for sd in scheduled_deletions:
+            sd.delete()
 
-    # send email if notifications on
-    if user.notify:
-        send_notification_email(user, files_to_delete, datetime.datetime.utcnow())
+        # send email if notifications on
+        if user.notify:
+            send_notification_email(user, deleted_paths, datetime.datetime.utcnow())
+
+    # one summary line for the user, rather than a line for each file
+    logging.info(
+        "Deleted %d files (%d bytes) of user %s", len(deleted_paths), old_user_used_space - user.total_used,
+        user.name, extra={"user": user.name, "n_files": len(deleted_paths),
+                          "bytes": old_user_used_space - user.total_used, "total_used": user.total_used}
+    )
 
 def exit_handler(signal, frame):
     logging.info("Stopping xfc_delete")
     sys.exit(0)
 
-def run_loop(config):
-    """Main loop."""
+def run_loop(config, profiler=None):
+    """Main loop.
+       :var dict config: the process config
+       :var xfc_control.profiling.Profiler profiler: (*optional*) profiler to time the users with
+    """
+    if profiler is None:
+        profiler = Profiler("xfc_delete")
     for user in User.objects.all():
-        logging.info(
-            "[" + get_log_time_string() + "] Running delete for user: " +
-            user.name
-        )
+        logging.debug("Running delete for user: %s", user.name)
         # check if user locked
         if user_locked(user):
-            logging.info(
-                "[" + get_log_time_string() + "] User already locked: " + user.name
-            )
+            logging.info("User already locked: %s", user.name)
+            USERS_LOCKED.inc(process="xfc_delete")
             continue
         # lock the user
         try:
-            lock_user(user)
-            do_deletions(user)
+            with LOCK_WAIT.time(process="xfc_delete"):
+                lock_user(user)
+            with profiler.user(user.name):
+                do_deletions(user, profiler)
             # unlock the user
             unlock_user(user)
         except Exception as e:
             unlock_user(user)
             raise Exception(e)
+    # refresh the rollups for the dashboard in the admin
+    with profiler.phase("rollups"):
+        refresh_rollups()
+    # write the profiles and metrics for this run
+    profiler.finish()
+    write_process_metrics("xfc_delete")
 
 def run(*args):
     """Entry point for the Django script run via ``./manage.py runscript``
     """
     # setup the logging
     config = read_process_config("xfc_delete")
-    logging.basicConfig(
-        format=get_logging_format(),
-        level=get_logging_level(config["LOG_LEVEL"]),
-        datefmt='%Y-%d-%m %I:%M:%S'
-    )
+    setup_logging("xfc_delete", config)
     logging.info("Starting xfc_delete")
 
     # setup exit signal handling
@@ -184,8 +295,8 @@ def run(*args):
         while True:
             current_time = datetime.datetime.utcnow()
             if (current_time - previous_time) > time_period:
-                run_loop(config)
+                run_loop(config, profiler_from_args("xfc_delete", arg_dict))
                 previous_time = current_time
                 sleep(5)
     else:
-        run_loop(config)
+        run_loop(config, profiler_from_args("xfc_delete", arg_dict))
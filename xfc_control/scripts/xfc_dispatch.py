@@ -0,0 +1,115 @@
+"""Function to put the users that are due to be scanned on the scan queue, for the scanners
+(``xfc_scan consume=true``) to take and scan (see xfc_control.broker).
+
+The queue is kept topped up to a target depth: on each run, the number of scan requests waiting on the
+queue is read, and enough of the users that are due to be scanned (see xfc_control.scan_frequency) are
+added to bring it back up to the target, those with the oldest User.next_scan first (users that have
+never been scanned come before all the others).  A user put on the queue is marked with
+User.scan_dispatched, and is not put on it again until it has been scanned, or REDISPATCH_HOURS have
+passed (in case the scan request was lost or the scan failed).
+
+ This script is designed to be run via the django-extensions runscript command:
+
+  ``python manage.py runscript xfc_dispatch --script-args daemon=true``
+
+ Arguments:
+
+  - ``daemon=true|false``: run continuously, every RUN_EVERY_MINUTES (default false)
+  - ``target_depth=<n>``: number of scan requests to keep on the queue (default: TARGET_DEPTH from the
+    config, or 10).  This should be a little more than the number of users the scanners can take at
+    once (the number of scanners times their prefetch), so that no scanner waits for work
+  - ``broker=<url>``: URL of the broker (default: the XFC_BROKER_URL setting)
+"""
+
+import datetime
+import logging
+import signal, sys
+
+from django.db import transaction
+from django.db.models import F, Q
+
+from xfc_control.models import User
+from xfc_control.broker import get_broker, scan_queue, scan_request
+from xfc_control.metrics import ROWS_WRITTEN, write_process_metrics
+
+from xfc_control.scripts.config import read_process_config, split_args
+from xfc_control.scripts.config import setup_logging
+
+
+def dispatch_scans(broker, target_depth, redispatch_after):
+    """Top up the scan queue to target_depth with the users that are due to be scanned, those that have
+    been due longest first.
+       :var broker: the broker to publish to (see xfc_control.broker)
+       :var int target_depth: number of scan requests to keep on the queue
+       :var datetime.timedelta redispatch_after: time after which a user that was put on the queue, and
+                                                 has not been scanned, is put on it again
+       :return: number of users put on the queue
+    """
+    queue = scan_queue()
+    n_needed = target_depth - broker.queue_depth(queue)
+    if n_needed <= 0:
+        return 0
+    now = datetime.datetime.utcnow()
+    with transaction.atomic():
+        # SKIP LOCKED, so that a second dispatcher does not put the same users on the queue
+        users = list(User.objects.select_for_update(skip_locked=True).filter(
+            Q(scan_dispatched__isnull=True) | Q(scan_dispatched__lt=now - redispatch_after),
+            Q(next_scan__isnull=True) | Q(next_scan__lte=now)
+        ).order_by(F("next_scan").asc(nulls_first=True), F("last_scanned").asc(nulls_first=True), "pk").only(
+            "pk", "name")[:n_needed])
+        for user in users:
+            broker.publish(queue, scan_request(user, now))
+        User.objects.filter(pk__in=[u.pk for u in users]).update(scan_dispatched=now)
+    ROWS_WRITTEN.inc(len(users), process="xfc_dispatch", model="User", operation="update")
+    return len(users)
+
+
+def run_loop(config, broker, target_depth):
+    """Top up the scan queue."""
+    redispatch_after = datetime.timedelta(hours=config.get("REDISPATCH_HOURS", 24))
+    n_dispatched = dispatch_scans(broker, target_depth, redispatch_after)
+    if n_dispatched != 0:
+        logging.info("Put %d users on the scan queue", n_dispatched, extra={"n_users": n_dispatched})
+    write_process_metrics("xfc_dispatch")
+
+
+def exit_handler(signal, frame):
+    logging.info("Stopping xfc_dispatch")
+    sys.exit(0)
+
+
+def run(*args):
+    """Entry point for the Django script run via ``./manage.py runscript``
+    """
+    # setup the logging
+    config = read_process_config("xfc_dispatch")
+    setup_logging("xfc_dispatch", config)
+    logging.info("Starting xfc_dispatch")
+
+    # setup exit signal handling
+    signal.signal(signal.SIGINT, exit_handler)
+    signal.signal(signal.SIGHUP, exit_handler)
+    signal.signal(signal.SIGTERM, exit_handler)
+
+    arg_dict = split_args(args)
+    daemon = (arg_dict.get("daemon", "false").lower() == "true")
+    target_depth = int(arg_dict.get("target_depth", config.get("TARGET_DEPTH", 10)))
+    broker = get_broker(arg_dict.get("broker"))
+
+    try:
+        # run as a daemon or one shot
+        if daemon:
+            # RUN_EVERY_MINUTES determines the period between top ups of the queue
+            time_period = datetime.timedelta(minutes=config.get("RUN_EVERY_MINUTES", 1))
+            previous_time = datetime.datetime.utcnow() - time_period
+            while True:
+                current_time = datetime.datetime.utcnow()
+                if (current_time - previous_time) > time_period:
+                    run_loop(config, broker, target_depth)
+                    previous_time = current_time
+                # keep the connection to the broker alive while waiting
+                broker.sleep(5)
+        else:
+            run_loop(config, broker, target_depth)
+    finally:
+        broker.close()
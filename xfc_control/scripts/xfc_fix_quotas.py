@@ -1,40 +1,150 @@
 """Function to fix the quotas for the Users and the CachedDisks
 
+The quotas are calculated with GROUP BY queries in the database, rather than by loading every
+CachedFile, and written back with bulk updates.  The per-user work can be split across a pool of
+processes, each of which fixes a contiguous range of users.
+
  This script is designed to be run via the django-extensions runscript command:
 
-  ``python manage.py runscript xfc_scan``
+  ``python manage.py runscript xfc_fix_quotas``
+
+ Arguments:
+
+  - ``processes=<n>``: number of processes to split the users across (default 1)
+  - ``profile=true|false``: profile the run, writing the cProfile stats and the per-phase breakdown to
+    ``profile_dir`` (see xfc_control.profiling, default false).  The work done in the pool of
+    processes is timed, but not profiled.
+  - ``profile_dir=<path>``: directory to write the profile to (default: the XFC_PROFILE_DIR setting)
 """
 
-from xfc_control.models import User, CacheDisk, CachedFile
-from xfc_control.scripts.xfc_scan import calc_user_quota
-import os
+import datetime
+from multiprocessing import Pool
+
+from django import db
+from django.db.models import Sum, Q
+from django.db.models.functions import TruncDate
+
+from xfc_control.models import User, CacheDisk, CachedFile, CachedDirectory
+from xfc_control.profiling import profiler_from_args
+from xfc_control.dashboard import refresh_rollups
+from xfc_control.scripts.config import split_args
+
+
+def user_usage(first_id=None, last_id=None, current_date=None):
+    """Calculate the temporal quota used and the total size of the files of the users, from
+    aggregates grouped by user and the day the files were first seen.
+
+    The quota used by a file is ``size * ((current_date - first_seen).days + 1)`` (see
+    CachedFile.quota_use).  All the files first seen on the same day have the same number of days
+    persistent, except that those first seen later in the day than the time of current_date have
+    one day fewer.  So the sizes in each group are summed separately for the files first seen before
+    and after the time of current_date, which gives exactly the same quota as summing over the files.
+    The directory aggregates of users scanned in directory mode are grouped in the same way, on their
+    own_first_seen (see CachedDirectory.own_quota_use).
+
+       :var int first_id: (*optional*) id of the first user to calculate
+       :var int last_id: (*optional*) id of the last user to calculate
+       :var datetime.datetime current_date: (*optional*) date to calculate the quota at
+       :return: dictionary of (quota_used, total_used), keyed on the user id
+    """
+    if current_date is None:
+        current_date = datetime.datetime.utcnow()
+    cached_files = CachedFile.objects.all()
+    directories = CachedDirectory.objects.filter(aggregate=True)
+    if first_id is not None:
+        cached_files = cached_files.filter(user_id__gte=first_id)
+        directories = directories.filter(user_id__gte=first_id)
+    if last_id is not None:
+        cached_files = cached_files.filter(user_id__lte=last_id)
+        directories = directories.filter(user_id__lte=last_id)
+
+    groups = list(cached_files.annotate(day=TruncDate("first_seen")).values("user", "day").annotate(
+        total=Sum("size"),
+        early=Sum("size", filter=Q(first_seen__time__lte=current_date.time()))
+    ).order_by())
+    groups += list(directories.annotate(day=TruncDate("own_first_seen")).values("user", "day").annotate(
+        total=Sum("own_size"),
+        early=Sum("own_size", filter=Q(own_first_seen__time__lte=current_date.time()))
+    ).order_by())
 
-def fix_user_quotas():
-    """Fix each user quota in turn by interrogating how much space is used for each
-    file owned by the user."""
-    # get the users in turn
-    for user in User.objects.all():
-        calc_user_quota(user)
+    usage = {}
+    for g in groups:
+        quota_used, total_used = usage.get(g["user"], (0, 0))
+        total_used += g["total"]
+        if g["day"] is not None:
+            days = (current_date.date() - g["day"]).days
+            early = g["early"] or 0
+            quota_used += early * (days + 1) + (g["total"] - early) * days
+        usage[g["user"]] = (quota_used, total_used)
+    return usage
+
+
+def fix_user_range(first_id, last_id, current_date=None):
+    """Fix the quota used and the total used for a contiguous range of users.
+       :var int first_id: id of the first user to fix
+       :var int last_id: id of the last user to fix
+       :var datetime.datetime current_date: (*optional*) date to calculate the quota at
+       :return: number of users fixed
+    """
+    usage = user_usage(first_id, last_id, current_date)
+    users = list(User.objects.filter(pk__gte=first_id, pk__lte=last_id).only("pk", "quota_used", "total_used"))
+    for user in users:
+        user.quota_used, user.total_used = usage.get(user.pk, (0, 0))
+    User.objects.bulk_update(users, ["quota_used", "total_used"], batch_size=1000)
+    return len(users)
+
+
+def _fix_user_range(args):
+    """Entry point for the processes in the pool."""
+    return fix_user_range(*args)
+
+
+def fix_user_quotas(processes=1):
+    """Fix each user quota, and the total space used by each user, from the files owned by the user.
+       :var int processes: number of processes to split the users across
+    """
+    current_date = datetime.datetime.utcnow()
+    user_ids = list(User.objects.order_by("pk").values_list("pk", flat=True))
+    if len(user_ids) == 0:
+        return
+    # split the users into contiguous ranges
+    n_ranges = max(1, min(processes, len(user_ids)))
+    step = (len(user_ids) + n_ranges - 1) // n_ranges
+    ranges = [(user_ids[i], user_ids[min(i + step, len(user_ids)) - 1], current_date)
+              for i in range(0, len(user_ids), step)]
+
+    if processes > 1:
+        # the database connection cannot be shared with the child processes
+        db.connections.close_all()
+        with Pool(processes) as pool:
+            pool.map(_fix_user_range, ranges)
+    else:
+        for r in ranges:
+            fix_user_range(*r)
 
 
 def fix_cache_disk_quotas():
-    # for each cache disk, get the files
-    for cd in CacheDisk.objects.all():
-        cache_disk_sum = 0
-        # get the users using this cache disk
-        users = User.objects.filter(cache_disk=cd)
-        # for each user get their files
-        for user in users:
-            files = CachedFile.objects.filter(user=user)
-            # calculate the total
-            for file in files:
-                file_path = os.path.join(cd.mountpoint, file.path)
-                cache_disk_sum += file.size
-            # reassign and save
-            cd.used_bytes = cache_disk_sum
-            cd.save()
-
-
-def run():
-    fix_user_quotas()
-    fix_cache_disk_quotas()
+    """Fix the used space of each CacheDisk from the total size of the files of its users."""
+    totals = {}
+    for qs, field in ((CachedFile.objects.all(), "size"),
+                      (CachedDirectory.objects.filter(aggregate=True), "own_size")):
+        for t in qs.values("user__cache_disk").annotate(total=Sum(field)).order_by():
+            totals[t["user__cache_disk"]] = totals.get(t["user__cache_disk"], 0) + t["total"]
+    disks = list(CacheDisk.objects.all())
+    for cd in disks:
+        cd.used_bytes = totals.get(cd.pk, 0)
+    CacheDisk.objects.bulk_update(disks, ["used_bytes"])
+
+
+def run(*args):
+    arg_dict = split_args(args)
+    profiler = profiler_from_args("xfc_fix_quotas", arg_dict)
+    # the quotas are fixed for all the users at once, so the whole run is profiled as one "user"
+    with profiler.user("all"):
+        with profiler.phase("users"):
+            fix_user_quotas(processes=int(arg_dict.get("processes", 1)))
+        with profiler.phase("cache_disks"):
+            fix_cache_disk_quotas()
+        with profiler.phase("rollups"):
+            refresh_rollups()
+    profiler.finish()
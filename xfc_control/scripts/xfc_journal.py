@@ -0,0 +1,66 @@
+"""Function to read the journal of the changes found by xfc_scan, or to prune it.
+
+The entries after the consumer's checkpoint are written to standard output, one JSON object per line.
+
+ This script is designed to be run via the django-extensions runscript command:
+
+  ``python manage.py runscript xfc_journal --script-args consumer=quota_history commit=true``
+
+ Arguments:
+
+  - ``consumer=<name>``: name of the consumer whose checkpoint the entries are read from
+  - ``limit=<n>``: maximum number of entries to read (default 1000)
+  - ``user=<name>``: (*optional*) only read the entries for this user (cannot be used with commit)
+  - ``commit=true|false``: move the consumer's checkpoint past the entries read (default false)
+  - ``prune=true|false``: delete the entries that every consumer has processed (default false)
+"""
+
+import json
+import logging
+import sys
+
+from xfc_control.models import User
+from xfc_control.journal import tail, commit, prune
+
+from xfc_control.scripts.config import read_process_config, split_args
+from xfc_control.scripts.config import setup_logging
+
+
+def entry_to_dict(entry):
+    """Convert a ScanJournalEntry to a dictionary for output as JSON."""
+    return {"sequence": entry.id,
+            "pass": entry.scan_pass_id,
+            "user": entry.user.name,
+            "event": entry.event,
+            "path": entry.path,
+            "aggregate": entry.aggregate,
+            "size": entry.size,
+            "old_size": entry.old_size,
+            "time": entry.time.isoformat()}
+
+
+def run(*args):
+    """Entry point for the Django script run via ``./manage.py runscript``
+    """
+    # setup the logging
+    config = read_process_config("xfc_journal")
+    setup_logging("xfc_journal", config)
+
+    arg_dict = split_args(args)
+    if "consumer" in arg_dict:
+        consumer = arg_dict["consumer"]
+        do_commit = (arg_dict.get("commit", "false").lower() == "true")
+        user = None
+        if "user" in arg_dict:
+            # the checkpoint is for all users, so it cannot be moved past the entries of one user
+            if do_commit:
+                raise Exception("commit=true cannot be used with user")
+            user = User.objects.get(name=arg_dict["user"])
+        entries = tail(consumer, limit=int(arg_dict.get("limit", 1000)), user=user)
+        for entry in entries:
+            sys.stdout.write(json.dumps(entry_to_dict(entry)) + "\n")
+        if do_commit and len(entries) != 0:
+            commit(consumer, entries[-1].id)
+
+    if arg_dict.get("prune", "false").lower() == "true":
+        logging.info("Pruned {} journal entries".format(prune()))
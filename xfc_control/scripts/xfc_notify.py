@@ -0,0 +1,76 @@
+"""Function to deliver the notification emails in the outbox, which are queued by xfc_schedule,
+xfc_delete and the REST API.
+
+The emails that are due are sent in batches, each over one connection to the mail server.  An email
+that cannot be sent is retried later, with an exponential backoff, and is marked as failed after
+MAX_ATTEMPTS (see xfc_control.notifications).
+
+ This script is designed to be run via the django-extensions runscript command:
+
+  ``python manage.py runscript xfc_notify --script-args daemon=true``
+
+ Arguments:
+
+  - ``daemon=true|false``: run continuously, every RUN_EVERY_MINUTES (default false)
+  - ``batch_size=<n>``: number of emails to send over each connection (default 100)
+  - ``purge=<days>``: (*optional*) delete the emails that were sent more than this number of days ago
+"""
+
+import datetime
+import logging
+from time import sleep
+import signal, sys
+
+from xfc_control.notifications import deliver, purge
+
+from xfc_control.scripts.config import read_process_config, split_args
+from xfc_control.scripts.config import setup_logging
+
+
+def run_loop(config, batch_size=100, purge_days=None):
+    """Deliver the outbox."""
+    n_sent, n_failed = deliver(batch_size=batch_size)
+    if n_sent != 0 or n_failed != 0:
+        logging.info("Sent {} notification emails, {} failed".format(n_sent, n_failed))
+    if purge_days is not None:
+        n_purged = purge(purge_days)
+        if n_purged != 0:
+            logging.info("Purged {} sent notification emails".format(n_purged))
+
+
+def exit_handler(signal, frame):
+    logging.info("Stopping xfc_notify")
+    sys.exit(0)
+
+
+def run(*args):
+    """Entry point for the Django script run via ``./manage.py runscript``
+    """
+    # setup the logging
+    config = read_process_config("xfc_notify")
+    setup_logging("xfc_notify", config)
+    logging.info("Starting xfc_notify")
+
+    # setup exit signal handling
+    signal.signal(signal.SIGINT, exit_handler)
+    signal.signal(signal.SIGHUP, exit_handler)
+    signal.signal(signal.SIGTERM, exit_handler)
+
+    arg_dict = split_args(args)
+    daemon = (arg_dict.get("daemon", "false").lower() == "true")
+    batch_size = int(arg_dict.get("batch_size", 100))
+    purge_days = int(arg_dict["purge"]) if "purge" in arg_dict else None
+
+    # run as a daemon or one shot
+    if daemon:
+        # RUN_EVERY_MINUTES determines the period between deliveries of the outbox
+        time_period = datetime.timedelta(minutes=config.get("RUN_EVERY_MINUTES", 1))
+        previous_time = datetime.datetime.utcnow() - time_period
+        while True:
+            current_time = datetime.datetime.utcnow()
+            if (current_time - previous_time) > time_period:
+                run_loop(config, batch_size, purge_days)
+                previous_time = current_time
+            sleep(5)
+    else:
+        run_loop(config, batch_size, purge_days)
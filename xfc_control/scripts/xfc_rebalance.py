@@ -0,0 +1,500 @@
+"""Function to move users' cache areas off CacheDisks that are being retired, or that are too full,
+onto other CacheDisks.
+
+Users are moved while they are still using their cache area:
+
+  1. Space for the user's quota is reserved on the target CacheDisk and a UserMigration is created
+  2. The user's directory tree is copied to the target CacheDisk, in parallel.  The copy is owned by root,
+     and closed to everyone else, until the user is switched to it
+  3. The user is locked, any files deleted from the source since they were copied are removed from the
+     target, any files changed since the copy started are copied, and the copy is verified against the
+     state of the source when the user was locked
+  4. The directories of the copy are given the ownership and permissions of the source, then
+     User.cache_disk is switched to the target CacheDisk, and the used and allocated bytes of both
+     CacheDisks are updated, in one transaction
+  5. The user is unlocked and (optionally) the source directory tree is removed, unless it has changed
+     since the user was locked (the lock only stops the other daemons, not the user)
+
+As the paths of the CachedFiles are relative to the CacheDisk mountpoint, they do not change and the
+user does not have to be rescanned.  If the script is stopped then it resumes the unfinished
+UserMigrations on the next run, and files that have already been copied are not copied again.  A move
+that fails is retried on the next run, until it has failed ``max_attempts`` times, when it is abandoned:
+the space reserved on the target CacheDisk is released and the partial copy is removed.  Users whose
+move was abandoned are not chosen again until their UserMigration is deleted.
+
+The script has to be run as root, so that it can read the users' files and preserve their ownership.
+As the users can change their directories at any time, no link is followed: the source is read through
+directory file descriptors with O_NOFOLLOW, and the copies are created with O_EXCL | O_NOFOLLOW inside
+the closed target.
+
+ This script is designed to be run via the django-extensions runscript command:
+
+  ``python manage.py runscript xfc_rebalance --script-args threshold=0.9 workers=8``
+
+ Arguments:
+
+  - ``retire=true|false``: move all users off CacheDisks that are marked as retiring (default true)
+  - ``threshold=<fraction>``: move the largest users off CacheDisks whose used_bytes is more than this
+    fraction of size_bytes, until they are below it (default: no threshold)
+  - ``max_users=<n>``: maximum number of users to move in this run (default: no maximum)
+  - ``workers=<n>``: number of files to copy in parallel (default 8)
+  - ``remove_source=true|false``: remove the user's directory tree from the source CacheDisk after the
+    move (default false)
+  - ``dry_run=true|false``: only log which users would be moved (default false)
+  - ``max_attempts=<n>``: number of times a move can fail before it is abandoned (default 5)
+  - ``cancel=<name>,<name>``: abandon the unfinished moves of these users, instead of moving any users
+"""
+
+import datetime
+import os
+import stat
+import shutil
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from django.db import transaction
+from django.db.models import F
+
+from xfc_control.models import User, CacheDisk, UserMigration
+from xfc_control.scripts.xfc_user_lock import lock_user, user_locked, unlock_user
+
+from xfc_control.scripts.config import read_process_config, split_args
+from xfc_control.scripts.config import setup_logging
+
+
+def select_users(retire=True, threshold=None):
+    """Choose the users to move.  All the users on retiring CacheDisks are chosen, and then the largest
+    users on each CacheDisk whose used space is over the threshold, until it would be under the threshold.
+       :var bool retire: move the users off retiring CacheDisks
+       :var float threshold: (*optional*) fraction of size_bytes that used_bytes should be below
+       :return: list of Users to move
+    """
+    users = []
+    # users who are already being moved are resumed separately, and users whose move was abandoned are
+    # not moved again until the UserMigration is deleted
+    moving = UserMigration.objects.filter(
+        state__in=[UserMigration.COPYING, UserMigration.ABANDONED]
+    ).values_list("user_id", flat=True)
+    for cd in CacheDisk.objects.all():
+        cd_users = User.objects.filter(cache_disk=cd).exclude(pk__in=moving).order_by("-total_used")
+        if retire and cd.retiring:
+            users.extend(cd_users)
+        elif threshold is not None and cd.size_bytes > 0:
+            used = cd.used_bytes
+            for user in cd_users:
+                if used <= threshold * cd.size_bytes:
+                    break
+                users.append(user)
+                used -= user.total_used
+    return users
+
+
+def _open_source_dir(source_dir, path):
+    """Open a directory below source_dir, without following a link in any part of its path below source_dir,
+    so that the copy cannot be sent outside the user's cache area by replacing a directory with a link.
+       :var string source_dir: the user's directory on the source CacheDisk
+       :var string path: path of the directory relative to source_dir
+       :return: file descriptor of the directory
+    """
+    fd = os.open(source_dir, os.O_RDONLY | os.O_DIRECTORY | os.O_NOFOLLOW)
+    try:
+        for part in path.split(os.sep):
+            if part in ("", "."):
+                continue
+            next_fd = os.open(part, os.O_RDONLY | os.O_DIRECTORY | os.O_NOFOLLOW, dir_fd=fd)
+            os.close(fd)
+            fd = next_fd
+    except Exception:
+        os.close(fd)
+        raise
+    return fd
+
+
+def _copy_file(source_dir, path, target):
+    """Copy a single file (or link), preserving its times, permissions and ownership.  No link is followed in
+    the source or the target: anything already at the target is removed, and the copy is created with
+    O_EXCL | O_NOFOLLOW.  A file that has been replaced by something other than a file or a link since the
+    tree was walked is not copied.
+       :var string source_dir: the user's directory on the source CacheDisk
+       :var string path: path of the file relative to source_dir
+       :var string target: path to copy the file to
+       :return: number of bytes copied
+    """
+    name = os.path.basename(path)
+    dir_fd = _open_source_dir(source_dir, os.path.dirname(path))
+    try:
+        st = os.stat(name, dir_fd=dir_fd, follow_symlinks=False)
+        if os.path.lexists(target):
+            os.unlink(target)
+        if stat.S_ISLNK(st.st_mode):
+            os.symlink(os.readlink(name, dir_fd=dir_fd), target)
+            os.chown(target, st.st_uid, st.st_gid, follow_symlinks=False)
+            os.utime(target, ns=(st.st_atime_ns, st.st_mtime_ns), follow_symlinks=False)
+            return 0
+        if not stat.S_ISREG(st.st_mode):
+            return 0
+        # non-blocking, so that a file replaced by a FIFO does not hang the copy
+        source_fd = os.open(name, os.O_RDONLY | os.O_NOFOLLOW | os.O_NONBLOCK, dir_fd=dir_fd)
+    finally:
+        os.close(dir_fd)
+    try:
+        st = os.fstat(source_fd)
+        if not stat.S_ISREG(st.st_mode):
+            return 0
+        target_fd = os.open(target, os.O_WRONLY | os.O_CREAT | os.O_EXCL | os.O_NOFOLLOW, 0o600)
+        try:
+            with open(source_fd, "rb", closefd=False) as fsrc, open(target_fd, "wb", closefd=False) as fdst:
+                shutil.copyfileobj(fsrc, fdst, 1024 * 1024)
+            # chown before chmod, as chown clears the setuid and setgid bits
+            os.fchown(target_fd, st.st_uid, st.st_gid)
+            os.fchmod(target_fd, st.st_mode & 0o7777)
+            os.utime(target_fd, ns=(st.st_atime_ns, st.st_mtime_ns))
+        finally:
+            os.close(target_fd)
+    finally:
+        os.close(source_fd)
+    return st.st_size
+
+
+def _needs_copy(st, target):
+    """Check whether a file needs copying - i.e. it does not exist in the target or has changed.
+       :var os.stat_result st: the lstat of the file in the source
+       :var string target: path of the file in the target
+    """
+    try:
+        tst = os.lstat(target)
+    except OSError:
+        return True
+    return (stat.S_IFMT(st.st_mode) != stat.S_IFMT(tst.st_mode) or st.st_size != tst.st_size or
+            int(st.st_mtime) != int(tst.st_mtime))
+
+
+def _close_directory(path):
+    """Create a directory of the copy, or close an existing one, so that it is owned by root and no one else
+    can use it.  Anything other than a directory at the path (such as a link) is refused."""
+    try:
+        os.mkdir(path, 0o700)
+    except FileExistsError:
+        if not stat.S_ISDIR(os.lstat(path).st_mode):
+            raise Exception("Target is not a directory: {}".format(path))
+    os.chown(path, os.geteuid(), os.getegid(), follow_symlinks=False)
+    os.chmod(path, 0o700)
+
+
+def close_target(target_dir):
+    """Make the target directory tree owned by root and closed to everyone else, before anything is copied
+    into it, so that the user cannot change it (for example, replace a file with a link to a file outside
+    their cache area) while it is being written to.  The target may be left open by an earlier move of the
+    user, so the whole tree is closed, from the top down, so that each directory is closed before the
+    directories in it are changed.  The directories are given the ownership and permissions of the source
+    when the user is switched (see open_target).
+       :var string target_dir: the user's directory on the target CacheDisk
+    """
+    os.makedirs(os.path.dirname(target_dir), exist_ok=True)
+    _close_directory(target_dir)
+    # fwalk does not follow links, and opens each directory relative to its (closed) parent
+    for root, dirs, files, root_fd in os.fwalk(target_dir):
+        for d in dirs:
+            if stat.S_ISDIR(os.stat(d, dir_fd=root_fd, follow_symlinks=False).st_mode):
+                os.chown(d, os.geteuid(), os.getegid(), dir_fd=root_fd, follow_symlinks=False)
+                os.chmod(d, 0o700, dir_fd=root_fd)
+
+
+def open_target(source_dir, target_dir):
+    """Give the directories of the copy the ownership and permissions of the directories in the source, once
+    the copy is complete.  This is done from the bottom up, so that the user can only get into a directory
+    once everything below it is finished.
+       :var string source_dir: the user's directory on the source CacheDisk
+       :var string target_dir: the user's directory on the target CacheDisk
+    """
+    for root, dirs, files in os.walk(target_dir, topdown=False):
+        source_root = os.path.normpath(os.path.join(source_dir, os.path.relpath(root, target_dir)))
+        st = os.lstat(source_root)
+        if not stat.S_ISDIR(st.st_mode):
+            raise Exception("Source directory has changed: {}".format(source_root))
+        os.chown(root, st.st_uid, st.st_gid, follow_symlinks=False)
+        os.chmod(root, st.st_mode & 0o7777)
+
+
+def remove_deleted(source_dir, target_dir):
+    """Remove the files, links and directories in the target that no longer exist in the source (as with
+    ``rsync --delete``), so that the files deleted from the source since they were copied do not stay in
+    the target.
+       :var string source_dir: the user's directory on the source CacheDisk
+       :var string target_dir: the user's directory on the target CacheDisk
+       :return: number of files removed
+    """
+    n_removed = 0
+    # bottom up, so that a directory is empty by the time it is removed
+    for root, dirs, files in os.walk(target_dir, topdown=False):
+        source_root = os.path.join(source_dir, os.path.relpath(root, target_dir))
+        for f in files + [d for d in dirs if os.path.islink(os.path.join(root, d))]:
+            source = os.path.join(source_root, f)
+            # a file that has been replaced by a directory in the source is removed too
+            if not os.path.lexists(source) or (os.path.isdir(source) and not os.path.islink(source)):
+                os.unlink(os.path.join(root, f))
+                n_removed += 1
+        if root != target_dir and (os.path.islink(source_root) or not os.path.isdir(source_root)):
+            os.rmdir(root)
+    logging.info("    Removed {} files deleted from the source".format(n_removed))
+    return n_removed
+
+
+def copy_tree(source_dir, target_dir, migration, workers=8):
+    """Copy the directory tree from the source to the target, in parallel.  Files that already exist in
+    the target, with the same size and modification time, are not copied again, so the copy can be resumed.
+    The target is closed first (see close_target), and anything in it that is no longer in the source is
+    removed (see remove_deleted).  Only files, links and directories are copied.
+       :var string source_dir: the user's directory on the source CacheDisk
+       :var string target_dir: the user's directory on the target CacheDisk
+       :var xfc_control.models.UserMigration migration: the UserMigration to record progress in
+       :var int workers: number of files to copy in parallel
+    """
+    close_target(target_dir)
+    remove_deleted(source_dir, target_dir)
+    to_copy = []
+    # fwalk does not follow links, so a link to a directory is copied as a link
+    for root, dirs, files, root_fd in os.fwalk(source_dir):
+        path = os.path.relpath(root, source_dir)
+        target_root = os.path.normpath(os.path.join(target_dir, path))
+        if target_root != target_dir:
+            _close_directory(target_root)
+        for f in dirs + files:
+            try:
+                st = os.stat(f, dir_fd=root_fd, follow_symlinks=False)
+            except FileNotFoundError:
+                continue
+            if not (stat.S_ISREG(st.st_mode) or stat.S_ISLNK(st.st_mode)):
+                continue
+            target = os.path.join(target_root, f)
+            if _needs_copy(st, target):
+                to_copy.append((os.path.normpath(os.path.join(path, f)), target))
+
+    # copy the files in parallel, saving the progress in batches
+    batch_size = 1000
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for b in range(0, len(to_copy), batch_size):
+            batch = to_copy[b:b+batch_size]
+            copied = list(executor.map(lambda pt: _copy_file(source_dir, *pt), batch))
+            UserMigration.objects.filter(pk=migration.pk).update(
+                files_copied=F("files_copied") + len(batch),
+                bytes_copied=F("bytes_copied") + sum(copied)
+            )
+    logging.info("    Copied {} files".format(len(to_copy)))
+
+
+def tree_state(directory):
+    """Return the size and modification time of each file and link in the directory tree, without
+    following links.
+       :return: dictionary of (size, mtime in ns), keyed on the path relative to the directory
+    """
+    state = {}
+    for root, dirs, files in os.walk(directory):
+        for f in dirs + files:
+            path = os.path.join(root, f)
+            try:
+                st = os.lstat(path)
+            except FileNotFoundError:
+                continue
+            if stat.S_ISREG(st.st_mode) or stat.S_ISLNK(st.st_mode):
+                state[os.path.relpath(path, directory)] = (st.st_size, st.st_mtime_ns)
+    return state
+
+
+def verify_copy(source_dir, source_state, target_dir):
+    """Check that the target holds the same files, with the same sizes, as the source did.
+       :var string source_dir: the user's directory on the source CacheDisk
+       :var dict source_state: the tree_state of the source
+       :var string target_dir: the user's directory on the target CacheDisk
+    """
+    source_sizes = {path: size for path, (size, mtime) in source_state.items()}
+    target_sizes = {path: size for path, (size, mtime) in tree_state(target_dir).items()}
+    if source_sizes != target_sizes:
+        raise Exception("Copy of {} does not match: {} files, {} bytes in source; {} files, {} bytes in target"
+                        .format(source_dir, len(source_sizes), sum(source_sizes.values()),
+                                len(target_sizes), sum(target_sizes.values())))
+
+
+def switch_user(user, migration):
+    """Switch the user to the target CacheDisk, and move the user's used and allocated space from the
+    source CacheDisk to the target CacheDisk, in one transaction.  The space for the user's quota was
+    already reserved on the target CacheDisk when the UserMigration was created.
+       :var xfc_control.models.User user: the user to switch
+       :var xfc_control.models.UserMigration migration: the UserMigration of the user
+    """
+    with transaction.atomic():
+        User.objects.filter(pk=user.pk).update(cache_disk=migration.target_disk)
+        CacheDisk.objects.filter(pk=migration.source_disk_id).update(
+            used_bytes=F("used_bytes") - user.total_used,
+            allocated_bytes=F("allocated_bytes") - user.hard_limit_size
+        )
+        CacheDisk.objects.filter(pk=migration.target_disk_id).update(
+            used_bytes=F("used_bytes") + user.total_used
+        )
+        # update, rather than save, so that the progress counters are not overwritten
+        UserMigration.objects.filter(pk=migration.pk).update(
+            state=UserMigration.DONE, finished=datetime.datetime.utcnow(), error=""
+        )
+
+
+def move_user(user, migration, workers=8, remove_source=False):
+    """Move the user's cache area to the target CacheDisk of the UserMigration.
+       :var xfc_control.models.User user: the user to move
+       :var xfc_control.models.UserMigration migration: the UserMigration of the user
+       :var int workers: number of files to copy in parallel
+       :var bool remove_source: remove the directory tree from the source CacheDisk after the move, if it
+                                has not changed since the final copy
+       :return: True if the user was moved, False if the user was locked and has to be moved later
+    """
+    source_dir = os.path.join(migration.source_disk.mountpoint, user.cache_path)
+    target_dir = os.path.join(migration.target_disk.mountpoint, user.cache_path)
+    logging.info("Moving user: {} from {} to {}".format(user.name, source_dir, target_dir))
+
+    # copy the tree while the user is still using it
+    copy_tree(source_dir, target_dir, migration, workers)
+
+    # lock the user while the final copy is made and the user is switched
+    if user_locked(user):
+        logging.info("    User locked, move will be completed on the next run: {}".format(user.name))
+        return False
+    lock_user(user)
+    try:
+        # the lock does not stop the user writing to the source, so the source is recorded before the final
+        # copy, and anything that changes after this fails the verification, or keeps the source
+        source_state = tree_state(source_dir)
+        copy_tree(source_dir, target_dir, migration, workers)
+        verify_copy(source_dir, source_state, target_dir)
+        # reread the user so that the used space is up to date
+        user.refresh_from_db()
+        open_target(source_dir, target_dir)
+        switch_user(user, migration)
+        unlock_user(user)
+    except Exception as e:
+        unlock_user(user)
+        raise Exception(e)
+
+    if remove_source:
+        if tree_state(source_dir) == source_state:
+            shutil.rmtree(source_dir)
+        else:
+            logging.error("    Source changed after the final copy, so it has not been removed: {}".format(
+                source_dir))
+    logging.info("    Moved user: {}".format(user.name))
+    return True
+
+
+def abandon_migration(migration):
+    """Abandon an unfinished move: release the space reserved for the user's quota on the target CacheDisk,
+    and remove the partial copy.
+       :var xfc_control.models.UserMigration migration: the UserMigration to abandon
+       :return: True if the move was abandoned, False if it had already finished
+    """
+    with transaction.atomic():
+        abandoned = UserMigration.objects.filter(pk=migration.pk, state=UserMigration.COPYING).update(
+            state=UserMigration.ABANDONED, finished=datetime.datetime.utcnow()
+        )
+        if not abandoned:
+            return False
+        migration.target_disk.release(migration.user.hard_limit_size)
+    target_dir = os.path.join(migration.target_disk.mountpoint, migration.user.cache_path)
+    if os.path.isdir(target_dir) and not os.path.islink(target_dir):
+        shutil.rmtree(target_dir)
+    logging.info("Abandoned moving user: {} to {}".format(migration.user.name, migration.target_disk))
+    return True
+
+
+def migration_failed(migration, error, max_attempts=5):
+    """Record the error that stopped a move, and abandon the move once it has failed max_attempts times."""
+    logging.error("Could not move user: {} : {}".format(migration.user.name, str(error)))
+    UserMigration.objects.filter(pk=migration.pk).update(error=str(error), attempts=F("attempts") + 1)
+    migration.refresh_from_db(fields=["attempts"])
+    if migration.attempts >= max_attempts:
+        abandon_migration(migration)
+
+
+def cancel_migrations(usernames):
+    """Abandon the unfinished moves of the users.
+       :var List[string] usernames: names of the users
+       :return: number of moves abandoned
+    """
+    n_cancelled = 0
+    migrations = UserMigration.objects.filter(state=UserMigration.COPYING, user__name__in=usernames)
+    for migration in migrations.select_related("user", "target_disk"):
+        if abandon_migration(migration):
+            n_cancelled += 1
+    return n_cancelled
+
+
+def start_migration(user):
+    """Reserve the space for the user's quota on another CacheDisk, and create the UserMigration.
+       :var xfc_control.models.User user: the user to move
+       :return: the UserMigration, or None if no CacheDisk has enough space for the user's quota
+    """
+    target_disk = CacheDisk.reserve_cache_disk(user.hard_limit_size, exclude=[user.cache_disk_id])
+    if target_disk is None:
+        return None
+    migration = UserMigration(user=user, source_disk=user.cache_disk, target_disk=target_disk,
+                              started=datetime.datetime.utcnow())
+    migration.save()
+    return migration
+
+
+def run_loop(retire=True, threshold=None, max_users=None, workers=8, remove_source=False, dry_run=False,
+             max_attempts=5):
+    """Resume the unfinished UserMigrations and then start moving the users chosen by select_users."""
+    n_moved = 0
+    # resume the unfinished moves first
+    for migration in UserMigration.objects.filter(state=UserMigration.COPYING).select_related(
+            "user", "source_disk", "target_disk"):
+        if max_users is not None and n_moved >= max_users:
+            return
+        if dry_run:
+            logging.info("Would resume moving user: {} to {}".format(migration.user.name, migration.target_disk))
+            n_moved += 1
+            continue
+        try:
+            if move_user(migration.user, migration, workers, remove_source):
+                n_moved += 1
+        except Exception as e:
+            migration_failed(migration, e, max_attempts)
+
+    for user in select_users(retire, threshold):
+        if max_users is not None and n_moved >= max_users:
+            return
+        if dry_run:
+            logging.info("Would move user: {} from {}".format(user.name, user.cache_disk))
+            n_moved += 1
+            continue
+        migration = start_migration(user)
+        if migration is None:
+            logging.error("No CacheDisk found with enough free space to move user: {}".format(user.name))
+            continue
+        try:
+            if move_user(user, migration, workers, remove_source):
+                n_moved += 1
+        except Exception as e:
+            migration_failed(migration, e, max_attempts)
+
+
+def run(*args):
+    """Entry point for the Django script run via ``./manage.py runscript``
+    """
+    # setup the logging
+    config = read_process_config("xfc_rebalance")
+    setup_logging("xfc_rebalance", config)
+    logging.info("Starting xfc_rebalance")
+
+    arg_dict = split_args(args)
+    if "cancel" in arg_dict:
+        n_cancelled = cancel_migrations(arg_dict["cancel"].split(","))
+        logging.info("Cancelled {} moves".format(n_cancelled))
+        return
+    run_loop(
+        retire=(arg_dict.get("retire", "true").lower() == "true"),
+        threshold=float(arg_dict["threshold"]) if "threshold" in arg_dict else None,
+        max_users=int(arg_dict["max_users"]) if "max_users" in arg_dict else None,
+        workers=int(arg_dict.get("workers", 8)),
+        remove_source=(arg_dict.get("remove_source", "false").lower() == "true"),
+        dry_run=(arg_dict.get("dry_run", "false").lower() == "true"),
+        max_attempts=int(arg_dict.get("max_attempts", 5)),
+    )
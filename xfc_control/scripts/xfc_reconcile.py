@@ -0,0 +1,119 @@
+"""Function to reconcile the used space recorded for the CacheDisks and Users with the filesystem.
+
+The real usage of each CacheDisk volume is read with ``statvfs`` and stored in
+CacheDisk.real_used_bytes.  The total size of each user's files is found with a single GROUP BY
+query on CachedFile, and these are summed to give the total for each CacheDisk.  The gaps between
+the filesystem, the per-user totals and the running totals in CacheDisk.used_bytes and
+User.total_used are reported.  No file on disk or row of CachedFile is visited individually.
+
+ This script is designed to be run via the django-extensions runscript command:
+
+  ``python manage.py runscript xfc_reconcile``
+
+ Arguments:
+
+  - ``fix=true|false``: set CacheDisk.used_bytes and User.total_used to the totals from the GROUP BY
+    query (default false)
+"""
+
+import datetime
+import logging
+
+from django.db import transaction
+from django.db.models import Sum
+from sizefield.utils import filesizeformat
+
+from xfc_control.models import User, CacheDisk, CachedFile, CachedDirectory
+
+from xfc_control.scripts.config import read_process_config, split_args
+from xfc_control.scripts.config import setup_logging
+
+
+def user_totals():
+    """Get the total size of the CachedFiles of every user, with one GROUP BY query, plus the totals
+    of the directory aggregates for users scanned in directory mode.
+       :return: dictionary of the total size, keyed on the user id
+    """
+    totals = CachedFile.objects.values("user").annotate(total=Sum("size")).order_by()
+    user_total = {t["user"]: t["total"] for t in totals}
+    aggregates = CachedDirectory.objects.filter(aggregate=True).values("user").annotate(
+        total=Sum("own_size")).order_by()
+    for t in aggregates:
+        user_total[t["user"]] = user_total.get(t["user"], 0) + t["total"]
+    return user_total
+
+
+def read_filesystem_usage():
+    """Read the used space of each CacheDisk volume from the filesystem and store it in
+    CacheDisk.real_used_bytes.
+       :return: list of CacheDisks, with real_used_bytes updated
+    """
+    now = datetime.datetime.utcnow()
+    disks = list(CacheDisk.objects.all())
+    for cd in disks:
+        try:
+            size, used = cd.filesystem_usage()
+        except OSError as e:
+            logging.error("Could not read filesystem usage of {} : {}".format(cd.mountpoint, str(e)))
+            continue
+        cd.real_used_bytes = used
+        cd.reconciled = now
+        CacheDisk.objects.filter(pk=cd.pk).update(real_used_bytes=used, reconciled=now)
+    return disks
+
+
+def reconcile(fix=False):
+    """Compare the used space recorded in the database with the filesystem and the per-user totals,
+    and log the differences.
+       :var bool fix: set CacheDisk.used_bytes and User.total_used to the per-user totals
+       :return: list of dictionaries, one per CacheDisk, containing the mountpoint and the used space
+                from the filesystem (real_used), the per-user totals (files_used) and the running
+                total (used), and the number of users whose total_used does not match their files
+    """
+    disks = read_filesystem_usage()
+    totals = user_totals()
+
+    # sum the per-user totals for each CacheDisk, and find the users whose running total has drifted
+    disk_totals = {cd.pk: 0 for cd in disks}
+    drifted = {cd.pk: [] for cd in disks}
+    for user in User.objects.only("pk", "name", "cache_disk", "total_used"):
+        total = totals.get(user.pk, 0)
+        disk_totals[user.cache_disk_id] += total
+        if user.total_used != total:
+            user.total_used = total
+            drifted[user.cache_disk_id].append(user)
+
+    report = []
+    for cd in disks:
+        files_used = disk_totals[cd.pk]
+        logging.info(
+            "{} : filesystem {}, files {}, recorded {} (filesystem - files = {}, recorded - files = {}), "
+            "{} users drifted".format(
+                cd.mountpoint, filesizeformat(cd.real_used_bytes), filesizeformat(files_used),
+                filesizeformat(cd.used_bytes), filesizeformat(cd.real_used_bytes - files_used),
+                filesizeformat(cd.used_bytes - files_used), len(drifted[cd.pk]))
+        )
+        report.append({"mountpoint": cd.mountpoint, "real_used": cd.real_used_bytes,
+                       "files_used": files_used, "used": cd.used_bytes,
+                       "users_drifted": len(drifted[cd.pk])})
+
+    if fix:
+        with transaction.atomic():
+            for cd in disks:
+                CacheDisk.objects.filter(pk=cd.pk).update(used_bytes=disk_totals[cd.pk])
+                User.objects.bulk_update(drifted[cd.pk], ["total_used"], batch_size=1000)
+        logging.info("Fixed used space of {} CacheDisks and {} users".format(
+            len(disks), sum(len(d) for d in drifted.values())))
+    return report
+
+
+def run(*args):
+    """Entry point for the Django script run via ``./manage.py runscript``
+    """
+    # setup the logging
+    config = read_process_config("xfc_reconcile")
+    setup_logging("xfc_reconcile", config)
+    logging.info("Starting xfc_reconcile")
+
+    arg_dict = split_args(args)
+    reconcile(fix=(arg_dict.get("fix", "false").lower() == "true"))
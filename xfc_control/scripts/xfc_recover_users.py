@@ -0,0 +1,161 @@
+"""Function to recover the Users from the directories that exist under the CacheDisk mountpoints.
+
+If the database of users has been lost, the users can be reinstated by looking at the directories
+in the ``user_cache`` area of each CacheDisk.  The ``user_cache`` area of each CacheDisk is listed
+in parallel, the directory names are looked up in LDAP in batches, and a User is created for each
+one that does not already exist, with the default quota and hard limit.  The Users are created with
+a single bulk insert, and the allocated space of each CacheDisk is updated to include them.
+
+Optionally, the size of each recovered user's directory tree can be found, without creating any
+CachedFiles, so that User.total_used and CacheDisk.used_bytes are correct before the first full scan.
+
+ This script is designed to be run via the django-extensions runscript command:
+
+  ``python manage.py runscript xfc_recover_users --script-args scan=true``
+
+ Arguments:
+
+  - ``scan=true|false``: find the total size of each recovered user's files (default false)
+  - ``workers=<n>``: number of directories to list or scan in parallel (default 8)
+  - ``dry_run=true|false``: only log which users would be recovered (default false)
+"""
+
+import os
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from django.db import transaction
+from django.db.models import F
+
+from xfc_control.models import User, CacheDisk
+from xfc_control.ldap_users import lookup_users
+
+from xfc_control.scripts.config import read_process_config, split_args
+from xfc_control.scripts.config import setup_logging
+
+
+def list_user_directories(cache_disk):
+    """List the names of the user directories in the user_cache area of the CacheDisk.
+       :var xfc_control.models.CacheDisk cache_disk: the CacheDisk to list
+       :return: list of directory names
+    """
+    cache_path = os.path.join(cache_disk.mountpoint, "user_cache")
+    try:
+        with os.scandir(cache_path) as it:
+            return [entry.name for entry in it if entry.is_dir(follow_symlinks=False)]
+    except OSError as e:
+        logging.error("Could not list user directories in {} : {}".format(cache_path, str(e)))
+        return []
+
+
+def find_lost_users(workers=8):
+    """Find the user directories that do not have a User, on all the CacheDisks in parallel.
+       :var int workers: number of CacheDisks to list in parallel
+       :return: dictionary of the CacheDisk for each user directory, keyed on the user name
+    """
+    disks = list(CacheDisk.objects.all())
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        listings = list(executor.map(list_user_directories, disks))
+
+    existing = set(User.objects.values_list("name", flat=True))
+    lost = {}
+    for cd, names in zip(disks, listings):
+        for name in names:
+            if name in existing:
+                continue
+            if name in lost:
+                # a user should only have a directory on one CacheDisk - prefer a CacheDisk that is not
+                # being retired, and report the duplicate
+                logging.warning("User directory {} found on {} and {}".format(name, lost[name], cd))
+                if not lost[name].retiring:
+                    continue
+            lost[name] = cd
+    return lost
+
+
+def tree_size(directory):
+    """Return the total size of the files in the directory tree, without following links."""
+    size = 0
+    for root, dirs, files in os.walk(directory):
+        for f in files:
+            try:
+                size += os.lstat(os.path.join(root, f)).st_size
+            except OSError:
+                continue
+    return size
+
+
+def scan_user_sizes(users, workers=8):
+    """Find the total size of each user's directory tree, in parallel, and update User.total_used
+    and CacheDisk.used_bytes.
+       :var List[xfc_control.models.User] users: the users to scan
+       :var int workers: number of directory trees to scan in parallel
+    """
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        sizes = list(executor.map(
+            lambda u: tree_size(os.path.join(u.cache_disk.mountpoint, u.cache_path)), users
+        ))
+    disk_used = {}
+    for user, size in zip(users, sizes):
+        user.total_used = size
+        disk_used[user.cache_disk_id] = disk_used.get(user.cache_disk_id, 0) + size
+    with transaction.atomic():
+        User.objects.bulk_update(users, ["total_used"], batch_size=1000)
+        for cd_id, used in disk_used.items():
+            CacheDisk.objects.filter(pk=cd_id).update(used_bytes=F("used_bytes") + used)
+
+
+def recover_users(scan=False, workers=8, dry_run=False):
+    """Create a User for each user directory under the CacheDisk mountpoints that does not have one,
+    and whose name is found in LDAP.
+       :var bool scan: find the total size of each recovered user's files
+       :var int workers: number of directories to list or scan in parallel
+       :var bool dry_run: only log which users would be recovered
+       :return: list of the recovered Users
+    """
+    lost = find_lost_users(workers)
+    ldap_users = lookup_users(sorted(lost))
+    for name in sorted(set(lost) - set(ldap_users)):
+        logging.warning("User directory {} on {} not found in LDAP".format(name, lost[name]))
+
+    qs = User.get_quota_size()
+    hl = User.get_hard_limit_size()
+    users = []
+    for name in sorted(ldap_users):
+        cd = lost[name]
+        users.append(User(name=name, email=ldap_users[name].email, quota_size=qs, quota_used=0,
+                          hard_limit_size=hl, total_used=0, cache_path=os.path.join("user_cache", name),
+                          cache_disk=cd))
+        logging.info("Recovering user: {} on {}".format(name, cd))
+    if dry_run or len(users) == 0:
+        return users
+
+    # allocate the users' quotas on their CacheDisks
+    allocated = {}
+    for user in users:
+        allocated[user.cache_disk_id] = allocated.get(user.cache_disk_id, 0) + hl
+    with transaction.atomic():
+        users = User.objects.bulk_create(users, batch_size=1000)
+        for cd_id, amount in allocated.items():
+            CacheDisk.objects.filter(pk=cd_id).update(allocated_bytes=F("allocated_bytes") + amount)
+    logging.info("Recovered {} users".format(len(users)))
+
+    if scan:
+        scan_user_sizes(users, workers)
+    return users
+
+
+def run(*args):
+    """Entry point for the Django script run via ``./manage.py runscript``
+    """
+    # setup the logging
+    config = read_process_config("xfc_recover_users")
+    setup_logging("xfc_recover_users", config)
+    logging.info("Starting xfc_recover_users")
+
+    arg_dict = split_args(args)
+    recover_users(
+        scan=(arg_dict.get("scan", "false").lower() == "true"),
+        workers=int(arg_dict.get("workers", 8)),
+        dry_run=(arg_dict.get("dry_run", "false").lower() == "true"),
+    )
@@ -1,9 +1,48 @@
 """Function to scan all the files in all user's directories and add them as
 entries to CachedFile.
 
+For users whose scan mode (see User.get_scan_mode) is CacheDisk.DIRECTORY_MODE, no CachedFiles are
+created - only the totals for each directory are stored, in CachedDirectory.
+
+Each pass over a user's cache area is recorded as a ScanPass, and the files (or directory totals)
+that are added, change size or are removed are appended to the journal (see xfc_control.journal).
+
+The inode, modification time and access time of each file are stored on its CachedFile, so that other
+scripts (e.g. xfc_delete) do not have to stat the files.  A file that has been renamed or moved within
+the user's cache area is found by its inode, and its CachedFile is moved rather than removed and added
+again, so that the file keeps its first_seen (in the journal, the rename is a remove and an add).
+
  This script is designed to be run via the django-extensions runscript command:
 
   ``python manage.py runscript xfc_scan``
+
+ Arguments:
+
+  - ``daemon=true|false``: run continuously, every RUN_EVERY_HOURS (default false)
+  - ``adaptive=true|false``: only scan the users that are due to be scanned, from how often their files
+    change and how close they are to their quota (see xfc_control.scan_frequency, default true).  With
+    adaptive, RUN_EVERY_HOURS can be as short as XFC_SCAN_MIN_HOURS, as the users that are not due are
+    skipped.  With ``adaptive=false`` every user is scanned on every run
+  - ``snapshot_dir=<path>``: write a binary snapshot (see xfc_control.snapshots) of the files found
+    for each user on each pass, to ``<path>/<user name>/<time>.xfcsnap`` (default: the
+    XFC_SNAPSHOT_DIR setting, or no snapshots if that is not set)
+  - ``profile=true|false``: profile each user, writing the cProfile stats and the per-phase breakdown
+    to ``profile_dir`` (see xfc_control.profiling, default false)
+  - ``profile_dir=<path>``: directory to write the profiles to (default: the XFC_PROFILE_DIR setting)
+  - ``profile_top=<n>``: (*optional*) only write the cProfile stats of the n slowest users
+  - ``consume=true|false``: rather than scanning every user, take the users to scan from the scan queue,
+    which is filled by xfc_dispatch, and publish a message on the completion queue when each scan has
+    finished (see xfc_control.broker, default false).  Any number of scanners can consume the queue.
+    The quotas of the users are saved from the completion messages by xfc_complete
+  - ``prefetch=<n>``: with consume, the number of users delivered to the scanner before their scans are
+    acknowledged (default 1)
+  - ``broker=<url>``: with consume, the URL of the broker (default: the XFC_BROKER_URL setting)
+  - ``shard=true|false``: share the CacheDisks with the other instances running with shard, through
+    leases in the database (see xfc_control.sharding, default false).  Each instance scans the users of
+    the CacheDisks it holds a lease on, every RUN_EVERY_HOURS with daemon, or once without
+  - ``mountpoints=<path>,<path>``: with shard, the mountpoints (or their parent directories) of the
+    volumes local to this instance, whose CacheDisks it claims first (default: the CacheDisks whose
+    mountpoint is a mount point on this host)
 """
 
 import datetime
@@ -12,13 +51,26 @@ import os
 import logging
 from time import sleep
 import signal, sys
+import socket
 
-from xfc_control.models import User, CachedFile
+from django.db.models import F, Q
+
+from xfc_control.models import User, CacheDisk, CachedFile, CachedDirectory
 from xfc_control.scripts.xfc_user_lock import lock_user, user_locked, unlock_user
+from xfc_control.dir_tree import DirectoryTree, update_directory_tree
+from xfc_control.snapshots import SnapshotWriter, snapshot_filename
+from xfc_control.journal import ScanJournal
+from xfc_control.metrics import FILES_WALKED, STAT_ERRORS, ROWS_WRITTEN
+from xfc_control.metrics import LOCK_WAIT, USERS_LOCKED, write_process_metrics
+from xfc_control.profiling import Profiler, profiler_from_args
+from xfc_control.dashboard import refresh_rollups
+from xfc_control.broker import get_broker, scan_queue, complete_queue
+from xfc_control.sharding import Leaser
+from xfc_control.scan_frequency import schedule_next_scan
 import xfc_site.settings as settings
 
 from xfc_control.scripts.config import read_process_config, split_args
-from xfc_control.scripts.config import get_logging_format, get_logging_level
+from xfc_control.scripts.config import setup_logging
 
 def get_log_time_string():
     current_time = datetime.datetime.utcnow()
@@ -28,93 +80,326 @@ def get_log_time_string():
         current_time.minute, current_time.second)
     return current_time_string
 
-def scan_for_added_files(user):
+
+# inode numbers are unsigned 64 bit integers, and are stored in a signed BigIntegerField
+INODE_RANGE = 2 ** 64
+# the access time of a CachedFile is only saved again once it has moved on by this much, so that reading the
+# files does not write every CachedFile on every scan (as with the relatime mount option)
+ATIME_RESOLUTION = datetime.timedelta(days=1)
+
+
+def stat_fields(st):
+    """Return the inode, modification time and access time of a file, as they are stored on CachedFile.
+       :var os.stat_result st: the result of stat on the file
+       :return: (inode, mtime, atime)
+    """
+    inode = st.st_ino if st.st_ino < INODE_RANGE // 2 else st.st_ino - INODE_RANGE
+    return (inode, datetime.datetime.utcfromtimestamp(st.st_mtime),
+            datetime.datetime.utcfromtimestamp(st.st_atime))
+
+
+def update_stat_fields(cf, inode, mtime, atime):
+    """Set the inode, modification time and access time of a CachedFile, if they have changed.
+       :return: whether the CachedFile needs to be saved
+    """
+    changed = cf.inode != inode or cf.mtime != mtime
+    if cf.atime is None or abs(atime - cf.atime) >= ATIME_RESOLUTION:
+        changed = True
+    if changed:
+        cf.inode = inode
+        cf.mtime = mtime
+        cf.atime = atime
+    return changed
+
+
+def find_renamed_files(user, directory, new_files, names):
+    """Find the CachedFiles that the new files in a directory have been renamed (or moved) from.  A
+    CachedFile has been renamed to a new file if it has the same inode and modification time, and its own
+    path no longer holds that inode (if it does, the new file is a hard link).
+       :var xfc_control.models.User user: the user being scanned
+       :var xfc_control.models.CachedDirectory directory: the directory containing the new files
+       :var dict new_files: the (inode, mtime) of each new file, keyed on its name
+       :var set names: the names of all the files in the directory
+       :return: dictionary of the renamed CachedFiles, keyed on the name of the new file
+    """
+    by_inode = {}
+    for name, key in new_files.items():
+        by_inode.setdefault(key, []).append(name)
+    inodes = list({inode for inode, mtime in by_inode})
+    renamed = {}
+    for i in range(0, len(inodes), 1000):
+        candidates = CachedFile.objects.filter(user=user, inode__in=inodes[i:i+1000]).select_related("directory")
+        for cf in candidates:
+            new_names = by_inode.get((cf.inode, cf.mtime))
+            if not new_names:
+                continue
+            if cf.directory_id == directory.pk:
+                if cf.name in names:
+                    continue
+            else:
+                try:
+                    if stat_fields(os.lstat(os.path.join(user.cache_disk.mountpoint, cf.path)))[0] == cf.inode:
+                        continue
+                except FileNotFoundError:
+                    pass
+                except OSError:
+                    continue
+            renamed[new_names.pop()] = cf
+    return renamed
+
+def scan_for_added_files(user, snapshot=None, journal=None):
     """Scan the user directory and add the files as CachedFile objects.
+    The sizes of the directories are accumulated during the walk and returned.
        :var xfc_control.models.User user: instance of User to scan
+       :var xfc_control.snapshots.SnapshotWriter snapshot: (*optional*) snapshot to add the files to
+       :var xfc_control.journal.ScanJournal journal: (*optional*) journal to record the changes in
+       :return: the DirectoryTree of the user's cache area
     """
-    logging.info("    Scanning for added files")
+    logging.debug("    Scanning for added files")
     # get the user directory
     user_dir = os.path.join(user.cache_disk.mountpoint, user.cache_path)
+    # create the short paths, that do not include the cache disk mountpoint
+    # ensure trailing slash
+    mp = user.cache_disk.mountpoint
+    if mp[-1] != "/":
+        mp += "/"
+    # accumulate the directory sizes during the walk, and get the directory records
+    tree = DirectoryTree(user.cache_path, user=user)
+    if journal is not None:
+        # the directory totals from DIRECTORY_MODE are replaced by the files
+        for cd in tree.records.values():
+            if cd.aggregate and cd.own_files != 0:
+                journal.remove(cd.path, cd.own_size, aggregate=True)
     # walk the directory
     user_file_list = os.walk(user_dir, followlinks=True)
     for root, dirs, files in user_file_list:
+        sh_root = root.replace(mp, "")
+        tree.add_directory(sh_root)
+        FILES_WALKED.inc(len(files), mode="file")
         # if the files is not an empty list then add the files to the user's files
         if len(files) != 0:
+            directory = tree.record(sh_root)
+            # get the files already in this directory in one query
+            current_files = {cf.name: cf for cf in CachedFile.objects.filter(directory=directory)}
+            added_files = []
+            changed_files = []
+            # the files not already in the directory, which have been added or renamed
+            new_files = {}
             for file in files:
-                # get the current time
-                current_time_string = get_log_time_string()
                 filepath = os.path.join(root, file)
-                # get the file info and the current time / date
+                # get the file info
                 try:
-                    filesize = os.path.getsize(filepath)
+                    st = os.stat(filepath)
+                    filesize = st.st_size
                 except os.error:
-                    logging.error(
-                        "[" + current_time_string + "] Could not find file with path: " + filepath
-                    )
+                    logging.error("Could not find file with path: %s", filepath)
+                    STAT_ERRORS.inc(process="xfc_scan")
                     continue
-                try:
-                    # create the short filepath, that does not include the cache disk mountpoint
-                    # ensure trailing slash
-                    mp = user.cache_disk.mountpoint
-                    if mp[-1] != "/":
-                        mp += "/"
-                    sh_filepath = filepath.replace(mp,"")
-                    # check whether this file already exists
-                    current_file = CachedFile.objects.filter(
-                        user=user, path=sh_filepath
-                    )
-                    if len(current_file) == 0:
-                        logging.info(
-                            "[" + current_time_string + "] Adding file: " + filepath
-                        )
-                        # create the CachedFile
-                        cf = CachedFile()
-                        cf.user = user
-                        cf.cache_disk = user.cache_disk
-                        cf.path = sh_filepath
-                        cf.size = filesize
-                        cf.first_seen = datetime.datetime.utcnow()
-                        cf.save()
-                    elif current_file[0].size != filesize:
-                        # check whether this file's size has changed
-                        logging.info(
-                            "[" + current_time_string + "] File size changed: " + filepath
-                        )
-                        current_file[0].size = filesize
-                        current_file[0].save()
-                except:
-                    logging.error(
-                        "[" + current_time_string + "] Could not create CachedFile with path: " + filepath
-                    )
-
-
-def scan_for_deleted_files(user):
+                # check whether this file already exists
+                current_file = current_files.get(file)
+                if current_file is None:
+                    new_files[file] = st
+                    continue
+                changed = False
+                if current_file.size != filesize:
+                    # check whether this file's size has changed
+                    logging.debug("File size changed: %s", filepath)
+                    if journal is not None:
+                        journal.resize(os.path.join(sh_root, file), current_file.size, filesize)
+                    current_file.size = filesize
+                    changed = True
+                if update_stat_fields(current_file, *stat_fields(st)) or changed:
+                    changed_files.append(current_file)
+                # add the file to the directory sizes
+                tree.add_file(sh_root, filesize, current_file.first_seen)
+                if snapshot is not None:
+                    snapshot.add(os.path.join(sh_root, file), st.st_ino, filesize, st.st_mtime,
+                                 current_file.first_seen)
+            renamed = {}
+            if len(new_files) != 0:
+                renamed = find_renamed_files(
+                    user, directory, {file: stat_fields(st)[:2] for file, st in new_files.items()}, set(files)
+                )
+            for file, st in new_files.items():
+                filepath = os.path.join(root, file)
+                filesize = st.st_size
+                cf = renamed.get(file)
+                if cf is not None:
+                    # move the CachedFile, so that the file keeps its first_seen
+                    logging.debug("File renamed: %s to %s", cf.path, filepath)
+                    if journal is not None:
+                        journal.remove(cf.path, cf.size)
+                        journal.add(os.path.join(sh_root, file), filesize)
+                    cf.directory = directory
+                    cf.name = file
+                    cf.size = filesize
+                    changed_files.append(cf)
+                else:
+                    logging.debug("Adding file: %s", filepath)
+                    # create the CachedFile
+                    cf = CachedFile()
+                    cf.user = user
+                    cf.directory = directory
+                    cf.name = file
+                    cf.size = filesize
+                    # keep the age of the files recorded by a directory total in DIRECTORY_MODE
+                    cf.first_seen = tree.aggregate_first_seen(sh_root) or datetime.datetime.utcnow()
+                    added_files.append(cf)
+                    if journal is not None:
+                        journal.add(os.path.join(sh_root, file), filesize)
+                update_stat_fields(cf, *stat_fields(st))
+                # add the file to the directory sizes
+                tree.add_file(sh_root, filesize, cf.first_seen)
+                if snapshot is not None:
+                    snapshot.add(os.path.join(sh_root, file), st.st_ino, filesize, st.st_mtime, cf.first_seen)
+            try:
+                CachedFile.objects.bulk_create(added_files, batch_size=1000)
+                CachedFile.objects.bulk_update(changed_files, ["directory", "name", "size", "inode", "mtime", "atime"],
+                                               batch_size=1000)
+                ROWS_WRITTEN.inc(len(added_files), process="xfc_scan", model="CachedFile", operation="create")
+                ROWS_WRITTEN.inc(len(changed_files), process="xfc_scan", model="CachedFile", operation="update")
+            except:
+                logging.error("Could not create CachedFiles in directory: %s", root)
+    return tree
+
+
+def files_first_seen(user, tree):
+    """Total the CachedFiles of a user in the same directories as a DIRECTORY_MODE DirectoryTree, so
+    that the directory totals get the size-weighted first_seen of the files when a user is changed from
+    FILE_MODE to DIRECTORY_MODE.
+       :var xfc_control.models.User user: instance of User
+       :var DirectoryTree tree: the DIRECTORY_MODE tree being built
+       :return: DirectoryTree of the CachedFiles
+    """
+    files_tree = DirectoryTree(tree.root_path, current_date=tree.current_date,
+                               aggregate=True, scan_depth=tree.scan_depth)
+    cached_files = CachedFile.objects.filter(user=user).values_list("directory__path", "size", "first_seen")
+    for dir_path, size, first_seen in cached_files.iterator(chunk_size=10000):
+        files_tree.add_file(files_tree.fold(dir_path), size, first_seen)
+    return files_tree
+
+
+def directory_first_seen(tree, path, size, files_tree=None):
+    """Return the size-weighted first_seen of the files in a directory total.
+       :var DirectoryTree tree: the DIRECTORY_MODE tree being built, with the records from the last scan
+       :var string path: path to the directory AFTER the CacheDisk mountpoint
+       :var int size: the total size of the files found in this scan
+       :var DirectoryTree files_tree: (*optional*) the CachedFiles of the user, from files_first_seen
+    """
+    cd = tree.records.get(path)
+    current_date = tree.current_date
+    if cd is not None and cd.aggregate and cd.own_first_seen is not None:
+        if size > cd.own_size:
+            # the bytes added since the last scan are first seen now
+            return cd.own_first_seen + (current_date - cd.own_first_seen) * ((size - cd.own_size) / size)
+        return cd.own_first_seen
+    if files_tree is not None:
+        entry = files_tree.directories.get(path)
+        if entry is not None and entry[1] != 0:
+            return files_tree.own_first_seen(path)
+    return current_date
+
+
+def scan_directories(user, snapshot=None, journal=None):
+    """Scan the user directory in DIRECTORY_MODE, totalling the size and number of files for each
+    directory, or for each subtree below the user's scan depth.  No CachedFiles are created, and any
+    existing CachedFiles (from FILE_MODE) are removed once their ages have been added to the totals.
+       :var xfc_control.models.User user: instance of User to scan
+       :var xfc_control.snapshots.SnapshotWriter snapshot: (*optional*) snapshot to add the files to,
+                                                          with the first_seen of their directory total
+       :var xfc_control.journal.ScanJournal journal: (*optional*) journal to record the changes to the
+                                                    directory totals in
+       :return: the DirectoryTree of the user's cache area
+    """
+    logging.debug("    Scanning directories")
+    user_dir = os.path.join(user.cache_disk.mountpoint, user.cache_path)
+    mp = user.cache_disk.mountpoint
+    if mp[-1] != "/":
+        mp += "/"
+    tree = DirectoryTree(user.cache_path, user=user, aggregate=True, scan_depth=user.get_scan_depth())
+    # [size, n_files] for each directory total
+    sizes = {}
+    # the files for the snapshot, for each directory total
+    snapshot_files = {}
+    for root, dirs, files in os.walk(user_dir, followlinks=True):
+        sh_root = root.replace(mp, "")
+        path = tree.fold(sh_root)
+        tree.add_directory(path)
+        entry = sizes.setdefault(path, [0, 0])
+        FILES_WALKED.inc(len(files), mode="directory")
+        for file in files:
+            filepath = os.path.join(root, file)
+            try:
+                st = os.stat(filepath)
+            except os.error:
+                logging.error("Could not find file with path: %s", filepath)
+                STAT_ERRORS.inc(process="xfc_scan")
+                continue
+            entry[0] += st.st_size
+            entry[1] += 1
+            if snapshot is not None:
+                snapshot_files.setdefault(path, []).append(
+                    (os.path.join(sh_root, file), st.st_ino, st.st_size, st.st_mtime)
+                )
+
+    files_tree = None
+    if CachedFile.objects.filter(user=user).exists():
+        files_tree = files_first_seen(user, tree)
+        if journal is not None:
+            # the files are replaced by the directory totals
+            cached_files = CachedFile.objects.filter(user=user).values_list("directory__path", "name", "size")
+            for dir_path, name, size in cached_files.iterator(chunk_size=10000):
+                journal.remove(os.path.join(dir_path, name), size)
+    if journal is not None:
+        for path, cd in tree.records.items():
+            old_size = cd.own_size if cd.aggregate and cd.own_files != 0 else None
+            size, n_files = sizes.get(path, (0, 0))
+            if n_files == 0:
+                if old_size is not None:
+                    journal.remove(path, old_size, aggregate=True)
+            elif old_size is None:
+                journal.add(path, size, aggregate=True)
+            elif old_size != size:
+                journal.resize(path, old_size, size, aggregate=True)
+        for path, (size, n_files) in sizes.items():
+            if path not in tree.records and n_files != 0:
+                journal.add(path, size, aggregate=True)
+    for path, (size, n_files) in sizes.items():
+        if n_files == 0:
+            continue
+        first_seen = directory_first_seen(tree, path, size, files_tree)
+        tree.add_file(path, size, first_seen, n_files)
+        for file_entry in snapshot_files.get(path, []):
+            snapshot.add(*file_entry, first_seen=first_seen)
+    if files_tree is not None:
+        # the files are now recorded by the directory totals
+        n_deleted, _ = CachedFile.objects.filter(user=user).delete()
+        ROWS_WRITTEN.inc(n_deleted, process="xfc_scan", model="CachedFile", operation="delete")
+    return tree
+
+
+def scan_for_deleted_files(user, journal=None):
     """Find any files that have been deleted but still exist in the database and
        remove them from the database.
        :var xfc_control.models.User user: instance of User to update
+       :var xfc_control.journal.ScanJournal journal: (*optional*) journal to record the removed files in
     """
     # loop over all the files
-    logging.info("    Scanning for deleted files")
-    cached_files = CachedFile.objects.filter(user=user)
+    logging.debug("    Scanning for deleted files")
+    cached_files = CachedFile.objects.filter(user=user).select_related("directory")
     for file in cached_files:
-
-        current_time = datetime.datetime.utcnow()
-        current_time_string = "%02i %s %d %02d:%02d.%02d" % (
-            current_time.day, calendar.month_abbr[current_time.month],
-            current_time.year, current_time.hour,
-            current_time.minute, current_time.second)
-
         # get the filepath as the concatenation of the mountpoint and path
         filepath = os.path.join(user.cache_disk.mountpoint, file.path)
         # check whether the file exists
         if not os.path.exists(filepath):
-            logging.info(
-                "[" + current_time_string + "] Deleting file: " + filepath
-            )
+            logging.debug("Deleting file: %s", filepath)
+            if journal is not None:
+                journal.remove(file.path, file.size)
             file.delete()
+            ROWS_WRITTEN.inc(process="xfc_scan", model="CachedFile", operation="delete")
 
 
-def calc_user_quota(user):
+def calc_user_quota(user, save=True):
     """Calculate how much of the user's quota has been used up.
        The quota is in bytes day - so the algorithm is::
 
@@ -123,8 +408,9 @@ def calc_user_quota(user):
           n=0
 
        :var xfc_control.models.User user: instance of User to update
+       :var bool save: save the user - otherwise only user.quota_used is set
     """
-    logging.info("    Calculating user quota")
+    logging.debug("    Calculating user quota")
     # get all the cached files
     cached_files = CachedFile.objects.filter(user=user)
     quota_sum = 0
@@ -134,18 +420,23 @@ def calc_user_quota(user):
         # get the time delta in days - add one so that the quota is used on
         # the first day the file was seen
         quota_sum += file.quota_use()
+    # add the files recorded by directory totals
+    for cd in CachedDirectory.objects.filter(user=user, aggregate=True):
+        quota_sum += cd.own_quota_use()
     # update the user and save
     user.quota_used = quota_sum
-    user.save()
+    if save:
+        user.save()
 
 
-def calc_user_used_space(user):
+def calc_user_used_space(user, save=True):
     """Calculate how much space on the cache disk the user has used.
        This is different to the quota as there is no temporal element to this
        number
        :var xfc_control.models.User user: instance of User to calculate
+       :var bool save: save the user - otherwise only user.total_used is set
     """
-    logging.info("    Calculating used space")
+    logging.debug("    Calculating used space")
     # get all the cached files
     cached_files = CachedFile.objects.filter(user=user)
     sum = 0
@@ -153,8 +444,12 @@ def calc_user_used_space(user):
     # calculate used
     for file in cached_files:
         sum += file.size
+    # add the files recorded by directory totals
+    for cd in CachedDirectory.objects.filter(user=user, aggregate=True):
+        sum += cd.own_size
     user.total_used = sum
-    user.save()
+    if save:
+        user.save()
 
 
 def update_cache_disk_used_space(user, amount):
@@ -162,62 +457,268 @@ def update_cache_disk_used_space(user, amount):
        :var User user: user whose CacheDisk we are modifying
        :var amount int: number of bytes (positive or negative) to update b
     """
-    # get the cache disk
-    cd = user.cache_disk
-    # update the amount and save
-    cd.used_bytes += amount
-    cd.save()
+    # update only used_bytes, in the database, so that the allocations made while the user was being
+    # scanned are not overwritten with the values read at the start of the scan
+    CacheDisk.objects.filter(pk=user.cache_disk_id).update(used_bytes=F("used_bytes") + amount)
 
 def exit_handler(signal, frame):
     logging.info("Stopping xfc_scan")
     sys.exit(0)
 
-def run_loop(config):
-    """Run the main loop"""
+def scan_user(user, snapshot_dir=None, profiler=None, save_user=True):
+    """Scan one user's cache area, and update their quota.  The user must be locked.
+       :var xfc_control.models.User user: instance of User to scan
+       :var string snapshot_dir: (*optional*) directory to write the snapshot of the user to
+       :var xfc_control.profiling.Profiler profiler: (*optional*) profiler to time the user with
+       :var bool save_user: save the quota and last_scanned of the user, and the used space of their
+                            CacheDisk - otherwise they are only set on user, for the completion consumer
+                            (xfc_complete) to save
+       :return: the ScanPass of the scan
+    """
+    if profiler is None:
+        profiler = Profiler("xfc_scan")
+    with profiler.user(user.name):
+        # get the current user quota
+        old_user_used_space = user.total_used
+        snapshot = None
+        if snapshot_dir:
+            snapshot = SnapshotWriter(
+                snapshot_filename(snapshot_dir, user.name, datetime.datetime.utcnow())
+            )
+        scan_mode = user.get_scan_mode()
+        journal = ScanJournal.start(user, scan_mode)
+        if scan_mode == CacheDisk.DIRECTORY_MODE:
+            # total the files in each directory
+            with profiler.phase("walk"):
+                tree = scan_directories(user, snapshot, journal)
+        else:
+            # scan the directories
+            with profiler.phase("walk"):
+                tree = scan_for_added_files(user, snapshot, journal)
+            # check for any files that have been deleted and remove them from the database
+            with profiler.phase("deleted"):
+                scan_for_deleted_files(user, journal)
+        # store the directory sizes
+        with profiler.phase("directory_tree"):
+            update_directory_tree(user, tree)
+        # record the end of the pass
+        with profiler.phase("journal"):
+            root = tree.totals()[tree.root_path]
+            journal.finish(n_files=root[1], total_size=root[0])
+        # write the snapshot of the files found
+        if snapshot is not None:
+            with profiler.phase("snapshot"):
+                n_records = snapshot.close()
+            logging.debug("    Written snapshot of %d files: %s", n_records, snapshot.filename)
+        with profiler.phase("quota"):
+            # calculate the user used_quota
+            calc_user_quota(user, save=False)
+            # calculate the total space used
+            calc_user_used_space(user, save=False)
+            # when to scan the user next, from the changes found and the quota
+            schedule_next_scan(user, journal.scan_pass)
+            if save_user:
+                # the time of the scan, for xfc_dispatch
+                user.last_scanned = journal.scan_pass.finished
+                user.scan_dispatched = None
+                user.save()
+                # adjust the used space in the cache_disk
+                update_cache_disk_used_space(user, user.total_used-old_user_used_space)
+    # one summary line for the user, rather than a line for each file
+    scan_pass = journal.scan_pass
+    logging.info(
+        "Scanned user %s: %d files, %d bytes, %d added, %d resized, %d removed, quota used %d",
+        user.name, scan_pass.n_files, scan_pass.total_size, scan_pass.n_added, scan_pass.n_resized,
+        scan_pass.n_removed, user.quota_used,
+        extra={"user": user.name, "scan_mode": scan_mode, "n_files": scan_pass.n_files,
+               "total_size": scan_pass.total_size, "n_added": scan_pass.n_added,
+               "n_resized": scan_pass.n_resized, "n_removed": scan_pass.n_removed,
+               "bytes_added": scan_pass.bytes_added, "bytes_removed": scan_pass.bytes_removed,
+               "quota_used": user.quota_used, "total_used": user.total_used}
+    )
+    return scan_pass
+
+def due_users(users, now=None):
+    """Filter users to those that are due to be scanned (see xfc_control.scan_frequency)."""
+    if now is None:
+        now = datetime.datetime.utcnow()
+    return users.filter(Q(next_scan__isnull=True) | Q(next_scan__lte=now))
+
+def run_loop(config, snapshot_dir=None, profiler=None, adaptive=True):
+    """Run the main loop
+       :var dict config: the process config
+       :var string snapshot_dir: (*optional*) directory to write the snapshots of each user to
+       :var xfc_control.profiling.Profiler profiler: (*optional*) profiler to time the users with
+       :var bool adaptive: only scan the users that are due to be scanned, rather than all of them
+    """
+    if profiler is None:
+        profiler = Profiler("xfc_scan")
+    users = User.objects.all()
+    if adaptive:
+        users = due_users(users)
     # loop over all the users
-    for user in User.objects.all():
-        logging.info(
-            "[" + get_log_time_string() + "] Running scan for user: " +
-            user.name
-        )
+    for user in users:
+        logging.debug("Running scan for user: %s", user.name)
 
         # check if user locked
         if user_locked(user):
-            logging.info(
-                "[" + get_log_time_string() + "] User already locked: " + user.name
-            )
+            logging.info("User already locked: %s", user.name)
+            USERS_LOCKED.inc(process="xfc_scan")
             continue
         # lock the user
-        lock_user(user)
+        with LOCK_WAIT.time(process="xfc_scan"):
+            lock_user(user)
         try:
-            # get the current user quota
-            old_user_used_space = user.total_used
-            # scan the directories
-            scan_for_added_files(user)
-            # check for any files that have been deleted and remove them from the database
-            scan_for_deleted_files(user)
-            # calculate the user used_quota
-            calc_user_quota(user)
-            # calculate the total space used
-            calc_user_used_space(user)
-            # adjust the used space in the cache_disk
-            update_cache_disk_used_space(user, user.total_used-old_user_used_space)
+            scan_user(user, snapshot_dir, profiler)
             # unlock the user
             unlock_user(user)
         except Exception as e:
             unlock_user(user)
             raise Exception(e)
+    # refresh the rollups for the dashboard in the admin
+    with profiler.phase("rollups"):
+        refresh_rollups()
+    # write the profiles and metrics for this run
+    profiler.finish()
+    write_process_metrics("xfc_scan")
+
+def scan_shard(lease, leaser, snapshot_dir=None, profiler=None):
+    """Make a pass over the users of a shard (a CacheDisk) held by this instance that are due to be
+    scanned, those that have gone longest without a scan first.  A pass left unfinished by another
+    instance is carried on, skipping the users it has scanned.
+       :var xfc_control.models.ScanLease lease: the lease of the shard
+       :var xfc_control.sharding.Leaser leaser: the leaser of this instance
+       :return: whether the pass was finished - False if the lease was lost
+    """
+    users = due_users(User.objects.filter(cache_disk=lease.cache_disk).select_related("cache_disk"))
+    if lease.in_pass():
+        users = list(users.filter(Q(last_scanned__isnull=True) | Q(last_scanned__lt=lease.pass_started)).order_by(
+            F("last_scanned").asc(nulls_first=True), "pk"))
+        logging.info("Carrying on the pass of %s: %d users left", lease.cache_disk.mountpoint, len(users))
+        leaser.renew(lease, users_total=lease.users_done + len(users))
+    else:
+        users = list(users.order_by(F("last_scanned").asc(nulls_first=True), "pk"))
+        leaser.renew(lease, pass_started=datetime.datetime.utcnow(), users_total=len(users), users_done=0)
+    for user in users:
+        if not leaser.renew(lease, current_user=user.name):
+            logging.warning("Lost the lease of %s", lease.cache_disk.mountpoint)
+            return False
+        if user_locked(user):
+            logging.info("User already locked: %s", user.name)
+            USERS_LOCKED.inc(process="xfc_scan")
+        else:
+            with LOCK_WAIT.time(process="xfc_scan"):
+                lock_user(user)
+            try:
+                scan_user(user, snapshot_dir, profiler)
+            finally:
+                unlock_user(user)
+        lease.users_done += 1
+        leaser.renew(lease, users_done=lease.users_done)
+    return leaser.renew(lease, pass_finished=datetime.datetime.utcnow(), current_user="")
+
+def shard_loop(config, leaser, snapshot_dir=None, profiler=None, once=False):
+    """Claim the shards this instance can scan, and make a pass over each of them every RUN_EVERY_HOURS,
+    refreshing the dashboard rollups after each pass.
+       :var dict config: the process config
+       :var xfc_control.sharding.Leaser leaser: the leaser of this instance
+       :var string snapshot_dir: (*optional*) directory to write the snapshots of each user to
+       :var xfc_control.profiling.Profiler profiler: (*optional*) profiler to time the users with
+       :var bool once: make one pass over each shard held, then return
+    """
+    if profiler is None:
+        profiler = Profiler("xfc_scan")
+    time_period = datetime.timedelta(hours=config.get("RUN_EVERY_HOURS", 24))
+    leaser.start_heartbeat()
+    while True:
+        for lease in leaser.claim():
+            due = (lease.in_pass() or lease.pass_finished is None or
+                   datetime.datetime.utcnow() - lease.pass_finished > time_period)
+            if not due:
+                continue
+            logging.info("Scanning shard %s", lease.cache_disk.mountpoint)
+            finished = scan_shard(lease, leaser, snapshot_dir, profiler)
+            refresh_rollups()
+            write_process_metrics("xfc_scan")
+            if finished and not leaser.is_local(lease.cache_disk):
+                # hand the shard back to the instance with affinity for it
+                leaser.release(lease)
+        if once:
+            break
+        sleep(5)
+    profiler.finish()
+
+def scan_completion(user, scan_pass):
+    """Return the message published on the completion queue when the scan of a user has finished."""
+    return {
+        "user_id": user.pk, "user": user.name, "scan_pass": scan_pass.pk,
+        "started": scan_pass.started.isoformat(), "finished": scan_pass.finished.isoformat(),
+        "scan_mode": scan_pass.scan_mode, "n_files": scan_pass.n_files, "total_size": scan_pass.total_size,
+        "quota_used": user.quota_used, "total_used": user.total_used, "host": socket.gethostname(),
+        "churn": user.churn, "scan_seconds": user.scan_seconds, "next_scan": user.next_scan.isoformat(),
+    }
+
+def consume_scan_request(broker, delivery, snapshot_dir=None, profiler=None):
+    """Scan the user in a scan request from the scan queue, publish the completion of the scan, and
+    acknowledge the request.  The quota and last_scanned of the user are not saved, but sent in the
+    completion message, and saved in batches by xfc_complete.  A request that fails is rejected, and not
+    requeued - the user is put on the queue again by xfc_dispatch once REDISPATCH_HOURS have passed.
+       :var broker: the broker the request was delivered by (see xfc_control.broker)
+       :var xfc_control.broker.Delivery delivery: the scan request
+       :return: the ScanPass of the scan, or None if the user was not scanned
+    """
+    user = User.objects.filter(pk=delivery.body["user_id"]).select_related("cache_disk").first()
+    if user is None:
+        logging.info("User in scan request no longer exists: %s", delivery.body["user"])
+        broker.ack(delivery)
+        return None
+    if user_locked(user):
+        # another process is working on the user - it will be dispatched again
+        logging.info("User already locked: %s", user.name)
+        USERS_LOCKED.inc(process="xfc_scan")
+        broker.ack(delivery)
+        return None
+    with LOCK_WAIT.time(process="xfc_scan"):
+        lock_user(user)
+    try:
+        scan_pass = scan_user(user, snapshot_dir, profiler, save_user=False)
+    except Exception:
+        logging.exception("Scan of user %s failed", user.name)
+        broker.nack(delivery, requeue=False)
+        return None
+    finally:
+        unlock_user(user)
+    broker.publish(complete_queue(), scan_completion(user, scan_pass))
+    broker.ack(delivery)
+    return scan_pass
+
+def consume_loop(config, broker, prefetch=1, snapshot_dir=None, profiler=None, stop_when_idle=False):
+    """Take the users to scan from the scan queue, until stopped.
+       :var dict config: the process config
+       :var broker: the broker to consume from (see xfc_control.broker)
+       :var int prefetch: number of scan requests delivered to this scanner before they are acknowledged
+       :var string snapshot_dir: (*optional*) directory to write the snapshots of each user to
+       :var xfc_control.profiling.Profiler profiler: (*optional*) profiler to time the users with
+       :var bool stop_when_idle: return when the scan queue is empty, rather than waiting for more requests
+    """
+    if profiler is None:
+        profiler = Profiler("xfc_scan")
+    idle_seconds = config.get("IDLE_SECONDS", 60)
+    for delivery in broker.consume(scan_queue(), prefetch=prefetch, inactivity_timeout=idle_seconds):
+        if delivery is None:
+            if stop_when_idle:
+                break
+            continue
+        consume_scan_request(broker, delivery, snapshot_dir, profiler)
+        write_process_metrics("xfc_scan")
+    profiler.finish()
 
 def run(*args):
     """Entry point for the Django script run via ``./manage.py runscript``
     """
     # setup the logging
     config = read_process_config("xfc_scan")
-    logging.basicConfig(
-        format=get_logging_format(),
-        level=get_logging_level(config["LOG_LEVEL"]),
-        datefmt='%Y-%d-%m %I:%M:%S'
-    )
+    setup_logging("xfc_scan", config)
     logging.info("Starting xfc_scan")
 
     # setup exit signal handling
@@ -235,6 +736,29 @@ def run(*args):
     else:
         daemon = False
 
+    snapshot_dir = arg_dict.get("snapshot_dir", getattr(settings, "XFC_SNAPSHOT_DIR", None))
+    adaptive = (arg_dict.get("adaptive", "true").lower() == "true")
+
+    # share the CacheDisks with the other instances through leases
+    if arg_dict.get("shard", "false").lower() == "true":
+        mountpoints = arg_dict["mountpoints"].split(",") if "mountpoints" in arg_dict else None
+        leaser = Leaser(local_mountpoints=mountpoints)
+        try:
+            shard_loop(config, leaser, snapshot_dir, profiler_from_args("xfc_scan", arg_dict), once=not daemon)
+        finally:
+            leaser.release_all()
+        return
+
+    # take the users to scan from the scan queue, filled by xfc_dispatch
+    if arg_dict.get("consume", "false").lower() == "true":
+        broker = get_broker(arg_dict.get("broker"))
+        try:
+            consume_loop(config, broker, int(arg_dict.get("prefetch", 1)), snapshot_dir,
+                         profiler_from_args("xfc_scan", arg_dict))
+        finally:
+            broker.close()
+        return
+
     # run as a daemon or one shot
     if daemon:
         # loop this indefinitely until the exit signals are triggered
@@ -246,8 +770,8 @@ def run(*args):
         while True:
             current_time = datetime.datetime.utcnow()
             if (current_time - previous_time) > time_period:
-                run_loop(config)
+                run_loop(config, snapshot_dir, profiler_from_args("xfc_scan", arg_dict), adaptive)
                 previous_time = current_time
                 sleep(5)
     else:
-        run_loop(config)
+        run_loop(config, snapshot_dir, profiler_from_args("xfc_scan", arg_dict), adaptive)
@@ -6,9 +6,20 @@
    However, the scheduling algorithm is relentless - it will simply schedule some other files to
    be deleted.
 
+   For users scanned in CacheDisk.DIRECTORY_MODE, the directory totals (CachedDirectory aggregates)
+   are scheduled instead of the files, oldest first, and all the files in them will be deleted.
+
    This script is designed to be run via the django-extensions runscript command:
 
-      ``python manage.py runscript xfc_scan``
+      ``python manage.py runscript xfc_schedule``
+
+   Arguments:
+
+    - ``daemon=true|false``: run continuously, every RUN_EVERY_HOURS (default false)
+    - ``profile=true|false``: profile each user, writing the cProfile stats and the per-phase breakdown
+      to ``profile_dir`` (see xfc_control.profiling, default false)
+    - ``profile_dir=<path>``: directory to write the profiles to (default: the XFC_PROFILE_DIR setting)
+    - ``profile_top=<n>``: (*optional*) only write the cProfile stats of the n slowest users
 """
 
 import datetime, calendar
@@ -17,19 +28,23 @@ import logging
 from time import sleep
 import signal, sys
 
-from django.core.mail import send_mail
+from django.db import transaction
 
-from xfc_control.models import User, ScheduledDeletion, CachedFile
+from xfc_control.models import User, CacheDisk, ScheduledDeletion, CachedFile, CachedDirectory
 from xfc_control.scripts.xfc_user_lock import lock_user, user_locked, unlock_user
-from xfc_control.scripts.xfc_scan import get_log_time_string
+from xfc_control.notifications import queue_notification
+from xfc_control.metrics import ROWS_WRITTEN, LOCK_WAIT, USERS_LOCKED, write_process_metrics
+from xfc_control.profiling import Profiler, profiler_from_args
+from xfc_control.dashboard import refresh_rollups
 import xfc_site.settings as settings
 
 from xfc_control.scripts.config import read_process_config, split_args
-from xfc_control.scripts.config import get_logging_format, get_logging_level
+from xfc_control.scripts.config import setup_logging
 
 
 def send_notification_email(user, file_list, date):
-    """Send an email to the user to notify which files will be deleted and when
+    """Queue an email to the user to notify which files will be deleted and when.  The email is
+    sent by xfc_notify.
     :var xfc_control.models.User user: user to send notification email to
     """
     if not user.notify:
@@ -38,11 +53,6 @@ def send_notification_email(user, file_list, date):
     if len(file_list) == 0:
         return
 
-    # to address is notify_on_first
-    toaddrs = [user.email]
-    # from address is just a dummy address
-    fromaddr = "support@ceda.ac.uk"
-
     # subject
     subject = "[XFC] - Notification of file deletion"
     date_string = "% 2i %s %d %02d:%02d" % (date.day, calendar.month_abbr[date.month], date.year, date.hour, date.minute)
@@ -51,7 +61,7 @@ def send_notification_email(user, file_list, date):
     for f in file_list:
         msg += os.path.join(user.cache_disk.mountpoint, f) + "\n"
 
-    send_mail(subject, msg, fromaddr, toaddrs, fail_silently=False)
+    queue_notification(user, subject, msg)
 
 
 def schedule_deletions(user):
@@ -68,8 +78,15 @@ def schedule_deletions(user):
     over_quota = user.quota_used - user.quota_size
     over_limit = user.total_used - user.hard_limit_size
 
-    # get a list of user cached files sorted descending
-    cached_files = CachedFile.objects.filter(user=user).order_by('first_seen')
+    directory_mode = (user.get_scan_mode() == CacheDisk.DIRECTORY_MODE)
+    if directory_mode:
+        # get a list of the directory totals sorted descending
+        cached_files = CachedDirectory.objects.filter(
+            user=user, aggregate=True, own_files__gt=0
+        ).order_by('own_first_seen')
+    else:
+        # get a list of user cached files sorted descending
+        cached_files = CachedFile.objects.filter(user=user).select_related("directory").order_by('first_seen')
     # sum of files to delete
     quota_delete = 0
     hard_delete  = 0
@@ -83,90 +100,108 @@ def schedule_deletions(user):
     # need to use the quota formula described in xfc_scan.calc_user_quota
     # get the current date
     for cf in cached_files:
+        if directory_mode:
+            first_seen, size, quota_use = cf.own_first_seen, cf.own_size, cf.own_quota_use()
+        else:
+            first_seen, size, quota_use = cf.first_seen, cf.size, cf.quota_use()
         # determine how old this file is in days
-        file_age = (current_date - cf.first_seen).days
+        file_age = (current_date - first_seen).days
         # the over_quota and over_limit could be negative, if the user is not
         # over their quota limit or hard limit
         # also check the file age, to check it's not over the MAX_PERSISTENCE
         if quota_delete > over_quota and hard_delete > over_limit and file_age < settings.XFC_DEFAULT_MAX_PERSISTENCE:
             continue
         # keep a running total
-        quota_delete += cf.quota_use()
-        hard_delete += cf.size
+        quota_delete += quota_use
+        hard_delete += size
         # add the files
-        files_to_delete.append(cf.path)
+        files_to_delete.append(cf)
 
     # don't do anything if no files found
     if len(files_to_delete) == 0:
         return
 
-    # create the ScheduledDeletion
-    sd = ScheduledDeletion()
-    sd.user = user
-    sd.time_entered = current_date
-    # users have 24 hours to save their files!
-    sd.time_delete = current_date + datetime.timedelta(hours=ScheduledDeletion.schedule_hours)
-    sd.save()
-    # deletion files
-    sd.delete_files = CachedFile.objects.filter(user=user, path__in=files_to_delete)
-    sd.save()
-
-    # send the notification email
-    if user.notify:
-        send_notification_email(user, files_to_delete, sd.time_delete)
-
-    # send to the logger
-    current_time_string = get_log_time_string()
-    schedule_time_string =  "%02i %s %d %02d:%02d" % \
-        (sd.time_delete.day, calendar.month_abbr[sd.time_delete.month], sd.time_delete.year,
-         sd.time_delete.hour, sd.time_delete.minute)
-
-    logging.info("[" + current_time_string + "] Scheduling files for deletion on: " + schedule_time_string)
-    for f in files_to_delete:
-        logging.info("    " + os.path.join(user.cache_disk.mountpoint, f))
+    # create the ScheduledDeletion, and queue the notification email in the same transaction, so
+    # that the email is only sent if the deletion is scheduled
+    with transaction.atomic():
+        sd = ScheduledDeletion()
+        sd.user = user
+        sd.time_entered = current_date
+        # users have 24 hours to save their files!
+        sd.time_delete = current_date + datetime.timedelta(hours=ScheduledDeletion.schedule_hours)
+        sd.save()
+        # deletion files
+        if directory_mode:
+            sd.delete_directories.set(files_to_delete)
+            # a trailing slash for all the files in the directory
+            paths = [os.path.join(cd.path, "") for cd in files_to_delete]
+        else:
+            sd.delete_files.set(files_to_delete)
+            paths = [cf.path for cf in files_to_delete]
+        ROWS_WRITTEN.inc(process="xfc_schedule", model="ScheduledDeletion", operation="create")
+
+        # send the notification email
+        if user.notify:
+            send_notification_email(user, paths, sd.time_delete)
+
+    # send to the logger - one summary line for the user, and the files at DEBUG
+    logging.info(
+        "Scheduled %d files (%d bytes) of user %s for deletion on: %s",
+        len(paths), hard_delete, user.name, sd.time_delete.strftime("%d %b %Y %H:%M"),
+        extra={"user": user.name, "n_files": len(paths), "bytes": hard_delete, "quota": quota_delete,
+               "time_delete": sd.time_delete.isoformat(), "directory_mode": directory_mode}
+    )
+    if logging.getLogger().isEnabledFor(logging.DEBUG):
+        for f in paths:
+            logging.debug("    %s", os.path.join(user.cache_disk.mountpoint, f))
 
 def exit_handler(signal, frame):
     logging.info("Stopping xfc_schedule")
     sys.exit(0)
 
-def run_loop(config):
-    """Main loop"""
+def run_loop(config, profiler=None):
+    """Main loop
+       :var dict config: the process config
+       :var xfc_control.profiling.Profiler profiler: (*optional*) profiler to time the users with
+    """
+    if profiler is None:
+        profiler = Profiler("xfc_schedule")
     # loop over all the users
     for user in User.objects.all():
-        logging.info(
-            "[" + get_log_time_string() + "] Running schedule for user: " +
-            user.name
-        )
+        logging.debug("Running schedule for user: %s", user.name)
         # check if user locked
         if user_locked(user):
-            logging.info(
-                "[" + get_log_time_string() + "] User already locked: " + user.name
-            )
+            logging.info("User already locked: %s", user.name)
+            USERS_LOCKED.inc(process="xfc_schedule")
             continue
         # lock the user
-        lock_user(user)
+        with LOCK_WAIT.time(process="xfc_schedule"):
+            lock_user(user)
         # schedule the deletions, there are three possibilities for files to be deleted:
         # 1. the user's temporal quota has been exceeded
         # 2. the user's hard limit has been exceeded
         # 3. some user's files are greater (in time) than the maximum persistence
         try:
-            schedule_deletions(user)
+            with profiler.user(user.name), profiler.phase("schedule"):
+                schedule_deletions(user)
             # unlock the user
             unlock_user(user)
         except Exception as e:
             unlock_user(user)
             raise Exception(e)
+    # refresh the rollups for the dashboard in the admin
+    with profiler.phase("rollups"):
+        refresh_rollups()
+    # write the profiles and metrics for this run
+    profiler.finish()
+    write_process_metrics("xfc_schedule")
 
 def run(*args):
     """Entry point for the Django script run via ``./manage.py runscript``
     """
     # setup the logging
     config = read_process_config("xfc_schedule")
-    logging.basicConfig(
-        format=get_logging_format(),
-        level=get_logging_level(config["LOG_LEVEL"]),
-        datefmt='%Y-%d-%m %I:%M:%S'
-    )
+    setup_logging("xfc_schedule", config)
     logging.info("Starting xfc_schedule")
 
     # setup exit signal handling
@@ -195,8 +230,8 @@ def run(*args):
         while True:
             current_time = datetime.datetime.utcnow()
             if (current_time - previous_time) > time_period:
-                run_loop(config)
+                run_loop(config, profiler_from_args("xfc_schedule", arg_dict))
                 previous_time = current_time
                 sleep(5)
     else:
-        run_loop(config)
+        run_loop(config, profiler_from_args("xfc_schedule", arg_dict))
@@ -0,0 +1,156 @@
+"""Sharing the scans between xfc_scan instances on more than one host, through leases in the database.
+
+Each CacheDisk is a shard, with a ScanLease.  An instance of xfc_scan running with ``shard=true``
+claims the leases of the shards it can scan, and scans the users of each shard it holds, those that
+have gone longest without a scan first.  The leases are claimed with SELECT ... FOR UPDATE SKIP LOCKED,
+so two instances never take the same shard.
+
+  - **affinity**: an instance claims the shards on its local volumes (see Leaser.is_local) as soon as
+    they are free.  It only claims a shard on another volume once that shard has gone unheld for
+    AFFINITY_GRACE_SECONDS, so that the instance on the volume's own host has the first chance to take
+    it, and it hands the shard back (releases it) at the end of each pass.
+  - **failover**: a lease is renewed by a heartbeat thread every LEASE_SECONDS / 3.  If an instance dies,
+    its leases expire after LEASE_SECONDS and are claimed by other instances, which carry on the pass
+    from where it was left (the users scanned since the pass started are skipped).
+  - **progress**: the users in the current pass, the number scanned and the user being scanned are kept
+    on the ScanLease, and shown in the admin.
+"""
+
+import datetime
+import logging
+import os
+import socket
+import threading
+
+from django.db import connection, transaction
+from django.db.models import Q
+
+from xfc_control.models import CacheDisk, ScanLease
+import xfc_site.settings as settings
+
+# time a lease lasts without being renewed
+LEASE_SECONDS = 300
+# time a shard must go unheld before an instance without affinity for it claims it
+AFFINITY_GRACE_SECONDS = 900
+
+
+def instance_name():
+    """Return the name of this instance, as the holder of its leases."""
+    return "%s:%d" % (socket.gethostname(), os.getpid())
+
+
+class Leaser(object):
+    """Claims, renews and releases the leases of one xfc_scan instance."""
+
+    def __init__(self, instance=None, local_mountpoints=None, lease_seconds=None, grace_seconds=None):
+        """:var string instance: (*optional*) name of the instance, defaults to ``<host>:<pid>``
+           :var List[string] local_mountpoints: (*optional*) mountpoints (or their parent directories) of the
+                                                local volumes, defaults to the CacheDisks whose mountpoint
+                                                is a mount point on this host
+           :var int lease_seconds: (*optional*) time a lease lasts, defaults to the XFC_LEASE_SECONDS setting
+           :var int grace_seconds: (*optional*) time a shard without affinity must go unheld before it is
+                                   claimed, defaults to the XFC_AFFINITY_GRACE_SECONDS setting
+        """
+        self.instance = instance or instance_name()
+        self.local_mountpoints = local_mountpoints
+        if lease_seconds is None:
+            lease_seconds = getattr(settings, "XFC_LEASE_SECONDS", LEASE_SECONDS)
+        if grace_seconds is None:
+            grace_seconds = getattr(settings, "XFC_AFFINITY_GRACE_SECONDS", AFFINITY_GRACE_SECONDS)
+        self.lease_time = datetime.timedelta(seconds=lease_seconds)
+        self.grace_time = datetime.timedelta(seconds=grace_seconds)
+        self._stop = threading.Event()
+        self._heartbeat = None
+
+    def is_local(self, cache_disk):
+        """Return whether a CacheDisk is on a volume local to this instance."""
+        if self.local_mountpoints is None:
+            return os.path.ismount(cache_disk.mountpoint)
+        mountpoint = os.path.join(cache_disk.mountpoint, "")
+        return any(mountpoint.startswith(os.path.join(mp, "")) for mp in self.local_mountpoints)
+
+    def ensure_leases(self):
+        """Create the ScanLeases of any CacheDisks that do not have one.  A new lease is expired, so the
+        grace period for instances without affinity starts when it is created."""
+        now = datetime.datetime.utcnow()
+        missing = CacheDisk.objects.filter(scan_lease__isnull=True)
+        ScanLease.objects.bulk_create([ScanLease(cache_disk=cd, expires=now) for cd in missing],
+                                      ignore_conflicts=True)
+
+    def claim(self):
+        """Claim the free and expired leases this instance can take, and renew those it holds.
+           :return: the ScanLeases held by this instance, local shards first
+        """
+        self.ensure_leases()
+        now = datetime.datetime.utcnow()
+        held = []
+        with transaction.atomic():
+            leases = ScanLease.objects.select_for_update(skip_locked=True).select_related("cache_disk").filter(
+                Q(holder="") | Q(holder=self.instance) | Q(expires__lt=now)
+            ).order_by("pk")
+            for lease in leases:
+                local = self.is_local(lease.cache_disk)
+                if lease.holder != self.instance:
+                    if not local:
+                        # give the instance with affinity the first chance to take the shard
+                        if lease.expires is not None and lease.expires > now - self.grace_time:
+                            continue
+                        if not os.path.isdir(lease.cache_disk.mountpoint):
+                            continue
+                    if lease.holder:
+                        logging.warning("Taking over the lease of %s from %s", lease.cache_disk.mountpoint,
+                                        lease.holder)
+                    lease.holder = self.instance
+                    lease.acquired = now
+                lease.expires = now + self.lease_time
+                held.append((not local, lease))
+            ScanLease.objects.bulk_update([lease for local, lease in held], ["holder", "acquired", "expires"])
+        return [lease for local, lease in sorted(held, key=lambda h: h[0])]
+
+    def renew(self, lease, **progress):
+        """Renew a lease, and record the progress of the pass.
+           :var xfc_control.models.ScanLease lease: the lease, with the progress set on it
+           :var progress: the fields of the lease to save
+           :return: whether this instance still holds the lease
+        """
+        for field, value in progress.items():
+            setattr(lease, field, value)
+        lease.expires = datetime.datetime.utcnow() + self.lease_time
+        return ScanLease.objects.filter(pk=lease.pk, holder=self.instance).update(
+            expires=lease.expires, **progress) == 1
+
+    def release(self, lease):
+        """Release a lease, so that another instance can claim it straight away."""
+        ScanLease.objects.filter(pk=lease.pk, holder=self.instance).update(
+            holder="", expires=datetime.datetime.utcnow(), current_user="")
+        lease.holder = ""
+
+    def release_all(self):
+        """Release all the leases held by this instance."""
+        self.stop_heartbeat()
+        ScanLease.objects.filter(holder=self.instance).update(
+            holder="", expires=datetime.datetime.utcnow(), current_user="")
+
+    def _beat(self):
+        interval = self.lease_time.total_seconds() / 3
+        try:
+            while not self._stop.wait(interval):
+                ScanLease.objects.filter(holder=self.instance).update(
+                    expires=datetime.datetime.utcnow() + self.lease_time)
+        finally:
+            # the thread has its own database connection
+            connection.close()
+
+    def start_heartbeat(self):
+        """Renew the leases held by this instance in a background thread, so that they do not expire
+        while a large user is being scanned."""
+        if self._heartbeat is None:
+            self._stop.clear()
+            self._heartbeat = threading.Thread(target=self._beat, name="xfc_scan_lease", daemon=True)
+            self._heartbeat.start()
+
+    def stop_heartbeat(self):
+        if self._heartbeat is not None:
+            self._stop.set()
+            self._heartbeat.join()
+            self._heartbeat = None
@@ -0,0 +1,289 @@
+"""Compact binary snapshots of the files found in a user's cache area by one pass of xfc_scan.
+
+A snapshot file has three parts:
+
+    - a header: the magic bytes ``XFCSNAP1``, the number of records, the offset of the string
+      table and the time the snapshot was taken
+    - the records: one fixed-width record per file, sorted by path, with the inode, size, mtime,
+      first_seen, and the offset and length of the path in the string table
+    - the string table: the UTF-8 encoded paths, AFTER the CacheDisk mountpoint, in the same
+      order as the records
+
+Times are stored as seconds since the epoch (UTC), with first_seen 0 if it is not known.  As the
+records have a fixed width, a snapshot can be read with ``mmap`` without loading it into memory,
+and the records can be viewed as a NumPy structured array (if NumPy is installed) with
+``Snapshot.array``.  As the records are sorted by path, two snapshots can be compared in linear
+time with ``diff``.
+
+The snapshots can also be read from the command line::
+
+    python -m xfc_control.snapshots dump <snapshot>
+    python -m xfc_control.snapshots diff <old snapshot> <new snapshot>
+
+This module does not import Django, so that the snapshots can be analysed away from the
+production database.
+"""
+
+import bisect
+import collections
+import datetime
+import mmap
+import os
+import struct
+import sys
+
+MAGIC = b"XFCSNAP1"
+# magic, number of records, offset of the string table, time of the snapshot
+HEADER = struct.Struct("<8sQQd")
+# inode, size, mtime, first_seen, path offset, path length, flags (unused)
+RECORD = struct.Struct("<QQddQII")
+
+# NumPy dtype with the same layout as RECORD
+RECORD_DTYPE = [("inode", "<u8"), ("size", "<u8"), ("mtime", "<f8"), ("first_seen", "<f8"),
+                ("path_offset", "<u8"), ("path_length", "<u4"), ("flags", "<u4")]
+
+EPOCH = datetime.datetime(1970, 1, 1)
+
+SnapshotRecord = collections.namedtuple("SnapshotRecord", ["path", "inode", "size", "mtime", "first_seen"])
+
+
+def to_timestamp(date):
+    """Convert a naive UTC datetime to seconds since the epoch, with None as 0."""
+    if date is None:
+        return 0.0
+    return (date - EPOCH).total_seconds()
+
+
+def from_timestamp(timestamp):
+    """Convert seconds since the epoch to a naive UTC datetime, with 0 as None."""
+    if timestamp == 0.0:
+        return None
+    return EPOCH + datetime.timedelta(seconds=timestamp)
+
+
+def encode_path(path):
+    return path.encode("utf-8", "surrogateescape")
+
+
+class SnapshotWriter(object):
+    """Collect the files found during a scan and write them as a snapshot.  The records are kept in
+    memory until close, when they are sorted by path and written to a temporary file, which is then
+    renamed, so that a partly written snapshot is never read."""
+
+    def __init__(self, filename, created=None):
+        """:var string filename: path of the snapshot file to write
+           :var datetime.datetime created: (*optional*) time of the snapshot, defaults to now
+        """
+        if created is None:
+            created = datetime.datetime.utcnow()
+        self.filename = filename
+        self.created = created
+        self.entries = []
+
+    def add(self, path, inode, size, mtime, first_seen=None):
+        """Add a file to the snapshot.
+           :var string path: path to the file AFTER the CacheDisk mountpoint
+           :var int inode: inode number of the file
+           :var int size: size of the file in bytes
+           :var float mtime: modification time of the file, in seconds since the epoch
+           :var datetime.datetime first_seen: (*optional*) date the file was first seen by xfc_scan
+        """
+        self.entries.append((encode_path(path), inode, size, mtime, to_timestamp(first_seen)))
+
+    def close(self):
+        """Write the snapshot file.
+           :return: the number of records written
+        """
+        self.entries.sort()
+        directory = os.path.dirname(self.filename)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp_filename = self.filename + ".tmp"
+        strings_offset = HEADER.size + RECORD.size * len(self.entries)
+        with open(tmp_filename, "wb") as fh:
+            fh.write(HEADER.pack(MAGIC, len(self.entries), strings_offset, to_timestamp(self.created)))
+            offset = 0
+            for path, inode, size, mtime, first_seen in self.entries:
+                fh.write(RECORD.pack(inode, size, mtime, first_seen, offset, len(path), 0))
+                offset += len(path)
+            for entry in self.entries:
+                fh.write(entry[0])
+        os.replace(tmp_filename, self.filename)
+        n_records = len(self.entries)
+        self.entries = []
+        return n_records
+
+
+class Snapshot(object):
+    """Read-only view of a snapshot file, through mmap.  Records are only decoded when they are
+    accessed, so the size of the snapshot does not affect the memory used."""
+
+    def __init__(self, filename):
+        """:var string filename: path of the snapshot file to read"""
+        self.filename = filename
+        self._fh = open(filename, "rb")
+        size = os.fstat(self._fh.fileno()).st_size
+        if size < HEADER.size:
+            self._fh.close()
+            raise ValueError("Not a snapshot file: {}".format(filename))
+        self._mm = mmap.mmap(self._fh.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.n_records, self.strings_offset, created = HEADER.unpack_from(self._mm, 0)
+        if magic != MAGIC:
+            self.close()
+            raise ValueError("Not a snapshot file: {}".format(filename))
+        self.created = from_timestamp(created)
+
+    def __len__(self):
+        return self.n_records
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += self.n_records
+        if i < 0 or i >= self.n_records:
+            raise IndexError("Snapshot record out of range")
+        inode, size, mtime, first_seen, offset, length, flags = RECORD.unpack_from(
+            self._mm, HEADER.size + RECORD.size * i)
+        return SnapshotRecord(self._path(offset, length), inode, size, mtime, from_timestamp(first_seen))
+
+    def __iter__(self):
+        for i in range(self.n_records):
+            yield self[i]
+
+    def _path(self, offset, length):
+        start = self.strings_offset + offset
+        return self._mm[start:start + length].decode("utf-8", "surrogateescape")
+
+    def path_bytes(self, i):
+        """Return the encoded path of record i, which is the sort key of the records."""
+        offset, length = struct.unpack_from("<QI", self._mm, HEADER.size + RECORD.size * i + 32)
+        start = self.strings_offset + offset
+        return self._mm[start:start + length]
+
+    def find(self, path):
+        """Find a file in the snapshot by binary search.
+           :var string path: path to the file AFTER the CacheDisk mountpoint
+           :return: the SnapshotRecord, or None if the file is not in the snapshot
+        """
+        key = encode_path(path)
+        keys = _SnapshotKeys(self)
+        i = bisect.bisect_left(keys, key)
+        if i < self.n_records and keys[i] == key:
+            return self[i]
+        return None
+
+    def array(self):
+        """Return the records as a NumPy structured array, backed by the mmap rather than a copy.
+        The paths can be read with ``path(offset, length)``.  NumPy is only imported when this is
+        called, so it is not needed to read the records one at a time.
+        """
+        import numpy
+        return numpy.frombuffer(self._mm, dtype=numpy.dtype(RECORD_DTYPE),
+                                count=self.n_records, offset=HEADER.size)
+
+    def path(self, offset, length):
+        """Return the path at an offset in the string table."""
+        return self._path(int(offset), int(length))
+
+    def close(self):
+        try:
+            self._mm.close()
+        except BufferError:
+            # an array from Snapshot.array still refers to the mmap - it is unmapped when the
+            # last array is garbage collected
+            pass
+        self._fh.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class _SnapshotKeys(object):
+    """Sequence of the encoded paths of a snapshot, for bisect."""
+
+    def __init__(self, snapshot):
+        self.snapshot = snapshot
+
+    def __len__(self):
+        return len(self.snapshot)
+
+    def __getitem__(self, i):
+        return self.snapshot.path_bytes(i)
+
+
+ADDED = "added"
+REMOVED = "removed"
+CHANGED = "changed"
+
+
+def diff(old, new):
+    """Compare two snapshots of the same user's cache area, in one pass over both.  A file is
+    changed if its inode, size or mtime are different.
+       :var Snapshot old: the earlier snapshot
+       :var Snapshot new: the later snapshot
+       :return: generator of (ADDED, None, record), (REMOVED, record, None) and
+                (CHANGED, old record, new record)
+    """
+    i = 0
+    j = 0
+    n_old = len(old)
+    n_new = len(new)
+    while i < n_old or j < n_new:
+        if j >= n_new:
+            yield REMOVED, old[i], None
+            i += 1
+            continue
+        if i >= n_old:
+            yield ADDED, None, new[j]
+            j += 1
+            continue
+        old_key = old.path_bytes(i)
+        new_key = new.path_bytes(j)
+        if old_key < new_key:
+            yield REMOVED, old[i], None
+            i += 1
+        elif new_key < old_key:
+            yield ADDED, None, new[j]
+            j += 1
+        else:
+            old_record = old[i]
+            new_record = new[j]
+            if (old_record.inode, old_record.size, old_record.mtime) != \
+               (new_record.inode, new_record.size, new_record.mtime):
+                yield CHANGED, old_record, new_record
+            i += 1
+            j += 1
+
+
+def snapshot_filename(snapshot_dir, user_name, created):
+    """Return the filename of the snapshot of a user's cache area taken at a time."""
+    return os.path.join(snapshot_dir, user_name, created.strftime("%Y%m%dT%H%M%S") + ".xfcsnap")
+
+
+def main(argv):
+    if len(argv) == 2 and argv[0] == "dump":
+        with Snapshot(argv[1]) as snapshot:
+            for record in snapshot:
+                print("{} {} {} {} {}".format(record.inode, record.size, record.mtime,
+                                              record.first_seen.isoformat() if record.first_seen else "",
+                                              record.path))
+    elif len(argv) == 3 and argv[0] == "diff":
+        with Snapshot(argv[1]) as old, Snapshot(argv[2]) as new:
+            for change, old_record, new_record in diff(old, new):
+                if change == ADDED:
+                    print("+ {} {}".format(new_record.size, new_record.path))
+                elif change == REMOVED:
+                    print("- {} {}".format(old_record.size, old_record.path))
+                else:
+                    print("~ {} {} {}".format(old_record.size, new_record.size, new_record.path))
+    else:
+        sys.stderr.write("Usage: python -m xfc_control.snapshots dump <snapshot>\n"
+                         "       python -m xfc_control.snapshots diff <old snapshot> <new snapshot>\n")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -1,6 +1,1734 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
-from django.test import TestCase
+import datetime
+import io
+import json
+import logging
+import os
+import pstats
+import shutil
+import tempfile
+import time
+from unittest import mock, skipIf
 
-# Create your tests here.
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from django.contrib import admin as django_admin
+from django.contrib.auth.models import User as AuthUser
+from django.core import mail
+from django.db import connection, transaction
+from django.db.migrations.executor import MigrationExecutor
+from django.db.models import F
+from django.test import TestCase, TransactionTestCase
+
+from xfc_control.models import User, CacheDisk, CachedFile, CachedDirectory, UserMigration, ScheduledDeletion
+from xfc_control.models import ScanPass, ScanJournalEntry, JournalCheckpoint, Notification
+from xfc_control.models import DiskRollup, UserRollup, ScanLease
+from xfc_control.ldap_users import FakeLDAPBackend, LDAPUser, LDAPUserCache, lookup_users, lookup_user, set_ldap_backend
+from xfc_control.fs_helper import FileSystemHelper, read_roots, serve, set_fs_helper
+from xfc_control.notifications import queue_notification, deliver, purge
+from xfc_control.broker import MemoryBroker, scan_queue, complete_queue
+from xfc_control import admin, journal, metrics, scan_frequency, snapshots
+from xfc_control.dashboard import refresh_rollups
+from xfc_control.sharding import Leaser
+from xfc_control.profiling import Profiler, profiler_from_args
+from xfc_control.scripts import xfc_scan, xfc_rebalance, xfc_reconcile, xfc_fix_quotas
+from xfc_control.scripts import xfc_recover_users, xfc_delete, xfc_dispatch, xfc_complete
+from xfc_control.scripts.xfc_user_lock import lock_user, user_locked
+from xfc_control.scripts.config import JsonFormatter, setup_logging
+
+
+def make_file(root, path, size):
+    """Create a file of size bytes below root."""
+    path = os.path.join(root, path)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as fh:
+        fh.write(b"x" * size)
+    return path
+
+
+class CacheAreaTestCase(TestCase):
+    """A temporary directory as the mountpoint of a CacheDisk, with a user on it."""
+
+    scan_mode = CacheDisk.FILE_MODE
+    scan_depth = None
+
+    def setUp(self):
+        self.mountpoint = tempfile.mkdtemp(prefix="xfc_test_")
+        self.addCleanup(shutil.rmtree, self.mountpoint, ignore_errors=True)
+        self.cache_disk = self.make_cache_disk(self.mountpoint)
+        self.user = self.make_user("fred")
+
+    def make_cache_disk(self, mountpoint, size_bytes=10 ** 9, **kwargs):
+        kwargs.setdefault("scan_mode", self.scan_mode)
+        kwargs.setdefault("scan_depth", self.scan_depth)
+        return CacheDisk.objects.create(mountpoint=mountpoint, size_bytes=size_bytes, **kwargs)
+
+    def make_user(self, name, quota_size=10 ** 6, hard_limit_size=10 ** 6, cache_disk=None):
+        if cache_disk is None:
+            cache_disk = self.cache_disk
+        os.makedirs(os.path.join(cache_disk.mountpoint, "user_cache", name), exist_ok=True)
+        return User.objects.create(name=name, email=name + "@example.com", cache_path="user_cache/" + name,
+                                   cache_disk=cache_disk, quota_size=quota_size,
+                                   hard_limit_size=hard_limit_size)
+
+    def make_file(self, user, path, size):
+        return make_file(os.path.join(user.cache_disk.mountpoint, user.cache_path), path, size)
+
+
+class DirectoryTreeTest(CacheAreaTestCase):
+
+    def test_totals(self):
+        self.make_file(self.user, "top", 5)
+        self.make_file(self.user, "a/f1", 100)
+        self.make_file(self.user, "a/b/f2", 50)
+        self.make_file(self.user, "a/b/f3", 10)
+        xfc_scan.scan_user(self.user)
+        totals = {cd.path: (cd.size, cd.n_files, cd.depth) for cd in CachedDirectory.objects.all()}
+        self.assertEqual(totals, {"user_cache/fred": (165, 4, 0), "user_cache/fred/a": (160, 3, 1),
+                                  "user_cache/fred/a/b": (60, 2, 2)})
+        b = CachedDirectory.objects.get(path="user_cache/fred/a/b")
+        self.assertEqual(b.parent.path, "user_cache/fred/a")
+        self.assertEqual(b.quota_used, sum(cf.quota_use() for cf in CachedFile.objects.filter(directory=b)))
+
+        # removing a directory removes its record, and its size from the directories above it
+        shutil.rmtree(os.path.join(self.mountpoint, "user_cache/fred/a/b"))
+        xfc_scan.scan_user(self.user)
+        totals = {cd.path: (cd.size, cd.n_files) for cd in CachedDirectory.objects.all()}
+        self.assertEqual(totals, {"user_cache/fred": (105, 2), "user_cache/fred/a": (100, 1)})
+
+    def test_directory_endpoint(self):
+        self.make_file(self.user, "a/f1", 100)
+        self.make_file(self.user, "b/f2", 300)
+        self.make_file(self.user, "b/c/f3", 1)
+        xfc_scan.scan_user(self.user)
+        response = self.client.get("/xfc_control/api/v1/directory", {"name": "fred"})
+        self.assertEqual(response.status_code, 200)
+        data = json.loads(response.content)
+        self.assertEqual((data["path"], data["size"], data["n_files"]), ("user_cache/fred", 401, 3))
+        # one level of the tree, largest first
+        self.assertEqual([(d["path"], d["size"]) for d in data["directories"]],
+                         [("user_cache/fred/b", 301), ("user_cache/fred/a", 100)])
+
+        response = self.client.get("/xfc_control/api/v1/directory", {"name": "fred", "path": "b/", "full_path": "1"})
+        data = json.loads(response.content)
+        self.assertEqual(data["path"], os.path.join(self.mountpoint, "user_cache/fred/b"))
+        self.assertEqual([d["n_files"] for d in data["directories"]], [1])
+
+        response = self.client.get("/xfc_control/api/v1/directory", {"name": "fred", "path": "missing"})
+        self.assertEqual(json.loads(response.content)["error"], "Directory not found.")
+
+
+class LDAPLookupTest(TestCase):
+
+    def setUp(self):
+        self.backend = FakeLDAPBackend()
+        for i in range(5):
+            self.backend.add_user("user%d" % i, 1000 + i, 2000 + i, "user%d@example.com" % i)
+        set_ldap_backend(self.backend)
+        self.addCleanup(set_ldap_backend, None)
+
+    def test_batch_lookup(self):
+        users = lookup_users(["user%d" % i for i in range(5)] + ["nobody"], batch_size=2)
+        self.assertEqual(sorted(users), ["user%d" % i for i in range(5)])
+        self.assertEqual(users["user3"], LDAPUser(name="user3", uid=1003, gid=2003, email="user3@example.com"))
+        # 6 names in batches of 2
+        self.assertEqual(self.backend.n_searches, 3)
+
+    def test_cache(self):
+        lookup_users(["user0", "user1"])
+        self.assertEqual(self.backend.n_searches, 1)
+        # found users come from the cache, only the missing user is looked up
+        users = lookup_users(["user0", "user1", "user2"])
+        self.assertEqual(len(users), 3)
+        self.assertEqual(self.backend.n_searches, 2)
+        self.assertEqual(lookup_user("user2").uid, 1002)
+        self.assertEqual(self.backend.n_searches, 2)
+        # users that were not found are not cached
+        self.assertIsNone(lookup_user("nobody"))
+        self.assertIsNone(lookup_user("nobody"))
+        self.assertEqual(self.backend.n_searches, 4)
+
+    def test_replacing_backend_clears_cache(self):
+        lookup_user("user0")
+        backend = FakeLDAPBackend()
+        backend.add_user("user0", 1, 1)
+        set_ldap_backend(backend)
+        self.assertEqual(lookup_user("user0").uid, 1)
+
+    def test_cache_expiry(self):
+        cache = LDAPUserCache(ttl=0.05)
+        cache.put(LDAPUser(name="user0", uid=1, gid=1, email=""))
+        self.assertEqual(cache.get("user0").uid, 1)
+        time.sleep(0.1)
+        self.assertIsNone(cache.get("user0"))
+
+
+class FileSystemHelperTest(CacheAreaTestCase):
+
+    def setUp(self):
+        super(FileSystemHelperTest, self).setUp()
+        self.helper = FileSystemHelper(privileged=False, roots=[self.mountpoint])
+        set_fs_helper(self.helper)
+        self.addCleanup(set_fs_helper, None)
+        ldap = FakeLDAPBackend()
+        ldap.add_user("bob", os.getuid(), os.getgid())
+        ldap.add_user("jim", os.getuid(), os.getgid())
+        set_ldap_backend(ldap)
+        self.addCleanup(set_ldap_backend, None)
+
+    def test_local_operations(self):
+        path = os.path.join(self.mountpoint, "a", "b")
+        self.helper.mkdir(path, 0o750)
+        self.helper.chown(path, os.getuid(), os.getgid(), recursive=True)
+        self.helper.chmod(os.path.join(self.mountpoint, "a"), 0o700)
+        self.assertEqual(self.helper.flush(), [])
+        self.assertEqual(os.stat(path).st_mode & 0o777, 0o750)
+        self.assertEqual(os.stat(os.path.join(self.mountpoint, "a")).st_mode & 0o777, 0o700)
+        # nothing is left queued
+        self.assertEqual(self.helper.flush(), [])
+
+    def test_roots(self):
+        outside = tempfile.mkdtemp(prefix="xfc_test_outside_")
+        self.addCleanup(shutil.rmtree, outside, ignore_errors=True)
+        self.helper.mkdir(os.path.join(outside, "x"))
+        self.helper.mkdir("relative/path")
+        self.helper.mkdir(os.path.join(self.mountpoint, "..", os.path.basename(outside), "y"))
+        self.helper.mkdir(os.path.join(self.mountpoint, "ok"))
+        failed = self.helper.flush()
+        self.assertEqual(len(failed), 3)
+        self.assertEqual(os.listdir(outside), [])
+        self.assertTrue(os.path.isdir(os.path.join(self.mountpoint, "ok")))
+
+    def test_serve(self):
+        operations = [{"op": "mkdir", "path": os.path.join(self.mountpoint, "s"), "mode": 0o711},
+                      {"op": "rename", "path": os.path.join(self.mountpoint, "s")}]
+        infile = io.StringIO(json.dumps(operations) + "\n" + "not json\n")
+        outfile = io.StringIO()
+        serve(infile, outfile, [self.mountpoint])
+        results = [json.loads(line) for line in outfile.getvalue().splitlines()]
+        self.assertIsNone(results[0][0])
+        self.assertIn("Unknown operation", results[0][1])
+        self.assertIn("error", results[1])
+        self.assertEqual(os.stat(os.path.join(self.mountpoint, "s")).st_mode & 0o777, 0o711)
+
+    def test_read_roots(self):
+        config_file = os.path.join(self.mountpoint, "fs_helper.json")
+        with open(config_file, "w") as fh:
+            json.dump({"roots": [self.mountpoint + "/"]}, fh)
+        os.chmod(config_file, 0o644)
+        if os.getuid() == 0:
+            self.assertEqual(read_roots(config_file), [self.mountpoint])
+        # a config that others can change is refused
+        os.chmod(config_file, 0o666)
+        with self.assertRaises(ValueError):
+            read_roots(config_file)
+
+    def test_create_user_cache_paths(self):
+        paths = self.cache_disk.create_user_cache_paths(["bob", "jim", "nobody"])
+        self.assertEqual(paths, {"bob": "user_cache/bob", "jim": "user_cache/jim"})
+        full_path = os.path.join(self.mountpoint, "user_cache", "bob")
+        self.assertEqual(os.stat(full_path).st_mode & 0o777, 0o700)
+        self.assertFalse(os.path.exists(os.path.join(self.mountpoint, "user_cache", "nobody")))
+        self.assertEqual(self.cache_disk.create_user_cache_path("bob"), "user_cache/bob")
+        with self.assertRaises(Exception):
+            self.cache_disk.create_user_cache_path("nobody")
+
+
+class CacheDiskPlacementTest(CacheAreaTestCase):
+
+    def setUp(self):
+        super(CacheDiskPlacementTest, self).setUp()
+        # only the disks made by each test are used
+        CacheDisk.objects.filter(pk=self.cache_disk.pk).update(retiring=True)
+        self.helper = FileSystemHelper(privileged=False, roots=[self.mountpoint])
+        set_fs_helper(self.helper)
+        self.addCleanup(set_fs_helper, None)
+
+    def make_disk(self, name, size_bytes, allocated_bytes=0, n_users=0):
+        cd = self.make_cache_disk(os.path.join(self.mountpoint, name), size_bytes=size_bytes,
+                                  allocated_bytes=allocated_bytes)
+        for i in range(n_users):
+            self.make_user("%s_user%d" % (name, i), cache_disk=cd)
+        return cd
+
+    def test_policies(self):
+        a = self.make_disk("a", 100, n_users=2)
+        b = self.make_disk("b", 200, allocated_bytes=150)
+        c = self.make_disk("c", 300, allocated_bytes=100, n_users=1)
+        order = lambda policy, requested=10, exclude=None: list(
+            CacheDisk.placement_candidates(requested, policy, exclude))
+        self.assertEqual(order("most_free"), [c, a, b])
+        self.assertEqual(order("fill_first"), [b, a, c])
+        self.assertEqual(order("least_loaded"), [b, c, a])
+        # disks without the space, and excluded disks, are not candidates
+        self.assertEqual(order("most_free", 60), [c, a])
+        self.assertEqual(order("fill_first", 10, [b.pk]), [a, c])
+        with self.assertRaises(Exception):
+            order("random")
+
+    def test_reservations_do_not_overcommit(self):
+        a = self.make_disk("a", 100)
+        for i in range(3):
+            self.assertEqual(CacheDisk.reserve_cache_disk(30), a)
+        self.assertIsNone(CacheDisk.reserve_cache_disk(30))
+        a.refresh_from_db()
+        self.assertEqual(a.allocated_bytes, 90)
+        # the mountpoint is created for the first reservation
+        self.assertTrue(os.path.isdir(a.mountpoint))
+        a.release(30)
+        self.assertEqual(a.allocated_bytes, 60)
+
+    def test_reservation_race(self):
+        a = self.make_disk("a", 100)
+        b = self.make_disk("b", 80)
+        real_atomic = transaction.atomic
+
+        def racing_atomic(*args, **kwargs):
+            # another process takes the rest of the first disk between the choice of the candidates
+            # and the reservation
+            CacheDisk.objects.filter(pk=a.pk).update(allocated_bytes=F("size_bytes") - 10)
+            return real_atomic(*args, **kwargs)
+
+        with mock.patch("django.db.transaction.atomic", racing_atomic):
+            cd = CacheDisk.reserve_cache_disk(50, "most_free")
+        self.assertEqual(cd, b)
+        a.refresh_from_db()
+        b.refresh_from_db()
+        self.assertEqual((a.allocated_bytes, b.allocated_bytes), (90, 50))
+
+    def test_mountpoint_failure_releases_reservation(self):
+        cd = self.make_cache_disk("/nonexistent/xfc_test_disk", size_bytes=100)
+        with self.assertRaises(Exception):
+            CacheDisk.reserve_cache_disk(50)
+        cd.refresh_from_db()
+        self.assertEqual(cd.allocated_bytes, 0)
+
+    def test_used_space_keeps_allocations(self):
+        a = self.make_disk("a", 1000)
+        user = self.make_user("jim", cache_disk=a)
+        user = User.objects.select_related("cache_disk").get(pk=user.pk)
+        # a reservation made while the user is being scanned is kept
+        CacheDisk.reserve_cache_disk(100)
+        xfc_scan.update_cache_disk_used_space(user, 50)
+        a.refresh_from_db()
+        self.assertEqual((a.allocated_bytes, a.used_bytes), (100, 50))
+
+    def test_create_user(self):
+        ldap = FakeLDAPBackend()
+        ldap.add_user("bob", os.getuid(), os.getgid())
+        set_ldap_backend(ldap)
+        self.addCleanup(set_ldap_backend, None)
+        hard_limit = User.get_hard_limit_size()
+        a = self.make_disk("a", hard_limit)
+
+        response = self.client.post("/xfc_control/api/v1/user", json.dumps({"name": "bob"}),
+                                    content_type="application/json")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.content)["cache_path"], os.path.join(a.mountpoint, "user_cache/bob"))
+        a.refresh_from_db()
+        self.assertEqual(a.allocated_bytes, hard_limit)
+        self.assertEqual(User.objects.get(name="bob").cache_disk, a)
+
+        # the disk is full
+        response = self.client.post("/xfc_control/api/v1/user", json.dumps({"name": "jim"}),
+                                    content_type="application/json")
+        self.assertEqual(response.status_code, 403)
+        # a user that cannot be created gives back the reservation
+        a.release(hard_limit)
+        response = self.client.post("/xfc_control/api/v1/user", json.dumps({"name": "jim"}),
+                                    content_type="application/json")
+        self.assertEqual(response.status_code, 500)
+        a.refresh_from_db()
+        self.assertEqual(a.allocated_bytes, 0)
+        self.assertFalse(User.objects.filter(name="jim").exists())
+
+
+class RebalanceTest(CacheAreaTestCase):
+
+    def setUp(self):
+        super(RebalanceTest, self).setUp()
+        self.target_mountpoint = tempfile.mkdtemp(prefix="xfc_test_target_")
+        self.addCleanup(shutil.rmtree, self.target_mountpoint, ignore_errors=True)
+        self.target_disk = self.make_cache_disk(self.target_mountpoint)
+        self.source_dir = os.path.join(self.mountpoint, "user_cache/fred")
+        self.target_dir = os.path.join(self.target_mountpoint, "user_cache/fred")
+        self.make_file(self.user, "a/f1", 100)
+        self.make_file(self.user, "a/b/f2", 50)
+        os.symlink("a/f1", os.path.join(self.source_dir, "link"))
+        os.symlink("a", os.path.join(self.source_dir, "dirlink"))
+        CacheDisk.objects.filter(pk=self.cache_disk.pk).update(retiring=True, used_bytes=150,
+                                                               allocated_bytes=self.user.hard_limit_size)
+        User.objects.filter(pk=self.user.pk).update(total_used=150)
+        self.user.refresh_from_db()
+        self.outside = tempfile.mkdtemp(prefix="xfc_test_outside_")
+        self.addCleanup(shutil.rmtree, self.outside, ignore_errors=True)
+        self.victim = make_file(self.outside, "victim", 7)
+
+    def sizes(self, directory):
+        return {path: size for path, (size, mtime) in xfc_rebalance.tree_state(directory).items()}
+
+    def test_move(self):
+        os.chmod(os.path.join(self.source_dir, "a"), 0o750)
+        os.chown(os.path.join(self.source_dir, "a/b/f2"), 1234, 1235)
+        migration = xfc_rebalance.start_migration(self.user)
+        self.assertEqual(migration.target_disk, self.target_disk)
+        self.target_disk.refresh_from_db()
+        self.assertEqual(self.target_disk.allocated_bytes, self.user.hard_limit_size)
+
+        self.assertTrue(xfc_rebalance.move_user(self.user, migration, workers=2))
+        self.assertEqual(self.sizes(self.target_dir), {"a/f1": 100, "a/b/f2": 50, "link": 4, "dirlink": 1})
+        self.assertEqual(os.readlink(os.path.join(self.target_dir, "link")), "a/f1")
+        self.assertTrue(os.path.islink(os.path.join(self.target_dir, "dirlink")))
+        # the ownership, permissions and times are kept
+        st = os.lstat(os.path.join(self.target_dir, "a/b/f2"))
+        self.assertEqual((st.st_uid, st.st_gid), (1234, 1235))
+        self.assertEqual(st.st_mtime_ns, os.lstat(os.path.join(self.source_dir, "a/b/f2")).st_mtime_ns)
+        self.assertEqual(os.stat(os.path.join(self.target_dir, "a")).st_mode & 0o777, 0o750)
+        self.assertEqual(os.stat(self.target_dir).st_mode, os.stat(self.source_dir).st_mode)
+
+        self.user.refresh_from_db()
+        self.assertEqual(self.user.cache_disk, self.target_disk)
+        self.assertFalse(user_locked(self.user))
+        migration.refresh_from_db()
+        self.assertEqual((migration.state, migration.files_copied, migration.bytes_copied),
+                         (UserMigration.DONE, 4, 150))
+        self.cache_disk.refresh_from_db()
+        self.target_disk.refresh_from_db()
+        self.assertEqual((self.cache_disk.used_bytes, self.cache_disk.allocated_bytes), (0, 0))
+        self.assertEqual((self.target_disk.used_bytes, self.target_disk.allocated_bytes),
+                         (150, self.user.hard_limit_size))
+        # the source is only removed with remove_source
+        self.assertTrue(os.path.isdir(self.source_dir))
+
+    def test_resume(self):
+        migration = xfc_rebalance.start_migration(self.user)
+        xfc_rebalance.copy_tree(self.source_dir, self.target_dir, migration)
+        # the copy is closed to the user until the move is finished
+        st = os.stat(self.target_dir)
+        self.assertEqual((st.st_uid, st.st_mode & 0o777), (os.geteuid(), 0o700))
+        self.assertEqual(os.stat(os.path.join(self.target_dir, "a")).st_mode & 0o777, 0o700)
+
+        # the source changes while it is being copied
+        os.unlink(os.path.join(self.source_dir, "a/f1"))
+        shutil.rmtree(os.path.join(self.source_dir, "a/b"))
+        self.make_file(self.user, "a/b", 3)
+        self.make_file(self.user, "c/f3", 20)
+        xfc_rebalance.copy_tree(self.source_dir, self.target_dir, migration)
+        self.assertEqual(self.sizes(self.target_dir), self.sizes(self.source_dir))
+        self.assertEqual(self.sizes(self.target_dir), {"a/b": 3, "c/f3": 20, "link": 4, "dirlink": 1})
+        migration.refresh_from_db()
+        # the unchanged files are not copied again
+        self.assertEqual(migration.files_copied, 6)
+
+    def test_links_in_target_not_followed(self):
+        migration = xfc_rebalance.start_migration(self.user)
+        xfc_rebalance.copy_tree(self.source_dir, self.target_dir, migration)
+        # a link planted in the copy, in place of a file that has changed in the source, or of a directory
+        target_file = os.path.join(self.target_dir, "a/f1")
+        os.unlink(target_file)
+        os.symlink(self.victim, target_file)
+        shutil.rmtree(os.path.join(self.target_dir, "a/b"))
+        os.symlink(self.outside, os.path.join(self.target_dir, "a/b"))
+        self.make_file(self.user, "a/f1", 30)
+        xfc_rebalance.copy_tree(self.source_dir, self.target_dir, migration)
+        with open(self.victim, "rb") as fh:
+            self.assertEqual(fh.read(), b"x" * 7)
+        self.assertEqual(os.listdir(self.outside), ["victim"])
+        self.assertFalse(os.path.islink(target_file))
+        self.assertEqual(self.sizes(self.target_dir), self.sizes(self.source_dir))
+
+        # the user's directory in the target replaced by a link is refused
+        shutil.rmtree(self.target_dir)
+        os.symlink(self.outside, self.target_dir)
+        with self.assertRaises(Exception):
+            xfc_rebalance.copy_tree(self.source_dir, self.target_dir, migration)
+        self.assertEqual(os.listdir(self.outside), ["victim"])
+
+    def test_links_in_source_not_followed(self):
+        migration = xfc_rebalance.start_migration(self.user)
+        # a file replaced by a link after the source was walked is copied as the link
+        self.assertEqual(xfc_rebalance._copy_file(self.source_dir, "a/f1", os.path.join(self.outside, "copy")), 100)
+        os.unlink(os.path.join(self.source_dir, "a/f1"))
+        os.symlink(self.victim, os.path.join(self.source_dir, "a/f1"))
+        self.assertEqual(xfc_rebalance._copy_file(self.source_dir, "a/f1", os.path.join(self.outside, "copy")), 0)
+        self.assertTrue(os.path.islink(os.path.join(self.outside, "copy")))
+        # a directory replaced by a link is not read through
+        shutil.rmtree(os.path.join(self.source_dir, "a/b"))
+        os.symlink(self.outside, os.path.join(self.source_dir, "a/b"))
+        with self.assertRaises(OSError):
+            xfc_rebalance._copy_file(self.source_dir, "a/b/victim", os.path.join(self.outside, "copy2"))
+
+    def test_verify_failure(self):
+        migration = xfc_rebalance.start_migration(self.user)
+        copy_file = xfc_rebalance._copy_file
+
+        def lossy_copy(source_dir, path, target):
+            if path == "a/b/f2":
+                return 0
+            return copy_file(source_dir, path, target)
+
+        with mock.patch.object(xfc_rebalance, "_copy_file", lossy_copy):
+            with self.assertRaises(Exception):
+                xfc_rebalance.move_user(self.user, migration)
+        self.user.refresh_from_db()
+        self.assertEqual(self.user.cache_disk, self.cache_disk)
+        self.assertFalse(user_locked(self.user))
+        migration.refresh_from_db()
+        self.assertEqual(migration.state, UserMigration.COPYING)
+        self.assertEqual(os.stat(self.target_dir).st_mode & 0o777, 0o700)
+
+    def test_remove_source(self):
+        migration = xfc_rebalance.start_migration(self.user)
+        self.assertTrue(xfc_rebalance.move_user(self.user, migration, remove_source=True))
+        self.assertFalse(os.path.exists(self.source_dir))
+
+    def test_source_changed_after_final_copy(self):
+        migration = xfc_rebalance.start_migration(self.user)
+        switch_user = xfc_rebalance.switch_user
+
+        def switch_and_write(user, migration):
+            switch_user(user, migration)
+            # the user writes to the source after the final copy
+            self.make_file(user, "late", 10)
+
+        with mock.patch.object(xfc_rebalance, "switch_user", switch_and_write):
+            self.assertTrue(xfc_rebalance.move_user(self.user, migration, remove_source=True))
+        self.assertTrue(os.path.exists(os.path.join(self.source_dir, "late")))
+
+    def test_locked_user(self):
+        migration = xfc_rebalance.start_migration(self.user)
+        lock_user(self.user)
+        self.assertFalse(xfc_rebalance.move_user(self.user, migration))
+        self.user.refresh_from_db()
+        self.assertEqual(self.user.cache_disk, self.cache_disk)
+
+    def test_abandon_after_max_attempts(self):
+        with mock.patch.object(xfc_rebalance, "move_user", side_effect=Exception("copy failed")):
+            xfc_rebalance.run_loop(max_attempts=2)
+            migration = UserMigration.objects.get(user=self.user)
+            self.assertEqual((migration.state, migration.attempts, migration.error),
+                             (UserMigration.COPYING, 1, "copy failed"))
+            xfc_rebalance.run_loop(max_attempts=2)
+            migration.refresh_from_db()
+            self.assertEqual(migration.state, UserMigration.ABANDONED)
+            self.target_disk.refresh_from_db()
+            self.assertEqual(self.target_disk.allocated_bytes, 0)
+            # the user is not moved again
+            xfc_rebalance.run_loop(max_attempts=2)
+        self.assertEqual(UserMigration.objects.count(), 1)
+        self.assertEqual(xfc_rebalance.select_users(), [])
+
+    def test_cancel(self):
+        migration = xfc_rebalance.start_migration(self.user)
+        xfc_rebalance.copy_tree(self.source_dir, self.target_dir, migration)
+        self.assertEqual(xfc_rebalance.cancel_migrations(["fred"]), 1)
+        self.assertEqual(xfc_rebalance.cancel_migrations(["fred"]), 0)
+        migration.refresh_from_db()
+        self.assertEqual(migration.state, UserMigration.ABANDONED)
+        self.target_disk.refresh_from_db()
+        self.assertEqual(self.target_disk.allocated_bytes, 0)
+        self.assertFalse(os.path.exists(self.target_dir))
+        self.assertTrue(os.path.isdir(self.source_dir))
+
+
+class ReconcileTest(CacheAreaTestCase):
+
+    def setUp(self):
+        super(ReconcileTest, self).setUp()
+        self.make_file(self.user, "a/f1", 100)
+        self.make_file(self.user, "f2", 50)
+        xfc_scan.scan_user(self.user)
+        self.jim = self.make_user("jim")
+        # a user scanned in directory mode
+        CachedDirectory.objects.create(user=self.jim, path="user_cache/jim", aggregate=True, own_size=25,
+                                       own_files=1, own_first_seen=datetime.datetime(2024, 1, 1))
+        # the running totals have drifted
+        User.objects.filter(pk=self.user.pk).update(total_used=120)
+        CacheDisk.objects.filter(pk=self.cache_disk.pk).update(used_bytes=1000)
+
+    def test_filesystem_usage(self):
+        st = os.statvfs(self.mountpoint)
+        size, used = self.cache_disk.filesystem_usage()
+        self.assertEqual(size, st.f_blocks * st.f_frsize)
+        self.assertGreater(used, 0)
+
+    def test_report(self):
+        missing = self.make_cache_disk("/nonexistent/xfc_test_disk")
+        report = {r["mountpoint"]: r for r in xfc_reconcile.reconcile()}
+        r = report[self.mountpoint]
+        self.assertEqual((r["files_used"], r["used"], r["users_drifted"]), (175, 1000, 2))
+        self.assertGreater(r["real_used"], 0)
+        self.cache_disk.refresh_from_db()
+        self.assertEqual(self.cache_disk.real_used_bytes, r["real_used"])
+        self.assertIsNotNone(self.cache_disk.reconciled)
+        # a volume that cannot be read is reported without its filesystem usage
+        self.assertEqual(report[missing.mountpoint]["real_used"], 0)
+        # nothing is changed without fix
+        self.assertEqual(User.objects.get(pk=self.user.pk).total_used, 120)
+
+    def test_fix(self):
+        xfc_reconcile.reconcile(fix=True)
+        self.cache_disk.refresh_from_db()
+        self.assertEqual(self.cache_disk.used_bytes, 175)
+        self.assertEqual(User.objects.get(pk=self.user.pk).total_used, 150)
+        self.assertEqual(User.objects.get(pk=self.jim.pk).total_used, 25)
+        report = xfc_reconcile.reconcile()
+        self.assertEqual([r["users_drifted"] for r in report], [0])
+
+
+class FixQuotasTest(CacheAreaTestCase):
+
+    def setUp(self):
+        super(FixQuotasTest, self).setUp()
+        self.jim = self.make_user("jim")
+        self.now = datetime.datetime(2024, 6, 15, 12, 0)
+        fred_dir = CachedDirectory.objects.create(user=self.user, path="user_cache/fred")
+        # files first seen on the same day, before and after the time of day of now, and on other days
+        for i, (first_seen, size) in enumerate([
+                (datetime.datetime(2024, 6, 10, 9, 0), 100),
+                (datetime.datetime(2024, 6, 10, 18, 0), 200),
+                (datetime.datetime(2024, 6, 15, 11, 0), 7),
+                (datetime.datetime(2023, 1, 1, 0, 0), 3)]):
+            CachedFile.objects.create(user=self.user, directory=fred_dir, name="f%d" % i, size=size,
+                                      first_seen=first_seen)
+        # a directory total for a user scanned in directory mode
+        CachedDirectory.objects.create(user=self.jim, path="user_cache/jim/a", aggregate=True, own_size=1000,
+                                       own_files=10, own_first_seen=datetime.datetime(2024, 6, 1, 13, 0))
+        User.objects.update(quota_used=12345, total_used=12345)
+
+    def expected(self, user):
+        quota_used = sum(cf.quota_use(self.now) for cf in CachedFile.objects.filter(user=user))
+        quota_used += sum(cd.own_quota_use(self.now)
+                          for cd in CachedDirectory.objects.filter(user=user, aggregate=True))
+        total_used = sum(cf.size for cf in CachedFile.objects.filter(user=user))
+        total_used += sum(cd.own_size for cd in CachedDirectory.objects.filter(user=user, aggregate=True))
+        return quota_used, total_used
+
+    def test_user_usage(self):
+        # the aggregates give the same quota as summing over the files
+        usage = xfc_fix_quotas.user_usage(current_date=self.now)
+        self.assertEqual(usage[self.user.pk], self.expected(self.user))
+        self.assertEqual(usage[self.jim.pk], self.expected(self.jim))
+        self.assertEqual(usage[self.user.pk][1], 310)
+
+    def test_fix(self):
+        empty = self.make_user("empty")
+        User.objects.filter(pk=empty.pk).update(quota_used=5, total_used=5)
+        xfc_fix_quotas.fix_user_range(self.user.pk, empty.pk, current_date=self.now)
+        self.assertEqual(User.objects.get(pk=self.user.pk).quota_used, self.expected(self.user)[0])
+        self.assertEqual(User.objects.get(pk=self.jim.pk).total_used, 1000)
+        # a user with no files has nothing used
+        self.assertEqual(User.objects.get(pk=empty.pk).total_used, 0)
+        self.assertEqual(User.objects.get(pk=empty.pk).quota_used, 0)
+
+        xfc_fix_quotas.fix_cache_disk_quotas()
+        self.cache_disk.refresh_from_db()
+        self.assertEqual(self.cache_disk.used_bytes, 1310)
+
+    def test_user_range(self):
+        usage = xfc_fix_quotas.user_usage(self.jim.pk, self.jim.pk, current_date=self.now)
+        self.assertEqual(list(usage), [self.jim.pk])
+
+    def test_fix_user_quotas(self):
+        xfc_fix_quotas.fix_user_quotas()
+        self.assertEqual(User.objects.get(pk=self.user.pk).total_used, 310)
+        self.assertEqual(User.objects.get(pk=self.jim.pk).total_used, 1000)
+        self.assertEqual(User.objects.get(pk=self.jim.pk).quota_used,
+                         CachedDirectory.objects.get(user=self.jim).own_quota_use())
+
+
+class RecoverUsersTest(CacheAreaTestCase):
+
+    def setUp(self):
+        super(RecoverUsersTest, self).setUp()
+        self.other_mountpoint = tempfile.mkdtemp(prefix="xfc_test_")
+        self.addCleanup(shutil.rmtree, self.other_mountpoint, ignore_errors=True)
+        self.other_disk = self.make_cache_disk(self.other_mountpoint)
+        CacheDisk.objects.filter(pk=self.cache_disk.pk).update(retiring=True)
+        # lost users: jim has directories on both disks, ghost is not in LDAP, and link is not a directory
+        user_cache = os.path.join(self.mountpoint, "user_cache")
+        other_user_cache = os.path.join(self.other_mountpoint, "user_cache")
+        make_file(user_cache, "bob/a/f1", 100)
+        make_file(user_cache, "jim/f1", 10)
+        make_file(other_user_cache, "jim/f2", 20)
+        make_file(other_user_cache, "ghost/f1", 1)
+        os.symlink(os.path.join(user_cache, "bob"), os.path.join(other_user_cache, "link"))
+        ldap = FakeLDAPBackend()
+        for name in ("fred", "bob", "jim", "link"):
+            ldap.add_user(name, 1000, 1000, name + "@example.com")
+        set_ldap_backend(ldap)
+        self.addCleanup(set_ldap_backend, None)
+
+    def test_find_lost_users(self):
+        lost = xfc_recover_users.find_lost_users(workers=2)
+        self.assertEqual({name: cd.pk for name, cd in lost.items()},
+                         {"bob": self.cache_disk.pk, "jim": self.other_disk.pk, "ghost": self.other_disk.pk})
+
+    def test_dry_run(self):
+        users = xfc_recover_users.recover_users(dry_run=True)
+        self.assertEqual([u.name for u in users], ["bob", "jim"])
+        self.assertEqual(list(User.objects.values_list("name", flat=True)), ["fred"])
+
+    def test_recover(self):
+        hard_limit = User.get_hard_limit_size()
+        xfc_recover_users.recover_users(scan=True, workers=2)
+        bob = User.objects.get(name="bob")
+        self.assertEqual((bob.cache_disk_id, bob.cache_path, bob.email, bob.total_used),
+                         (self.cache_disk.pk, "user_cache/bob", "bob@example.com", 100))
+        jim = User.objects.get(name="jim")
+        self.assertEqual((jim.cache_disk_id, jim.total_used), (self.other_disk.pk, 20))
+        self.assertFalse(User.objects.filter(name__in=["ghost", "link"]).exists())
+        self.cache_disk.refresh_from_db()
+        self.other_disk.refresh_from_db()
+        self.assertEqual((self.cache_disk.allocated_bytes, self.cache_disk.used_bytes), (hard_limit, 100))
+        self.assertEqual((self.other_disk.allocated_bytes, self.other_disk.used_bytes), (hard_limit, 20))
+        # the users are only recovered once
+        self.assertEqual(xfc_recover_users.recover_users(), [])
+
+
+class MigrationTestCase(TransactionTestCase):
+    """Migrate the database back to migrate_from, so that the data step in migrate_to can be run on rows
+    created with the historical models."""
+
+    migrate_from = None
+    migrate_to = None
+
+    def setUp(self):
+        self.executor = MigrationExecutor(connection)
+        self.addCleanup(self.migrate, self.executor.loader.graph.leaf_nodes("xfc_control"))
+        self.apps = self.migrate([("xfc_control", self.migrate_from)])
+
+    def migrate(self, targets):
+        """Migrate to the targets and return the historical apps at that state."""
+        executor = MigrationExecutor(connection)
+        executor.migrate(targets)
+        return executor.loader.project_state(targets).apps
+
+    def make_user(self, apps, name):
+        CacheDisk = apps.get_model("xfc_control", "CacheDisk")
+        cache_disk, created = CacheDisk.objects.get_or_create(mountpoint="/cache")
+        return apps.get_model("xfc_control", "User").objects.create(
+            name=name, email=name + "@example.com", cache_path="user_cache/" + name, cache_disk=cache_disk)
+
+
+class PathHashMigrationTest(MigrationTestCase):
+
+    migrate_from = "0005_cachedfile_path_hash"
+    migrate_to = "0006_populate_path_hash"
+
+    def test_populate_path_hash(self):
+        CachedFile = self.apps.get_model("xfc_control", "CachedFile")
+        fred = self.make_user(self.apps, "fred")
+        bob = self.make_user(self.apps, "bob")
+        now = datetime.datetime.utcnow()
+        keep = CachedFile.objects.create(user=fred, path="user_cache/fred/a/f1", size=1, first_seen=now)
+        CachedFile.objects.create(user=fred, path="user_cache/fred/a/f1", size=2, first_seen=now)
+        CachedFile.objects.create(user=fred, path="user_cache/fred/a/f2", size=3, first_seen=now)
+        # the same path for a different user is not a duplicate
+        CachedFile.objects.create(user=bob, path="user_cache/fred/a/f1", size=4, first_seen=now)
+
+        apps = self.migrate([("xfc_control", self.migrate_to)])
+        CachedFile = apps.get_model("xfc_control", "CachedFile")
+        files = CachedFile.objects.order_by("pk")
+        self.assertEqual([(cf.user.name, cf.path, cf.size) for cf in files],
+                         [("fred", "user_cache/fred/a/f1", 1), ("fred", "user_cache/fred/a/f2", 3),
+                          ("bob", "user_cache/fred/a/f1", 4)])
+        self.assertEqual(files[0].pk, keep.pk)
+        for cf in files:
+            self.assertEqual(cf.path_hash, CachedDirectory.hash_path(cf.path))
+
+
+class SplitFilePathsMigrationTest(MigrationTestCase):
+
+    migrate_from = "0008_cachedfile_directory"
+    migrate_to = "0009_split_file_paths"
+
+    def test_split_and_join_file_paths(self):
+        CachedFile = self.apps.get_model("xfc_control", "CachedFile")
+        Directory = self.apps.get_model("xfc_control", "CachedDirectory")
+        fred = self.make_user(self.apps, "fred")
+        root = Directory.objects.create(user=fred, path="user_cache/fred", size=30)
+        now = datetime.datetime.utcnow()
+        for path, size in (("user_cache/fred/f1", 10), ("user_cache/fred/a/b/f2", 20), ("user_cache/fred/a/f3", 30)):
+            CachedFile.objects.create(user=fred, path=path, path_hash="", size=size, first_seen=now)
+        CachedFile.objects.create(user=None, path="user_cache/lost/f4", path_hash="", size=40, first_seen=now)
+
+        apps = self.migrate([("xfc_control", self.migrate_to)])
+        CachedFile = apps.get_model("xfc_control", "CachedFile")
+        Directory = apps.get_model("xfc_control", "CachedDirectory")
+        # the existing directory is reused, and the missing directories are created with their parents
+        directories = {cd.path: cd for cd in Directory.objects.all()}
+        self.assertEqual(sorted(directories), ["user_cache/fred", "user_cache/fred/a", "user_cache/fred/a/b"])
+        self.assertEqual(directories["user_cache/fred"].pk, root.pk)
+        self.assertEqual(directories["user_cache/fred/a"].parent_id, root.pk)
+        self.assertEqual(directories["user_cache/fred/a/b"].parent_id, directories["user_cache/fred/a"].pk)
+        self.assertEqual([directories[p].depth for p in sorted(directories)], [0, 1, 2])
+        for path, cd in directories.items():
+            self.assertEqual(cd.path_hash, CachedDirectory.hash_path(path))
+        self.assertEqual(
+            sorted((cf.directory.path, cf.name, cf.size) for cf in CachedFile.objects.all()),
+            [("user_cache/fred", "f1", 10), ("user_cache/fred/a", "f3", 30), ("user_cache/fred/a/b", "f2", 20)])
+
+        # reversing the migration rebuilds the paths
+        apps = self.migrate([("xfc_control", self.migrate_from)])
+        CachedFile = apps.get_model("xfc_control", "CachedFile")
+        self.assertEqual(sorted((cf.path, cf.path_hash) for cf in CachedFile.objects.all()),
+                         sorted((p, CachedDirectory.hash_path(p)) for p in
+                                ("user_cache/fred/f1", "user_cache/fred/a/b/f2", "user_cache/fred/a/f3")))
+
+
+class DirectoryModeScanTest(CacheAreaTestCase):
+
+    scan_mode = CacheDisk.DIRECTORY_MODE
+    scan_depth = 1
+
+    def test_scan(self):
+        self.make_file(self.user, "top", 5)
+        self.make_file(self.user, "a/f1", 100)
+        self.make_file(self.user, "a/b/f2", 50)
+        scan_pass = xfc_scan.scan_user(self.user)
+        self.assertEqual(scan_pass.scan_mode, CacheDisk.DIRECTORY_MODE)
+        # only the directory totals are recorded
+        self.assertEqual(CachedFile.objects.count(), 0)
+        totals = {cd.path: (cd.own_size, cd.own_files, cd.subtree)
+                  for cd in CachedDirectory.objects.filter(aggregate=True)}
+        self.assertEqual(totals, {"user_cache/fred": (5, 1, False), "user_cache/fred/a": (150, 2, True)})
+        self.assertEqual(self.user.total_used, 155)
+
+        self.make_file(self.user, "a/b/f3", 45)
+        xfc_scan.scan_user(self.user)
+        self.assertEqual(CachedDirectory.objects.get(path="user_cache/fred/a").own_size, 195)
+        self.assertEqual(self.user.total_used, 200)
+
+    def test_change_from_file_mode(self):
+        self.make_file(self.user, "a/f1", 100)
+        self.user.scan_mode = CacheDisk.FILE_MODE
+        self.user.save()
+        xfc_scan.scan_user(self.user)
+        CachedFile.objects.update(first_seen=datetime.datetime(2020, 1, 1))
+        self.user.scan_mode = ""
+        self.user.save()
+        xfc_scan.scan_user(self.user)
+        # the CachedFiles are replaced by the total, which keeps their age
+        self.assertEqual(CachedFile.objects.count(), 0)
+        cd = CachedDirectory.objects.get(path="user_cache/fred/a")
+        self.assertEqual(cd.own_size, 100)
+        self.assertEqual(cd.own_first_seen, datetime.datetime(2020, 1, 1))
+
+    def schedule(self, time_entered):
+        self.make_file(self.user, "a/f1", 100)
+        self.make_file(self.user, "a/b/f2", 50)
+        xfc_scan.scan_user(self.user)
+        cd = CachedDirectory.objects.get(path="user_cache/fred/a")
+        sd = ScheduledDeletion.objects.create(user=self.user, time_entered=time_entered,
+                                              time_delete=time_entered)
+        sd.delete_directories.add(cd)
+        return sd, cd
+
+    def test_delete_directory_files(self):
+        # a link to a directory outside the total is not followed
+        outside = tempfile.mkdtemp(prefix="xfc_test_")
+        self.addCleanup(shutil.rmtree, outside, ignore_errors=True)
+        outside_file = make_file(outside, "keep", 10)
+        sd, cd = self.schedule(datetime.datetime.utcnow() + datetime.timedelta(minutes=1))
+        os.symlink(outside, os.path.join(self.mountpoint, "user_cache/fred/a/link"))
+        deleted = xfc_delete.delete_directory_files(self.user, sd, cd)
+        self.assertEqual(sorted(deleted), ["user_cache/fred/a/b/f2", "user_cache/fred/a/f1"])
+        self.assertTrue(os.path.exists(outside_file))
+        self.assertTrue(os.path.islink(os.path.join(self.mountpoint, "user_cache/fred/a/link")))
+        cd.refresh_from_db()
+        self.assertEqual((cd.own_size, cd.own_files), (0, 0))
+
+    def test_keep_files_changed_after_scheduling(self):
+        sd, cd = self.schedule(datetime.datetime.utcnow() - datetime.timedelta(hours=1))
+        # a file moved into the directory with an old modification time is kept, as its change time is newer
+        path = os.path.join(self.mountpoint, "user_cache/fred/a/f1")
+        os.utime(path, (0, 0))
+        self.assertEqual(xfc_delete.delete_directory_files(self.user, sd, cd), [])
+        self.assertTrue(os.path.exists(path))
+        cd.refresh_from_db()
+        self.assertEqual((cd.own_size, cd.own_files), (150, 2))
+
+
+class SnapshotTest(CacheAreaTestCase):
+
+    def setUp(self):
+        super(SnapshotTest, self).setUp()
+        self.snapshot_dir = tempfile.mkdtemp(prefix="xfc_test_")
+        self.addCleanup(shutil.rmtree, self.snapshot_dir, ignore_errors=True)
+
+    def write(self, name, entries, created=datetime.datetime(2024, 6, 15, 12, 0)):
+        writer = snapshots.SnapshotWriter(os.path.join(self.snapshot_dir, name), created)
+        for entry in entries:
+            writer.add(*entry)
+        self.assertEqual(writer.close(), len(entries))
+        return writer.filename
+
+    def test_write_and_read(self):
+        first_seen = datetime.datetime(2024, 6, 1, 9, 30)
+        filename = self.write("a.xfcsnap", [("user_cache/fred/b", 2, 20, 200.5, None),
+                                            ("user_cache/fred/a", 1, 10, 100.0, first_seen),
+                                            ("user_cache/fred/\udcff", 3, 30, 300.0, None)])
+        with snapshots.Snapshot(filename) as snapshot:
+            self.assertEqual(snapshot.created, datetime.datetime(2024, 6, 15, 12, 0))
+            # the records are sorted by path
+            self.assertEqual([r.path for r in snapshot],
+                             ["user_cache/fred/a", "user_cache/fred/b", "user_cache/fred/\udcff"])
+            self.assertEqual(snapshot[0], snapshots.SnapshotRecord("user_cache/fred/a", 1, 10, 100.0, first_seen))
+            self.assertEqual(snapshot[-1].inode, 3)
+            self.assertEqual(snapshot.find("user_cache/fred/b").mtime, 200.5)
+            self.assertIsNone(snapshot.find("user_cache/fred/c"))
+            with self.assertRaises(IndexError):
+                snapshot[3]
+        self.assertFalse(os.path.exists(filename + ".tmp"))
+
+    @skipIf(numpy is None, "NumPy is not installed")
+    def test_array(self):
+        filename = self.write("a.xfcsnap", [("a", 1, 10, 100.0, None), ("bb", 2, 20, 200.0, None)])
+        snapshot = snapshots.Snapshot(filename)
+        array = snapshot.array()
+        self.assertEqual(list(array["size"]), [10, 20])
+        self.assertEqual(snapshot.path(array[1]["path_offset"], array[1]["path_length"]), "bb")
+        del array
+        snapshot.close()
+
+    def test_not_a_snapshot(self):
+        filename = os.path.join(self.snapshot_dir, "bad")
+        with open(filename, "wb") as fh:
+            fh.write(b"x" * snapshots.HEADER.size)
+        with self.assertRaises(ValueError):
+            snapshots.Snapshot(filename)
+
+    def test_diff(self):
+        old = self.write("old", [("a", 1, 10, 100.0, None), ("b", 2, 20, 200.0, None), ("c", 3, 30, 300.0, None)])
+        new = self.write("new", [("b", 2, 20, 200.0, None), ("c", 4, 30, 300.0, None), ("d", 5, 50, 500.0, None)])
+        with snapshots.Snapshot(old) as o, snapshots.Snapshot(new) as n:
+            changes = [(change, (old_r or new_r).path) for change, old_r, new_r in snapshots.diff(o, n)]
+        self.assertEqual(changes, [(snapshots.REMOVED, "a"), (snapshots.CHANGED, "c"), (snapshots.ADDED, "d")])
+        with mock.patch("sys.stdout", new_callable=io.StringIO) as stdout:
+            self.assertEqual(snapshots.main(["diff", old, new]), 0)
+        self.assertEqual(stdout.getvalue(), "- 10 a\n~ 30 30 c\n+ 50 d\n")
+
+    def test_scan_user(self):
+        self.make_file(self.user, "a/f1", 100)
+        self.make_file(self.user, "f2", 5)
+        xfc_scan.scan_user(self.user, snapshot_dir=self.snapshot_dir)
+        filenames = os.listdir(os.path.join(self.snapshot_dir, "fred"))
+        self.assertEqual(len(filenames), 1)
+        with snapshots.Snapshot(os.path.join(self.snapshot_dir, "fred", filenames[0])) as snapshot:
+            records = {r.path: r for r in snapshot}
+        self.assertEqual(sorted(records), ["user_cache/fred/a/f1", "user_cache/fred/f2"])
+        cf = CachedFile.objects.get(name="f1")
+        record = records["user_cache/fred/a/f1"]
+        self.assertEqual((record.size, record.inode), (100, cf.inode))
+        self.assertAlmostEqual(snapshots.to_timestamp(record.first_seen), snapshots.to_timestamp(cf.first_seen),
+                               places=3)
+
+    def test_scan_user_directory_mode(self):
+        CacheDisk.objects.filter(pk=self.cache_disk.pk).update(scan_mode=CacheDisk.DIRECTORY_MODE, scan_depth=1)
+        self.user.refresh_from_db()
+        self.make_file(self.user, "a/b/f1", 100)
+        xfc_scan.scan_user(self.user, snapshot_dir=self.snapshot_dir)
+        filename = os.listdir(os.path.join(self.snapshot_dir, "fred"))[0]
+        with snapshots.Snapshot(os.path.join(self.snapshot_dir, "fred", filename)) as snapshot:
+            records = list(snapshot)
+        # each file gets the first_seen of its directory total
+        cd = CachedDirectory.objects.get(path="user_cache/fred/a")
+        self.assertEqual([(r.path, r.size) for r in records], [("user_cache/fred/a/b/f1", 100)])
+        self.assertAlmostEqual(snapshots.to_timestamp(records[0].first_seen),
+                               snapshots.to_timestamp(cd.own_first_seen), places=3)
+
+
+class JournalTest(CacheAreaTestCase):
+
+    def test_scan_user(self):
+        self.make_file(self.user, "f1", 10)
+        self.make_file(self.user, "f2", 20)
+        xfc_scan.scan_user(self.user)
+        self.make_file(self.user, "f1", 15)
+        os.unlink(os.path.join(self.mountpoint, "user_cache/fred/f2"))
+        scan_pass = xfc_scan.scan_user(self.user)
+        entries = [(e.event, e.path, e.old_size, e.size) for e in scan_pass.entries.order_by("id")]
+        self.assertEqual(sorted(entries), [(ScanJournalEntry.REMOVE, "user_cache/fred/f2", 20, 0),
+                                           (ScanJournalEntry.RESIZE, "user_cache/fred/f1", 10, 15)])
+        scan_pass.refresh_from_db()
+        self.assertEqual((scan_pass.n_added, scan_pass.n_resized, scan_pass.n_removed), (0, 1, 1))
+        self.assertEqual((scan_pass.bytes_added, scan_pass.bytes_removed), (5, 20))
+        self.assertEqual((scan_pass.n_files, scan_pass.total_size), (1, 15))
+        self.assertIsNotNone(scan_pass.finished)
+
+    def test_batches(self):
+        scan_journal = journal.ScanJournal.start(self.user, CacheDisk.FILE_MODE, batch_size=2)
+        scan_journal.add("a", 1)
+        self.assertEqual(ScanJournalEntry.objects.count(), 0)
+        scan_journal.add("b", 2)
+        self.assertEqual(ScanJournalEntry.objects.count(), 2)
+        scan_journal.remove("a", 1)
+        scan_journal.finish(n_files=1, total_size=2)
+        self.assertEqual(list(ScanJournalEntry.objects.order_by("id").values_list("path", "event")),
+                         [("a", ScanJournalEntry.ADD), ("b", ScanJournalEntry.ADD), ("a", ScanJournalEntry.REMOVE)])
+
+    def test_entries_written_holding_the_writer_lock(self):
+        scan_journal = journal.ScanJournal(self.user)
+        scan_journal.add("a", 1)
+        bulk_create = ScanJournalEntry.objects.bulk_create
+
+        def locked_bulk_create(*args, **kwargs):
+            # the entries are written in the transaction that locked the writer's row
+            self.assertTrue(transaction.get_connection().in_atomic_block)
+            self.assertTrue(JournalCheckpoint.objects.filter(consumer=journal.WRITER_LOCK).exists())
+            return bulk_create(*args, **kwargs)
+
+        with mock.patch.object(ScanJournalEntry.objects, "bulk_create", side_effect=locked_bulk_create), \
+                mock.patch.object(JournalCheckpoint.objects, "select_for_update",
+                                  wraps=JournalCheckpoint.objects.select_for_update) as select_for_update:
+            scan_journal.flush()
+        select_for_update.assert_called_once_with()
+        self.assertEqual(ScanJournalEntry.objects.count(), 1)
+        self.assertIsNone(ScanJournalEntry.objects.get().scan_pass)
+
+    def test_tail_commit_and_prune(self):
+        jim = self.make_user("jim")
+        fred_journal = journal.ScanJournal(self.user)
+        jim_journal = journal.ScanJournal(jim)
+        for i in range(3):
+            fred_journal.add("fred%d" % i, i)
+            jim_journal.add("jim%d" % i, i)
+            fred_journal.flush()
+            jim_journal.flush()
+        self.assertEqual(journal.checkpoint("history"), 0)
+        self.assertEqual([e.path for e in journal.tail("history", limit=3)], ["fred0", "jim0", "fred1"])
+        self.assertEqual([e.path for e in journal.tail("history", user=jim)], ["jim0", "jim1", "jim2"])
+
+        entries = journal.tail("history", limit=2)
+        journal.commit("history", entries[-1].id)
+        self.assertEqual([e.path for e in journal.tail("history", limit=2)], ["fred1", "jim1"])
+        journal.commit("notify", journal.tail("notify", limit=4)[-1].id)
+        with self.assertRaises(Exception):
+            journal.commit(journal.WRITER_LOCK, 0)
+
+        # only the entries processed by every consumer are pruned
+        self.assertEqual(journal.prune(), 2)
+        self.assertEqual([e.path for e in journal.tail("history")], ["fred1", "jim1", "fred2", "jim2"])
+        self.assertEqual([e.path for e in journal.tail("notify")], ["fred2", "jim2"])
+
+    def test_prune_without_consumers(self):
+        scan_journal = journal.ScanJournal(self.user)
+        scan_journal.add("a", 1)
+        scan_journal.flush()
+        self.assertEqual(journal.prune(), 0)
+        self.assertEqual(ScanJournalEntry.objects.count(), 1)
+
+
+class NotificationTest(CacheAreaTestCase):
+
+    def test_deliver(self):
+        for i in range(3):
+            queue_notification(self.user, "[XFC] - Test %d" % i, "body %d" % i)
+        self.assertEqual(len(mail.outbox), 0)
+        self.assertEqual(deliver(batch_size=2), (3, 0))
+        self.assertEqual([m.subject for m in mail.outbox], ["[XFC] - Test %d" % i for i in range(3)])
+        self.assertEqual(mail.outbox[0].to, ["fred@example.com"])
+        self.assertEqual(Notification.objects.filter(state=Notification.SENT).count(), 3)
+        # the sent emails are not sent again
+        self.assertEqual(deliver(), (0, 0))
+        self.assertEqual(len(mail.outbox), 3)
+
+    def test_rolled_back(self):
+        # the email is only sent if the change it describes is committed
+        with self.assertRaises(ValueError):
+            with transaction.atomic():
+                queue_notification(self.user, "[XFC] - Test", "body")
+                raise ValueError("change failed")
+        self.assertEqual(deliver(), (0, 0))
+        self.assertEqual(len(mail.outbox), 0)
+
+    def test_retry(self):
+        notification = queue_notification(self.user, "[XFC] - Test", "body")
+
+        class FailingConnection(object):
+            def open(self):
+                raise IOError("mail server unavailable")
+
+            def close(self):
+                pass
+
+        self.assertEqual(deliver(connection=FailingConnection()), (0, 1))
+        notification.refresh_from_db()
+        self.assertEqual(notification.state, Notification.PENDING)
+        self.assertEqual(notification.attempts, 1)
+        self.assertEqual(notification.error, "mail server unavailable")
+        self.assertGreater(notification.next_attempt, datetime.datetime.utcnow())
+        # not due again yet
+        self.assertEqual(deliver(), (0, 0))
+        Notification.objects.update(next_attempt=datetime.datetime.utcnow())
+        self.assertEqual(deliver(), (1, 0))
+        self.assertEqual(len(mail.outbox), 1)
+
+        # the sent emails are purged after the given number of days
+        self.assertEqual(purge(1), 0)
+        Notification.objects.update(sent=datetime.datetime.utcnow() - datetime.timedelta(days=2))
+        self.assertEqual(purge(1), 1)
+
+    def test_failed(self):
+        notification = queue_notification(self.user, "[XFC] - Test", "body")
+        with mock.patch.object(mail.get_connection().__class__, "send_messages", side_effect=IOError("refused")):
+            for i in range(2):
+                Notification.objects.update(next_attempt=datetime.datetime.utcnow())
+                self.assertEqual(deliver(max_attempts=2), (0, 1))
+        notification.refresh_from_db()
+        self.assertEqual((notification.state, notification.attempts), (Notification.FAILED, 2))
+        # a failed email is not retried
+        self.assertEqual(deliver(), (0, 0))
+
+
+class MetricsTest(CacheAreaTestCase):
+
+    def setUp(self):
+        super(MetricsTest, self).setUp()
+        self.registry = metrics.Registry()
+
+    def test_render(self):
+        counter = metrics.Counter("test_total", "Test counter", ["process"], registry=self.registry)
+        gauge = metrics.Gauge("test_gauge", "Test gauge", registry=self.registry)
+        histogram = metrics.Histogram("test_seconds", "Test histogram", ["phase"], buckets=(1, 5),
+                                      registry=self.registry)
+        counter.inc(2, process='a"b')
+        counter.inc(process='a"b')
+        gauge.set(0.5)
+        for value in (0.5, 2, 10):
+            histogram.observe(value, phase="walk")
+        self.assertEqual(self.registry.render(), "\n".join([
+            '# HELP test_gauge Test gauge',
+            '# TYPE test_gauge gauge',
+            'test_gauge 0.5',
+            '# HELP test_seconds Test histogram',
+            '# TYPE test_seconds histogram',
+            'test_seconds_bucket{phase="walk",le="1"} 1',
+            'test_seconds_bucket{phase="walk",le="5"} 2',
+            'test_seconds_bucket{phase="walk",le="+Inf"} 3',
+            'test_seconds_sum{phase="walk"} 12.5',
+            'test_seconds_count{phase="walk"} 3',
+            '# HELP test_total Test counter',
+            '# TYPE test_total counter',
+            'test_total{process="a\\"b"} 3',
+        ]) + "\n")
+        self.assertEqual(histogram.get(phase="walk"), (12.5, 3))
+
+    def test_invalid(self):
+        counter = metrics.Counter("test_total", "Test counter", ["process"], registry=self.registry)
+        with self.assertRaises(ValueError):
+            counter.inc(-1, process="a")
+        with self.assertRaises(ValueError):
+            counter.inc(user="fred")
+        with self.assertRaises(ValueError):
+            metrics.Counter("test_total", "Test counter", registry=self.registry)
+
+    def test_write_process_metrics(self):
+        metrics_dir = tempfile.mkdtemp(prefix="xfc_test_")
+        self.addCleanup(shutil.rmtree, metrics_dir, ignore_errors=True)
+        with mock.patch.object(metrics.settings, "XFC_METRICS_DIR", metrics_dir, create=True):
+            metrics.write_process_metrics("xfc_test")
+        with open(os.path.join(metrics_dir, "xfc_test.prom")) as fh:
+            self.assertIn('xfc_last_run_timestamp_seconds{process="xfc_test"}', fh.read())
+        self.assertEqual(os.listdir(metrics_dir), ["xfc_test.prom"])
+
+    def test_instrument_view(self):
+        requests = metrics.REQUESTS.get(view="user", method="GET", status=200)
+        count = metrics.REQUEST_LATENCY.get(view="user", method="GET")[1]
+        response = self.client.get("/xfc_control/api/v1/user", {"name": "fred"})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(metrics.REQUESTS.get(view="user", method="GET", status=200), requests + 1)
+        self.assertEqual(metrics.REQUEST_LATENCY.get(view="user", method="GET")[1], count + 1)
+        self.assertGreater(metrics.REQUEST_QUERIES.get(view="user", method="GET")[0], 0)
+
+        response = self.client.get("/xfc_control/metrics")
+        self.assertEqual(response["Content-Type"], metrics.CONTENT_TYPE)
+        self.assertIn('xfc_http_requests_total{view="user",method="GET",status="200"}',
+                      response.content.decode())
+
+
+class ProfilingTest(CacheAreaTestCase):
+
+    def setUp(self):
+        super(ProfilingTest, self).setUp()
+        self.profile_dir = tempfile.mkdtemp(prefix="xfc_test_")
+        self.addCleanup(shutil.rmtree, self.profile_dir, ignore_errors=True)
+
+    def test_disabled(self):
+        count = metrics.PHASE_DURATION.get(process="xfc_test", phase="walk")[1]
+        profiler = Profiler("xfc_test", profile_dir=self.profile_dir)
+        with profiler.user("fred"):
+            with profiler.phase("walk"):
+                pass
+        self.assertIsNone(profiler.finish())
+        # only the metrics are recorded
+        self.assertEqual(metrics.PHASE_DURATION.get(process="xfc_test", phase="walk")[1], count + 1)
+        self.assertEqual(os.listdir(self.profile_dir), [])
+
+    def test_scan_user(self):
+        self.make_file(self.user, "a/f1", 100)
+        profiler = Profiler("xfc_scan", enabled=True, profile_dir=self.profile_dir)
+        xfc_scan.scan_user(self.user, profiler=profiler)
+        path = profiler.finish()
+        with open(path) as fh:
+            summary = json.load(fh)
+        self.assertEqual((summary["process"], summary["profiled"]), ("xfc_scan", ["fred"]))
+        user_summary = summary["users"][0]
+        self.assertEqual(user_summary["user"], "fred")
+        self.assertIn("walk", user_summary["phases"])
+        self.assertGreater(user_summary["queries"], 0)
+        self.assertLessEqual(sum(p["queries"] for p in user_summary["phases"].values()), user_summary["queries"])
+        stats = pstats.Stats(os.path.join(profiler.run_dir, "fred.prof"))
+        self.assertTrue(any(func[2] == "scan_for_added_files" for func in stats.stats))
+
+    def test_top_n(self):
+        profiler = Profiler("xfc_test", enabled=True, profile_dir=self.profile_dir, top_n=1)
+        for name, delay in (("fred", 0), ("jim", 0.05), ("bob", 0)):
+            with profiler.user(name):
+                with profiler.phase("sleep"):
+                    time.sleep(delay)
+        path = profiler.finish()
+        with open(path) as fh:
+            summary = json.load(fh)
+        # the slowest user is first, and only its stats are written
+        self.assertEqual(summary["users"][0]["user"], "jim")
+        self.assertEqual(summary["profiled"], ["jim"])
+        self.assertEqual(sorted(os.listdir(profiler.run_dir)), ["jim.prof", "summary.json"])
+
+    def test_profiler_from_args(self):
+        profiler = profiler_from_args("xfc_test", {"profile": "True", "profile_dir": self.profile_dir,
+                                                   "profile_top": "3"})
+        self.assertEqual((profiler.enabled, profiler.top_n), (True, 3))
+        self.assertTrue(profiler.run_dir.startswith(os.path.join(self.profile_dir, "xfc_test")))
+        self.assertFalse(profiler_from_args("xfc_test", {}).enabled)
+
+
+class LoggingTest(CacheAreaTestCase):
+
+    def setUp(self):
+        super(LoggingTest, self).setUp()
+        root = logging.getLogger()
+        self.addCleanup(setattr, root, "handlers", list(root.handlers))
+        self.addCleanup(root.setLevel, root.level)
+        log_dir = tempfile.mkdtemp(prefix="xfc_test_")
+        self.addCleanup(shutil.rmtree, log_dir, ignore_errors=True)
+        self.log_file = os.path.join(log_dir, "xfc_test.log")
+
+    def read_log(self):
+        with open(self.log_file) as fh:
+            return fh.read().splitlines()
+
+    def test_json(self):
+        listener = setup_logging("xfc_test", {"LOG_LEVEL": "INFO", "LOG_FORMAT": "json", "LOG_FILE": self.log_file})
+        logging.debug("Not written: %s", "debug")
+        logging.info("Scanned user %s", "fred", extra={"user": "fred", "n_files": 3})
+        try:
+            raise ValueError("bad file")
+        except ValueError:
+            logging.exception("Failed")
+        # the records are written when the listener is stopped
+        listener.stop()
+        entries = [json.loads(line) for line in self.read_log()]
+        self.assertEqual(len(entries), 2)
+        self.assertEqual({k: entries[0][k] for k in ("level", "process", "message", "user", "n_files")},
+                         {"level": "INFO", "process": "xfc_test", "message": "Scanned user fred",
+                          "user": "fred", "n_files": 3})
+        self.assertTrue(entries[0]["time"].endswith("Z"))
+        self.assertIn("ValueError: bad file", entries[1]["exc_info"])
+
+    def test_text(self):
+        listener = setup_logging("xfc_test", {"LOG_LEVEL": "WARNING", "LOG_FILE": self.log_file})
+        logging.info("Not written")
+        logging.warning("Could not find file with path: %s", "/a/b")
+        listener.stop()
+        lines = self.read_log()
+        self.assertEqual(len(lines), 1)
+        self.assertTrue(lines[0].endswith("] WARNING:Could not find file with path: /a/b"))
+
+    def test_lazy_formatting(self):
+        setup_logging("xfc_test", {"LOG_LEVEL": "INFO", "LOG_FILE": self.log_file}).stop()
+        # the arguments of the per-file debug messages are not formatted below DEBUG
+        argument = mock.MagicMock()
+        logging.debug("Adding file: %s", argument)
+        argument.__str__.assert_not_called()
+
+    def test_scan_summary(self):
+        self.make_file(self.user, "f1", 10)
+        self.make_file(self.user, "a/f2", 20)
+        with self.assertLogs(level="DEBUG") as logs:
+            xfc_scan.scan_user(self.user)
+        summaries = [r for r in logs.records if getattr(r, "user", None) == "fred"]
+        self.assertEqual(len(summaries), 1)
+        self.assertEqual(summaries[0].levelno, logging.INFO)
+        self.assertEqual((summaries[0].n_files, summaries[0].total_size, summaries[0].n_added), (2, 30, 2))
+        # the files added are only logged at DEBUG
+        added = [r for r in logs.records if r.msg == "Adding file: %s"]
+        self.assertEqual([r.levelno for r in added], [logging.DEBUG, logging.DEBUG])
+        json.loads(JsonFormatter("xfc_scan").format(summaries[0]))
+
+
+class LargeTableAdminTest(CacheAreaTestCase):
+
+    def setUp(self):
+        super(LargeTableAdminTest, self).setUp()
+        self.client.force_login(AuthUser.objects.create_superuser("admin", "admin@example.com", "password"))
+        self.jim = self.make_user("jim")
+        self.freddie = self.make_user("freddie")
+        for user in (self.user, self.jim):
+            directory = CachedDirectory.objects.create(user=user, path=user.cache_path,
+                                                       path_hash=CachedDirectory.hash_path(user.cache_path))
+            CachedFile.objects.create(user=user, directory=directory, name="f1", size=10,
+                                      first_seen=datetime.datetime.utcnow())
+
+    def change_list(self, model, query):
+        response = self.client.get("/admin/xfc_control/{}/".format(model), {"q": query})
+        self.assertEqual(response.status_code, 200)
+        return sorted(obj.pk for obj in response.context["cl"].result_list)
+
+    def test_search(self):
+        # user names are matched by prefix, and directories by their exact path
+        self.assertEqual(self.change_list("user", "fred"), [self.user.pk, self.freddie.pk])
+        self.assertEqual(self.change_list("user", "red"), [])
+        self.assertEqual(len(self.change_list("cachedfile", "ji")), 1)
+        self.assertEqual(len(self.change_list("cachedfile", "/user_cache/fred/")), 1)
+        self.assertEqual(len(self.change_list("cacheddirectory", "user_cache/jim")), 1)
+        self.assertEqual(len(self.change_list("cacheddirectory", "user_cache")), 0)
+
+    def test_default_search_term_q(self):
+        model_admin = admin.LargeTableAdmin(CachedFile, django_admin.site)
+        queryset, distinct = model_admin.get_search_results(None, CachedFile.objects.all(), "fred")
+        self.assertEqual((list(queryset), distinct), ([], False))
+
+    def test_estimated_count(self):
+        # the planner's estimate is only used on PostgreSQL - otherwise the rows are counted
+        self.assertIsNone(admin.estimate_count(CachedFile.objects.all()))
+        paginator = admin.EstimatedCountPaginator(CachedFile.objects.order_by("pk"), 1)
+        self.assertEqual(paginator.count, 2)
+        with mock.patch.object(admin, "estimate_count", return_value=admin.EXACT_COUNT_LIMIT):
+            paginator = admin.EstimatedCountPaginator(CachedFile.objects.order_by("pk"), 1)
+            self.assertEqual(paginator.count, admin.EXACT_COUNT_LIMIT)
+
+
+class DashboardTest(CacheAreaTestCase):
+
+    def setUp(self):
+        super(DashboardTest, self).setUp()
+        self.now = datetime.datetime.utcnow()
+        self.other_mountpoint = tempfile.mkdtemp(prefix="xfc_test_")
+        self.addCleanup(shutil.rmtree, self.other_mountpoint, ignore_errors=True)
+        self.other_disk = self.make_cache_disk(self.other_mountpoint)
+        self.jim = self.make_user("jim", quota_size=100, hard_limit_size=1000)
+        self.bob = self.make_user("bob", quota_size=100, hard_limit_size=1000, cache_disk=self.other_disk)
+        User.objects.filter(pk=self.user.pk).update(quota_used=50, total_used=500)
+        User.objects.filter(pk=self.jim.pk).update(quota_used=300, total_used=2000)
+        User.objects.filter(pk=self.bob.pk).update(quota_used=150, total_used=10)
+        # fred was scanned recently, jim a long time ago, and bob never
+        ScanPass.objects.create(user=self.user, started=self.now, finished=self.now)
+        ScanPass.objects.create(user=self.jim, started=self.now, finished=self.now - datetime.timedelta(days=3))
+        # a scheduled deletion of a file for fred, and of a directory total for bob
+        directory = CachedDirectory.objects.create(user=self.user, path="user_cache/fred")
+        sd = ScheduledDeletion.objects.create(user=self.user, time_entered=self.now, time_delete=self.now)
+        sd.delete_files.add(CachedFile.objects.create(user=self.user, directory=directory, name="f1", size=40,
+                                                      first_seen=self.now))
+        sd = ScheduledDeletion.objects.create(user=self.bob, time_entered=self.now, time_delete=self.now)
+        sd.delete_directories.add(CachedDirectory.objects.create(
+            user=self.bob, path="user_cache/bob/a", aggregate=True, own_size=7, own_files=3))
+
+    def test_refresh_rollups(self):
+        refresh_rollups(top_n=2, stale_hours=24)
+        rollup = DiskRollup.objects.get(cache_disk=self.cache_disk)
+        self.assertEqual((rollup.n_users, rollup.quota_used, rollup.total_used, rollup.quota_size),
+                         (2, 350, 2500, 10 ** 6 + 100))
+        self.assertEqual((rollup.n_over_quota, rollup.n_over_hard_limit), (1, 1))
+        self.assertEqual((rollup.pending_deletions, rollup.pending_files, rollup.pending_bytes), (1, 1, 40))
+        self.assertEqual((rollup.oldest_scan, rollup.newest_scan, rollup.n_stale),
+                         (self.now - datetime.timedelta(days=3), self.now, 1))
+        rollup = DiskRollup.objects.get(cache_disk=self.other_disk)
+        self.assertEqual((rollup.n_users, rollup.n_over_quota, rollup.n_stale), (1, 1, 1))
+        self.assertEqual((rollup.pending_deletions, rollup.pending_files, rollup.pending_bytes), (1, 3, 7))
+        self.assertIsNone(rollup.newest_scan)
+
+        rankings = {}
+        for ur in UserRollup.objects.all():
+            rankings.setdefault(ur.ranking, []).append((ur.rank, ur.user.name, ur.used, ur.limit))
+        self.assertEqual(rankings, {
+            UserRollup.TEMPORAL: [(1, "jim", 300, 100), (2, "bob", 150, 100)],
+            UserRollup.HARD: [(1, "jim", 2000, 1000), (2, "fred", 500, 10 ** 6)],
+            UserRollup.OVER_QUOTA: [(1, "jim", 300, 100), (2, "bob", 150, 100)],
+        })
+        self.assertEqual(UserRollup.objects.get(ranking=UserRollup.HARD, rank=2).last_scan, self.now)
+
+        # the rollups are replaced, not added to
+        User.objects.filter(pk=self.jim.pk).update(quota_used=0)
+        refresh_rollups(top_n=2, stale_hours=24)
+        self.assertEqual(DiskRollup.objects.count(), 2)
+        self.assertEqual(list(UserRollup.objects.filter(ranking=UserRollup.OVER_QUOTA).values_list("user__name")),
+                         [("bob",)])
+
+    def test_daemon_refreshes_rollups(self):
+        with mock.patch("xfc_control.scripts.xfc_delete.refresh_rollups") as refresh:
+            xfc_delete.run_loop({})
+        refresh.assert_called_once_with()
+
+    def test_dashboard(self):
+        refresh_rollups()
+        self.client.force_login(AuthUser.objects.create_superuser("admin", "admin@example.com", "password"))
+        with self.assertNumQueries(4):
+            response = self.client.get("/admin/xfc_control/diskrollup/")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context["totals"]["n_users"], 3)
+        self.assertEqual(response.context["totals"]["pending_files"], 4)
+        self.assertContains(response, "jim")
+
+
+class BrokerRoundTripTest(CacheAreaTestCase):
+
+    def setUp(self):
+        super(BrokerRoundTripTest, self).setUp()
+        self.broker = MemoryBroker()
+        self.jim = self.make_user("jim")
+        self.make_file(self.user, "a/f1", 100)
+        self.make_file(self.user, "f2", 50)
+        self.make_file(self.jim, "g", 20)
+        self.redispatch = datetime.timedelta(hours=24)
+
+    def test_dispatch_scan_complete(self):
+        self.assertEqual(xfc_dispatch.dispatch_scans(self.broker, 10, self.redispatch), 2)
+        self.assertEqual(self.broker.queue_depth(scan_queue()), 2)
+        # the dispatched users are not put on the queue again
+        self.assertEqual(xfc_dispatch.dispatch_scans(self.broker, 10, self.redispatch), 0)
+
+        xfc_scan.consume_loop({}, self.broker, prefetch=2, stop_when_idle=True)
+        self.assertEqual(self.broker.queue_depth(scan_queue()), 0)
+        self.assertEqual(self.broker.queue_depth(complete_queue()), 2)
+        # the scanners do not save the quotas, the completion consumer does
+        self.assertEqual(User.objects.get(name="fred").total_used, 0)
+
+        xfc_complete.consume_loop({}, self.broker)
+        self.assertEqual(self.broker.queue_depth(complete_queue()), 0)
+        self.assertEqual(self.broker.unacked, {})
+        fred = User.objects.get(name="fred")
+        self.assertEqual((fred.total_used, fred.quota_used), (150, 150))
+        self.assertIsNotNone(fred.last_scanned)
+        self.assertIsNone(fred.scan_dispatched)
+        self.assertEqual(User.objects.get(name="jim").total_used, 20)
+        self.cache_disk.refresh_from_db()
+        self.assertEqual(self.cache_disk.used_bytes, 170)
+
+    def test_target_depth(self):
+        self.assertEqual(xfc_dispatch.dispatch_scans(self.broker, 1, self.redispatch), 1)
+        self.assertEqual(xfc_dispatch.dispatch_scans(self.broker, 1, self.redispatch), 0)
+        # a user whose scan request was lost is put on the queue again after redispatch_after
+        self.broker.queues[scan_queue()].clear()
+        self.assertEqual(xfc_dispatch.dispatch_scans(self.broker, 10, self.redispatch), 1)
+        User.objects.update(scan_dispatched=datetime.datetime.utcnow() - self.redispatch * 2)
+        self.broker.queues[scan_queue()].clear()
+        self.assertEqual(xfc_dispatch.dispatch_scans(self.broker, 10, self.redispatch), 2)
+
+    def test_locked_and_failed_requests(self):
+        xfc_dispatch.dispatch_scans(self.broker, 10, self.redispatch)
+        lock_user(self.jim)
+        with mock.patch.object(xfc_scan, "scan_user", side_effect=OSError("disk gone")):
+            with self.assertLogs(level="ERROR"):
+                xfc_scan.consume_loop({}, self.broker, stop_when_idle=True)
+        # both requests are removed from the queue, without a completion - the users are dispatched again later
+        self.assertEqual(self.broker.queue_depth(scan_queue()), 0)
+        self.assertEqual(self.broker.queue_depth(complete_queue()), 0)
+        self.assertEqual(self.broker.unacked, {})
+        self.assertTrue(user_locked(self.jim))
+        self.assertFalse(user_locked(self.user))
+
+
+class CompletionTest(CacheAreaTestCase):
+
+    def setUp(self):
+        super(CompletionTest, self).setUp()
+        self.broker = MemoryBroker()
+        self.now = datetime.datetime(2024, 6, 15, 12, 0)
+
+    def completion(self, user, finished, quota_used, total_used):
+        return {"user_id": user.pk, "user": user.name, "finished": finished.isoformat(),
+                "quota_used": quota_used, "total_used": total_used}
+
+    def test_out_of_date_completion(self):
+        User.objects.filter(pk=self.user.pk).update(last_scanned=self.now, total_used=150)
+        self.broker.publish(complete_queue(), self.completion(self.user, self.now, 1, 1))
+        self.broker.publish(complete_queue(), self.completion(self.user, self.now - datetime.timedelta(hours=1), 1, 1))
+        xfc_complete.consume_loop({}, self.broker)
+        # a completion from before (or at) the last scan is ignored
+        self.assertEqual(User.objects.get(pk=self.user.pk).total_used, 150)
+        self.assertEqual(self.broker.unacked, {})
+
+    def test_batches(self):
+        jim = self.make_user("jim")
+        # a batch can hold more than one scan of a user - the latest is applied
+        for hours, total_used in ((2, 20), (3, 30), (1, 10)):
+            self.broker.publish(complete_queue(), self.completion(
+                self.user, self.now + datetime.timedelta(hours=hours), total_used, total_used))
+        self.broker.publish(complete_queue(), self.completion(jim, self.now, 5, 5))
+        with mock.patch.object(xfc_complete, "refresh_rollups") as refresh:
+            xfc_complete.consume_loop({}, self.broker, batch_size=2)
+        # the dashboard is refreshed after each batch
+        self.assertEqual(refresh.call_count, 2)
+        self.assertEqual(User.objects.get(pk=self.user.pk).total_used, 30)
+        self.assertEqual(User.objects.get(pk=jim.pk).total_used, 5)
+        self.cache_disk.refresh_from_db()
+        self.assertEqual(self.cache_disk.used_bytes, 35)
+
+    def test_over_quota_notification(self):
+        User.objects.filter(pk=self.user.pk).update(notify=True)
+        self.assertEqual(xfc_complete.apply_completions([self.completion(self.user, self.now, 2 * 10 ** 6, 10)]),
+                         (1, 1))
+        notification = Notification.objects.get()
+        self.assertEqual((notification.to_address, notification.subject), ("fred@example.com", "[XFC] - Over quota"))
+        # the user is only notified when they go over their quota
+        xfc_complete.apply_completions([self.completion(self.user, self.now + datetime.timedelta(hours=1),
+                                                        3 * 10 ** 6, 10)])
+        self.assertEqual(Notification.objects.count(), 1)
+
+    def test_failed_batch(self):
+        self.broker.publish(complete_queue(), self.completion(self.user, self.now, 1, 1))
+        with mock.patch.object(xfc_complete, "apply_completions", side_effect=Exception("database gone")):
+            with self.assertLogs(level="ERROR"):
+                xfc_complete.consume_loop({}, self.broker)
+        # the batch is tried once more, then dropped
+        self.assertEqual(self.broker.queue_depth(complete_queue()), 0)
+        self.assertEqual(self.broker.unacked, {})
+        self.assertEqual(User.objects.get(pk=self.user.pk).total_used, 0)
+
+
+class ShardingTest(CacheAreaTestCase):
+
+    def setUp(self):
+        super(ShardingTest, self).setUp()
+        self.other_mountpoint = tempfile.mkdtemp(prefix="xfc_test_")
+        self.addCleanup(shutil.rmtree, self.other_mountpoint, ignore_errors=True)
+        self.other_disk = self.make_cache_disk(self.other_mountpoint)
+        self.jim = self.make_user("jim")
+        self.bob = self.make_user("bob", cache_disk=self.other_disk)
+        self.make_file(self.user, "f1", 10)
+        self.make_file(self.jim, "f1", 20)
+        self.make_file(self.bob, "f1", 30)
+
+    def leaser(self, instance, local_mountpoints, grace_seconds=900):
+        leaser = Leaser(instance, local_mountpoints, lease_seconds=300, grace_seconds=grace_seconds)
+        self.addCleanup(leaser.stop_heartbeat)
+        return leaser
+
+    def held(self, leases):
+        return [lease.cache_disk.pk for lease in leases]
+
+    def test_claim_affinity(self):
+        a = self.leaser("a", [self.mountpoint])
+        b = self.leaser("b", [self.other_mountpoint])
+        # each instance takes its local shard, and the other shard is left to its instance during the grace time
+        self.assertEqual(self.held(a.claim()), [self.cache_disk.pk])
+        self.assertEqual(self.held(b.claim()), [self.other_disk.pk])
+        # the shards held are renewed on the next claim, and not taken by the other instance
+        self.assertEqual(self.held(a.claim()), [self.cache_disk.pk])
+        self.assertEqual(ScanLease.objects.get(cache_disk=self.other_disk).holder, "b")
+
+    def test_claim_after_grace(self):
+        a = self.leaser("a", [self.mountpoint], grace_seconds=0)
+        ScanLease.objects.all().delete()
+        a.ensure_leases()
+        ScanLease.objects.update(expires=datetime.datetime.utcnow() - datetime.timedelta(seconds=1))
+        # a shard without an instance with affinity is taken once the grace time has passed, local shards first
+        self.assertEqual(self.held(a.claim()), [self.cache_disk.pk, self.other_disk.pk])
+
+    def test_expiry(self):
+        a = self.leaser("a", [self.mountpoint])
+        b = self.leaser("b", [self.mountpoint])
+        lease = a.claim()[0]
+        self.assertEqual(b.claim(), [])
+        # a lease that has not been renewed is taken over, and the old holder finds out when it renews
+        ScanLease.objects.update(expires=datetime.datetime.utcnow() - datetime.timedelta(seconds=1))
+        self.assertEqual(self.held(b.claim()), [self.cache_disk.pk])
+        self.assertFalse(a.renew(lease, users_done=1))
+        self.assertEqual(ScanLease.objects.get(cache_disk=self.cache_disk).users_done, 0)
+        # a released lease is free to claim straight away
+        b.release_all()
+        self.assertEqual(self.held(a.claim()), [self.cache_disk.pk])
+
+    def test_scan_shard(self):
+        a = self.leaser("a", [self.mountpoint])
+        lease = a.claim()[0]
+        self.assertTrue(xfc_scan.scan_shard(lease, a))
+        lease.refresh_from_db()
+        self.assertEqual((lease.users_total, lease.users_done, lease.current_user), (2, 2, ""))
+        self.assertFalse(lease.in_pass())
+        self.assertEqual(User.objects.get(pk=self.jim.pk).total_used, 20)
+        # the users on the other shard are not scanned
+        self.assertIsNone(User.objects.get(pk=self.bob.pk).last_scanned)
+
+    def test_carry_on_pass(self):
+        a = self.leaser("a", [self.mountpoint])
+        lease = a.claim()[0]
+        started = datetime.datetime.utcnow() - datetime.timedelta(minutes=5)
+        # another instance started the pass, and scanned fred before it died
+        ScanLease.objects.filter(pk=lease.pk).update(pass_started=started, users_total=2, users_done=1)
+        User.objects.filter(pk=self.user.pk).update(last_scanned=started + datetime.timedelta(minutes=1))
+        lease.refresh_from_db()
+        with mock.patch.object(xfc_scan, "scan_user", wraps=xfc_scan.scan_user) as scan_user:
+            self.assertTrue(xfc_scan.scan_shard(lease, a))
+        self.assertEqual([c.args[0].name for c in scan_user.call_args_list], ["jim"])
+        lease.refresh_from_db()
+        self.assertEqual((lease.users_total, lease.users_done), (2, 2))
+
+    def test_shard_loop(self):
+        a = self.leaser("a", [self.mountpoint], grace_seconds=0)
+        ScanLease.objects.all().delete()
+        a.ensure_leases()
+        ScanLease.objects.update(expires=datetime.datetime.utcnow() - datetime.timedelta(seconds=1))
+        with mock.patch.object(xfc_scan, "refresh_rollups") as refresh:
+            xfc_scan.shard_loop({}, a, once=True)
+        # the rollups are refreshed after each pass, and the shard without affinity is handed back
+        self.assertEqual(refresh.call_count, 2)
+        self.assertEqual(User.objects.get(pk=self.bob.pk).total_used, 30)
+        self.assertEqual(ScanLease.objects.get(cache_disk=self.cache_disk).holder, "a")
+        self.assertEqual(ScanLease.objects.get(cache_disk=self.other_disk).holder, "")
+
+
+class ScanFrequencyTest(CacheAreaTestCase):
+
+    def interval_hours(self, churn=0.0, scan_seconds=0.0, quota_size=10 ** 9, quota_used=0,
+                       hard_limit_size=10 ** 9, total_used=0):
+        user = User(churn=churn, scan_seconds=scan_seconds, quota_size=quota_size, quota_used=quota_used,
+                    hard_limit_size=hard_limit_size, total_used=total_used)
+        return scan_frequency.scan_interval(user).total_seconds() / 3600
+
+    def test_scan_interval(self):
+        # an idle user is scanned every MAX_HOURS, and a busy user when TARGET_CHANGES files have changed
+        self.assertEqual(self.interval_hours(), scan_frequency.MAX_HOURS)
+        self.assertEqual(self.interval_hours(churn=10), 10)
+        self.assertEqual(self.interval_hours(churn=10 ** 6), scan_frequency.MIN_HOURS)
+        # a user whose scan takes a long time is not scanned almost continuously
+        self.assertEqual(self.interval_hours(churn=10, scan_seconds=7200), 20)
+        # a user near their quota or hard limit is scanned every MIN_HOURS
+        self.assertEqual(self.interval_hours(quota_size=100, quota_used=95), scan_frequency.MIN_HOURS)
+        self.assertEqual(self.interval_hours(hard_limit_size=100, total_used=90, quota_size=0),
+                         scan_frequency.MIN_HOURS)
+        # a user is scanned at least twice before they would reach their quota with no changes
+        self.assertEqual(self.interval_hours(quota_size=1000, quota_used=400, total_used=300), 48 / 2)
+        self.assertEqual(self.interval_hours(quota_size=1000, quota_used=400, total_used=300, churn=1), 48 / 2)
+        self.assertEqual(self.interval_hours(quota_size=1000, quota_used=400, total_used=50), scan_frequency.MAX_HOURS)
+
+    def test_settings(self):
+        with mock.patch.object(scan_frequency.settings, "XFC_SCAN_MAX_HOURS", 24, create=True), \
+                mock.patch.object(scan_frequency.settings, "XFC_SCAN_TARGET_CHANGES", 10, create=True):
+            self.assertEqual(self.interval_hours(), 24)
+            self.assertEqual(self.interval_hours(churn=5), 2)
+
+    def test_schedule_next_scan(self):
+        finished = datetime.datetime(2024, 6, 15, 12, 0)
+        scan_pass = ScanPass(user=self.user, started=finished - datetime.timedelta(seconds=30), finished=finished,
+                             n_added=10, n_resized=5, n_removed=5)
+        # the first scan adds all the files, which does not count as churn
+        self.user.last_scanned = None
+        scan_frequency.schedule_next_scan(self.user, scan_pass)
+        self.assertEqual((self.user.churn, self.user.scan_seconds), (0, 30))
+        self.assertEqual(self.user.next_scan, finished + datetime.timedelta(hours=scan_frequency.MAX_HOURS))
+        # 20 changes in 2 hours, averaged with the previous churn
+        self.user.churn = 4.0
+        self.user.last_scanned = finished - datetime.timedelta(hours=2)
+        scan_frequency.schedule_next_scan(self.user, scan_pass)
+        self.assertEqual(self.user.churn, 7.0)
+        self.assertEqual(self.user.next_scan, finished + datetime.timedelta(hours=100 / 7.0))
+
+    def test_due_users(self):
+        self.make_file(self.user, "f1", 10)
+        xfc_scan.scan_user(self.user)
+        user = User.objects.get(pk=self.user.pk)
+        self.assertGreater(user.next_scan, user.last_scanned)
+        self.assertEqual(list(xfc_scan.due_users(User.objects.all())), [])
+        User.objects.update(next_scan=datetime.datetime.utcnow() - datetime.timedelta(minutes=1))
+        self.assertEqual(list(xfc_scan.due_users(User.objects.all())), [self.user])
+
+    def test_run_loop(self):
+        jim = self.make_user("jim")
+        User.objects.filter(pk=self.user.pk).update(next_scan=datetime.datetime.utcnow() + datetime.timedelta(hours=1))
+        with mock.patch.object(xfc_scan, "scan_user") as scan_user:
+            xfc_scan.run_loop({})
+        # only the users that are due are scanned, unless adaptive scheduling is turned off
+        self.assertEqual([c.args[0].pk for c in scan_user.call_args_list], [jim.pk])
+        with mock.patch.object(xfc_scan, "scan_user") as scan_user:
+            xfc_scan.run_loop({}, adaptive=False)
+        self.assertEqual(sorted(c.args[0].pk for c in scan_user.call_args_list), [self.user.pk, jim.pk])
+
+
+class FileModeScanTest(CacheAreaTestCase):
+
+    def test_scan(self):
+        self.make_file(self.user, "a/f1", 100)
+        self.make_file(self.user, "a/b/f2", 50)
+        scan_pass = xfc_scan.scan_user(self.user)
+        self.assertEqual(scan_pass.n_added, 2)
+        paths = sorted(cf.path for cf in CachedFile.objects.select_related("directory"))
+        self.assertEqual(paths, ["user_cache/fred/a/b/f2", "user_cache/fred/a/f1"])
+        cf = CachedFile.objects.get(name="f1")
+        st = os.stat(os.path.join(self.mountpoint, "user_cache/fred/a/f1"))
+        self.assertEqual(cf.inode, st.st_ino)
+        self.assertEqual(cf.mtime, datetime.datetime.utcfromtimestamp(st.st_mtime))
+        self.assertEqual(self.user.total_used, 150)
+
+        # a rescan with no changes does not change anything
+        scan_pass = xfc_scan.scan_user(self.user)
+        self.assertEqual((scan_pass.n_added, scan_pass.n_resized, scan_pass.n_removed), (0, 0, 0))
+
+    def test_rename(self):
+        self.make_file(self.user, "a/f1", 100)
+        self.make_file(self.user, "a/f2", 10)
+        xfc_scan.scan_user(self.user)
+        first_seen = datetime.datetime(2020, 1, 1)
+        f1 = CachedFile.objects.get(name="f1")
+        CachedFile.objects.filter(pk=f1.pk).update(first_seen=first_seen)
+
+        user_dir = os.path.join(self.mountpoint, self.user.cache_path)
+        os.makedirs(os.path.join(user_dir, "c"))
+        os.rename(os.path.join(user_dir, "a/f1"), os.path.join(user_dir, "c/moved"))
+        os.rename(os.path.join(user_dir, "a/f2"), os.path.join(user_dir, "a/f2b"))
+        scan_pass = xfc_scan.scan_user(self.user)
+
+        # the CachedFiles are moved, and keep their first_seen
+        moved = CachedFile.objects.select_related("directory").get(pk=f1.pk)
+        self.assertEqual(moved.path, "user_cache/fred/c/moved")
+        self.assertEqual(moved.first_seen, first_seen)
+        self.assertEqual(sorted(CachedFile.objects.values_list("name", flat=True)), ["f2b", "moved"])
+        # a rename is a remove and an add in the journal
+        self.assertEqual((scan_pass.n_added, scan_pass.n_removed), (2, 2))
+
+    def test_hard_link_is_not_a_rename(self):
+        self.make_file(self.user, "a/f1", 100)
+        xfc_scan.scan_user(self.user)
+        user_dir = os.path.join(self.mountpoint, self.user.cache_path)
+        os.link(os.path.join(user_dir, "a/f1"), os.path.join(user_dir, "link"))
+        xfc_scan.scan_user(self.user)
+        paths = sorted(cf.path for cf in CachedFile.objects.select_related("directory"))
+        self.assertEqual(paths, ["user_cache/fred/a/f1", "user_cache/fred/link"])
+
+    def test_delete_uses_stored_mtime(self):
+        for name in ("old", "touched", "scanned_after"):
+            path = self.make_file(self.user, name, 10)
+            os.utime(path, (0, 0))
+        xfc_scan.scan_user(self.user)
+        time_entered = datetime.datetime.utcnow() - datetime.timedelta(hours=1)
+        sd = ScheduledDeletion.objects.create(user=self.user, time_entered=time_entered, time_delete=time_entered)
+        sd.delete_files.add(*CachedFile.objects.all())
+        # touched on disk since the last scan, and touched before the last scan
+        os.utime(os.path.join(self.mountpoint, "user_cache/fred/touched"))
+        CachedFile.objects.filter(name="scanned_after").update(mtime=datetime.datetime.utcnow())
+
+        with mock.patch("xfc_control.scripts.xfc_delete.os.stat", wraps=os.stat) as stat:
+            xfc_delete.do_deletions(self.user)
+        # the file whose stored mtime is after the deletion was scheduled is not read from the disk
+        self.assertEqual(sorted(os.path.basename(c.args[0]) for c in stat.call_args_list), ["old", "touched"])
+        self.assertEqual(sorted(CachedFile.objects.values_list("name", flat=True)), ["scanned_after", "touched"])
+        self.assertEqual(sorted(os.listdir(os.path.join(self.mountpoint, "user_cache/fred"))),
+                         ["scanned_after", "touched"])
+        self.assertFalse(ScheduledDeletion.objects.exists())
@@ -1,11 +1,13 @@
-
 from django.urls import re_path
 from xfc_control.views import *
+from xfc_control.metrics import instrument_view
 
 urlpatterns = (
-    re_path(r'^api/v1/disk$', CacheDiskView.as_view()),
-    re_path(r'^api/v1/user$', UserView.as_view()),
-    re_path(r'^api/v1/file$', CachedFileView.as_view()),
-    re_path(r'^api/v1/scheduled_deletions$', ScheduledDeletionView.as_view()),
-    re_path(r'^api/v1/predict_deletions$', predict, name='predict')
+    re_path(r'^api/v1/disk$', instrument_view("disk")(CacheDiskView.as_view())),
+    re_path(r'^api/v1/user$', instrument_view("user")(UserView.as_view())),
+    re_path(r'^api/v1/file$', instrument_view("file")(CachedFileView.as_view())),
+    re_path(r'^api/v1/directory$', instrument_view("directory")(CachedDirectoryView.as_view())),
+    re_path(r'^api/v1/scheduled_deletions$', instrument_view("scheduled_deletions")(ScheduledDeletionView.as_view())),
+    re_path(r'^api/v1/predict_deletions$', instrument_view("predict_deletions")(predict), name='predict'),
+    re_path(r'^metrics$', metrics, name='metrics')
 )
@@ -5,7 +5,12 @@ from xfc_control.models import *
 from django.shortcuts import get_object_or_404
 from django.http import HttpResponse, Http404
 from django.views.generic import View
-from django.core.mail import send_mail
+from django.db.models import CharField, Value
+from django.db.models.functions import Concat
+from django.db import transaction
+
+from xfc_control.notifications import queue_notification
+from xfc_control.metrics import REGISTRY, CONTENT_TYPE
 
 import json
 import os
@@ -19,14 +24,10 @@ def HttpError(error_data, status=404):
 
 
 def send_notification_email(user, notify):
-    """Send an email to the user to confirm that notifications have been switched on
+    """Queue an email to the user to confirm that notifications have been switched on.  The email
+    is sent by xfc_notify.
     :var xfc_control.models.User user: user to send notification email to
     """
-    # to address is user.email
-    toaddrs = [user.email]
-    # from address is just a dummy address
-    fromaddr = "support@ceda.ac.uk"
-
     # subject
     subject = "[XFC] - Notifications"
     if notify:
@@ -40,7 +41,7 @@ def send_notification_email(user, notify):
     msg += "be notified when "+\
            "files are scheduled for deletion from the JASMIN transfer cache (XFC)."
 
-    send_mail(subject, msg, fromaddr, toaddrs, fail_silently=False)
+    queue_notification(user, subject, msg)
 
 
 class UserView(View):
@@ -241,8 +242,13 @@ class UserView(View):
         # get the hard limit size
         hl = User.get_hard_limit_size()
 
-        # find a CacheDisk with enough free space (unallocated space)
-        cache_disk = CacheDisk.find_free_cache_disk(hl)
+        # find a CacheDisk with enough free space (unallocated space) and reserve the user's quota on it
+        try:
+            cache_disk = CacheDisk.reserve_cache_disk(hl)
+        except Exception as e:
+            # the reservation has been released by reserve_cache_disk
+            error_data["error"] = str(e)
+            return HttpError(error_data, status=500)
         # check that a CacheDisk was found, if not return an error
         if not cache_disk:
             error_data["error"] = "No CacheDisk found with enough free space for user's quota."
@@ -256,11 +262,10 @@ class UserView(View):
                         cache_path=user_path, cache_disk=cache_disk)
             user.save()
         except Exception as e:
+            # give the reserved quota back to the cache_disk
+            cache_disk.release(hl)
             error_data["error"] = str(e)
             return HttpError(error_data, status=500)
-        # update the cache_disk allocated quotas
-        cache_disk.allocated_bytes += hl
-        cache_disk.save()
 
         # return the details
         data_out = {"name" : username, "email" : email,
@@ -365,13 +370,15 @@ class UserView(View):
             else:
                 data["email"] = user.email
 
-            if "notify" in data:
-                user.notify = data["notify"]
-                # create and send a confirmation email to the user
-                send_notification_email(user, user.notify)
-            else:
-                data["notify"] = user.notify
-            user.save()
+            # save the user and queue the confirmation email in the same transaction
+            with transaction.atomic():
+                if "notify" in data:
+                    user.notify = data["notify"]
+                    # create and send a confirmation email to the user
+                    send_notification_email(user, user.notify)
+                else:
+                    data["notify"] = user.notify
+                user.save()
             # return something meaningful
             data_out = {"name": username, "email": data["email"], "notify": data["notify"]}
             return HttpResponse(json.dumps(data_out), content_type="application/json")
@@ -459,7 +466,12 @@ class CachedFileView(View):
             # get whether a full path is required
             full_path = (request.GET.get("full_path", "") == "1")
             # filter the files on user and matching key
-            cfiles = CachedFile.objects.filter(user=user, path__contains=match)
+            cfiles = CachedFile.objects.filter(user=user).select_related("directory")
+            if match:
+                # the path is not stored, so rebuild it in the query to match against
+                cfiles = cfiles.annotate(
+                    match_path=Concat("directory__path", Value("/"), "name", output_field=CharField())
+                ).filter(match_path__contains=match)
             data = []
             # get the current date for calculating quota used
             current_date = datetime.datetime.utcnow()
@@ -480,6 +492,120 @@ class CachedFileView(View):
             return HttpResponse(json.dumps(data), content_type = "application/json")
 
 
+class CachedDirectoryView(View):
+    """:rest-api
+
+    Requests to resources which return the sizes of the directories in a user's area of the Transfer Cache.
+    """
+
+    def get(self, request, *args, **kwargs):
+        """:rest-api
+
+         .. http:get:: /xfc_control/api/v1/directory
+
+             Get the total size of a directory, and of each of its subdirectories, in a user's cache area.
+             Only one level of the directory tree is returned per request.
+
+             :queryparam string name: The username (same as JASMIN username).
+
+             :queryparam string path: (*optional*) Path of the directory, relative to the user's cache area.  Defaults to the user's cache area.
+
+             :queryparam bool full_path: (*optional*) whether to output full paths of the directories or paths relative to the mountpoint of the CacheDisk.
+
+             ..
+
+             :>jsonarr string path: path to the directory
+             :>jsonarr int size: total size of the files in the directory and its subdirectories (in bytes)
+             :>jsonarr int n_files: number of files in the directory and its subdirectories
+             :>jsonarr int quota_used: amount of temporal quota used by the directory and its subdirectories
+             :>jsonarr string first_seen: date the oldest file in the directory was first seen in the system, in isoformat
+             :>jsonarr List[Dictionary] directories: the same details for each subdirectory, largest first
+
+             :statuscode 200: request completed successfully.
+             :statuscode 404: name not found - i.e. user does not exist
+             :statuscode 404: directory not found
+
+             **Example request**
+
+             .. sourcecode:: http
+
+                 GET /xfc_control/api/v1/directory?name=fred&path=cru HTTP/1.1
+                 Host: xfc.ceda.ac.uk
+                 Accept: application/json
+
+             **Example response**
+
+             .. sourcecode:: http
+
+                 HTTP/1.1 200 OK
+                 Vary: Accept
+                 Content-Type: application/json
+
+                 {
+                   "name": "fred",
+                   "cache_disk": "/cache/disk1",
+                   "path": "user_cache/fred/cru",
+                   "size": 5242880,
+                   "n_files": 2,
+                   "quota_used": 15728640,
+                   "first_seen": "2017-05-17T09:55:02.789476",
+                   "directories": [
+                                    {
+                                      "path": "user_cache/fred/cru/data",
+                                      "size": 5242880,
+                                      "n_files": 2,
+                                      "quota_used": 15728640,
+                                      "first_seen": "2017-05-17T09:55:02.789476"
+                                    }
+                                  ]
+                 }
+
+        """
+        error_data = {}
+        if len(request.GET) == 0:
+            return HttpError({"error" : "No name supplied."})
+        else:
+            # get the username
+            username = request.GET.get("name", "")
+            try:
+                if username:
+                    user = User.objects.get(name=username)
+                else:
+                    error_data["error"] = "Error with name parameter."
+                    return HttpError(error_data)
+            except:
+                error_data["error"] = "User not found."
+                return HttpError(error_data)
+            # get the directory path, relative to the user's cache area
+            path = os.path.normpath(os.path.join(user.cache_path, request.GET.get("path", "").strip("/")))
+            # get whether a full path is required
+            full_path = (request.GET.get("full_path", "") == "1")
+            try:
+                directory = CachedDirectory.objects.get(user=user, path_hash=CachedDirectory.hash_path(path))
+            except CachedDirectory.DoesNotExist:
+                error_data["error"] = "Directory not found."
+                return HttpError(error_data)
+
+            def directory_entry(d):
+                entry = {"size": d.size, "n_files": d.n_files, "quota_used": d.quota_used}
+                if d.first_seen:
+                    entry["first_seen"] = d.first_seen.isoformat()
+                else:
+                    entry["first_seen"] = ""
+                # output the full path or not
+                if full_path:
+                    entry["path"] = os.path.join(user.cache_disk.mountpoint, d.path)
+                else:
+                    entry["path"] = d.path
+                return entry
+
+            data = directory_entry(directory)
+            data["name"] = user.name
+            data["cache_disk"] = user.cache_disk.mountpoint
+            data["directories"] = [directory_entry(d) for d in directory.children.order_by("-size")]
+            return HttpResponse(json.dumps(data), content_type = "application/json")
+
+
 class CacheDiskView(View):
     """:rest-api
 
@@ -506,6 +632,7 @@ class CacheDiskView(View):
                    - **mountpoint** (`string`): path of the mountpoint of the disk.
                    - **allocated** (`int`): the amount of space that has been allocated to users via their quotas (in bytes).
                    - **used** (`int`): the amount of space that has been used by the users via their quotas (in bytes).
+                   - **real_used** (`int`): the amount of space used on the volume, as last read from the filesystem (in bytes).
                    - **size** (`int`): the total size of the disk (in bytes).
                    - **id** (`int`): the unique identifier of the disk.
 
@@ -534,6 +661,7 @@ class CacheDiskView(View):
                                           "mountpoint": "/cache/disk1",
                                           "allocated": 0,
                                           "used": 0,
+                                          "real_used": 0,
                                           "id": 1,
                                           "size": 5242880
                                         }
@@ -544,14 +672,15 @@ class CacheDiskView(View):
         """
         # first case - get all disks
         disks = []
-        error_data = data
+        error_data = {}
         if len(request.GET) == 0:
             for disk in CacheDisk.objects.all():
                 disk_data = {"id": disk.pk,
                              "mountpoint": disk.mountpoint,
                              "size": disk.size_bytes,
                              "allocated": disk.allocated_bytes,
-                             "used": disk.used_bytes}
+                             "used": disk.used_bytes,
+                             "real_used": disk.real_used_bytes}
                 disks.append(disk_data)
         else:
             # check if search by mountpoint or id
@@ -577,7 +706,8 @@ class CacheDiskView(View):
                       "mountpoint": disk.mountpoint,
                       "size": disk.size_bytes,
                       "allocated": disk.allocated_bytes,
-                      "used": disk.used_bytes}]
+                      "used": disk.used_bytes,
+                      "real_used": disk.real_used_bytes}]
         data = {"cache_disks": disks}
 
         return HttpResponse(json.dumps(data), content_type="application/json")
@@ -609,6 +739,7 @@ class ScheduledDeletionView(View):
                    - **time_delete** (`string`): the date / time on which the deletion will take place, in isoformat
                    - **cache_disk** (`string`): mountpoint of the cache disk where the files are kept
                    - **files** (`List[string]`): list of files scheduled to be deleted
+                   - **directories** (`List[Dictionary]`): for users scanned in directory mode, list of directories whose files are scheduled to be deleted, with the path, size, n_files, first_seen, quota_used and subtree (whether the files in the subdirectories will be deleted too)
 
                :statuscode 200: request completed successfully
 
@@ -663,7 +794,8 @@ class ScheduledDeletionView(View):
         current_date = datetime.datetime.utcnow()
         if len(scheduled_deletions) == 0:  # no scheduled deletions for this user
             # return JSON with null strings for the times and an empty list for the files
-            data = [{"name": username, "time_entered": "", "time_delete": "", "cache_disk":"", "files": []}]
+            data = [{"name": username, "time_entered": "", "time_delete": "", "cache_disk":"", "files": [],
+                     "directories": []}]
         else:
             data = []
             # there should only be one scheduled deletion, but there may be more in the future
@@ -671,7 +803,7 @@ class ScheduledDeletionView(View):
             for sd in scheduled_deletions:
                 # create the file entries with all the info for the files
                 files = []
-                for f in sd.delete_files.all():
+                for f in sd.delete_files.select_related("directory", "user__cache_disk"):
                     # calculate the quota used
                     quota_used = ((current_date - f.first_seen).days + 1) * f.size
                     c_file = {"cache_disk" : f.user.cache_disk.mountpoint,
@@ -680,12 +812,22 @@ class ScheduledDeletionView(View):
                               "first_seen" : f.first_seen.isoformat(),
                               "quota_used" : quota_used}
                     files.append(c_file)
+                # and the directory totals, for users scanned in directory mode
+                directories = []
+                for cd in sd.delete_directories.all():
+                    directories.append({"path": cd.path,
+                                        "size": cd.own_size,
+                                        "n_files": cd.own_files,
+                                        "first_seen": cd.own_first_seen.isoformat() if cd.own_first_seen else "",
+                                        "quota_used": cd.own_quota_use(current_date),
+                                        "subtree": cd.subtree})
                 # output this scheduled deletion data
                 data.append({"name": sd.user.name,
                              "time_entered": sd.time_entered.isoformat(),
                              "time_delete": sd.time_delete.isoformat(),
                              "cache_disk": sd.user.cache_disk.mountpoint,
-                             "files": files})
+                             "files": files,
+                             "directories": directories})
         return HttpResponse(json.dumps(data), content_type = "application/json")
 
 
@@ -708,7 +850,7 @@ def predict(request):
                 - **time_predict** (`string`): the date when deletions will start, in isoformat
                 - **over_quota** (`int`): the amount that the user will exceed the quota by
                 - **cache_disk** (`string`): mountpoint of the cache disk where the files are kept
-                - **files** (`List[string]`): list of files which will be deleted
+                - **files** (`List[string]`): list of files which will be deleted.  For users scanned in directory mode, these are the directories whose files will be deleted, with a trailing slash and the number of files (n_files)
 
             :statuscode 200: request completed successfully
 
@@ -786,12 +928,30 @@ def predict(request):
 
     # get a list of (predicted) files that will be deleted
     # get a list of user cached files sorted descending
-    cached_files = CachedFile.objects.filter(user=user).order_by('first_seen')
+    cached_files = CachedFile.objects.filter(user=user).select_related("directory", "user__cache_disk").order_by('first_seen')
     # sum of files to delete
     quota_delete = 0
     # list of files to delete
     files_to_delete = []
 
+    if user.get_scan_mode() == CacheDisk.DIRECTORY_MODE:
+        # the directory totals are deleted as a whole, oldest first
+        directories = CachedDirectory.objects.filter(
+            user=user, aggregate=True, own_files__gt=0
+        ).order_by('own_first_seen')
+        for cd in directories:
+            if quota_delete > over_quota:
+                break
+            quota_used = cd.own_quota_use(current_date)
+            quota_delete += quota_used
+            files_to_delete.append({"cache_disk": user.cache_disk.mountpoint,
+                                    "path": os.path.join(cd.path, ""),
+                                    "size": cd.own_size,
+                                    "n_files": cd.own_files,
+                                    "first_seen": cd.own_first_seen.isoformat(),
+                                    "quota_used": quota_used})
+        cached_files = []
+
     # get enough files to bring the quota back to its allocated amount
     for cf in cached_files:
         if quota_delete > over_quota:
@@ -814,3 +974,11 @@ def predict(request):
             "over_quota": over_quota,
             "files": files_to_delete}
     return HttpResponse(json.dumps(data), content_type="application/json")
+
+
+def metrics(request):
+    """Return the metrics of this web server process (see xfc_control.metrics), in the Prometheus text
+    exposition format.  The metrics are held in the memory of the process, so the REST API must be served
+    by a single (multi-threaded) process for them to cover every request.  The metrics of the daemons are
+    written to XFC_METRICS_DIR by each daemon."""
+    return HttpResponse(REGISTRY.render(), content_type=CONTENT_TYPE)